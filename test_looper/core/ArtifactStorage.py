@@ -174,6 +174,10 @@ class ArtifactStorage(object):
         """Download a build in 'key_name' to 'dest'"""
         assert False, "Subclasses implement"
 
+    def open_build(self, testHash, key_name):
+        """A file-like object that reads the build in 'key_name' as it downloads. Callers close it."""
+        assert False, "Subclasses implement"
+
     def clear_build(self, testHash, key_name):
         """Clear a build"""
         assert False, "Subclasses implement"
@@ -283,6 +287,9 @@ class AwsArtifactStorage(ArtifactStorage):
     def download_build(self, testHash, key_name, dest):
         self._bucket.download_file(self.build_artifact_key_prefix + "/" + testHash + "/" + key_name, dest)
 
+    def open_build(self, testHash, key_name):
+        return self._bucket.Object(self.build_artifact_key_prefix + "/" + testHash + "/" + key_name).get()["Body"]
+
     def clear_build(self, testHash, key_name):
         """Clear a build"""
         self._bucket.Object(self.build_artifact_key_prefix + "/" + testHash + "/" + key_name).delete()
@@ -381,6 +388,9 @@ class LocalArtifactStorage(ArtifactStorage):
     def download_build(self, testHash, key_name, dest):
         self.filecopy(dest, os.path.join(self.build_storage_path, testHash, key_name))
 
+    def open_build(self, testHash, key_name):
+        return open(os.path.join(self.build_storage_path, testHash, key_name), "rb")
+
     def uploadSingleTestArtifact(self, testHash, testId, artifact_name, path):
         self.filecopy(os.path.join(self.test_artifacts_storage_path, testHash, testId, artifact_name), path)
 
@@ -0,0 +1,456 @@
+"""EventLoop
+
+Multiplexes many framed socket connections on one thread.
+
+Each message on the wire is a little-endian 4-byte length followed by that many
+bytes, as in socket_util. A single thread owns every socket: it waits on epoll
+(or poll where there's no epoll), reads whatever has arrived without blocking,
+and writes whatever is queued as the socket will take it. Complete incoming
+messages go to a small pool of threads. The pool runs a connection's messages
+one at a time and in order, and runs its close callback after its last message,
+so a handler can keep per-connection state without locking.
+
+Any thread can send on a connection. We queue the bytes and wake the loop, and
+the loop writes them, so only the loop thread ever touches a socket.
+"""
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import select
+import socket
+import ssl
+import threading
+import traceback
+
+import test_looper.core.socket_util as socket_util
+
+#refuse messages bigger than this rather than buffering them
+MAX_MESSAGE_BYTES = 1024 * 1024 * 1024
+
+READ_CHUNK_BYTES = 64 * 1024
+WRITE_CHUNK_BYTES = 256 * 1024
+
+_READ = select.POLLIN
+_WRITE = select.POLLOUT
+_BROKEN = select.POLLERR | select.POLLHUP
+
+class _Poller(object):
+    """epoll if we have it, otherwise poll. Both use the same event bits."""
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._scale = 1.0
+        else:
+            self._poller = select.poll()
+            self._scale = 1000.0
+
+    def register(self, fd, mask):
+        self._poller.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self._poller.modify(fd, mask)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self._poller.poll(timeout * self._scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+class OrderedWorkerPool(object):
+    """Runs callables on a few threads.
+
+    Callables submitted with the same key run one at a time, in the order they
+    were submitted. Callables with different keys run in parallel.
+    """
+    def __init__(self, threadCount, name="OrderedWorkerPool"):
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        #key -> deque of callables waiting behind the one that's queued or running
+        self._waiting = {}
+        self._ready = Queue.Queue()
+        self._threads = []
+
+        for i in xrange(threadCount):
+            t = threading.Thread(target=self._work, name="%s-%s" % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn):
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting is not None:
+                waiting.append(fn)
+                return
+            self._waiting[key] = collections.deque()
+
+        self._ready.put((key, fn))
+
+    def _work(self):
+        while True:
+            key, fn = self._ready.get()
+
+            if fn is None:
+                return
+
+            try:
+                fn()
+            except:
+                logging.error("Unhandled exception in worker pool:\n%s", traceback.format_exc())
+
+            with self._lock:
+                waiting = self._waiting[key]
+                if waiting:
+                    fn = waiting.popleft()
+                else:
+                    del self._waiting[key]
+                    fn = None
+                    if not self._waiting:
+                        self._idle.notify_all()
+
+            #back of the line, so one busy key can't starve the others
+            if fn is not None:
+                self._ready.put((key, fn))
+
+    def stop(self):
+        """Finish everything already submitted, then stop the threads."""
+        with self._lock:
+            while self._waiting:
+                self._idle.wait()
+
+        for _ in self._threads:
+            self._ready.put((None, None))
+        for t in self._threads:
+            t.join()
+
+class Connection(object):
+    def __init__(self, sock, address=None):
+        self.sock = sock
+        self.address = address
+        self.fd = sock.fileno()
+
+        self._lock = threading.Lock()
+        self._outgoing = []
+        #bytes we've read but not yet handed out, and how many we need before there's a whole message
+        self._incoming = []
+        self._incomingBytes = 0
+        self._needed = socket_util.longLength
+        self._eventLoop = None
+        self._mask = 0
+
+        self.closed = False
+        self._closeRequested = False
+        self._discardPending = False
+
+        self.onMessage = None
+        self.onClosed = None
+
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+    def send(self, data):
+        """Queue one message. Safe to call from any thread."""
+        with self._lock:
+            if self.closed or self._closeRequested:
+                return False
+            self._outgoing.append(socket_util.prependSize(data))
+            eventLoop = self._eventLoop
+
+        if eventLoop is not None:
+            eventLoop._wake(self)
+
+        return True
+
+    def close(self, discardPending=False):
+        """Close the connection once what's already queued is written. Safe to call from any thread.
+
+        With discardPending, drop anything still queued and close right away, for peers that
+        have stopped reading.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self._closeRequested = True
+            if discardPending:
+                self._outgoing = []
+                self._discardPending = True
+            eventLoop = self._eventLoop
+
+        if eventLoop is not None:
+            eventLoop._wake(self)
+
+    def _read(self):
+        """Read everything available. Returns (complete messages, whether the other end closed)."""
+        chunks = []
+        closed = False
+
+        #read until the socket is dry. With SSL, stopping early could leave decrypted bytes
+        #sitting in the SSL object, and epoll would never tell us about them.
+        while True:
+            try:
+                data = self.sock.recv(READ_CHUNK_BYTES)
+            except ssl.SSLError as e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    break
+                raise
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not data:
+                closed = True
+                break
+
+            chunks.append(data)
+
+        for data in chunks:
+            self.bytesRead += len(data)
+            self._incomingBytes += len(data)
+            self._incoming.append(data)
+
+        #don't join a big message back together until all of it is here
+        if self._incomingBytes < self._needed:
+            return [], closed
+
+        messages = []
+        buf = "".join(self._incoming)
+        pos = 0
+        needed = socket_util.longLength
+
+        while len(buf) - pos >= socket_util.longLength:
+            size = socket_util.stringToLong(buf[pos:pos + socket_util.longLength])
+
+            if size > MAX_MESSAGE_BYTES:
+                raise socket_util.SocketException("Message of %s bytes is too big" % size)
+
+            if len(buf) - pos - socket_util.longLength < size:
+                needed = socket_util.longLength + size
+                break
+
+            pos += socket_util.longLength
+            messages.append(buf[pos:pos + size])
+            pos += size
+
+        self._incoming = [buf[pos:]] if pos < len(buf) else []
+        self._incomingBytes = len(buf) - pos
+        self._needed = needed
+
+        return messages, closed
+
+    def _write(self):
+        """Write as much as the socket will take. Returns whether we still have bytes to write."""
+        with self._lock:
+            data = "".join(self._outgoing)
+            self._outgoing = []
+
+        sent = 0
+
+        try:
+            while sent < len(data):
+                sent += self.sock.send(data[sent:sent + WRITE_CHUNK_BYTES])
+        except ssl.SSLError as e:
+            if e.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                raise
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+        finally:
+            self.bytesWritten += sent
+
+            with self._lock:
+                if sent < len(data):
+                    self._outgoing.insert(0, data[sent:])
+
+        with self._lock:
+            return bool(self._outgoing)
+
+class EventLoop(object):
+    def __init__(self, workerThreads=8, name="EventLoop"):
+        self.name = name
+        self.pool = OrderedWorkerPool(workerThreads, name + "Worker")
+
+        self._poller = _Poller()
+        self._connections = {}
+
+        self._lock = threading.Lock()
+        #connections added, or with new writes or close requests, since the loop last looked
+        self._touched = set()
+        self._added = []
+
+        self._wakeRead, self._wakeWrite = os.pipe()
+        fcntl.fcntl(self._wakeRead, fcntl.F_SETFL, fcntl.fcntl(self._wakeRead, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._wakePending = False
+        self._poller.register(self._wakeRead, _READ)
+
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+        self._signal()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self.pool.stop()
+
+    def connectionCount(self):
+        return len(self._connections)
+
+    def add(self, connection, onMessage, onClosed=None):
+        """Start servicing 'connection'. onMessage(data) and onClosed() run on the worker pool."""
+        connection.sock.setblocking(0)
+        connection.onMessage = onMessage
+        connection.onClosed = onClosed
+
+        with connection._lock:
+            connection._eventLoop = self
+
+        with self._lock:
+            self._added.append(connection)
+
+        self._signal()
+
+    def call(self, connection, fn):
+        """Run fn() on the worker pool, in order with the messages of 'connection'."""
+        self.pool.submit(connection, fn)
+
+    def _wake(self, connection):
+        with self._lock:
+            self._touched.add(connection)
+        self._signal()
+
+    def _signal(self):
+        with self._lock:
+            if self._wakePending:
+                return
+            self._wakePending = True
+
+        os.write(self._wakeWrite, "x")
+
+    def _drainWakeups(self):
+        #empty the pipe before clearing _wakePending, so we can't swallow a wakeup meant for next time
+        try:
+            os.read(self._wakeRead, 4096)
+        except OSError:
+            pass
+
+        with self._lock:
+            self._wakePending = False
+            added, self._added = self._added, []
+            touched, self._touched = self._touched, set()
+            stopping = self._stopping
+
+        for connection in added:
+            self._connections[connection.fd] = connection
+            connection._mask = _READ
+            self._poller.register(connection.fd, _READ)
+            touched.add(connection)
+
+        for connection in touched:
+            if connection.fd in self._connections and connection is self._connections[connection.fd]:
+                self._flush(connection)
+
+        return stopping
+
+    def _run(self):
+        try:
+            while True:
+                for fd, events in self._poller.poll(1.0):
+                    if fd == self._wakeRead:
+                        continue
+
+                    connection = self._connections.get(fd)
+                    if connection is None:
+                        continue
+
+                    if events & _READ or events & _BROKEN:
+                        self._read(connection)
+
+                    if events & _WRITE and not connection.closed:
+                        self._flush(connection)
+
+                if self._drainWakeups():
+                    break
+        except:
+            logging.critical("%s exiting:\n%s", self.name, traceback.format_exc())
+        finally:
+            for connection in self._connections.values():
+                self._close(connection)
+
+            self._poller.unregister(self._wakeRead)
+            os.close(self._wakeRead)
+            os.close(self._wakeWrite)
+
+    def _read(self, connection):
+        try:
+            messages, closed = connection._read()
+        except socket_util.SocketException as e:
+            logging.info("Closing connection from %s: %s", connection.address, e)
+            messages, closed = [], True
+        except socket.error as e:
+            logging.info("Socket error reading from %s: %s", connection.address, e)
+            messages, closed = [], True
+
+        for message in messages:
+            self.pool.submit(connection, lambda message=message: connection.onMessage(message))
+
+        if closed:
+            self._close(connection)
+
+    def _flush(self, connection):
+        try:
+            stillWriting = connection._write()
+        except socket.error as e:
+            logging.info("Socket error writing to %s: %s", connection.address, e)
+            self._close(connection)
+            return
+
+        if connection._closeRequested and (connection._discardPending or not stillWriting):
+            self._close(connection)
+            return
+
+        mask = _READ | (_WRITE if stillWriting else 0)
+
+        if mask != connection._mask:
+            connection._mask = mask
+            self._poller.modify(connection.fd, mask)
+
+    def _close(self, connection):
+        with connection._lock:
+            if connection.closed:
+                return
+            connection.closed = True
+
+        if self._connections.get(connection.fd) is connection:
+            del self._connections[connection.fd]
+            try:
+                self._poller.unregister(connection.fd)
+            except (IOError, ValueError):
+                pass
+
+        try:
+            connection.sock.close()
+        except:
+            logging.error("Failed to close socket for %s:\n%s", connection.address, traceback.format_exc())
+
+        if connection.onClosed is not None:
+            self.pool.submit(connection, connection.onClosed)
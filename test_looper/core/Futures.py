@@ -0,0 +1,197 @@
+"""Futures
+
+A Future holds the result of some work running on another thread. A
+FuturePool runs work on at most a fixed number of threads and hands back a
+Future for each piece of it.
+
+Anyone waiting on a Future, or on several at once with 'waitAll', sleeps until
+it finishes instead of polling. Each Future also remembers when its work was
+queued, started, and finished, so callers can say where the time went.
+"""
+
+import collections
+import sys
+import threading
+import time
+import traceback
+
+class Future(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self._done = False
+        self._result = None
+        self._excInfo = None
+        self._callbacks = []
+
+        self.queuedAt = time.time()
+        self.startedAt = None
+        self.finishedAt = None
+
+    def done(self):
+        with self._lock:
+            return self._done
+
+    def started(self):
+        self.startedAt = time.time()
+
+    def setResult(self, result):
+        self._finish(result, None)
+
+    def setException(self, excInfo=None):
+        """Finish with the exception we're handling, or the one given as a sys.exc_info() triple."""
+        self._finish(None, excInfo or sys.exc_info())
+
+    def addDoneCallback(self, callback):
+        """Call 'callback(future)' once we're done, or right away if we already are."""
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """Block until we're done, or for 'timeout' seconds. Returns whether we're done."""
+        with self._lock:
+            deadline = None if timeout is None else time.time() + timeout
+
+            while not self._done:
+                if deadline is None:
+                    self._finished.wait()
+                elif deadline > time.time():
+                    self._finished.wait(deadline - time.time())
+                else:
+                    break
+
+            return self._done
+
+    def result(self, timeout=None):
+        """Our result, or raise the exception our work raised."""
+        if not self.wait(timeout):
+            raise UserWarning("Timed out waiting for a Future")
+
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+
+        return self._result
+
+    def exception(self):
+        """The exception our work raised, or None. Only meaningful once we're done."""
+        return self._excInfo[1] if self._excInfo is not None else None
+
+    def formattedTraceback(self):
+        return "".join(traceback.format_exception(*self._excInfo)) if self._excInfo is not None else None
+
+    def secondsQueued(self):
+        """How long our work waited for a thread."""
+        return (self.startedAt or self.finishedAt or time.time()) - self.queuedAt
+
+    def secondsRunning(self):
+        if self.startedAt is None:
+            return 0.0
+        return (self.finishedAt or time.time()) - self.startedAt
+
+    def _finish(self, result, excInfo):
+        with self._lock:
+            assert not self._done, "Future finished twice"
+            self.finishedAt = time.time()
+            self._result = result
+            self._excInfo = excInfo
+            self._done = True
+            self._finished.notifyAll()
+
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            callback(self)
+
+def waitAll(futures, timeout=None):
+    """Block until every one of 'futures' is done, or for 'timeout' seconds. Returns whether they all are."""
+    futures = list(futures)
+
+    lock = threading.Lock()
+    allDone = threading.Event()
+    remaining = [len(futures)]
+
+    def onDone(future):
+        with lock:
+            remaining[0] -= 1
+            if not remaining[0]:
+                allDone.set()
+
+    if not futures:
+        return True
+
+    for f in futures:
+        f.addDoneCallback(onDone)
+
+    allDone.wait(timeout)
+
+    return allDone.is_set()
+
+def spawn(fn, *args):
+    """Run 'fn(*args)' on a new daemon thread, and return a Future for what it returns."""
+    future = Future()
+
+    def run():
+        _runInto(future, fn, args)
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+
+    return future
+
+class FuturePool(object):
+    """Runs work on at most 'threads' threads at a time, in the order it was submitted.
+
+    Threads only live while there's work queued, so an idle pool costs nothing.
+    """
+    def __init__(self, threads, name="FuturePool"):
+        assert threads > 0
+        self.threads = threads
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._running = 0
+
+    def submit(self, fn, *args):
+        """Queue 'fn(*args)', and return a Future for what it returns."""
+        future = Future()
+
+        with self._lock:
+            self._queue.append((future, fn, args))
+
+            if self._running < self.threads:
+                self._running += 1
+
+                t = threading.Thread(target=self._worker, name="%s-%s" % (self.name, self._running))
+                t.daemon = True
+                t.start()
+
+        return future
+
+    def queued(self):
+        with self._lock:
+            return len(self._queue)
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._running -= 1
+                    return
+                future, fn, args = self._queue.popleft()
+
+            _runInto(future, fn, args)
+
+def _runInto(future, fn, args):
+    future.started()
+    try:
+        result = fn(*args)
+    except:
+        future.setException()
+    else:
+        future.setResult(result)
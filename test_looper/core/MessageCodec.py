@@ -0,0 +1,105 @@
+"""MessageCodec
+
+Turns one connection's protocol messages into frames and back.
+
+Every connection starts out speaking JSON, which is all that older workers
+know. A worker that knows better offers the protocol versions it speaks and a
+hash of its message definitions, and if the server speaks one of them and the
+hashes match, the two switch to it. The first byte of each frame says how it's
+encoded, so messages already in flight during the switch are still readable:
+
+    '{' or '"'  JSON, from algebraic_to_json
+    '\\x01'      binary, from algebraic_to_binary
+    '\\x02'      binary, then compressed by the connection's zlib stream
+
+Compressed frames share one zlib stream per direction, which is what makes
+small, repetitive messages like heartbeats compress well. That means frames
+have to be decoded in the order they were encoded, and sent in the order they
+were encoded, so callers serialize 'encode' with their writes.
+"""
+
+import json
+import zlib
+
+import test_looper.core.algebraic_to_binary as algebraic_to_binary
+import test_looper.core.algebraic_to_json as algebraic_to_json
+
+JSON = 0
+BINARY = 1
+
+SUPPORTED_VERSIONS = (JSON, BINARY)
+
+#frames smaller than this aren't worth compressing
+COMPRESSION_MIN_BYTES = 64
+
+#refuse to inflate a compressed frame past this
+MAX_DECOMPRESSED_BYTES = 1024 * 1024 * 1024
+
+_BINARY_MARKER = "\x01"
+_COMPRESSED_MARKER = "\x02"
+
+#the binary encoder only caches per-type functions, so every connection can share it
+_binaryEncoder = algebraic_to_binary.Encoder()
+
+class MessageCodec(object):
+    def __init__(self, outgoingType, incomingType):
+        self.outgoingType = outgoingType
+        self.incomingType = incomingType
+
+        self.schema = algebraic_to_binary.schemaHash(*sorted([outgoingType, incomingType], key=lambda t: t._name))
+
+        self.version = JSON
+        self.compression = False
+
+        self._json = algebraic_to_json.Encoder()
+        self._compressor = zlib.compressobj()
+        self._decompressor = zlib.decompressobj()
+
+        #message bytes before and after compression, for anyone measuring what it buys us
+        self.uncompressedBytes = 0
+        self.compressedBytes = 0
+
+    def choose(self, versions, schema, compression):
+        """Pick the version and compression to use with a peer that offered these."""
+        if schema != self.schema:
+            return JSON, False
+
+        version = max((set(versions) & set(SUPPORTED_VERSIONS)) | set([JSON]))
+
+        return version, compression and version != JSON
+
+    def use(self, version, compression):
+        assert version in SUPPORTED_VERSIONS, version
+        self.version = version
+        self.compression = compression and version != JSON
+
+    def encode(self, msg):
+        if self.version == JSON:
+            return json.dumps(self._json.to_json(msg))
+
+        data = _binaryEncoder.to_binary(msg, self.outgoingType)
+
+        if not self.compression or len(data) < COMPRESSION_MIN_BYTES:
+            return _BINARY_MARKER + data
+
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.uncompressedBytes += len(data)
+        self.compressedBytes += len(compressed)
+
+        return _COMPRESSED_MARKER + compressed
+
+    def decode(self, frame):
+        if not frame:
+            raise UserWarning("Empty message")
+
+        if frame[0] == _BINARY_MARKER:
+            return _binaryEncoder.from_binary(frame, self.incomingType, 1)
+
+        if frame[0] == _COMPRESSED_MARKER:
+            data = self._decompressor.decompress(buffer(frame, 1), MAX_DECOMPRESSED_BYTES)
+            if self._decompressor.unconsumed_tail:
+                raise UserWarning("Compressed message is bigger than %s bytes" % MAX_DECOMPRESSED_BYTES)
+            return _binaryEncoder.from_binary(data, self.incomingType)
+
+        return self._json.from_json(json.loads(frame), self.incomingType)
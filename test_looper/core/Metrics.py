@@ -0,0 +1,239 @@
+"""Metrics
+
+A registry of counters, gauges and histograms for watching the server from
+the outside. Recording a value is a dict update under a lock, so it's cheap
+enough to leave on everywhere. Gauges can be given a function, which we call
+only when someone asks for the metrics.
+
+The registry renders in the Prometheus text format (for /metrics) or as JSON.
+"""
+
+import bisect
+import threading
+import time
+
+#upper bounds, in seconds, of the default histogram buckets
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _formatLabels(key):
+    if not key:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, _escape(v)) for k, v in key) + "}"
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+def labeled(labelName, values):
+    """Turn {x: value} into gauge samples labeled labelName=x."""
+    return dict((((labelName, k),), v) for k, v in values.items())
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_labelKey(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def renderText(self):
+        return ["%s%s %s" % (self.name, _formatLabels(key), _formatValue(value)) for key, value in self.samples()]
+
+    def toJson(self):
+        return [{"labels": dict(key), "value": value} for key, value in self.samples()]
+
+class Gauge(Counter):
+    """A value that goes up and down.
+
+    If 'fn' is given, it's called whenever we render, and returns either a number
+    or a dict from label keys (tuples of (name, value) pairs) to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        Counter.__init__(self, name, help)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = _labelKey(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            return Counter.samples(self)
+
+        values = self.fn()
+
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        return sorted(values.items())
+
+class _HistogramValue(object):
+    def __init__(self, bucketCount):
+        #counts[i] is the number of observations in bucket i alone; the last bucket is +Inf
+        self.counts = [0] * (bucketCount + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _labelKey(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = _HistogramValue(len(self.buckets))
+            h.counts[bucket] += 1
+            h.sum += value
+            h.count += 1
+
+    def time(self, **labels):
+        """A context manager that observes how long its block took."""
+        histogram = self
+
+        class Timer:
+            def __enter__(timer):
+                timer.t0 = time.time()
+
+            def __exit__(timer, *args):
+                histogram.observe(time.time() - timer.t0, **labels)
+
+        return Timer()
+
+    def samples(self):
+        """Returns [(labelKey, count, sum, [(upperBound, cumulativeCount)])]."""
+        with self.lock:
+            res = []
+            for key, h in sorted(self.values.items()):
+                cumulative = []
+                total = 0
+                for bound, count in zip(self.buckets + (float("inf"),), h.counts):
+                    total += count
+                    cumulative.append((bound, total))
+                res.append((key, h.count, h.sum, cumulative))
+            return res
+
+    def renderText(self):
+        lines = []
+        for key, count, total, cumulative in self.samples():
+            for bound, bucketCount in cumulative:
+                lines.append("%s_bucket%s %s" % (self.name, _formatLabels(key + (("le", _formatValue(bound)),)), bucketCount))
+            lines.append("%s_sum%s %s" % (self.name, _formatLabels(key), _formatValue(total)))
+            lines.append("%s_count%s %s" % (self.name, _formatLabels(key), count))
+        return lines
+
+    def toJson(self):
+        return [{
+            "labels": dict(key),
+            "count": count,
+            "sum": total,
+            "buckets": [[_formatValue(bound), bucketCount] for bound, bucketCount in cumulative]
+            } for key, count, total, cumulative in self.samples()]
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args)
+            assert type(metric) is cls, "%s is already a %s" % (name, metric.kind)
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help, fn=None):
+        return self._get(Gauge, name, help, fn)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def _sorted(self):
+        with self.lock:
+            return [self.metrics[name] for name in sorted(self.metrics)]
+
+    def renderText(self):
+        lines = []
+        for metric in self._sorted():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(metric.renderText())
+        return "\n".join(lines) + "\n"
+
+    def toJson(self):
+        return dict(
+            (metric.name, {"type": metric.kind, "help": metric.help, "values": metric.toJson()})
+                for metric in self._sorted()
+            )
+
+class TimedLock(object):
+    """Wraps a reentrant lock, recording how long callers wait for it and how long they hold it.
+
+    Only the outermost acquisition on each thread is timed.
+    """
+    def __init__(self, lock, waitHistogram, holdHistogram):
+        self.lock = lock
+        self.waitHistogram = waitHistogram
+        self.holdHistogram = holdHistogram
+        self.local = threading.local()
+
+    def __enter__(self):
+        depth = getattr(self.local, "depth", 0)
+
+        if depth:
+            self.lock.__enter__()
+            self.local.depth = depth + 1
+            return
+
+        t0 = time.time()
+        self.lock.__enter__()
+        acquiredAt = time.time()
+
+        self.waitHistogram.observe(acquiredAt - t0)
+        self.local.depth = 1
+        self.local.acquiredAt = acquiredAt
+
+    def __exit__(self, *args):
+        self.local.depth -= 1
+
+        if self.local.depth == 0:
+            self.holdHistogram.observe(time.time() - self.local.acquiredAt)
+
+        return self.lock.__exit__(*args)
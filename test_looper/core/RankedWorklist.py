@@ -0,0 +1,64 @@
+"""RankedWorklist
+
+A set of dirty nodes that get popped in order of a 'rank' function, where each
+node is processed at most once. If the rank function is a topological order
+of the graph that dirtiness flows along, then nodes dirtied while processing
+other nodes always come later in the worklist, and every node is visited
+exactly once per batch.
+
+Nodes that get dirtied again after they've already been processed (which only
+happens if the rank function isn't a true topological order) are recorded
+as 'deferred' so that the caller can reschedule them in a later batch.
+"""
+
+import heapq
+
+class RankedWorklist(object):
+    def __init__(self, rankFunction, descending=False):
+        self.rankFunction = rankFunction
+        self.descending = descending
+        self._heap = []
+        self._pending = set()
+        self._ct = 0
+
+        self.processed = set()
+        self.deferred = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, node):
+        return node in self._pending
+
+    def add(self, node):
+        """Mark 'node' dirty. Returns False if it was already processed and got deferred."""
+        if node in self._pending:
+            return True
+
+        if node in self.processed:
+            if node not in self.deferred:
+                self.deferred.append(node)
+            return False
+
+        rank = self.rankFunction(node)
+        if self.descending:
+            rank = -rank
+
+        #the counter breaks ties in insertion order so we never compare nodes directly
+        self._ct += 1
+        heapq.heappush(self._heap, (rank, self._ct, node))
+        self._pending.add(node)
+
+        return True
+
+    def pop(self):
+        """Return the next node to process, or None if we're empty."""
+        if not self._heap:
+            return None
+
+        _, _, node = heapq.heappop(self._heap)
+
+        self._pending.discard(node)
+        self.processed.add(node)
+
+        return node
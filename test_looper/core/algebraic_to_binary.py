@@ -0,0 +1,294 @@
+"""algebraic_to_binary
+
+A compact binary encoding of algebraic values. Both sides have to know the
+type, so the bytes carry no field names:
+
+    * ints are zigzag varints, bools one byte, floats 8-byte doubles
+    * strs are a varint length followed by the bytes
+    * Lists and Dicts are a varint count followed by the items (keys and values interleaved)
+    * tuples are their elements in order
+    * Alternatives are a varint giving the alternative's position among the sorted
+      alternative names, followed by its fields in sorted order of field name
+    * types with their own to_json/from_json go through json
+
+Since the encoding depends on the exact definitions of the types, 'schemaHash'
+gives a fingerprint that two processes can compare before they agree to use it.
+"""
+
+import hashlib
+import json
+import struct
+import threading
+
+import test_looper.core.algebraic as algebraic
+
+_double = struct.Struct("<d")
+
+def _writeVarint(out, n):
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+def _readVarint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _describe(t, seen):
+    if isinstance(t, algebraic.Alternative):
+        if id(t) in seen:
+            return "ref(%s)" % t._name
+        seen = seen | set([id(t)])
+        return "%s{%s}" % (t._name, ";".join(
+            "%s(%s)" % (which, ",".join("%s:%s" % (f, _describe(t._types[which][f], seen)) for f in sorted(t._types[which])))
+                for which in sorted(t._types)
+            ))
+    if isinstance(t, tuple):
+        return "(%s)" % ",".join(_describe(x, seen) for x in t)
+    if isinstance(t, algebraic.List):
+        return "List(%s)" % _describe(t.subtype, seen)
+    if isinstance(t, algebraic.Dict):
+        return "Dict(%s,%s)" % (_describe(t.keytype, seen), _describe(t.valtype, seen))
+    return getattr(t, "__name__", str(t))
+
+def schemaHash(*types):
+    """A fingerprint of the definitions of 'types' and everything they refer to."""
+    return hashlib.sha1("|".join(_describe(t, frozenset()) for t in types)).hexdigest()
+
+class Encoder(object):
+    """An algebraic <---> binary encoder.
+
+    We build an encode and a decode function for each type the first time we see
+    it and keep them, so keep one Encoder around rather than making one per message.
+    Encoders are safe to share between threads.
+    """
+    def __init__(self):
+        self._encoders = {}
+        self._decoders = {}
+        #held while building functions. (id(functions), key) -> (functions, function) for the build in progress.
+        self._lock = threading.RLock()
+        self._building = None
+
+    def to_binary(self, value, algebraic_type):
+        out = []
+        self._encoder(algebraic_type)(value, out)
+        return "".join(out)
+
+    def from_binary(self, data, algebraic_type, pos=0):
+        """Decode the value that starts at 'pos' and runs to the end of 'data'."""
+        value, pos = self._decoder(algebraic_type)(data, pos)
+        if pos != len(data):
+            raise UserWarning("%s trailing bytes after %s" % (len(data) - pos, algebraic_type))
+        return value
+
+    def _key(self, t):
+        #tuples of types aren't always hashable by value in a useful way, and Alternatives hash by identity
+        return id(t) if not isinstance(t, tuple) else tuple(self._key(x) for x in t)
+
+    def _encoder(self, t):
+        return self._function(self._encoders, t, self._makeEncoder)
+
+    def _decoder(self, t):
+        return self._function(self._decoders, t, self._makeDecoder)
+
+    def _function(self, functions, t, make):
+        """The function in 'functions' for 't', making it with 'make' the first time.
+
+        Recursive types refer to themselves through a forwarder we register before we make
+        their function. Forwarders don't work until the build finishes, so we keep everything
+        we build to ourselves until the outermost build is done, and only then publish it.
+        """
+        key = self._key(t)
+        f = functions.get(key)
+        if f is not None:
+            return f
+
+        with self._lock:
+            if key in functions:
+                return functions[key]
+
+            outermost = self._building is None
+            if outermost:
+                self._building = {}
+
+            try:
+                if (id(functions), key) not in self._building:
+                    self._building[id(functions), key] = (functions, lambda *args: made(*args))
+                    made = make(t)
+                    self._building[id(functions), key] = (functions, made)
+
+                f = self._building[id(functions), key][1]
+
+                if outermost:
+                    for (_, k), (built, g) in self._building.items():
+                        built[k] = g
+            finally:
+                if outermost:
+                    self._building = None
+
+            return f
+
+    def _makeEncoder(self, t):
+        if t is bool:
+            return lambda value, out: out.append("\x01" if value else "\x00")
+
+        if t is int:
+            def encodeInt(value, out):
+                _writeVarint(out, value * 2 if value >= 0 else -value * 2 - 1)
+            return encodeInt
+
+        if t is float:
+            return lambda value, out: out.append(_double.pack(value))
+
+        if t is str or t is bytes:
+            def encodeStr(value, out):
+                if isinstance(value, unicode):
+                    value = value.encode('ascii', errors='ignore')
+                _writeVarint(out, len(value))
+                out.append(value)
+            return encodeStr
+
+        if isinstance(t, tuple):
+            encoders = [self._encoder(x) for x in t]
+            def encodeTuple(value, out):
+                assert len(value) == len(encoders), "Can't convert %s to %s" % (value, t)
+                for encoder, item in zip(encoders, value):
+                    encoder(item, out)
+            return encodeTuple
+
+        if isinstance(t, algebraic.List):
+            encodeItem = self._encoder(t.subtype)
+            def encodeList(value, out):
+                _writeVarint(out, len(value))
+                for item in value:
+                    encodeItem(item, out)
+            return encodeList
+
+        if isinstance(t, algebraic.Dict):
+            encodeKey = self._encoder(t.keytype)
+            encodeValue = self._encoder(t.valtype)
+            def encodeDict(value, out):
+                value = value or {}
+                _writeVarint(out, len(value))
+                for k, v in value.iteritems():
+                    encodeKey(k, out)
+                    encodeValue(v, out)
+            return encodeDict
+
+        if isinstance(t, algebraic.Alternative):
+            names = sorted(t._types)
+            #which -> (index, [(fieldname, encoder)])
+            layouts = {}
+
+            def encodeAlternative(value, out):
+                layout = layouts.get(value._which)
+                if layout is None:
+                    layout = layouts[value._which] = (
+                        names.index(value._which),
+                        [(f, self._encoder(t._types[value._which][f])) for f in sorted(t._types[value._which])]
+                        )
+                index, fields = layout
+                _writeVarint(out, index)
+                for fieldname, encoder in fields:
+                    encoder(value._fields[fieldname], out)
+            return encodeAlternative
+
+        if hasattr(t, "to_json"):
+            encodeStr = self._encoder(str)
+            return lambda value, out: encodeStr(json.dumps(t.to_json(value)), out)
+
+        raise UserWarning("Can't encode values of type %s" % (t,))
+
+    def _makeDecoder(self, t):
+        if t is bool:
+            return lambda data, pos: (data[pos] != "\x00", pos + 1)
+
+        if t is int:
+            def decodeInt(data, pos):
+                n, pos = _readVarint(data, pos)
+                return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+            return decodeInt
+
+        if t is float:
+            return lambda data, pos: (_double.unpack_from(data, pos)[0], pos + _double.size)
+
+        if t is str or t is bytes:
+            def decodeStr(data, pos):
+                n, pos = _readVarint(data, pos)
+                if pos + n > len(data):
+                    raise UserWarning("String runs past the end of the message")
+                return data[pos:pos + n], pos + n
+            return decodeStr
+
+        if isinstance(t, tuple):
+            decoders = [self._decoder(x) for x in t]
+            def decodeTuple(data, pos):
+                res = []
+                for decoder in decoders:
+                    item, pos = decoder(data, pos)
+                    res.append(item)
+                return tuple(res), pos
+            return decodeTuple
+
+        if isinstance(t, algebraic.List):
+            decodeItem = self._decoder(t.subtype)
+            def decodeList(data, pos):
+                n, pos = _readVarint(data, pos)
+                res = []
+                for _ in xrange(n):
+                    item, pos = decodeItem(data, pos)
+                    res.append(item)
+                return tuple(res), pos
+            return decodeList
+
+        if isinstance(t, algebraic.Dict):
+            decodeKey = self._decoder(t.keytype)
+            decodeValue = self._decoder(t.valtype)
+            def decodeDict(data, pos):
+                n, pos = _readVarint(data, pos)
+                res = {}
+                for _ in xrange(n):
+                    k, pos = decodeKey(data, pos)
+                    v, pos = decodeValue(data, pos)
+                    res[k] = v
+                return res, pos
+            return decodeDict
+
+        if isinstance(t, algebraic.Alternative):
+            names = sorted(t._types)
+            #index -> (alternative, [(fieldname, decoder)])
+            layouts = {}
+
+            def decodeAlternative(data, pos):
+                index, pos = _readVarint(data, pos)
+                layout = layouts.get(index)
+                if layout is None:
+                    if index >= len(names):
+                        raise UserWarning("%s has no alternative number %s" % (t, index))
+                    which = names[index]
+                    layout = layouts[index] = (
+                        getattr(t, which),
+                        [(f, self._decoder(t._types[which][f])) for f in sorted(t._types[which])]
+                        )
+                alternative, fields = layout
+                values = {}
+                for fieldname, decoder in fields:
+                    values[fieldname], pos = decoder(data, pos)
+                return alternative(**values), pos
+            return decodeAlternative
+
+        if hasattr(t, "from_json"):
+            decodeStr = self._decoder(str)
+            def decodeViaJson(data, pos):
+                s, pos = decodeStr(data, pos)
+                return t.from_json(json.loads(s)), pos
+            return decodeViaJson
+
+        raise UserWarning("Can't decode values of type %s" % (t,))
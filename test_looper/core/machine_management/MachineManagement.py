@@ -65,10 +65,32 @@ class MachineManagement(object):
     def ensureOsConfigAvailable(self, osConfig, setupScript):
         assert False, "Not implemented"
 
+    def isBootable(self, hardwareConfig, osConfig):
+        """Could we boot this combination at all, ignoring the limits on how much we boot?"""
+        return True
+
+    def hourlyCost(self, hardwareConfig):
+        """The relative cost of keeping a machine of this type up for an hour."""
+        return float(hardwareConfig.cores)
+
+    def remainingCapacity(self):
+        """Returns (cores, ram_gb, workers) we can still boot. None means no limit."""
+        with self._lock:
+            config = self.config.machine_management
+
+            return (
+                None if config.max_cores <= 0 else config.max_cores - self.cores_booted,
+                None if config.max_ram_gb <= 0 else config.max_ram_gb - self.ram_gb_booted,
+                None if config.max_workers <= 0 else config.max_workers - len(self.runningMachines)
+                )
+
     def canBoot(self, hardwareConfig, osConfig):
         with self._lock:
             config = self.config.machine_management
 
+            if not self.isBootable(hardwareConfig, osConfig):
+                return False
+
             if not (self.ram_gb_booted + hardwareConfig.ram_gb <= config.max_ram_gb or config.max_ram_gb <= 0):
                 return False
 
@@ -289,14 +311,14 @@ class AwsMachineManagement(MachineManagement):
     def all_hardware_configs(self):
         return sorted(self.instance_types.keys(), key=lambda hw: hw.cores)
 
-    def canBoot(self, hardwareConfig, osConfig):
+    def isBootable(self, hardwareConfig, osConfig):
         if hardwareConfig not in self.instance_types:
             return False
 
         if osConfig.matches.WindowsVM and osConfig not in self.windowsOsConfigsAvailable:
             return False
 
-        return MachineManagement.canBoot(self, hardwareConfig, osConfig)
+        return True
 
     def wantsToSeeSetupScriptForOsConfig(self, osConfig):
         with self._lock:
@@ -79,6 +79,11 @@ class DatabaseObject(object):
     def lookupAll(cls, **kwargs):
         return cls._database.current_transaction().indexLookup(cls, **kwargs)
 
+    @classmethod
+    def lookupSome(cls, maxCount, **kwargs):
+        """Like lookupAll, but returns at most 'maxCount' objects, without building the rest."""
+        return cls._database.current_transaction().indexLookup(cls, maxCount=maxCount, **kwargs)
+
     @classmethod
     def lookupAny(cls, **kwargs):
         return cls._database.current_transaction().indexLookupAny(cls, **kwargs)
@@ -340,7 +345,7 @@ class DatabaseView(object):
                         new_index_list = tuple(self._get_dbkey(new_index_name) or ())
                         self._writes[new_index_name] = new_index_list + (identity,)
 
-    def indexLookup(self, type, **kwargs):
+    def indexLookup(self, type, maxCount=None, **kwargs):
         assert len(kwargs) == 1, "Can only lookup one index at a time."
         tname, value = kwargs.items()[0]
 
@@ -359,6 +364,9 @@ class DatabaseView(object):
             
         if not identities:
             return ()
+
+        if maxCount is not None:
+            identities = identities[:maxCount]
         
         return tuple([type(str(x)) for x in identities])
 
@@ -201,6 +201,11 @@ class BranchPinning:
         """
         assert newCommit != oldCommit
 
+        if oldCommit.generation and newCommit.generation:
+            #a chain of single-parent commits loses exactly one generation per step
+            if not (0 < newCommit.generation - oldCommit.generation < max_commits):
+                return None
+
         chain = [newCommit]
 
         while chain[-1] != oldCommit:
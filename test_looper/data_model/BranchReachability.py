@@ -0,0 +1,195 @@
+"""BranchReachability
+
+Maintains, for every commit, the branch we'd best describe it by and the path from
+that branch's head to the commit (e.g. 'master~3^2~'), so that naming a commit is
+a lookup rather than a search of the commit graph.
+
+Paths change every time a branch head moves, so we don't store them directly.
+Each branch numbers the commits along its first-parent chain ('positions'), and
+each commit stores the position of the first-parent commit its path leaves the
+chain at (its 'anchor') and the rest of the path (its 'suffix'). A fast-forward
+just increases the branch's head position, so existing entries stay valid and
+we only visit commits that are new to the branch. Anything else (a force push,
+a deleted branch) clears the branch's entries and repairs them from the
+neighboring commits.
+
+When several branches reach a commit, we prefer the least feature-branchy
+branch name, and then the shortest path.
+"""
+
+import collections
+import re
+
+#how many first-parents we'll walk looking for the old head when a branch moves
+#before we give up and treat the move as a force push
+MAX_FAST_FORWARD_SEARCH = 1000
+
+version_pattern = re.compile(".*([0-9-._]+).*")
+
+def branchMasteryness(branchname):
+    """A sort key for branch names. Smaller values are better names to describe commits by."""
+    fields = []
+
+    if branchname == "master":
+        fields.append(0)
+    elif branchname == "svn-master":
+        fields.append(1)
+    elif 'master' in branchname:
+        fields.append(2)
+    elif 'trunk' in branchname:
+        fields.append(3)
+
+    #look for a version number
+    match = version_pattern.match(branchname)
+    if not match:
+        #sort last
+        fields.append("XXX")
+    else:
+        version = match.groups()[0]
+        for char in ".-_":
+            version = version.replace(char," ")
+        fields.append(version.split(" "))
+
+    return tuple(fields)
+
+def compressPathBack(path):
+    """Collapse runs of '~' in a git-style path, so '~~~^2~' becomes '~3^2~'."""
+    start = None
+    i = 0
+    while i <= len(path):
+        if i < len(path) and path[i] == "~":
+            if start is None:
+                start = i
+            i += 1
+        else:
+            if start is not None and i-start > 1:
+                path = path[:start] + "~" + str(i - start) + path[i:]
+                i = start+1
+                start = None
+            else:
+                start = None
+                i += 1
+
+    return path
+
+class BranchReachability:
+    def __init__(self, database, commitGraph):
+        self.database = database
+        self.commitGraph = commitGraph
+
+    def pathFor(self, commit):
+        """The path from the head of commit.reachBranch to 'commit'."""
+        return compressPathBack(
+            "~" * (commit.reachBranch.reachHeadPosition - commit.reachAnchor) + commit.reachSuffix
+            )
+
+    def _distance(self, branch, anchor, suffix):
+        return branch.reachHeadPosition - anchor + suffix.count("~") + suffix.count("^")
+
+    def _rank(self, branch, anchor, suffix):
+        return branchMasteryness(branch.branchname) + (self._distance(branch, anchor, suffix), branch.branchname)
+
+    def _offer(self, commit, branch, anchor, suffix):
+        """Describe 'commit' using 'branch' if that's better than what we have. Returns True if it changed."""
+        if commit.reachBranch:
+            if (commit.reachBranch == branch and commit.reachAnchor == anchor and commit.reachSuffix == suffix
+                    or self._rank(branch, anchor, suffix) >=
+                        self._rank(commit.reachBranch, commit.reachAnchor, commit.reachSuffix)):
+                return False
+
+        commit.reachBranch = branch
+        commit.reachAnchor = anchor
+        commit.reachSuffix = suffix
+
+        return True
+
+    def _propagate(self, toCheck):
+        """Push the entries of the commits in 'toCheck' down to their parents."""
+        toCheck = collections.deque(toCheck)
+
+        while toCheck:
+            c = toCheck.popleft()
+
+            if not c.reachBranch or not c.data:
+                continue
+
+            for ix, parent in enumerate(c.data.parents):
+                if not c.reachSuffix:
+                    if ix == 0:
+                        anchor, suffix = c.reachAnchor - 1, ""
+                    else:
+                        anchor, suffix = c.reachAnchor, "^" + str(ix+1)
+                else:
+                    anchor, suffix = c.reachAnchor, c.reachSuffix + ("~" if ix == 0 else "^" + str(ix+1))
+
+                if self._offer(parent, c.reachBranch, anchor, suffix):
+                    toCheck.append(parent)
+
+    def _firstParentDistance(self, newHead, oldHead):
+        """How many first-parents back from 'newHead' 'oldHead' is.
+
+        Returns None if it isn't there, or False if we can't tell yet because we're
+        missing commit data.
+        """
+        return self.commitGraph.firstParentDistance(newHead, oldHead, MAX_FAST_FORWARD_SEARCH)
+
+    def syncBranch(self, branch):
+        """Bring the index up to date with branch.head. Returns False if we need more commit data first."""
+        if branch.head == branch.reachHead:
+            return True
+
+        if branch.reachHead and branch.head:
+            distance = self._firstParentDistance(branch.head, branch.reachHead)
+
+            if distance is False:
+                return False
+
+            if distance is not None:
+                branch.reachHeadPosition = branch.reachHeadPosition + distance
+                branch.reachHead = branch.head
+
+                self._offer(branch.head, branch, branch.reachHeadPosition, "")
+                self._propagate([branch.head])
+
+                return True
+
+        self._rebuildBranch(branch)
+
+        return True
+
+    def _rebuildBranch(self, branch):
+        cleared = list(self.database.Commit.lookupAll(reachBranch=branch))
+
+        for c in cleared:
+            c.reachBranch = self.database.Branch.Null
+            c.reachAnchor = 0
+            c.reachSuffix = ""
+
+        branch.reachHead = branch.head
+        branch.reachHeadPosition = 0
+
+        toCheck = []
+
+        if branch.head:
+            self._offer(branch.head, branch, 0, "")
+            toCheck.append(branch.head)
+
+        #anything we cleared that's reachable some other way gets picked up from its
+        #children, or from branches that point right at it.
+        for c in cleared:
+            for r in self.database.CommitRelationship.lookupAll(parent=c):
+                if r.child.reachBranch:
+                    toCheck.append(r.child)
+
+            for other in self.database.Branch.lookupAll(head=c):
+                if other.reachHead == c and self._offer(c, other, other.reachHeadPosition, ""):
+                    toCheck.append(c)
+
+        self._propagate(toCheck)
+
+    def commitDataAdded(self, commit):
+        """'commit' just learned its parents."""
+        self._propagate([commit])
+
+        for branch in self.database.Branch.lookupAll(reachStale=commit.repo):
+            self.syncBranch(branch)
@@ -0,0 +1,193 @@
+"""CommitGraph
+
+Generation numbers and compact parent lists for a repo's commits, along the lines
+of git's commit-graph file.
+
+A commit's generation is one more than the largest generation of its parents
+(root commits have generation 1), so a commit can only be an ancestor of commits
+with a strictly larger generation. That lets ancestry queries stop walking as soon
+as they're below the generation they're looking for. Generations are stored on
+Commit in the database and computed when UpdateCommitData ingests the commit. A
+generation of zero means we don't know it yet because some ancestor hasn't been
+ingested, and we don't prune on it.
+
+Parent lists never change once a commit has data, so a CommitGraph keeps them in
+memory as it sees them rather than reading them back out of the database on
+every walk. It only keeps the most recently used ones, so it doesn't grow with
+the size of every repo we've ever walked.
+"""
+
+import collections
+
+#how many commits a CommitGraph keeps parent lists for
+MAX_CACHED_COMMITS = 100000
+
+def computeGeneration(parents):
+    """The generation of a commit with 'parents', or 0 if any of them is unknown."""
+    generation = 0
+    for p in parents:
+        if not p.generation:
+            return 0
+        generation = max(generation, p.generation)
+    return generation + 1
+
+def assignGenerations(database, commit):
+    """'commit' just got its data. Assign its generation and those of any children that were waiting on it.
+
+    Returns the number of commits assigned.
+    """
+    assigned = 0
+    toCheck = collections.deque([commit])
+
+    while toCheck:
+        c = toCheck.popleft()
+
+        if c.generation or not c.data:
+            continue
+
+        c.generation = computeGeneration(c.data.parents)
+
+        if c.generation:
+            assigned += 1
+            for r in database.CommitRelationship.lookupAll(parent=c):
+                toCheck.append(r.child)
+
+    return assigned
+
+def backfillGenerations(database, heads):
+    """Assign generations to everything reachable from 'heads' that's missing one.
+
+    Databases from before we tracked generations need this. Returns the number of
+    commits assigned.
+    """
+    assigned = 0
+    seen = set()
+    stack = list(heads)
+
+    while stack:
+        c = stack.pop()
+
+        if c in seen or c.generation or not c.data:
+            continue
+        seen.add(c)
+
+        if computeGeneration(c.data.parents):
+            #this fills in the children we've already stepped over, too
+            assigned += assignGenerations(database, c)
+        else:
+            stack.extend(c.data.parents)
+
+    return assigned
+
+class CommitGraph(object):
+    def __init__(self, maxEntries=MAX_CACHED_COMMITS):
+        self.maxEntries = maxEntries
+
+        #commit -> (generation, tuple of parents) for commits whose data we've seen,
+        #least recently used first. we only cache known generations, since unknown
+        #ones can still change.
+        self._entries = collections.OrderedDict()
+
+    def _entry(self, commit):
+        entry = self._entries.pop(commit, None)
+        if entry is not None:
+            self._entries[commit] = entry
+            return entry
+
+        if not commit.data:
+            return None
+
+        entry = (commit.generation, tuple(commit.data.parents))
+
+        if commit.generation:
+            self._entries[commit] = entry
+            if len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def generationOf(self, commit):
+        entry = self._entry(commit)
+        return entry[0] if entry else 0
+
+    def parentsOf(self, commit):
+        """The parents of 'commit', or () if we don't have its data yet."""
+        entry = self._entry(commit)
+        return entry[1] if entry else ()
+
+    def isAncestor(self, ancestor, descendant):
+        """Is 'ancestor' reachable from 'descendant' through parents (or the same commit)."""
+        if ancestor == descendant:
+            return True
+
+        minGeneration = self.generationOf(ancestor)
+
+        if minGeneration and self.generationOf(descendant) and self.generationOf(descendant) <= minGeneration:
+            return False
+
+        seen = set([descendant])
+        frontier = collections.deque([descendant])
+
+        while frontier:
+            c = frontier.popleft()
+
+            for p in self.parentsOf(c):
+                if p == ancestor:
+                    return True
+
+                if p in seen:
+                    continue
+                seen.add(p)
+
+                #p's ancestors all have smaller generations than p
+                generation = self.generationOf(p)
+                if minGeneration and generation and generation <= minGeneration:
+                    continue
+
+                frontier.append(p)
+
+        return False
+
+    def commitsBelow(self, commit, N, restrictTo=None):
+        """Breadth-first search of up to N commits starting at (and including) 'commit'."""
+        commits = []
+        seen = set()
+        frontier = collections.deque([commit])
+
+        while frontier and len(commits) < N:
+            c = frontier.popleft()
+            if c not in seen and (not restrictTo or c in restrictTo):
+                seen.add(c)
+                commits.append(c)
+                frontier.extend(self.parentsOf(c))
+
+        return commits
+
+    def firstParentDistance(self, newCommit, oldCommit, maxDistance):
+        """How many first-parents back from 'newCommit' 'oldCommit' is.
+
+        Returns None if it isn't there (or is more than maxDistance back), or False if
+        we can't tell because we're missing commit data.
+        """
+        oldGeneration = self.generationOf(oldCommit)
+
+        c = newCommit
+        for distance in xrange(maxDistance+1):
+            if c == oldCommit:
+                return distance
+
+            generation = self.generationOf(c)
+            if oldGeneration and generation:
+                if generation <= oldGeneration:
+                    return None
+                if generation - oldGeneration > maxDistance - distance:
+                    #every step back loses at least one generation
+                    return None
+
+            parents = self.parentsOf(c)
+            if not parents:
+                return False if not c.data else None
+
+            c = parents[0]
+
+        return None
@@ -0,0 +1,79 @@
+"""DeadlineHeap
+
+A min-heap of (deadline, key) for finding the things that have timed out
+without looking at the ones that haven't.
+
+Deadlines move forward all the time (every heartbeat pushes one out), and we
+don't want to touch the heap for that. So the heap holds the deadline each key
+had when we last pushed it, and we ask 'deadlineFor(key)' for the current one
+when that entry comes due. If the deadline has moved out we push the key back
+at its new deadline, and if 'deadlineFor' returns None the key is gone and we
+drop it. Each key is in the heap at most once, so the work of a pop is
+proportional to what has actually come due.
+"""
+
+import heapq
+
+class DeadlineHeap(object):
+    def __init__(self, deadlineFor):
+        self.deadlineFor = deadlineFor
+
+        #heap of (deadline, key)
+        self._heap = []
+        #key -> the deadline of its entry in the heap
+        self._scheduled = {}
+
+        #entries we've looked at in popExpired, for seeing what cleanup costs
+        self.examined = 0
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def __contains__(self, key):
+        return key in self._scheduled
+
+    def add(self, key, deadline):
+        """Make sure we look at 'key' no later than 'deadline'."""
+        existing = self._scheduled.get(key)
+        if existing is not None and existing <= deadline:
+            return
+
+        #an existing later entry becomes stale and is skipped when it comes up
+        self._scheduled[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+
+    def discard(self, key):
+        self._scheduled.pop(key, None)
+
+    def nextDeadline(self):
+        """The earliest deadline in the heap, or None. May be earlier than the true next expiration."""
+        while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+        return self._heap[0][0] if self._heap else None
+
+    def popExpired(self, curTimestamp):
+        """Remove and return the keys whose current deadline is at or before 'curTimestamp'."""
+        expired = []
+
+        while self._heap and self._heap[0][0] <= curTimestamp:
+            deadline, key = heapq.heappop(self._heap)
+
+            if self._scheduled.get(key) != deadline:
+                continue
+
+            self.examined += 1
+            del self._scheduled[key]
+
+            current = self.deadlineFor(key)
+
+            if current is None:
+                continue
+
+            if current > curTimestamp:
+                self._scheduled[key] = current
+                heapq.heappush(self._heap, (current, key))
+            else:
+                expired.append(key)
+
+        return expired
@@ -0,0 +1,80 @@
+"""FairShare
+
+Stride scheduling across tenants, so that one repo (or branch) with a huge
+backlog can't starve everybody else.
+
+A tenant's 'pass' is the machine-seconds it has used divided by its weight.
+Whenever a machine asks for work we give it to the contending tenant with the
+lowest pass. Under contention each tenant's share of machine time converges to
+its share of the total weight.
+
+Usage counts the machine-seconds of finished runs plus, for runs still going,
+the larger of their elapsed and predicted durations. Charging predicted time
+up front means a tenant can't grab every idle machine in a burst just because
+none of its runs have finished yet.
+
+A tenant that stops contending for a while rejoins at the current global pass,
+so it can't bank credit while idle and then monopolize the cluster.
+"""
+
+DEFAULT_WEIGHT = 1.0
+
+#a tenant that hasn't contended for this long rejoins at the global pass
+IDLE_RESET_SECONDS = 600
+
+class StrideScheduler(object):
+    def __init__(self):
+        #tenant -> machine-seconds of finished runs
+        self.usage = {}
+
+        #runId -> (tenant, startTimestamp, predictedSeconds)
+        self.inFlight = {}
+
+        #tenant -> last time it contended for a machine
+        self.lastContended = {}
+
+        self.globalPass = 0.0
+
+    def _inFlightUsage(self, tenant, curTimestamp):
+        total = 0.0
+        for runTenant, start, predicted in self.inFlight.itervalues():
+            if runTenant == tenant:
+                total += max(curTimestamp - start, predicted)
+        return total
+
+    def passFor(self, tenant, weight, curTimestamp):
+        return (self.usage.get(tenant, 0.0) + self._inFlightUsage(tenant, curTimestamp)) / max(weight, 0.000001)
+
+    def choose(self, tenantWeights, curTimestamp):
+        """Pick the tenant to serve next from a dict of contending tenants to their weights."""
+        passes = {}
+
+        for tenant, weight in tenantWeights.iteritems():
+            passes[tenant] = self.passFor(tenant, weight, curTimestamp)
+
+            if curTimestamp - self.lastContended.get(tenant, curTimestamp - IDLE_RESET_SECONDS - 1) > IDLE_RESET_SECONDS:
+                if passes[tenant] < self.globalPass:
+                    self.usage[tenant] = self.usage.get(tenant, 0.0) + (self.globalPass - passes[tenant]) * weight
+                    passes[tenant] = self.globalPass
+
+            self.lastContended[tenant] = curTimestamp
+
+        chosen = min(passes, key=lambda t: (passes[t], t))
+
+        self.globalPass = max(self.globalPass, passes[chosen])
+
+        return chosen
+
+    def runStarted(self, runId, tenant, curTimestamp, predictedSeconds):
+        self.inFlight[runId] = (tenant, curTimestamp, predictedSeconds)
+
+    def runFinished(self, runId, tenant, machineSeconds):
+        """Charge 'tenant' for a run that finished or was canceled after 'machineSeconds'."""
+        self.inFlight.pop(runId, None)
+        self.usage[tenant] = self.usage.get(tenant, 0.0) + max(machineSeconds, 0.0)
+
+    def sharesOfUsage(self):
+        total = sum(self.usage.values())
+        if not total:
+            return {}
+        return dict((t, u / total) for t, u in self.usage.iteritems())
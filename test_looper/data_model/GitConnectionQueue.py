@@ -0,0 +1,189 @@
+"""GitConnectionQueue
+
+Hands out leases on connections to the git server to workers that need to pull
+source. Requests beyond the concurrency limit wait in a queue, ordered by
+priority and then by arrival, and we grant them as leases come back rather
+than making workers poll.
+
+Leases expire if a worker never releases them. The concurrency limit adapts
+to how long git operations take: while leases come back about as fast as
+they used to, we creep the limit up as long as there's a queue. Once they
+start taking much longer than the fastest we've seen, the git server is
+struggling, so we cut the limit back.
+"""
+
+import heapq
+
+#a lease nobody has released after this long is presumed dead
+LEASE_SECONDS = 1800
+
+#at most this many leases for the same test (or test hash) at once
+MAX_LEASES_PER_TEST = 2
+
+#weight of the newest sample in the smoothed git latency
+LATENCY_ALPHA = 0.2
+
+#cut the limit when smoothed latency is this many times the baseline
+LATENCY_TOLERANCE = 2.0
+
+#multiply the limit by this when we cut it
+DECREASE_FACTOR = 0.75
+
+#how fast the baseline latency drifts toward the smoothed latency, so it can recover
+BASELINE_DRIFT = 0.01
+
+class Lease(object):
+    def __init__(self, requestId, testOrDeployId, testHash, grantedAt):
+        self.requestId = requestId
+        self.testOrDeployId = testOrDeployId
+        self.testHash = testHash
+        self.grantedAt = grantedAt
+
+class Waiter(object):
+    def __init__(self, requestId, testOrDeployId, testHash, priority, queuedAt, onGranted):
+        self.requestId = requestId
+        self.testOrDeployId = testOrDeployId
+        self.testHash = testHash
+        self.priority = priority
+        self.queuedAt = queuedAt
+        self.onGranted = onGranted
+
+class GitConnectionQueue(object):
+    def __init__(self, initialLimit, minLimit, maxLimit):
+        self.limit = float(initialLimit)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+
+        #requestId -> Lease
+        self.leases = {}
+
+        #heap of (-priority, sequence, requestId)
+        self._heap = []
+        #requestId -> Waiter, for waiters still in the heap
+        self.waiters = {}
+        self._sequence = 0
+
+        self.latency = None
+        self.baselineLatency = None
+
+        self.stats = {
+            "granted": 0,
+            "queued": 0,
+            "expired": 0,
+            "abandoned": 0,
+            "wait_seconds_total": 0.0,
+            "max_wait_seconds": 0.0
+            }
+
+    def currentLimit(self):
+        return max(int(self.limit), self.minLimit)
+
+    def queueLength(self):
+        return len(self.waiters)
+
+    def _leasesFor(self, waiter):
+        return len([l for l in self.leases.itervalues()
+                    if l.testOrDeployId == waiter.testOrDeployId or l.testHash == waiter.testHash])
+
+    def request(self, requestId, testOrDeployId, testHash, priority, curTimestamp, onGranted):
+        """Ask for a lease. Returns a list of (requestId, onGranted) for every lease granted as a result.
+
+        Asking again with a requestId that already holds a lease grants it again, and asking
+        again while it's queued keeps its place in line.
+        """
+        if requestId in self.leases:
+            return [(requestId, onGranted)]
+
+        if requestId in self.waiters:
+            self.waiters[requestId].onGranted = onGranted
+            return []
+
+        self._sequence += 1
+        self.waiters[requestId] = Waiter(requestId, testOrDeployId, testHash, priority, curTimestamp, onGranted)
+        heapq.heappush(self._heap, (-priority, self._sequence, requestId))
+
+        granted = self._grant(curTimestamp)
+
+        if requestId in self.waiters:
+            self.stats["queued"] += 1
+
+        return granted
+
+    def release(self, requestId, curTimestamp):
+        """A worker is done with its lease. Returns the leases granted to waiters as a result."""
+        lease = self.leases.pop(requestId, None)
+
+        if lease is not None:
+            self._observeLatency(curTimestamp - lease.grantedAt)
+
+        return self._grant(curTimestamp)
+
+    def abandon(self, requestIds, curTimestamp):
+        """Drop leases and queued requests (e.g. for a worker that disconnected)."""
+        for requestId in requestIds:
+            self.leases.pop(requestId, None)
+            if self.waiters.pop(requestId, None) is not None:
+                self.stats["abandoned"] += 1
+
+        return self._grant(curTimestamp)
+
+    def expire(self, curTimestamp, isDead=lambda testOrDeployId: False):
+        """Drop leases that are too old or whose test is dead, and waiters whose test is dead."""
+        for requestId, lease in list(self.leases.iteritems()):
+            if curTimestamp - lease.grantedAt > LEASE_SECONDS or isDead(lease.testOrDeployId):
+                del self.leases[requestId]
+                self.stats["expired"] += 1
+
+        for requestId, waiter in list(self.waiters.iteritems()):
+            if isDead(waiter.testOrDeployId):
+                del self.waiters[requestId]
+                self.stats["abandoned"] += 1
+
+        return self._grant(curTimestamp)
+
+    def _observeLatency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+            self.baselineLatency = seconds
+            return
+
+        self.latency = self.latency + LATENCY_ALPHA * (seconds - self.latency)
+        self.baselineLatency = min(self.latency, self.baselineLatency + BASELINE_DRIFT * (self.latency - self.baselineLatency))
+
+        if self.latency > LATENCY_TOLERANCE * max(self.baselineLatency, 0.001):
+            self.limit = max(self.minLimit, self.limit * DECREASE_FACTOR)
+        elif self.waiters:
+            #additive increase: about one more connection per round of leases
+            self.limit = min(self.maxLimit, self.limit + 1.0 / self.limit)
+
+    def _grant(self, curTimestamp):
+        granted = []
+        skipped = []
+
+        while self._heap and len(self.leases) < self.currentLimit():
+            entry = heapq.heappop(self._heap)
+            waiter = self.waiters.get(entry[2])
+
+            if waiter is None:
+                #abandoned while it was queued
+                continue
+
+            if self._leasesFor(waiter) >= MAX_LEASES_PER_TEST:
+                skipped.append(entry)
+                continue
+
+            del self.waiters[waiter.requestId]
+
+            self.leases[waiter.requestId] = Lease(waiter.requestId, waiter.testOrDeployId, waiter.testHash, curTimestamp)
+
+            wait = curTimestamp - waiter.queuedAt
+            self.stats["granted"] += 1
+            self.stats["wait_seconds_total"] += wait
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+
+            granted.append((waiter.requestId, waiter.onGranted))
+
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+
+        return granted
@@ -0,0 +1,203 @@
+"""LiveLogStore
+
+Holds the live output of running tests within a fixed memory budget.
+
+Each test's log is a sequence of bytes addressed by offset. We keep the most
+recent bytes of each log in memory, and when a test goes over its own budget,
+or all tests together go over the global budget, we move the oldest bytes out
+to an append-only file on local disk. A log's file always holds a prefix of the
+log, so a byte's offset in the log is its position in the file, and readers can
+seek anywhere in the log without us keeping any other index.
+
+Disk is bounded too. When the spilled logs together go over their budget, we
+delete the biggest log's file, and that log then starts at the first byte we
+still hold. Offsets don't move, so writers and readers that are further along
+aren't affected.
+"""
+
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+#most bytes of any one test's log we keep in memory
+MAX_BYTES_PER_TEST = 1024 * 1024
+
+#most bytes of log we keep in memory across all tests
+MAX_BYTES_IN_MEMORY = 64 * 1024 * 1024
+
+#most bytes of log we keep on disk across all tests
+MAX_BYTES_ON_DISK = 4 * 1024 * 1024 * 1024
+
+#how much we read from disk at a time when replaying a log
+READ_CHUNK_SIZE = 1024 * 1024
+
+class _TestLog(object):
+    def __init__(self, path):
+        self.path = path
+        #(offset, bytes) for the tail of the log we hold in memory, oldest first
+        self.chunks = collections.deque()
+        self.memoryBytes = 0
+        #everything before this offset is on disk...
+        self.spilledBytes = 0
+        #...except what's before this one, which we've thrown away. The file starts here.
+        self.startOffset = 0
+        self.totalBytes = 0
+
+class LiveLogStore(object):
+    def __init__(self, spillDirectory=None, maxBytesPerTest=MAX_BYTES_PER_TEST, maxBytesInMemory=MAX_BYTES_IN_MEMORY, maxBytesOnDisk=MAX_BYTES_ON_DISK):
+        self.spillDirectory = spillDirectory
+        self._ownsSpillDirectory = spillDirectory is None
+        self.maxBytesPerTest = maxBytesPerTest
+        self.maxBytesInMemory = maxBytesInMemory
+        self.maxBytesOnDisk = maxBytesOnDisk
+
+        self.lock = threading.RLock()
+        self.logs = {}
+        self.memoryBytes = 0
+        #bytes in the spill files right now
+        self.spilledBytes = 0
+        #bytes we deleted from the spill files to stay within 'maxBytesOnDisk'
+        self.droppedBytes = 0
+
+    def _pathFor(self, testId):
+        if self.spillDirectory is None:
+            self.spillDirectory = tempfile.mkdtemp(prefix="test_looper_logs_")
+        elif not os.path.exists(self.spillDirectory):
+            os.makedirs(self.spillDirectory)
+
+        return os.path.join(self.spillDirectory, testId + ".log")
+
+    def size(self, testId):
+        with self.lock:
+            log = self.logs.get(testId)
+            return log.totalBytes if log else 0
+
+    def append(self, testId, data):
+        """Add 'data' to the end of a log. Returns the offset it landed at."""
+        with self.lock:
+            log = self.logs.get(testId)
+            if log is None:
+                log = self.logs[testId] = _TestLog(self._pathFor(testId))
+
+            offset = log.totalBytes
+
+            if data:
+                log.chunks.append((offset, data))
+                log.memoryBytes += len(data)
+                log.totalBytes += len(data)
+                self.memoryBytes += len(data)
+
+                if log.memoryBytes > self.maxBytesPerTest:
+                    self._spill(log, log.memoryBytes - self.maxBytesPerTest)
+
+                while self.memoryBytes > self.maxBytesInMemory:
+                    biggest = max(self.logs.itervalues(), key=lambda l: l.memoryBytes)
+                    self._spill(biggest, biggest.memoryBytes)
+
+            return offset
+
+    def _spill(self, log, byteCount):
+        """Move at least 'byteCount' of the oldest in-memory bytes of 'log' to disk."""
+        toWrite = []
+        written = 0
+
+        while log.chunks and written < byteCount:
+            _, data = log.chunks.popleft()
+            toWrite.append(data)
+            written += len(data)
+
+        if not toWrite:
+            return
+
+        with open(log.path, "ab") as f:
+            f.write("".join(toWrite))
+
+        log.memoryBytes -= written
+        log.spilledBytes += written
+        self.memoryBytes -= written
+        self.spilledBytes += written
+
+        while self.spilledBytes > self.maxBytesOnDisk:
+            self._dropSpilled(max(self.logs.itervalues(), key=lambda l: l.spilledBytes - l.startOffset))
+
+    def _dropSpilled(self, log):
+        """Delete the spilled part of 'log'. The log now starts where its in-memory bytes do."""
+        onDisk = log.spilledBytes - log.startOffset
+
+        try:
+            os.remove(log.path)
+        except OSError:
+            logging.warn("Failed to remove spilled log %s", log.path)
+
+        log.startOffset = log.spilledBytes
+        self.spilledBytes -= onDisk
+        self.droppedBytes += onDisk
+
+    def read(self, testId, offset, maxBytes):
+        """Up to 'maxBytes' of a log starting at 'offset'. Returns (data, nextOffset).
+
+        If we've thrown away the bytes at 'offset', we start at the first one we have.
+        """
+        with self.lock:
+            log = self.logs.get(testId)
+            if log is None:
+                return "", offset
+
+            offset = max(log.startOffset, min(offset, log.totalBytes))
+            pieces = []
+            remaining = maxBytes
+            pos = offset
+
+            if pos < log.spilledBytes:
+                with open(log.path, "rb") as f:
+                    f.seek(pos - log.startOffset)
+                    data = f.read(min(remaining, log.spilledBytes - pos))
+                pieces.append(data)
+                pos += len(data)
+                remaining -= len(data)
+
+            for chunkOffset, data in log.chunks:
+                if remaining <= 0:
+                    break
+                if chunkOffset + len(data) <= pos:
+                    continue
+                piece = data[pos - chunkOffset:pos - chunkOffset + remaining]
+                pieces.append(piece)
+                pos += len(piece)
+                remaining -= len(piece)
+
+            return "".join(pieces), pos
+
+    def readAll(self, testId, offset=0):
+        with self.lock:
+            return self.read(testId, offset, self.size(testId))[0]
+
+    def tail(self, testId, maxBytes):
+        with self.lock:
+            return self.read(testId, max(0, self.size(testId) - maxBytes), maxBytes)[0]
+
+    def discard(self, testId):
+        with self.lock:
+            log = self.logs.pop(testId, None)
+            if log is None:
+                return
+
+            self.memoryBytes -= log.memoryBytes
+            self.spilledBytes -= log.spilledBytes - log.startOffset
+
+            if os.path.exists(log.path):
+                try:
+                    os.remove(log.path)
+                except OSError:
+                    logging.warn("Failed to remove spilled log %s", log.path)
+
+    def close(self):
+        with self.lock:
+            for testId in list(self.logs):
+                self.discard(testId)
+
+            if self._ownsSpillDirectory and self.spillDirectory and os.path.exists(self.spillDirectory):
+                shutil.rmtree(self.spillDirectory, ignore_errors=True)
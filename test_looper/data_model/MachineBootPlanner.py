@@ -0,0 +1,199 @@
+"""MachineBootPlanner
+
+Decides which machines to boot (and which idle machines to shut down to make
+room) given the outstanding demand in each machine category and the cores,
+ram and worker limits in MachineManagement.
+
+Categories are considered in priority tiers, so that lower priority demand
+never takes capacity away from higher priority demand. Within a tier every
+category that fits gets one machine so nothing starves, and the remaining
+capacity is packed to maximize the predicted seconds of test work we start,
+breaking ties in favor of the cheaper plan. That's a bounded knapsack over
+several resources, which we solve with a depth-first branch-and-bound that
+gives up after a fixed number of nodes and keeps the best plan it found.
+"""
+
+#cap on the number of search nodes per priority tier
+MAX_SEARCH_NODES = 20000
+
+class CategoryDemand(object):
+    """'wanted' more machines of a given size for 'category'."""
+    def __init__(self, category, cores, ram_gb, wanted, priority, predictedDuration, hourlyCost):
+        self.category = category
+        self.cores = cores
+        self.ram_gb = ram_gb
+        self.wanted = wanted
+        self.priority = priority
+        self.predictedDuration = predictedDuration
+        self.hourlyCost = hourlyCost
+
+    def usage(self):
+        return (self.cores, self.ram_gb, 1)
+
+class Surplus(object):
+    """'count' idle machines in 'category' we could shut down if we need the room."""
+    def __init__(self, category, cores, ram_gb, count):
+        self.category = category
+        self.cores = cores
+        self.ram_gb = ram_gb
+        self.count = count
+
+    def usage(self):
+        return (self.cores, self.ram_gb, 1)
+
+class Capacity(object):
+    """How much more we can boot. None means unlimited."""
+    def __init__(self, cores=None, ram_gb=None, workers=None):
+        self.cores = cores
+        self.ram_gb = ram_gb
+        self.workers = workers
+
+    def asTuple(self):
+        return (self.cores, self.ram_gb, self.workers)
+
+class BootPlan(object):
+    def __init__(self, boots, shutdowns):
+        #lists of (category, count), in the order we should act on them
+        self.boots = boots
+        self.shutdowns = shutdowns
+
+    def bootCount(self):
+        return sum(count for _, count in self.boots)
+
+def _maxFit(usage, budget, limit):
+    n = limit
+    for u, b in zip(usage, budget):
+        if b is not None and u > 0:
+            n = min(n, b // u)
+    return max(n, 0)
+
+def _subtract(budget, usage, count):
+    return tuple(None if b is None else b - u * count for u, b in zip(usage, budget))
+
+def _add(budget, usage, count):
+    return _subtract(budget, usage, -count)
+
+def _upperBound(items, limits, start, budget):
+    """The most work we could start with items[start:], relaxing each resource to be fractional."""
+    bound = sum(items[i].predictedDuration * limits[i] for i in xrange(start, len(items)))
+
+    for dim in xrange(len(budget)):
+        if budget[dim] is None:
+            continue
+
+        remaining = budget[dim]
+        dimBound = 0.0
+
+        free = [i for i in xrange(start, len(items)) if items[i].usage()[dim] <= 0]
+        used = [i for i in xrange(start, len(items)) if items[i].usage()[dim] > 0]
+
+        for i in free:
+            dimBound += items[i].predictedDuration * limits[i]
+
+        used.sort(key=lambda i: -float(items[i].predictedDuration) / items[i].usage()[dim])
+
+        for i in used:
+            size = items[i].usage()[dim]
+            take = min(limits[i], float(remaining) / size)
+            dimBound += items[i].predictedDuration * take
+            remaining -= take * size
+            if remaining <= 0:
+                break
+
+        bound = min(bound, dimBound)
+
+    return bound
+
+def _solveTier(items, limits, budget, maxNodes):
+    """Choose counts[i] <= limits[i] fitting in 'budget' maximizing (work, -cost)."""
+    best = [None, [0] * len(items)]
+    counts = [0] * len(items)
+    nodes = [0]
+
+    def score():
+        return (
+            sum(items[i].predictedDuration * counts[i] for i in xrange(len(items))),
+            -sum(items[i].hourlyCost * counts[i] for i in xrange(len(items)))
+            )
+
+    def search(i, budget, work):
+        nodes[0] += 1
+
+        if i == len(items):
+            s = score()
+            if best[0] is None or s > best[0]:
+                best[0] = s
+                best[1] = list(counts)
+            return
+
+        if best[0] is not None and nodes[0] > maxNodes:
+            return
+
+        if best[0] is not None and work + _upperBound(items, limits, i, budget) < best[0][0]:
+            return
+
+        for n in reversed(xrange(_maxFit(items[i].usage(), budget, limits[i]) + 1)):
+            counts[i] = n
+            search(i + 1, _subtract(budget, items[i].usage(), n), work + n * items[i].predictedDuration)
+        counts[i] = 0
+
+    search(0, budget, 0.0)
+
+    return best[1]
+
+def planBoots(demands, surplus, capacity, maxSearchNodes=MAX_SEARCH_NODES):
+    """Decide what to boot for 'demands' (CategoryDemands) in 'capacity', shutting down 'surplus' if we have to."""
+    budget = capacity.asTuple()
+    for s in surplus:
+        budget = _add(budget, s.usage(), s.count)
+
+    boots = {}
+    order = []
+
+    def density(d):
+        return float(d.predictedDuration) / max(d.hourlyCost, 0.000001)
+
+    for priority in sorted(set(d.priority for d in demands), reverse=True):
+        tier = sorted(
+            [d for d in demands if d.priority == priority and d.wanted > 0],
+            key=lambda d: -density(d)
+            )
+
+        #everybody who fits gets one machine before we start packing
+        limits = []
+        for d in tier:
+            if _maxFit(d.usage(), budget, 1):
+                boots[d.category] = 1
+                order.append(d.category)
+                budget = _subtract(budget, d.usage(), 1)
+                limits.append(d.wanted - 1)
+            else:
+                limits.append(0)
+
+        counts = _solveTier(tier, limits, budget, maxSearchNodes)
+
+        for d, n in zip(tier, counts):
+            if n:
+                if d.category not in boots:
+                    boots[d.category] = 0
+                    order.append(d.category)
+                boots[d.category] += n
+                budget = _subtract(budget, d.usage(), n)
+
+    #we only need to shut machines down if the plan doesn't fit in what's free
+    overage = capacity.asTuple()
+    for category in order:
+        demand = [d for d in demands if d.category == category][0]
+        overage = _subtract(overage, demand.usage(), boots[category])
+
+    shutdowns = []
+
+    for s in sorted(surplus, key=lambda s: (-s.cores, -s.ram_gb)):
+        needed = 0
+        while needed < s.count and any(o is not None and o < 0 for o in overage):
+            needed += 1
+            overage = _add(overage, s.usage(), 1)
+        if needed:
+            shutdowns.append((s.category, needed))
+
+    return BootPlan([(c, boots[c]) for c in order], shutdowns)
@@ -0,0 +1,106 @@
+import time
+import test_looper.core.RankedWorklist as RankedWorklist
+
+#maximum number of queued priority-update tasks we'll fold into a single batch
+MAX_TASKS_PER_BATCH = 2000
+
+class PriorityBatch(object):
+    """Accumulates dirty commits and tests and recomputes each priority once.
+
+    Commit priorities flow from children to parents, so commits are processed
+    newest-first. Test priorities flow in two directions: 'calculatedPriority' flows
+    from a test to the builds it depends on, and the test's state (waiting on builds,
+    dependency failed, etc.) flows from builds to the tests that depend on them. We
+    handle this in two sweeps over the test dependency graph: first we settle
+    calculatedPriority walking from dependent tests down to their builds, and then
+    we recompute full test priorities walking from builds up to dependent tests.
+
+    Anything that gets dirtied after we've already processed it is 'deferred' and
+    rescheduled by the TestManager once the batch is finished.
+    """
+    def __init__(self, testManager, curTimestamp):
+        self.testManager = testManager
+        self.database = testManager.database
+        self.curTimestamp = curTimestamp
+
+        self._testDepths = {}
+        self._initialCalculatedPriority = {}
+
+        self.commits = RankedWorklist.RankedWorklist(testManager._commitTopologicalRank, descending=True)
+        self.calculatedPriorities = RankedWorklist.RankedWorklist(self.testDepth, descending=True)
+        self.tests = RankedWorklist.RankedWorklist(self.testDepth)
+
+        self.elapsed = 0.0
+
+    def testDepth(self, test):
+        """The length of the longest chain of builds underneath 'test'."""
+        if test not in self._testDepths:
+            #guard against cycles, which the resolver should already have rejected
+            self._testDepths[test] = 0
+
+            depth = 0
+            for dep in self.database.TestDependency.lookupAll(test=test):
+                depth = max(depth, self.testDepth(dep.dependsOn) + 1)
+
+            self._testDepths[test] = depth
+
+        return self._testDepths[test]
+
+    def markCommitDirty(self, commit):
+        self.commits.add(commit)
+
+    def markTestDirty(self, test):
+        if test not in self._initialCalculatedPriority:
+            self._initialCalculatedPriority[test] = test.calculatedPriority
+
+        if test not in self.tests.processed:
+            self.calculatedPriorities.add(test)
+
+        self.tests.add(test)
+
+    def deferredCommits(self):
+        return list(self.commits.deferred)
+
+    def deferredTests(self):
+        return list(self.tests.deferred)
+
+    def run(self):
+        t0 = time.time()
+
+        while True:
+            if len(self.commits):
+                self.testManager._updateCommitPriority(self.commits.pop())
+            elif len(self.calculatedPriorities):
+                self._settleCalculatedPriority(self.calculatedPriorities.pop())
+            elif len(self.tests):
+                self._updateTestPriority(self.tests.pop())
+            else:
+                break
+
+        self.elapsed = time.time() - t0
+
+    def _settleCalculatedPriority(self, test):
+        calculatedPriority = self.testManager._computeTestCalculatedPriority(test)
+
+        if calculatedPriority != test.calculatedPriority:
+            test.calculatedPriority = calculatedPriority
+
+            for dep in self.database.TestDependency.lookupAll(test=test):
+                self.markTestDirty(dep.dependsOn)
+
+    def _updateTestPriority(self, test):
+        self.testManager._updateTestPriority(test, self.curTimestamp)
+
+        #the first sweep may have changed calculatedPriority without the test's
+        #own update noticing, but tests depending on us care about it.
+        if test.calculatedPriority != self._initialCalculatedPriority[test]:
+            for dep in self.database.TestDependency.lookupAll(dependsOn=test):
+                self.markTestDirty(dep.test)
+
+    def stats(self):
+        return {
+            "commits_touched": len(self.commits.processed),
+            "tests_touched": len(self.tests.processed),
+            "deferred": len(self.commits.deferred) + len(self.tests.deferred),
+            "elapsed": self.elapsed
+            }
@@ -0,0 +1,137 @@
+"""RunnableTestIndex
+
+The tests that want a machine, grouped by machine category, priority, and
+fair-share tenant, and ordered within each group by rank (the critical path
+TestManager keeps on each test). Deciding what a machine runs next is then a
+look at the top of a few heaps, rather than scanning and scoring candidates.
+
+TestManager calls 'update' whenever it recomputes a test's priority. Like
+DeadlineHeap, we never search a heap to take anything out of it: each test
+remembers the slot of its live entry, and entries that don't match it, or that
+the database no longer agrees with (say, because a transaction rolled back),
+get dropped when they come up.
+
+A test stays with the tenant it had when it was last updated, even if its
+branch has moved since.
+"""
+
+import heapq
+
+class RunnableTestIndex(object):
+    def __init__(self, slotFor, isCurrent):
+        #slotFor(test) -> (category, priority, tenant, weight, rank), or None if it doesn't want to run
+        self.slotFor = slotFor
+        #isCurrent(test, slot) -> does the database still put 'test' in 'slot'
+        self.isCurrent = isCurrent
+
+        #(category, priority) -> tenant -> heap of (-rank, ct, test, slot)
+        self._heaps = {}
+        #test -> the slot of its live entry
+        self._slots = {}
+        #tenant -> its weight as of the last test we saw for it
+        self.weights = {}
+
+        self._entries = 0
+        self._ct = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, test):
+        return test in self._slots
+
+    def update(self, test):
+        slot = self.slotFor(test)
+
+        if slot == self._slots.get(test):
+            return
+
+        if slot is None:
+            #its entry is stale now
+            del self._slots[test]
+            return
+
+        category, priority, tenant, weight, rank = slot
+
+        self._slots[test] = slot
+        self.weights[tenant] = weight
+
+        #the counter breaks ties in insertion order so we never compare tests directly
+        self._ct += 1
+        heapq.heappush(
+            self._heaps.setdefault((category, priority), {}).setdefault(tenant, []),
+            (-rank, self._ct, test, slot)
+            )
+        self._entries += 1
+
+        if self._entries > 2 * len(self._slots) + 100:
+            self._compact()
+
+    def tenants(self, category, priority):
+        return list(self._heaps.get((category, priority), ()))
+
+    def best(self, category, priority, tenant, count, skip=()):
+        """Up to 'count' of the highest ranked tests for 'tenant' in 'category' and 'priority', best first.
+
+        Tests whose identities are in 'skip' are passed over but stay in the index.
+        """
+        group = self._heaps.get((category, priority))
+        heap = group.get(tenant) if group else None
+
+        if not heap:
+            return []
+
+        while heap and not self._isLive(heap[0]):
+            heapq.heappop(heap)
+            self._entries -= 1
+
+        if not heap:
+            del group[tenant]
+            if not group:
+                del self._heaps[(category, priority)]
+            return []
+
+        #walk the heap's tree best-first, without popping anything
+        tests = []
+        frontier = [(heap[0], 0)]
+
+        while frontier and len(tests) < count:
+            entry, ix = heapq.heappop(frontier)
+            test = entry[2]
+
+            if test._identity not in skip and test not in tests and self._isLive(entry):
+                tests.append(test)
+
+            for child in (2 * ix + 1, 2 * ix + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+        return tests
+
+    def _isLive(self, entry):
+        _, _, test, slot = entry
+
+        if self._slots.get(test) != slot:
+            return False
+
+        if not self.isCurrent(test, slot):
+            del self._slots[test]
+            return False
+
+        return True
+
+    def _compact(self):
+        """Drop every entry that isn't some test's live one."""
+        for key, group in list(self._heaps.items()):
+            for tenant, heap in list(group.items()):
+                live = [e for e in heap if self._slots.get(e[2]) == e[3]]
+                if live:
+                    heapq.heapify(live)
+                    group[tenant] = live
+                else:
+                    del group[tenant]
+
+            if not group:
+                del self._heaps[key]
+
+        self._entries = sum(len(heap) for group in self._heaps.values() for heap in group.values())
@@ -0,0 +1,167 @@
+"""RuntimePredictor
+
+Predicts how long a test will run from the durations of its past runs.
+
+We keep statistics under two keys: the test's hash, which identifies one exact
+test definition, and the test's name, which pools every version of the test
+across commits. A brand new test definition usually takes about as long as the
+previous version did, so we predict from the name until the hash has seen a few
+runs of its own.
+
+Each key keeps an exponentially weighted mean and variance (so the prediction
+follows a test that gets slower over time) plus its most recent durations, from
+which we read percentiles.
+"""
+
+import math
+
+#weight of the newest sample in the exponentially weighted statistics
+ALPHA = 0.2
+
+#how many recent durations we keep for percentiles
+WINDOW = 32
+
+#how many runs a test hash needs before we trust it over the test name
+MIN_SAMPLES_FOR_HASH = 3
+
+def hashKey(test):
+    return "hash:" + test.hash
+
+def nameKey(testName):
+    return "name:" + testName
+
+class Prediction(object):
+    def __init__(self, mean, stddev, p50, p90, samples, key):
+        self.mean = mean
+        self.stddev = stddev
+        self.p50 = p50
+        self.p90 = p90
+        self.samples = samples
+        self.key = key
+
+    def __repr__(self):
+        return "Prediction(mean=%.1f, stddev=%.1f, p50=%.1f, p90=%.1f, samples=%s, key=%s)" % (
+            self.mean, self.stddev, self.p50, self.p90, self.samples, self.key
+            )
+
+def percentile(values, p):
+    """The p'th percentile (0 <= p <= 1) of 'values', interpolating between samples."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+
+    pos = p * (len(values) - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(values) - 1)
+
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def updateStats(stats, duration):
+    """Fold 'duration' into 'stats', which has samples, mean, variance and recent."""
+    duration = float(duration)
+
+    if stats.samples == 0:
+        stats.mean = duration
+        stats.variance = 0.0
+    else:
+        delta = duration - stats.mean
+        stats.mean = stats.mean + ALPHA * delta
+        stats.variance = (1 - ALPHA) * (stats.variance + ALPHA * delta * delta)
+
+    stats.samples = stats.samples + 1
+    stats.recent = (list(stats.recent) + [duration])[-WINDOW:]
+
+def predictionFromStats(stats):
+    return Prediction(
+        mean=stats.mean,
+        stddev=math.sqrt(max(stats.variance, 0.0)),
+        p50=percentile(stats.recent, .5),
+        p90=percentile(stats.recent, .9),
+        samples=stats.samples,
+        key=stats.key
+        )
+
+def _statsFor(database, key):
+    stats = database.TestRuntimeStats.lookupAny(key=key)
+    if stats is None:
+        stats = database.TestRuntimeStats.New(key=key)
+    return stats
+
+def recordRun(database, test, duration):
+    """A run of 'test' finished after 'duration' seconds."""
+    if duration <= 0:
+        return
+
+    for key in (hashKey(test), nameKey(test.testDefinitionSummary.name)):
+        updateStats(_statsFor(database, key), duration)
+
+def predict(database, test):
+    """A Prediction for 'test', or None if we've never seen it (or anything with its name) run."""
+    stats = database.TestRuntimeStats.lookupAny(key=hashKey(test))
+
+    if stats is None or stats.samples < MIN_SAMPLES_FOR_HASH:
+        stats = database.TestRuntimeStats.lookupAny(key=nameKey(test.testDefinitionSummary.name)) or stats
+
+    if stats is None:
+        return None
+
+    return predictionFromStats(stats)
+
+class _OfflineStats(object):
+    def __init__(self, key):
+        self.key = key
+        self.samples = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.recent = []
+
+def evaluateDump(results):
+    """Replay the test runs in an ImportExport dump in order, predicting each before we learn it.
+
+    Dumps identify tests by name rather than by hash, so this measures the name-keyed
+    predictions. Returns a dict of error statistics.
+    """
+    runs = []
+
+    for repodef in results["repos"].values():
+        for commitdef in repodef["commits"].values():
+            for testname, testdef in commitdef["tests"].iteritems():
+                for run in testdef["runs"]:
+                    if not run["canceled"] and run["endTimestamp"] > 0.0 and run["startedTimestamp"] > 0.0:
+                        runs.append((run["endTimestamp"], testname, run["endTimestamp"] - run["startedTimestamp"]))
+
+    runs.sort()
+
+    stats = {}
+    errors = []
+    relativeErrors = []
+    underP90 = 0
+    unpredicted = 0
+
+    for _, testname, duration in runs:
+        key = nameKey(testname)
+
+        if key not in stats:
+            stats[key] = _OfflineStats(key)
+            unpredicted += 1
+        else:
+            prediction = predictionFromStats(stats[key])
+
+            errors.append(abs(prediction.mean - duration))
+            if duration > 0:
+                relativeErrors.append(abs(prediction.mean - duration) / duration)
+            if duration <= prediction.p90:
+                underP90 += 1
+
+        updateStats(stats[key], duration)
+
+    return {
+        "runs": len(runs),
+        "tests": len(stats),
+        "unpredicted": unpredicted,
+        "predicted": len(errors),
+        "mean_absolute_error": sum(errors) / len(errors) if errors else 0.0,
+        "median_absolute_error": percentile(errors, .5),
+        "median_relative_error": percentile(relativeErrors, .5),
+        "p90_coverage": float(underP90) / len(errors) if errors else 0.0
+        }
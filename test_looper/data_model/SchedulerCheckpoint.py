@@ -0,0 +1,112 @@
+"""SchedulerCheckpoint
+
+Records which version of the derived scheduler state each repo has, so that
+TestManager can skip the full scan of every commit and test on startup.
+
+The derived state itself lives in the object database and is written in the same
+transactions as the things it's derived from: test priorities and the
+per-category queues (the 'priority' and 'machineCategoryAndPrioritized' indices
+on Test), the set of commits with live tests (the 'hasLiveTests' index on Commit),
+branch reachability (Commit.reachBranch) and generation numbers (see CommitGraph).
+A checkpoint says which FORMAT_VERSION that state was computed under, and whether
+the last TestManager to write the database closed it cleanly. Bumping the version
+forces a full rescan on the next startup, which is also how older databases get
+the indices populated.
+
+Only a TestManager writes the database, and each one opens the checkpoint (marks
+it not closed) in its constructor, before it can write anything, and closes it
+with its last write when the server stops. So if the server crashed, or another
+TestManager is running against the same store or died without stopping, the
+next one to start finds the checkpoint open and does the full scan. (Running a
+version of the server from before checkpoints existed doesn't open them, so the
+first startup after rolling back and forward again needs them cleared by hand.)
+
+Test.activeRuns is the exception: it's only as good as the code that counts
+runs in and out, so TestManager still checks it when it restores.
+"""
+
+import logging
+
+#bump this whenever the rules for computing derived scheduler state change.
+#version 2 added Commit.liveTestCount, version 3 added branch reachability and
+#version 4 added Commit.generation, all of which the full rescan populates.
+FORMAT_VERSION = 4
+
+#how often (in seconds) we write checkpoints for repos that don't have a current one
+CHECKPOINT_INTERVAL = 300
+
+def writeCheckpoint(testManager, curTimestamp, close=False):
+    """Write the checkpoint of each active repo that's missing one or has an old format. Returns the number written.
+
+    If 'close', this is the TestManager's last write, so we write them all, and mark them closed.
+    """
+    database = testManager.database
+    written = 0
+
+    for repo in database.Repo.lookupAll(isActive=True):
+        checkpoint = database.SchedulerCheckpoint.lookupAny(repo=repo)
+
+        if checkpoint is None:
+            checkpoint = database.SchedulerCheckpoint.New(repo=repo)
+        elif checkpoint.formatVersion == FORMAT_VERSION and not close:
+            continue
+
+        checkpoint.timestamp = curTimestamp
+        checkpoint.formatVersion = FORMAT_VERSION
+        checkpoint.closedCleanly = close
+
+        written += 1
+
+    return written
+
+def openCheckpoint(testManager):
+    """Check whether the derived state in the database can be trusted, and mark the checkpoint open.
+
+    TestManager calls this before it writes anything, and gets back what loadCheckpoint said.
+    """
+    usable = loadCheckpoint(testManager)
+
+    for checkpoint in testManager.database.SchedulerCheckpoint.lookupAll(closedCleanly=True):
+        checkpoint.closedCleanly = False
+
+    return usable
+
+def loadCheckpoint(testManager):
+    """Check whether the derived state in the database can be trusted.
+
+    Returns False if any active repo lacks a current checkpoint, or one that was
+    closed cleanly, in which case the caller needs to do a full scan.
+    """
+    database = testManager.database
+
+    checkpoints = []
+
+    for repo in database.Repo.lookupAll(isActive=True):
+        checkpoint = database.SchedulerCheckpoint.lookupAny(repo=repo)
+
+        if checkpoint is None:
+            logging.info("No scheduler checkpoint for repo %s", repo.name)
+            return False
+
+        if checkpoint.formatVersion != FORMAT_VERSION:
+            logging.info("Scheduler checkpoint for repo %s has format version %s, not %s",
+                repo.name,
+                checkpoint.formatVersion,
+                FORMAT_VERSION
+                )
+            return False
+
+        if not checkpoint.closedCleanly:
+            logging.info("Scheduler checkpoint for repo %s wasn't closed cleanly. The database may have changed since.",
+                repo.name
+                )
+            return False
+
+        checkpoints.append(checkpoint)
+
+    if not checkpoints:
+        return False
+
+    logging.info("Using scheduler checkpoint for %s repos", len(checkpoints))
+
+    return True
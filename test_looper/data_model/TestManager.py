@@ -3,18 +3,31 @@ import logging
 import random
 import time
 import traceback
+import sys
 import simplejson
 import threading
 import fnmatch
+import hashlib
 import textwrap
-import re
 from test_looper.core.hash import sha_hash
 import test_looper.core.Bitstring as Bitstring
+import test_looper.core.Metrics as Metrics
 import test_looper.core.object_database as object_database
 import test_looper.core.algebraic as algebraic
 import test_looper.core.machine_management.MachineManagement as MachineManagement
 import test_looper.data_model.Types as Types
 import test_looper.data_model.BranchPinning as BranchPinning
+import test_looper.data_model.BranchReachability as BranchReachability
+import test_looper.data_model.CommitGraph as CommitGraph
+import test_looper.data_model.DeadlineHeap as DeadlineHeap
+import test_looper.data_model.FairShare as FairShare
+import test_looper.data_model.GitConnectionQueue as GitConnectionQueue
+import test_looper.data_model.LiveLogStore as LiveLogStore
+import test_looper.data_model.MachineBootPlanner as MachineBootPlanner
+import test_looper.data_model.PriorityPropagation as PriorityPropagation
+import test_looper.data_model.RunnableTestIndex as RunnableTestIndex
+import test_looper.data_model.RuntimePredictor as RuntimePredictor
+import test_looper.data_model.SchedulerCheckpoint as SchedulerCheckpoint
 import test_looper.data_model.TestDefinitionResolver as TestDefinitionResolver
 
 pendingVeryHigh = Types.BackgroundTaskStatus.PendingVeryHigh()
@@ -26,8 +39,11 @@ running = Types.BackgroundTaskStatus.Running()
 
 MAX_TEST_PRIORITY = 2
 TEST_TIMEOUT_SECONDS = 60
+#heartbeats live in memory and get written to the database when we run cleanup tasks,
+#which the server does about this often. After a restart we give workers this long
+#on top of the usual timeout to check back in, since the database is that stale.
+HEARTBEAT_FLUSH_INTERVAL = 30
 IDLE_TIME_BEFORE_SHUTDOWN = 180
-MAX_LOG_MESSAGES_PER_TEST = 100000
 MACHINE_TIMEOUT_SECONDS = 600
 MACHINE_TIMEOUT_SECONDS_FIRST_HEARTBEAT = 1200
 DISABLE_MACHINE_TERMINATION = False
@@ -35,7 +51,44 @@ DEAD_WORKER_PRUNE_INTERVAL = 600
 AMI_CHECK_INTERVAL = 30
 
 OLDEST_TIMESTAMP_WITH_TESTS = 1500000000
+#git connections we start out allowing. The limit adapts to git's latency between
+#MIN_GIT_CONNECTIONS and MAX_ADAPTIVE_GIT_CONNECTIONS
 MAX_GIT_CONNECTIONS = 4
+MIN_GIT_CONNECTIONS = 1
+MAX_ADAPTIVE_GIT_CONNECTIONS = 12
+DEFAULT_PREDICTED_TEST_DURATION = 600
+CRITICAL_PATH_SCHEDULING = True
+CACHE_LOCALITY_SCHEDULING = True
+#how far down a tenant's runnable tests we look for one whose inputs a machine has cached
+MAX_CACHE_LOCALITY_CANDIDATES = 20
+MAX_CACHE_LOCALITY_SKIPS = 3
+HEDGE_STRAGGLERS = True
+#a run is a straggler once it's taken this multiple of its predicted p90...
+STRAGGLER_P90_MULTIPLE = 2.0
+#...and at least this many seconds more than its predicted mean
+STRAGGLER_MIN_EXCESS_SECONDS = 300
+#we don't judge tests with fewer completed runs than this
+STRAGGLER_MIN_SAMPLES = 3
+#cap on the number of speculative duplicate runs at any one time
+MAX_HEDGED_RUNS = 2
+FAIR_SHARE_SCHEDULING = True
+PREFETCH_NEXT_TEST = True
+#reserve a machine's next test once its current one is this close to its predicted end
+PREFETCH_LEAD_SECONDS = 120
+#drop reservations the worker's connection hasn't asked about in this long
+RESERVATION_TIMEOUT_SECONDS = 60
+#how long we keep a finished test's live log for anyone still watching it. The worker
+#uploads the whole log with the test's artifacts.
+FINISHED_LOG_SECONDS = 300
+
+class Reservation:
+    """A test we told a worker it will probably run next, so it can fetch what the test needs early."""
+    def __init__(self, test, testDefinition, timestamp):
+        self.test = test
+        self.testDefinition = testDefinition
+        #the last time the worker's connection asked about it
+        self.confirmed = timestamp
+
 class MessageBuffer:
     def __init__(self, name):
         self.name = name
@@ -117,64 +170,90 @@ class DeploymentStream:
 
 
 class HeartbeatHandler(object):
-    def __init__(self):
+    def __init__(self, logStore=None):
         self.lock = threading.RLock()
-        self.logs = {}
+        self.logs = logStore or LiveLogStore.LiveLogStore()
         self.timestamps = {}
         self.listeners = {}
+        #testId -> when it finished, oldest first
+        self.finished = collections.OrderedDict()
         
     def getMostRecentTestHeartbeats(self, testId):
         with self.lock:
-            if testId in self.logs:
-                res = "".join(self.logs[testId])
-                if len(res) < 10 * 1024:
-                    return res
-                return res[-10*1024:]
-            return ""        
-        
+            return self.logs.tail(testId, 10 * 1024)
 
     def getAllLogsFor(self, testId):
         with self.lock:
-            if testId in self.logs:
-                return "".join(self.logs[testId])
-            return ""        
-        
-    def addListener(self, testId, listener):
+            return self.logs.readAll(testId)
+
+    def logSize(self, testId):
+        return self.logs.size(testId)
+
+    def addListener(self, testId, listener, offset=0, chunkSize=LiveLogStore.READ_CHUNK_SIZE):
+        """Send 'listener' the log from 'offset' onward, and then every new message as it arrives."""
         with self.lock:
             if testId not in self.listeners:
                 self.listeners[testId] = []
 
-            if testId in self.logs:
+            while offset < self.logs.size(testId):
+                data, offset = self.logs.read(testId, offset, chunkSize)
                 try:
-                    listener("".join(self.logs[testId]))
+                    listener(data)
                 except:
                     logging.error("Failed to write log message for testId %s to listener %s:\n%s", testId, listener, traceback.format_exc())
                     return
                 
-                self.listeners[testId].append(listener)
+            self.listeners[testId].append(listener)
+
+    def testFinished(self, testId, timestamp):
+        """The test's log isn't live anymore, so drop it once it's been finished for FINISHED_LOG_SECONDS."""
+        with self.lock:
+            self.finished.pop(testId, None)
+            self.finished[testId] = timestamp
 
-    def testFinished(self, testId):
-        #reset the logs since they're not live anymore.
-        #self.logs[testId] = []
-        pass
+            self._expireFinishedLogs(timestamp)
+
+    def _expireFinishedLogs(self, timestamp):
+        while self.finished:
+            testId, finishedAt = next(self.finished.iteritems())
+            if timestamp - finishedAt < FINISHED_LOG_SECONDS:
+                return
+
+            del self.finished[testId]
+            self.logs.discard(testId)
+            self.timestamps.pop(testId, None)
+            self.listeners.pop(testId, None)
         
     def testHeartbeatReinitialized(self, testId, timestamp, logMessagesFromStart):
+        self.testLogOutputAt(testId, timestamp, 0, logMessagesFromStart)
+
+    def testLogOutputAt(self, testId, timestamp, offset, logMessage):
+        """Record output that belongs at byte 'offset' of the test's log, skipping whatever we already have.
+
+        Returns how many bytes of the log we now hold. If that's less than 'offset', we've
+        lost output (say, because we restarted) and the worker needs to send it again.
+        """
         with self.lock:
-            message_len = sum([len(x) for x in self.logs.get(testId, [])])
-            self.testHeartbeat(testId, timestamp, logMessagesFromStart[message_len:])
+            size = self.logs.size(testId)
+
+            if offset <= size < offset + len(logMessage):
+                self.testHeartbeat(testId, timestamp, logMessage[size - offset:])
+            else:
+                self.testHeartbeat(testId, timestamp)
+
+            return self.logs.size(testId)
 
 
     def testHeartbeat(self, testId, timestamp, logMessage=None):
         """Record the log message, fire off socket connections, and return whether to log the heartbeat in the database."""
         with self.lock:
+            self._expireFinishedLogs(timestamp)
+
             if testId not in self.timestamps:
                 self.timestamps[testId] = timestamp
-                self.logs[testId] = []
 
             if logMessage is not None:
-                self.logs[testId].append(logMessage)
-                if len(self.logs[testId]) > MAX_LOG_MESSAGES_PER_TEST:
-                    self.logs[testId] = self.logs[testId][100:]
+                self.logs.append(testId, logMessage)
 
                 new_listeners = []
                 for l in self.listeners.get(testId, []):
@@ -192,15 +271,69 @@ class HeartbeatHandler(object):
             else:
                 return False
 
+class LivenessTable(object):
+    """The most recent heartbeat from each running test and each machine.
+
+    This is the authority on whether a test or machine has timed out. The database
+    copies in TestRun.lastHeartbeat and Machine.lastHeartbeat are only brought up to
+    date when we flush. Recording a heartbeat is a plain dict update, so it doesn't
+    need the TestManager's writelock.
+    """
+    def __init__(self):
+        #testRunId -> machineId, for runs we know are running
+        self.runningTests = {}
+        #testRunId -> last heartbeat
+        self.testHeartbeats = {}
+        #machineId -> last heartbeat
+        self.machineHeartbeats = {}
+
+        #heartbeats we haven't flushed yet
+        self._dirtyTests = {}
+        self._dirtyMachines = {}
+
+    def testRunStarted(self, testId, machineId, timestamp):
+        self.runningTests[testId] = machineId
+        self.testHeartbeats[testId] = timestamp
+
+    def testRunEnded(self, testId):
+        self.runningTests.pop(testId, None)
+        self.testHeartbeats.pop(testId, None)
+        self._dirtyTests.pop(testId, None)
+
+    def testHeartbeat(self, testId, timestamp):
+        """Returns False if we don't know the test to be running, in which case the caller should check the database."""
+        machineId = self.runningTests.get(testId)
+        if machineId is None:
+            return False
+
+        self.testHeartbeats[testId] = timestamp
+        self._dirtyTests[testId] = timestamp
+        self.machineHeartbeat(machineId, timestamp)
+        return True
+
+    def machineHeartbeat(self, machineId, timestamp, msg=None):
+        self.machineHeartbeats[machineId] = timestamp
+        self._dirtyMachines[machineId] = (timestamp, msg)
+
+    def lastTestHeartbeat(self, testRun):
+        return max(testRun.lastHeartbeat, self.testHeartbeats.get(testRun._identity, 0.0))
+
+    def lastMachineHeartbeat(self, machine):
+        return max(machine.lastHeartbeat, self.machineHeartbeats.get(machine.machineId, 0.0))
+
+    def drain(self):
+        """Returns ({testRunId: timestamp}, {machineId: (timestamp, msg)}) for everything since the last drain."""
+        tests, self._dirtyTests = self._dirtyTests, {}
+        machines, self._dirtyMachines = self._dirtyMachines, {}
 
-version_pattern = re.compile(".*([0-9-._]+).*")
+        #items() copies atomically even if a heartbeat lands in the old dict while we're here
+        return dict(tests.items()), dict(machines.items())
 
 class TestManager(object):
     def __init__(self, server_port_config, source_control, machine_management, kv_store, initialTimestamp=None):
-        self._repoCommitCalcCache = {}
-
         self.initialTimestamp = initialTimestamp or time.time()
         self.lastWorkerPruneOperation = self.initialTimestamp
+        self.lastSchedulerCheckpoint = self.initialTimestamp
         self.lastAmiCheckTimestamp = 0
 
         self.server_port_config = server_port_config
@@ -210,14 +343,143 @@ class TestManager(object):
         self.database = object_database.Database(kv_store)
         Types.setup_types(self.database)
 
-        self.writelock = threading.RLock()
+        self.metrics = Metrics.Registry()
+
+        self.writelock = Metrics.TimedLock(
+            threading.RLock(),
+            self.metrics.histogram("test_looper_writelock_wait_seconds", "Time spent waiting for the TestManager's writelock"),
+            self.metrics.histogram("test_looper_writelock_hold_seconds", "Time the TestManager's writelock was held")
+            )
 
         self.heartbeatHandler = HeartbeatHandler()
 
+        self.liveness = LivenessTable()
+
+        #("test", testRunId) and ("machine", machineId) by when they time out
+        self.timeouts = DeadlineHeap.DeadlineHeap(self._timeoutDeadline)
+        self._timeoutsPrimed = False
+
+        #the tests waiting for a machine, in the order we'd hand them out
+        self.runnableTests = RunnableTestIndex.RunnableTestIndex(self._runnableSlot, self._runnableSlotIsCurrent)
+
         self.deploymentStreams = {}
 
         self.commitTestCache_ = {}
 
+        #parent lists and generations of recently walked commits, across all repos
+        self.commitGraph = CommitGraph.CommitGraph()
+
+        #the PriorityBatch collecting priority updates, if we're currently propagating them
+        self._activePriorityBatch = None
+        self.priorityPropagationStats = {
+            "batches": 0,
+            "commits_touched": 0,
+            "tests_touched": 0,
+            "deferred": 0,
+            "elapsed": 0.0
+            }
+
+        #machineId -> (build hash -> bytes, set of docker image hashes) from the machine's last heartbeat
+        self.machineCaches = {}
+        #machineId -> how many tests and deployments the machine runs at once, for machines that told us
+        self.machineSlots = {}
+        #test hash -> how many times we've passed that test over for one with a local cache hit
+        self._cacheLocalitySkips = {}
+        self.cacheLocalityStats = {
+            "local_hits": 0,
+            "passed_over": 0,
+            "forced": 0,
+            "bytes_saved": 0
+            }
+
+        self.gitConnections = GitConnectionQueue.GitConnectionQueue(
+            MAX_GIT_CONNECTIONS,
+            MIN_GIT_CONNECTIONS,
+            MAX_ADAPTIVE_GIT_CONNECTIONS
+            )
+
+        #machine-seconds used by each repo (or branch), for fair-share scheduling. This only lives
+        #in memory, so every tenant starts even again when the server restarts.
+        self.fairShare = FairShare.StrideScheduler()
+
+        #testRunId -> testRunId of its speculative duplicate, in both directions
+        self._hedges = {}
+        #testRunIds that were stragglers at the last cleanup, oldest first
+        self._stragglers = []
+        self.hedgeStats = {
+            "launched": 0,
+            "hedge_won": 0,
+            "original_won": 0
+            }
+
+        #machine category identity -> OrderedDict of key -> onWorkAvailable, for idle worker connections
+        #waiting for something to run, oldest first
+        self._idleWorkers = {}
+        self._idleWorkersLock = threading.Lock()
+        #counts the times work became available. '_workStamps' has the count as of each category's latest.
+        self._workStamp = 0
+        self._workStamps = {}
+        self.idleWorkerStats = {
+            "parked": 0,
+            "woken": 0
+            }
+
+        #testRunId -> Reservation of the test its machine runs next
+        self.reservations = {}
+        self.reservationStats = {
+            "reserved": 0,
+            "taken": 0,
+            "revoked": 0
+            }
+
+        self._registerMetrics()
+
+        #before we write anything, see whether the last TestManager left us a checkpoint we can use
+        with self.transaction_and_lock():
+            self._checkpointUsable = SchedulerCheckpoint.openCheckpoint(self)
+            self._indexRunnableTests()
+
+    def _registerMetrics(self):
+        m = self.metrics
+
+        self._taskSeconds = m.histogram("test_looper_task_seconds", "Time spent processing background tasks, by task type")
+        self._taskWaitSeconds = m.histogram("test_looper_task_wait_seconds", "Time background tasks waited in the queue, by task type")
+        self._tasksProcessed = m.counter("test_looper_tasks_total", "Background tasks processed, by task type and outcome")
+        self._startNewTestSeconds = m.histogram("test_looper_start_new_test_seconds", "Latency of startNewTest, by whether it found work")
+
+        def queueDepths():
+            depths = {}
+            with self.database.view():
+                for status in [pendingVeryHigh, pendingHigh, pendingMedium, pendingLow, pendingVeryLow]:
+                    head = self.database.DataTask.lookupAny(status=status)
+                    depths[status._which] = head.prior_ct + 1 if head else 0
+            return Metrics.labeled("priority", depths)
+
+        m.gauge("test_looper_task_queue_depth", "Background tasks waiting, by priority", queueDepths)
+
+        m.gauge("test_looper_priority_propagation", "Priority propagation totals", lambda: Metrics.labeled("stat", self.priorityPropagationStats))
+        m.gauge("test_looper_cache_locality", "Cache-locality scheduling totals", lambda: Metrics.labeled("stat", self.cacheLocalityStats))
+        m.gauge("test_looper_hedges", "Straggler hedging totals", lambda: Metrics.labeled("stat", self.hedgeStats))
+        m.gauge("test_looper_reservations", "Next-test reservation totals", lambda: Metrics.labeled("stat", self.reservationStats))
+        m.gauge("test_looper_idle_workers", "Idle worker connections waiting for work", self.idleWorkerCount)
+        m.gauge("test_looper_idle_worker_wakeups", "Idle worker parking totals", lambda: Metrics.labeled("stat", self.idleWorkerStats))
+        m.gauge("test_looper_git_connections", "Git connection queue totals", lambda: Metrics.labeled("stat", self.gitConnections.stats))
+        m.gauge("test_looper_git_connection_limit", "Current limit on concurrent git connections", self.gitConnections.currentLimit)
+        m.gauge("test_looper_git_connection_queue_length", "Git connection requests waiting", self.gitConnections.queueLength)
+        m.gauge("test_looper_fair_share_usage", "Share of recent machine time used by each repo (or branch)", lambda: Metrics.labeled("tenant", self.fairShare.sharesOfUsage()))
+        m.gauge("test_looper_live_timeouts", "Test runs and machines we're watching for timeouts", lambda: len(self.timeouts))
+
+    def _taskDequeued(self, task):
+        """The type of a task we're about to run, for labeling, and how long it waited, if we know."""
+        return task.task._which, (time.time() - task.queuedAt if task.queuedAt else None)
+
+    def _taskProcessed(self, kind, waited, elapsed, succeeded):
+        """Record a finished task. Called outside the transaction that dequeued it, so it only counts once."""
+        if waited is not None:
+            self._taskWaitSeconds.observe(waited, task=kind)
+        self._taskSeconds.observe(elapsed, task=kind)
+        self._tasksProcessed.inc(task=kind, outcome="ok" if succeeded else "error")
+
     def allTestsForCommit(self, commit):
         if not commit.data:
             return []
@@ -239,102 +501,10 @@ class TestManager(object):
         return branch.branchname + name
 
     def bestCommitBranchAndName(self, commit):
-        if commit.repo in self._repoCommitCalcCache and \
-                commit in self._repoCommitCalcCache[commit.repo]:
-            return self._repoCommitCalcCache[commit.repo][commit]
-
-
-        branches = self.commitFindAllBranches(commit)
-
-        branches_by_name = {b.branchname: v for b,v in branches.items()}
-
-        if not branches:
+        if not commit.reachBranch:
             return None, str(commit.hash)[:10]
 
-        def masteryness(branchname):
-            fields = []
-
-            if branchname == "master":
-                fields.append(0)
-            elif branchname == "svn-master":
-                fields.append(1)
-            elif 'master' in branchname:
-                fields.append(2)
-            elif 'trunk' in branchname:
-                fields.append(3)
-
-            #look for a version number
-            match = version_pattern.match(branchname)
-            if not match:
-                #sort last
-                fields.append("XXX")
-            else:
-                version = match.groups()[0]
-                for char in ".-_":
-                    version = version.replace(char," ")
-                fields.append(version.split(" "))
-
-            #shortest
-            fields.append(len(branchname + branches_by_name[branchname]))
-
-            return tuple(fields)
-            
-        #pick the least feature-branchy name we can
-        best_branch = sorted(branches, key=lambda b: masteryness(b.branchname))[0]
-
-        if commit.repo not in self._repoCommitCalcCache:
-            self._repoCommitCalcCache[commit.repo] = {}
-        self._repoCommitCalcCache[commit.repo][commit] = (best_branch, branches[best_branch])
-
-        return best_branch, branches[best_branch]
-
-    def commitFindAllBranches(self, commit):
-        childCommits = {}
-
-        def children(c):
-            toCheck = {}
-            for r in self.database.CommitRelationship.lookupAll(parent=c):
-                child = r.child
-
-                ix = child.data.parents.index(c)
-
-                toCheck[child] = "^" + str(ix+1) if ix > 0 else "~"
-
-            return toCheck
-
-        def compress_pathback(path):
-            start = None
-            i = 0
-            while i <= len(path):
-                if i < len(path) and path[i] == "~":
-                    if start is None:
-                        start = i
-                    i += 1
-                else:
-                    if start is not None and i-start > 1:
-                        path = path[:start] + "~" + str(i - start) + path[i:]
-                        i = start+1
-                        start = None
-                    else:
-                        i += 1
-
-            return path
-
-        branches = {}
-
-        def check(c, path_back):
-            if c not in childCommits or len(path_back) < len(childCommits[c]):
-                childCommits[c] = path_back
-
-                for branch in self.database.Branch.lookupAll(head=c):
-                    branches[branch] = compress_pathback(path_back)
-
-                for child, to_add in children(c).items():
-                    check(child, to_add + path_back)
-
-        check(commit, "")
-
-        return branches
+        return commit.reachBranch, BranchReachability.BranchReachability(self.database, self.commitGraph).pathFor(commit)
 
     def streamForDeployment(self, deploymentId):
         with self.writelock:
@@ -364,22 +534,21 @@ class TestManager(object):
 
         assert direction in ("above", "below")
 
+        if direction == "below":
+            return self.commitGraph.commitsBelow(commit, N, restrictTo)[1:]
+
         commits = []
         seen = set()
-        frontier = [commit]
+        frontier = collections.deque([commit])
 
         while frontier and len(commits) < N:
-            c = frontier.pop(0)
+            c = frontier.popleft()
             if c not in seen and (not restrictTo or c in restrictTo):
                 seen.add(c)
                 commits.append(c)
-                if direction == "below":
-                    if c.data:
-                        frontier.extend(c.data.parents)
-                else:
-                    frontier.extend([
-                        r.child for r in self.database.CommitRelationship.lookupAll(parent=c)
-                        ])
+                frontier.extend([
+                    r.child for r in self.database.CommitRelationship.lookupAll(parent=c)
+                    ])
 
         return commits[1:]
 
@@ -484,6 +653,8 @@ class TestManager(object):
 
             cat.desired = cat.desired + 1
 
+            self._workAvailable(cat)
+
             self.streamForDeployment(deploymentId).addMessageFromDeployment(
                 time.asctime() + " TestLooper> Deployment for %s waiting for hardware.\n\r" % (test.hash + "/" + test.testDefinitionSummary.name)
                 )
@@ -558,17 +729,122 @@ class TestManager(object):
         if msg:
             logging.info("Machine %s heartbeating %s", machineId, msg)
 
+        self.liveness.machineHeartbeat(machineId, curTimestamp, msg)
+
+    def flushHeartbeats(self):
+        """Write the heartbeats recorded since the last flush to the database in one transaction."""
+        tests, machines = self.liveness.drain()
+
+        if not tests and not machines:
+            return
+
         with self.transaction_and_lock():
+            for testId, timestamp in tests.iteritems():
+                testRun = self.database.TestRun(testId)
+                if testRun.exists() and timestamp > testRun.lastHeartbeat:
+                    testRun.lastHeartbeat = timestamp
+
+            for machineId, (timestamp, msg) in machines.iteritems():
+                machine = self.database.Machine.lookupAny(machineId=machineId)
+                if machine is None:
+                    logging.warn("Hearbeat from unknown machine %s", machineId)
+                elif timestamp > machine.lastHeartbeat:
+                    self._machineHeartbeat(machine, timestamp, msg)
+
+    def machineCacheReported(self, machineId, cachedBuilds, cachedImages):
+        """Record the builds (hash -> bytes) and docker images (dockerfile hashes) a machine has locally."""
+        self.machineCaches[machineId] = (dict(cachedBuilds), set(cachedImages))
+
+    def machineSlotsReported(self, machineId, slots):
+        """Record that a machine runs up to 'slots' tests and deployments at once, one per connection."""
+        self.machineSlots[machineId] = max(1, slots)
+
+    def workStamp(self):
+        """Take this before looking for work, and pass it to waitForWork if there wasn't any."""
+        return self._workStamp
+
+    def waitForWork(self, machineId, key, onWorkAvailable, sinceStamp):
+        """Park an idle worker connection until there's a test or deployment its machine could run.
+
+        We call onWorkAvailable() once, from whatever thread made the work available, so it should
+        only schedule the connection to look. If work arrived since 'sinceStamp', we call it right away.
+        Returns False if we can't park the connection, in which case it should keep polling.
+        """
+        with self.database.view():
             machine = self.database.Machine.lookupAny(machineId=machineId)
-            if machine:
-                self._machineHeartbeat(machine, curTimestamp, msg)
-            else:
-                logging.warn("Hearbeat from unknown machine %s", machineId)
+            if not machine or not machine.isAlive:
+                return False
+
+            #a machine whose slots are full isn't waiting on new work, and shouldn't take wakeups from one that is
+            if not self._machineHasFreeSlot(machine):
+                return False
+
+            category = self.database.MachineCategory.lookupAny(hardware_and_os=(machine.hardware, machine.os))
+            if not category:
+                return False
+
+            categoryId = category._identity
+
+        with self._idleWorkersLock:
+            missedIt = self._workStamps.get(categoryId, 0) > sinceStamp
+            if not missedIt:
+                self._idleWorkers.setdefault(categoryId, collections.OrderedDict())[key] = onWorkAvailable
+                self.idleWorkerStats["parked"] += 1
+
+        if missedIt:
+            self._notifyIdleWorker(onWorkAvailable)
+
+        return True
+
+    def idleWorkerCount(self):
+        with self._idleWorkersLock:
+            return sum(len(waiters) for waiters in self._idleWorkers.values())
+
+    def stopWaitingForWork(self, key):
+        with self._idleWorkersLock:
+            for waiters in self._idleWorkers.values():
+                waiters.pop(key, None)
+
+    def _workAvailable(self, category):
+        """A test or deployment in 'category' can run, so wake one of the connections waiting for it."""
+        with self._idleWorkersLock:
+            self._workStamp += 1
+            self._workStamps[category._identity] = self._workStamp
+
+            waiters = self._idleWorkers.get(category._identity)
+            if not waiters:
+                return
+
+            _, onWorkAvailable = waiters.popitem(last=False)
+            self.idleWorkerStats["woken"] += 1
+
+        self._notifyIdleWorker(onWorkAvailable)
+
+    def _notifyIdleWorker(self, onWorkAvailable):
+        try:
+            onWorkAvailable()
+        except:
+            logging.error("Failed to wake an idle worker:\n%s", traceback.format_exc())
+
+    def _machineHasFreeSlot(self, machine):
+        slots = self.machineSlots.get(machine.machineId)
+
+        if slots is None:
+            #it runs one thing per connection, and its connection only asks when it's idle
+            return True
+
+        running = len(list(self.database.TestRun.lookupAll(runningOnMachine=machine))) + \
+            len(list(self.database.Deployment.lookupAll(runningOnMachine=machine)))
+
+        return running < slots
 
     def _machineHeartbeat(self, machine, curTimestamp, msg=None):
         if machine.firstHeartbeat == 0.0:
             machine.firstHeartbeat = curTimestamp
         machine.lastHeartbeat=curTimestamp
+        if machine.firstHeartbeat == curTimestamp:
+            #its timeout just got shorter, so its entry in the heap may be too late
+            self._watchTimeout(("machine", machine.machineId))
         if msg:
             machine.lastHeartbeatMsg = msg
             
@@ -649,11 +925,18 @@ class TestManager(object):
         if not canceled:
             if endTimestamp > 0.0:
                 test.totalRuns += 1
+                if startedTimestamp > 0.0:
+                    RuntimePredictor.recordRun(self.database, test, endTimestamp - startedTimestamp)
             else:
                 test.activeRuns += 1
+                self._updateTestLiveness(test)
 
         self._triggerTestPriorityUpdate(testRun.test)
 
+    def predictedTestRuntime(self, test):
+        """A RuntimePredictor.Prediction of how many seconds 'test' will take, or None if we can't say."""
+        return RuntimePredictor.predict(self.database, test)
+
     @staticmethod
     def configurationForTest(test):
         return test.testDefinitionSummary.configuration
@@ -726,10 +1009,14 @@ class TestManager(object):
                     assert False
 
             testRun.endTimestamp = curTimestamp
+
+            if testRun.startedTimestamp > 0.0:
+                RuntimePredictor.recordRun(self.database, testRun.test, curTimestamp - testRun.startedTimestamp)
             
             testRun.test.activeRuns = testRun.test.activeRuns - 1
             testRun.test.totalRuns = testRun.test.totalRuns + 1
             testRun.test.lastTestEndTimestamp = curTimestamp
+            self._updateTestLiveness(testRun.test)
 
             names = sorted(testSuccesses.keys())
             testRun.testNames = self._testNameSet(names)
@@ -742,7 +1029,11 @@ class TestManager(object):
             testRun.test.totalFailedTestCount = testRun.test.totalFailedTestCount + testRun.totalFailedTestCount
 
             testRun.success = success
-            self.heartbeatHandler.testFinished(testId)
+            self.heartbeatHandler.testFinished(testId, curTimestamp)
+
+            self._resolveHedge(testRun, curTimestamp)
+            self._chargeFairShare(testRun, curTimestamp)
+            self.liveness.testRunEnded(testRun._identity)
 
             if success:
                 testRun.test.successes = testRun.test.successes + 1
@@ -764,14 +1055,36 @@ class TestManager(object):
             return True
 
     def handleTestConnectionReinitialized(self, testId, timestamp, allLogs, allArtifacts):
-        self.heartbeatHandler.testHeartbeatReinitialized(testId, timestamp, allLogs)
+        return self.handleTestConnectionResumed(testId, timestamp, 0, allLogs, allArtifacts)[0]
+
+    def handleTestConnectionResumed(self, testId, timestamp, logOffset, logsSinceOffset, allArtifacts):
+        """A worker running 'testId' reconnected, and sent its log from 'logOffset' on.
+
+        Returns (whether the test should keep running, how many bytes of its log we hold).
+        """
+        logBytes = self.heartbeatHandler.testLogOutputAt(testId, timestamp, logOffset, logsSinceOffset)
         self.recordTestArtifactUploaded(testId, allArtifacts, timestamp, isCumulative=True)
-        return self.testHeartbeat(testId, timestamp)
+        return self._testRunHeartbeat(testId, timestamp), logBytes
+
+    def testLogOutputAt(self, testId, timestamp, offset, logMessage):
+        """Like testHeartbeat, for output tagged with its offset in the log.
+
+        Returns (whether the test should keep running, how many bytes of its log we hold).
+        """
+        logBytes = self.heartbeatHandler.testLogOutputAt(testId, timestamp, offset, logMessage)
+        return self._testRunHeartbeat(testId, timestamp), logBytes
 
     def testHeartbeat(self, testId, timestamp, logMessage = None):
-        if not self.heartbeatHandler.testHeartbeat(testId, timestamp, logMessage):
+        self.heartbeatHandler.testHeartbeat(testId, timestamp, logMessage)
+
+        return self._testRunHeartbeat(testId, timestamp)
+
+    def _testRunHeartbeat(self, testId, timestamp):
+        """Record that the test is still running. Returns whether it should be."""
+        if self.liveness.testHeartbeat(testId, timestamp):
             return True
 
+        #we don't know about this run, probably because we restarted, so check the database
         logging.debug('test %s heartbeating', testId)
 
         with self.transaction_and_lock():
@@ -780,7 +1093,7 @@ class TestManager(object):
             if not testRun.exists():
                 return False
 
-            if testRun.canceled:
+            if testRun.canceled or testRun.endTimestamp > 0.0:
                 return False
 
             if not testRun.machine.isAlive:
@@ -793,6 +1106,9 @@ class TestManager(object):
 
                 testRun.lastHeartbeat = timestamp
 
+                self.liveness.testRunStarted(testRun._identity, testRun.machine.machineId, timestamp)
+                self._watchTimeout(("test", testRun._identity))
+
                 return True
 
     def checkAllTestPriorities(self, curTimestamp, resetUnbootable):
@@ -803,13 +1119,90 @@ class TestManager(object):
         return c.data and c.data.timestamp > OLDEST_TIMESTAMP_WITH_TESTS        
 
     def _allCommitsWithPossibilityOfTests(self):
-        commits = set()
-        to_check = set()
+        return [c for c in self.database.Commit.lookupAll(hasLiveTests=True) if c.repo.isActive]
+
+    def _testIsLive(self, test):
+        """Is 'test' runnable, prioritized, or running. These are the tests the scheduler needs to look at."""
+        if test.activeRuns != 0 or test.priority.matches.HardwareComboUnbootable:
+            return True
+
+        return test.calculatedPriority > 0 and not (
+            test.priority.matches.NoMoreTests
+            or test.priority.matches.DependencyFailed
+            or test.priority.matches.UnresolvedDependencies
+            )
+
+    def _updateTestLiveness(self, test):
+        """Keep test.isLive and the liveTestCount of the commits containing 'test' up to date."""
+        isLive = self._testIsLive(test)
+
+        if isLive == test.isLive:
+            return
+
+        test.isLive = isLive
+
+        delta = 1 if isLive else -1
+
+        for dep in self.database.CommitTestDependency.lookupAll(test=test):
+            dep.commit.liveTestCount = dep.commit.liveTestCount + delta
+
+    def _rebuildCommitsWithLiveTests(self):
+        """Recompute test.isLive and commit.liveTestCount by walking the commit graph.
+
+        This is only needed to repair the index (or build it for a database that
+        predates it), so we only do it as part of the full priority check.
+        """
+        commits = set(self.database.Commit.lookupAll(hasLiveTests=True))
+        for repo in self.database.Repo.lookupAll(isActive=True):
+            commits.update(self._walkCommitsWithPossibilityOfTests(repo))
+
+        repaired = 0
+
+        for c in commits:
+            liveTests = set()
+
+            for dep in self.database.CommitTestDependency.lookupAll(commit=c):
+                test = dep.test
+                if test.isLive != self._testIsLive(test):
+                    test.isLive = not test.isLive
+                if test.isLive:
+                    liveTests.add(test)
+
+            if c.liveTestCount != len(liveTests):
+                c.liveTestCount = len(liveTests)
+                repaired += 1
+
+        if repaired:
+            logging.warn("Repaired the live test count of %s commits", repaired)
+
+    def _assignAllCommitGenerations(self):
+        """Fill in Commit.generation for commits ingested before we tracked it."""
+        assigned = 0
+
+        for repo in self.database.Repo.lookupAll(isActive=True):
+            assigned += CommitGraph.backfillGenerations(
+                self.database,
+                [b.head for b in self.database.Branch.lookupAll(repo=repo) if b.head]
+                )
+
+        if assigned:
+            logging.info("Assigned generation numbers to %s commits", assigned)
+
+    def _syncAllBranchReachability(self):
+        """Make sure every branch is in the reachability index, which older databases won't have."""
+        reachability = BranchReachability.BranchReachability(self.database, self.commitGraph)
 
         for repo in self.database.Repo.lookupAll(isActive=True):
             for branch in self.database.Branch.lookupAll(repo=repo):
-                if branch.head:
-                    to_check.add(branch.head)
+                reachability.syncBranch(branch)
+
+    def _walkCommitsWithPossibilityOfTests(self, repo):
+        commits = set()
+        to_check = set()
+
+        for branch in self.database.Branch.lookupAll(repo=repo):
+            if branch.head:
+                to_check.add(branch.head)
 
         while to_check:
             c = to_check.pop()
@@ -834,11 +1227,33 @@ class TestManager(object):
                         return True
         return False
 
+    def _repairActiveRunsIfCorrupt(self):
+        if self._checkActiveRunsLooksCorrupt():
+            logging.warn("Active runs looks corrupt. Rebuilding.")
+            commitsWithTests = self._allCommitsWithPossibilityOfTests()
+
+            tests = set()
+            for c in commitsWithTests:
+                for test in self.allTestsForCommit(c):
+                    test.activeRuns = 0
+                    tests.add(test)
+
+            for runningTest in self.database.TestRun.lookupAll(isRunning=True):
+                runningTest.test.activeRuns += 1
+                tests.add(runningTest.test)
+
+            for test in tests:
+                self._updateTestLiveness(test)
+
     def _checkAllTestPriorities(self, curTimestamp, resetUnbootable):
         logging.info("Checking all test priorities to ensure they are correct")
 
         total = 0
 
+        self._assignAllCommitGenerations()
+        self._rebuildCommitsWithLiveTests()
+        self._syncAllBranchReachability()
+
         if resetUnbootable:
             categories = set()
     
@@ -855,26 +1270,20 @@ class TestManager(object):
                     category.hardwareComboUnbootable = False
                     changed.add(category)
 
+            mispriorizited = []
             for c in commitsWithTests:
                 for test in self.allTestsForCommit(c):
                     if test.machineCategory in changed and test.priority.matches.HardwareComboUnbootable:
                         logging.info("Updating mispriorizited test %s", test)
-                        self._updateTestPriority(test, curTimestamp)
+                        mispriorizited.append(test)
 
+            self._propagatePriorities(curTimestamp, tests=mispriorizited)
 
-        if self._checkActiveRunsLooksCorrupt():
-            logging.warn("Active runs looks corrupt. Rebuilding.")
-            commitsWithTests = self._allCommitsWithPossibilityOfTests()
 
-            for c in commitsWithTests:
-                for test in self.allTestsForCommit(c):
-                    test.activeRuns = 0
+        self._repairActiveRunsIfCorrupt()
 
 
-            for runningTest in self.database.TestRun.lookupAll(isRunning=True):
-                runningTest.test.activeRuns += 1
-
-    
+        toCheck = []
         for priorityType in [
                 self.database.TestPriority.FirstBuild,
                 self.database.TestPriority.FirstTest,
@@ -883,16 +1292,24 @@ class TestManager(object):
             for priority in reversed(range(1,MAX_TEST_PRIORITY+1)):
                 for test in self.database.Test.lookupAll(priority=priorityType(priority)):
                     total += 1
-                    self._updateTestPriority(test, curTimestamp)
+                    toCheck.append(test)
+
+        self._propagatePriorities(curTimestamp, tests=toCheck)
 
         logging.info("Done checking all test priorities to ensure they are correct. Checked %s", total)
 
 
                     
-    def _lookupHighestPriorityTest(self, machine, curTimestamp):
-        t0 = time.time()
+    def _lookupHighestPriorityTest(self, machine, curTimestamp, skip=()):
+        """The test 'machine' should run next, ignoring tests whose identities are in 'skip'."""
+        category = self.database.MachineCategory.lookupAny(hardware_and_os=(machine.hardware, machine.os))
+        if not category:
+            return None
 
-        count = 0
+        cache = self.machineCaches.get(machine.machineId) if CACHE_LOCALITY_SCHEDULING else None
+
+        #with a cache we look a little past the best test for one the machine already has inputs for
+        count = MAX_CACHE_LOCALITY_CANDIDATES if cache else 1
 
         for priorityType in [
                 self.database.TestPriority.FirstBuild,
@@ -902,9 +1319,156 @@ class TestManager(object):
             for priorityLevel in reversed(range(1,MAX_TEST_PRIORITY+1)):
                 priority=priorityType(priorityLevel)
 
-                for test in self.database.Test.lookupAll(priority=priority):
-                    if self._machineCategoryPairForTest(test) == (machine.hardware, machine.os):
-                        return test
+                #tenant -> its best tests at this level, best first
+                candidates = {}
+                for tenant in self.runnableTests.tenants(category, priority):
+                    tests = self.runnableTests.best(category, priority, tenant, count, skip)
+                    if tests:
+                        candidates[tenant] = tests
+
+                if not candidates:
+                    continue
+
+                if FAIR_SHARE_SCHEDULING:
+                    tenant = self.fairShare.choose(
+                        dict((t, self.runnableTests.weights[t]) for t in candidates),
+                        curTimestamp
+                        )
+                else:
+                    tenant = max(candidates, key=lambda t: self._schedulingRank(candidates[t][0]))
+
+                tests = candidates[tenant]
+
+                if cache:
+                    return self._preferCachedCandidate(tests[0], tests, self._schedulingRank, cache)
+
+                return tests[0]
+
+    def _indexRunnableTests(self):
+        """Index every test that was already waiting to run when we started up."""
+        for priorityType in [
+                self.database.TestPriority.FirstBuild,
+                self.database.TestPriority.FirstTest,
+                self.database.TestPriority.WantsMoreTests
+                ]:
+            for priorityLevel in range(1,MAX_TEST_PRIORITY+1):
+                for test in self.database.Test.lookupAll(priority=priorityType(priorityLevel)):
+                    self.runnableTests.update(test)
+
+    def _schedulingRank(self, test):
+        """Among tests at the same priority, we run the ones with larger ranks first."""
+        #break ties in favor of whatever has the most waiting on it
+        return test.criticalPath if CRITICAL_PATH_SCHEDULING else 0.0
+
+    def _runnableSlot(self, test):
+        """Where 'test' goes in self.runnableTests, or None if it isn't waiting for a machine."""
+        if not self._testWantsToRun(test) or not test.machineCategory:
+            return None
+
+        if FAIR_SHARE_SCHEDULING:
+            tenant, weight = self._fairShareTenant(test)
+        else:
+            tenant, weight = "", FairShare.DEFAULT_WEIGHT
+
+        return (test.machineCategory, test.priority, tenant, weight, self._schedulingRank(test))
+
+    def _runnableSlotIsCurrent(self, test, slot):
+        category, priority, _, _, rank = slot
+
+        return (self._testWantsToRun(test) and test.machineCategory == category
+                and test.priority == priority and self._schedulingRank(test) == rank)
+
+    def _fairShareTenant(self, test):
+        """Returns (tenant, weight) for fair-share scheduling: the test's repo, or its branch if the repo asks for that."""
+        commitDep = self.database.CommitTestDependency.lookupAny(test=test)
+        if commitDep is None:
+            return "", FairShare.DEFAULT_WEIGHT
+
+        commit = commitDep.commit
+        repo = commit.repo
+        weight = repo.fairShareWeight or FairShare.DEFAULT_WEIGHT
+
+        if repo.fairShareByBranch:
+            branch = commit.reachBranch or commit.anyBranch
+            if branch:
+                return repo.name + "/" + branch.branchname, branch.fairShareWeight or weight
+
+        return repo.name, weight
+
+    def _chargeFairShare(self, testRun, curTimestamp):
+        if testRun.startedTimestamp > 0.0:
+            tenant, _ = self._fairShareTenant(testRun.test)
+            self.fairShare.runFinished(testRun._identity, tenant, curTimestamp - testRun.startedTimestamp)
+
+    def _cacheHitsForTest(self, test, cache):
+        """Returns (hits, bytes) for the builds and docker image of 'test' already cached on a machine."""
+        cachedBuilds, cachedImages = cache
+
+        hits = 0
+        bytes = 0
+
+        for dep in self.database.TestDependency.lookupAll(test=test):
+            if dep.dependsOn.hash in cachedBuilds:
+                hits += 1
+                bytes += cachedBuilds[dep.dependsOn.hash]
+
+        if cachedImages:
+            testDefinition = self.definitionForTest(test)
+            image = testDefinition.environment.image if testDefinition and testDefinition.environment.matches.Environment else None
+
+            if image is not None and image.matches.DockerfileInline:
+                if hashlib.md5(image.dockerfile_contents).hexdigest() in cachedImages:
+                    hits += 1
+
+        return hits, bytes
+
+    def _preferCachedCandidate(self, best, candidates, rank, cache):
+        """Pick a test whose inputs the machine already has over 'best', the test we'd otherwise run.
+
+        This is delay scheduling: 'best' only gets passed over MAX_CACHE_LOCALITY_SKIPS times
+        before we hand it to whoever asks next, so it can't starve.
+        """
+        choice = best
+        hits, bytes = self._cacheHitsForTest(best, cache)
+
+        if not hits:
+            if self._cacheLocalitySkips.get(best.hash, 0) >= MAX_CACHE_LOCALITY_SKIPS:
+                self.cacheLocalityStats["forced"] += 1
+            else:
+                local = []
+                for test in candidates:
+                    if test != best:
+                        testHits, testBytes = self._cacheHitsForTest(test, cache)
+                        if testHits:
+                            local.append((rank(test), testBytes, testHits, test))
+
+                if local:
+                    _, bytes, hits, choice = max(local, key=lambda l: l[:3])
+
+                    self._cacheLocalitySkips[best.hash] = self._cacheLocalitySkips.get(best.hash, 0) + 1
+                    self.cacheLocalityStats["passed_over"] += 1
+
+        if hits:
+            self.cacheLocalityStats["local_hits"] += 1
+            self.cacheLocalityStats["bytes_saved"] += bytes
+
+        self._cacheLocalitySkips.pop(choice.hash, None)
+
+        return choice
+
+    def _criticalPathLength(self, test):
+        """Predicted seconds from starting 'test' until everything we want that depends on it is done.
+
+        This builds on the critical paths already stored on the tests that depend on us.
+        """
+        downstream = 0.0
+        for dep in self.database.TestDependency.lookupAll(dependsOn=test):
+            if dep.test.calculatedPriority > 0:
+                downstream = max(downstream, dep.test.criticalPath)
+
+        prediction = self.predictedTestRuntime(test)
+
+        return (prediction.mean if prediction else DEFAULT_PREDICTED_TEST_DURATION) + downstream
 
     def startNewDeployment(self, machineId, timestamp):
         """Allocates a new test and returns (deploymentId, testDefinition) or (None,None) if no work."""
@@ -917,6 +1481,9 @@ class TestManager(object):
 
             self._machineHeartbeat(machine, timestamp)
 
+            if not self._machineHasFreeSlot(machine):
+                return None, None
+
             for deployment in self.database.Deployment.lookupAll(isAliveAndPending=True):
                 if self._machineCategoryForTest(deployment.test) == self._machineCategoryForPair(machine.hardware, machine.os):
                     deployment.machine = machine
@@ -932,82 +1499,79 @@ class TestManager(object):
 
             return None, None
 
-    def _cleanupGitRepoLocks(self):
-        cleaned = 0
-
-        for lock in self.database.AllocatedGitRepoLocks.lookupAll(alive=True):
-            if lock.testOrDeployId is None:
-                logging.info("Deleted an invalid GitRepoLock.")
-                lock.delete()
-                cleaned += 1
-            else:                
-                testRun = self.database.TestRun(lock.testOrDeployId)
-                if testRun.exists() and (testRun.canceled or testRun.endTimestamp > 0.0):
-                    logging.info("Deleted a GitRepoLock because test %s is dead.", lock.testOrDeployId)
-                    lock.delete()
-                    cleaned += 1
-                else:
-                    deployment = self.database.Deployment(lock.testOrDeployId)
-                    if deployment.exists() and not deployment.isAlive:
-                        logging.info("Deleted a GitRepoLock because deployment %s is dead", lock.testOrDeployId)
-                        lock.delete()
-                        cleaned += 1
-
-        if cleaned:
-            logging.info("Cleaned up %s git dead repo locks. %s remaining.", 
-                cleaned, 
-                len(self.database.AllocatedGitRepoLocks.lookupAll(alive=True))
-                )
+    def requestGitRepoLock(self, requestId, testOrDeployId, onGranted, curTimestamp):
+        """Queue a request for a connection to the git server.
 
-    def tryToAllocateGitRepoLock(self, requestId, testOrDeployId):
+        We call 'onGranted(requestId)' when the request gets its turn, which may be
+        before we return. Returns False if we don't know 'testOrDeployId', in which
+        case the request is refused.
+        """
         with self.transaction_and_lock():
-            self._cleanupGitRepoLocks()
+            if self.database.TestRun(testOrDeployId).exists():
+                test = self.database.TestRun(testOrDeployId).test
+                priority = test.calculatedPriority
+            elif self.database.Deployment(testOrDeployId).exists():
+                test = self.database.Deployment(testOrDeployId).test
+                #somebody is sitting at a terminal waiting for this
+                priority = sys.maxint
+            else:
+                return False
+
+            granted = self.gitConnections.request(requestId, testOrDeployId, test.hash, priority, curTimestamp, onGranted)
 
-            if self.database.AllocatedGitRepoLocks.lookupAny(requestUniqueId=requestId):
-                #lock already exists
+            if requestId not in self.gitConnections.leases:
                 logging.info(
-                    "Reiterating to %s that it has a git repo lock. There are still %s locks.",
+                    "Queued git repo request for test/deploy %s behind %s others. %s of %s connections in use.",
                     testOrDeployId,
-                    len(self.database.AllocatedGitRepoLocks.lookupAll(alive=True))
+                    self.gitConnections.queueLength() - 1,
+                    len(self.gitConnections.leases),
+                    self.gitConnections.currentLimit()
                     )
-                return True
 
-            if self.database.TestRun(testOrDeployId).exists():
-                testHash = self.database.TestRun(testOrDeployId).test.hash
-            elif self.database.Deployment(testOrDeployId).exists():
-                testHash = self.database.Deployment(testOrDeployId).test.hash
-            else:
-                return False
+        self._notifyGitRepoGrants(granted)
 
-            if len(self.database.AllocatedGitRepoLocks.lookupAll(alive=True)) > MAX_GIT_CONNECTIONS:
-                return False
-            if len(self.database.AllocatedGitRepoLocks.lookupAll(testOrDeployId=testOrDeployId)) > 1:
-                return False
-            if len(self.database.AllocatedGitRepoLocks.lookupAll(testHash=testHash)) > 1:
-                return False
+        return True
 
-            self.database.AllocatedGitRepoLocks.New(requestUniqueId=requestId,testOrDeployId=testOrDeployId, testHash=testHash)
+    def gitRepoLockReleased(self, requestId, curTimestamp):
+        with self.transaction_and_lock():
+            granted = self.gitConnections.release(requestId, curTimestamp)
 
-            logging.info(
-                "Allocating a git repo lock to test/deploy %s. There are now %s",
-                testOrDeployId,
-                len(self.database.AllocatedGitRepoLocks.lookupAll(alive=True))
-                )
-            return True
+        self._notifyGitRepoGrants(granted)
 
-    def gitRepoLockReleased(self, requestId):
+    def gitRepoSessionClosed(self, requestIds, curTimestamp):
+        """A worker disconnected, so drop any git connections it held or was waiting for."""
         with self.transaction_and_lock():
-            lock = self.database.AllocatedGitRepoLocks.lookupAny(requestUniqueId=requestId)
-            if lock:
-                testOrDeployId = lock.testOrDeployId
+            granted = self.gitConnections.abandon(requestIds, curTimestamp)
 
-                lock.delete()
+        self._notifyGitRepoGrants(granted)
 
-                logging.info(
-                    "Released a git repo lock to test/deploy %s. There are now %s",
-                    testOrDeployId,
-                    len(self.database.AllocatedGitRepoLocks.lookupAll(alive=True))
-                    )
+    def _expireGitRepoLocks(self, curTimestamp):
+        def isDead(testOrDeployId):
+            testRun = self.database.TestRun(testOrDeployId)
+            if testRun.exists():
+                return testRun.canceled or testRun.endTimestamp > 0.0
+
+            deployment = self.database.Deployment(testOrDeployId)
+            if deployment.exists():
+                return not deployment.isAlive
+
+            return True
+
+        return self.gitConnections.expire(curTimestamp, isDead)
+
+    def _notifyGitRepoGrants(self, granted):
+        for requestId, onGranted in granted:
+            logging.info(
+                "Granted git repo lock %s. %s of %s connections in use, %s waiting.",
+                requestId,
+                len(self.gitConnections.leases),
+                self.gitConnections.currentLimit(),
+                self.gitConnections.queueLength()
+                )
+            try:
+                onGranted(requestId)
+            except:
+                logging.error("Failed to notify worker of git repo lock %s:\n%s", requestId, traceback.format_exc())
 
     def isDeployment(self, deploymentId):
         with self.database.view():
@@ -1033,8 +1597,111 @@ class TestManager(object):
 
         return True
 
-    def startNewTest(self, machineId, timestamp):
-        """Allocates a new test and returns (testId, testDefinition) or (None,None) if no work."""
+    def reserveNextTest(self, testRunId, curTimestamp):
+        """Returns (testHash, testDefinition) of the test the machine running 'testRunId' should run next,
+        or (None, None) if we don't know yet.
+
+        Connections ask every so often while a test runs. Once the test nears its predicted end
+        we pick its successor, and keep it as long as it still wants to run.
+        """
+        if not PREFETCH_NEXT_TEST:
+            return None, None
+
+        #most asks are too early, or confirm a reservation we already made, and don't need the writelock
+        with self.database.view():
+            testRun = self.database.TestRun(testRunId)
+            reservation = self.reservations.get(testRunId)
+
+            if not testRun.exists() or testRun.canceled or testRun.endTimestamp > 0.0:
+                if reservation is None:
+                    return None, None
+            elif reservation is not None:
+                if (curTimestamp - reservation.confirmed <= RESERVATION_TIMEOUT_SECONDS and
+                        self._testWantsToRun(reservation.test)):
+                    reservation.confirmed = curTimestamp
+                    return reservation.test.hash, reservation.testDefinition
+            else:
+                prediction = self.predictedTestRuntime(testRun.test)
+                if prediction is None or curTimestamp - testRun.startedTimestamp < prediction.mean - PREFETCH_LEAD_SECONDS:
+                    return None, None
+
+        with self.transaction_and_lock():
+            self._expireReservations(curTimestamp)
+
+            testRun = self.database.TestRun(testRunId)
+
+            if not testRun.exists() or testRun.canceled or testRun.endTimestamp > 0.0:
+                self.reservations.pop(testRunId, None)
+                return None, None
+
+            reservation = self.reservations.get(testRunId)
+
+            if reservation is not None:
+                if self._testWantsToRun(reservation.test):
+                    reservation.confirmed = curTimestamp
+                    return reservation.test.hash, reservation.testDefinition
+
+                logging.info("Revoking the reservation of %s after testRun %s: it doesn't need to run anymore.",
+                    reservation.test.testDefinitionSummary.name, testRunId)
+                del self.reservations[testRunId]
+                self.reservationStats["revoked"] += 1
+                return None, None
+
+            prediction = self.predictedTestRuntime(testRun.test)
+            if prediction is None or curTimestamp - testRun.startedTimestamp < prediction.mean - PREFETCH_LEAD_SECONDS:
+                return None, None
+
+            #two machines shouldn't both get ready to run the same thing
+            reserved = set(r.test._identity for r in self.reservations.values())
+
+            test = self._lookupHighestPriorityTest(testRun.machine, curTimestamp, skip=reserved)
+            if test is None:
+                return None, None
+
+            reservation = self.reservations[testRunId] = Reservation(test, self.definitionForTest(test), curTimestamp)
+            self.reservationStats["reserved"] += 1
+
+            return test.hash, reservation.testDefinition
+
+    def _testWantsToRun(self, test):
+        return test.exists() and (
+            test.priority.matches.FirstBuild or test.priority.matches.FirstTest or test.priority.matches.WantsMoreTests
+            )
+
+    def _expireReservations(self, curTimestamp):
+        for testRunId, reservation in list(self.reservations.items()):
+            if curTimestamp - reservation.confirmed > RESERVATION_TIMEOUT_SECONDS:
+                del self.reservations[testRunId]
+
+    def _takeReservation(self, testRunId):
+        """The test reserved after 'testRunId', if it still wants to run."""
+        reservation = self.reservations.pop(testRunId, None)
+
+        if reservation is None:
+            return None
+
+        if not self._testWantsToRun(reservation.test):
+            self.reservationStats["revoked"] += 1
+            return None
+
+        self.reservationStats["taken"] += 1
+        return reservation.test
+
+    def startNewTest(self, machineId, timestamp, reservedAfter=None):
+        """Allocates a new test and returns (testId, testDefinition) or (None,None) if no work.
+
+        If 'reservedAfter' is the testRunId the machine just finished, we give it the test
+        we reserved for it then, if that still wants to run.
+        """
+        t0 = time.time()
+
+        result = self._startNewTest(machineId, timestamp, reservedAfter)
+
+        self._startNewTestSeconds.observe(time.time() - t0, outcome="assigned" if result[0] else "idle")
+
+        return result
+
+    def _startNewTest(self, machineId, timestamp, reservedAfter=None):
         with self.transaction_and_lock():
             machine = self.database.Machine.lookupAny(machineId=machineId)
 
@@ -1044,15 +1711,27 @@ class TestManager(object):
             self._machineHeartbeat(machine, timestamp)
 
         with self.transaction_and_lock():
+            if not self._machineHasFreeSlot(machine):
+                return None, None
+
             t0 = time.time()
-            test = self._lookupHighestPriorityTest(machine, timestamp)
+            test = self._takeReservation(reservedAfter) if reservedAfter is not None else None
+            if test is None:
+                test = self._lookupHighestPriorityTest(machine, timestamp)
             if time.time() - t0 > .25:
                 logging.warn("Took %s to get priority", time.time() - t0)
 
+            straggler = None
+
             if not test:
-                return None, None
+                #the machine would sit idle, so put it to work duplicating a straggler
+                straggler = self._findStragglerToHedge(machine, timestamp) if HEDGE_STRAGGLERS else None
+                if not straggler:
+                    return None, None
+                test = straggler.test
 
             test.activeRuns = test.activeRuns + 1
+            self._updateTestLiveness(test)
 
             machine = self.database.Machine.lookupOne(machineId=machineId)
 
@@ -1063,42 +1742,233 @@ class TestManager(object):
                 machine=machine
                 )
 
+            self.liveness.testRunStarted(runningTest._identity, machineId, timestamp)
+            self._watchTimeout(("test", runningTest._identity))
+
+            prediction = self.predictedTestRuntime(test)
+            self.fairShare.runStarted(
+                runningTest._identity,
+                self._fairShareTenant(test)[0],
+                timestamp,
+                prediction.mean if prediction else DEFAULT_PREDICTED_TEST_DURATION
+                )
+
+            if straggler:
+                logging.info("Hedging straggling testRun %s of %s (running for %s seconds) with %s on machine %s",
+                    straggler._identity,
+                    test.testDefinitionSummary.name,
+                    timestamp - straggler.startedTimestamp,
+                    runningTest._identity,
+                    machineId
+                    )
+                self._hedges[straggler._identity] = runningTest._identity
+                self._hedges[runningTest._identity] = straggler._identity
+                self.hedgeStats["launched"] += 1
+
             self._updateTestPriority(test, timestamp)
 
             return (runningTest._identity, self.definitionForTest(test))
 
+    def _isStraggler(self, testRun, curTimestamp):
+        prediction = self.predictedTestRuntime(testRun.test)
+
+        if prediction is None or prediction.samples < STRAGGLER_MIN_SAMPLES:
+            return False
+
+        elapsed = curTimestamp - testRun.startedTimestamp
+
+        return elapsed > max(prediction.p90 * STRAGGLER_P90_MULTIPLE, prediction.mean + STRAGGLER_MIN_EXCESS_SECONDS)
+
+    def _refreshStragglers(self, curTimestamp):
+        """Find the running TestRuns we could hedge. This looks at every one, so we only do it during cleanup."""
+        stragglers = []
+
+        if HEDGE_STRAGGLERS:
+            with self.database.view():
+                for testRun in self.database.TestRun.lookupAll(isRunning=True):
+                    #tests that want several runs at once aren't held up by any one of them
+                    if testRun.test.activeRuns == 1 and self._isStraggler(testRun, curTimestamp):
+                        stragglers.append((testRun.startedTimestamp, testRun._identity))
+
+        self._stragglers = [testRunId for _, testRunId in sorted(stragglers)]
+
+    def _findStragglerToHedge(self, machine, curTimestamp):
+        """The longest-overdue TestRun 'machine' could duplicate, or None.
+
+        Runs only get later, so the stragglers we found at the last cleanup are still stragglers.
+        """
+        if len(self._hedges) / 2 >= MAX_HEDGED_RUNS:
+            return None
+
+        for testRunId in self._stragglers:
+            testRun = self.database.TestRun(testRunId)
+
+            if not testRun.exists() or testRun.canceled or testRun.endTimestamp > 0.0:
+                continue
+
+            if testRunId in self._hedges or testRun.machine == machine or testRun.test.activeRuns != 1:
+                continue
+
+            if self._machineCategoryPairForTest(testRun.test) == (machine.hardware, machine.os):
+                return testRun
+
+        return None
+
+    def _resolveHedge(self, testRun, curTimestamp):
+        """'testRun' finished or died, so its duplicate (if it has one) is no longer a hedge.
+
+        If 'testRun' finished, we take its result and cancel the duplicate.
+        """
+        otherId = self._hedges.pop(testRun._identity, None)
+        if otherId is None:
+            return
+
+        self._hedges.pop(otherId, None)
+
+        if testRun.canceled:
+            return
+
+        other = self.database.TestRun(otherId)
+
+        if other.exists() and not other.canceled and other.endTimestamp <= 0.0:
+            if other.startedTimestamp < testRun.startedTimestamp:
+                self.hedgeStats["hedge_won"] += 1
+            else:
+                self.hedgeStats["original_won"] += 1
+
+            logging.info("TestRun %s finished first, so canceling its duplicate %s", testRun._identity, otherId)
+
+            self._cancelTestRun(other, curTimestamp)
+
     def performCleanupTasks(self, curTimestamp):
-        #check all tests to see if we've exceeded the timeout and the test is dead
+        self.flushHeartbeats()
+
+        self.expireTimeouts(curTimestamp)
+
         with self.transaction_and_lock():
-            for t in self.database.TestRun.lookupAll(isRunning=True):
-                if t.lastHeartbeat < curTimestamp - TEST_TIMEOUT_SECONDS and curTimestamp - self.initialTimestamp > TEST_TIMEOUT_SECONDS:
+            self._scheduleBootCheck()
+            self._shutdownMachinesIfNecessary(curTimestamp)
+            self._checkRetryTests(curTimestamp)
+            granted = self._expireGitRepoLocks(curTimestamp)
+
+        self._notifyGitRepoGrants(granted)
+
+        self._refreshStragglers(curTimestamp)
+
+        if curTimestamp - self.lastSchedulerCheckpoint > SchedulerCheckpoint.CHECKPOINT_INTERVAL:
+            self.checkpointSchedulerState(curTimestamp)
+
+    def nextTimeoutDeadline(self):
+        """When the next test or machine could time out, or None if nothing is being watched."""
+        if not self._timeoutsPrimed:
+            return 0.0
+        return self.timeouts.nextDeadline()
+
+    def expireTimeouts(self, curTimestamp):
+        """Cancel test runs and shut down machines whose heartbeats have stopped.
+
+        We only look at entries whose deadline has passed, so this is cheap to call
+        whenever nextTimeoutDeadline comes due.
+        """
+        with self.transaction_and_lock():
+            if not self._timeoutsPrimed:
+                self._primeTimeouts()
+
+            for kind, identity in self.timeouts.popExpired(curTimestamp):
+                if kind == "test":
+                    t = self.database.TestRun(identity)
+
+                    if not t.exists() or t.canceled or t.endTimestamp > 0.0:
+                        self.liveness.testRunEnded(identity)
+                        continue
+
                     logging.error("Canceling testRun %s because it has not had a heartbeat for a long time. Most recent logs:\n%s", 
-                        t._identity,
-                        self.heartbeatHandler.getMostRecentTestHeartbeats(t._identity)
+                        identity,
+                        self.heartbeatHandler.getMostRecentTestHeartbeats(identity)
                         )
                     
                     self._cancelTestRun(t, curTimestamp)
+                else:
+                    logging.info("Shutting down machine %s because it has not heartbeat in a long time", identity)
 
-            for m in self.database.Machine.lookupAll(isAlive=True):
-                heartbeat = max(m.lastHeartbeat, m.bootTime)
+                    self._terminateMachine(self.database.Machine.lookupOne(machineId=identity), curTimestamp)
 
-                if m.lastHeartbeat == 0:
-                    timeout = MACHINE_TIMEOUT_SECONDS_FIRST_HEARTBEAT
-                else:
-                    timeout = MACHINE_TIMEOUT_SECONDS
+    def _primeTimeouts(self):
+        """Start watching everything that was already running when we started up."""
+        self._timeoutsPrimed = True
 
-                if heartbeat < curTimestamp - timeout and \
-                        curTimestamp - self.initialTimestamp > MACHINE_TIMEOUT_SECONDS:
-                    logging.info("Shutting down machine %s because it has not heartbeat in a long time",
-                        m.machineId
-                        )
-                    self._terminateMachine(m, curTimestamp)
+        for t in self.database.TestRun.lookupAll(isRunning=True):
+            if t._identity not in self.liveness.runningTests:
+                self.liveness.testRunStarted(t._identity, t.machine.machineId, t.lastHeartbeat)
+            self._watchTimeout(("test", t._identity))
+
+        for m in self.database.Machine.lookupAll(isAlive=True):
+            self._watchTimeout(("machine", m.machineId))
+
+    def _watchTimeout(self, key):
+        deadline = self._timeoutDeadline(key)
+        if deadline is not None:
+            self.timeouts.add(key, deadline)
+
+    def _timeoutDeadline(self, key):
+        """When 'key' times out given its latest heartbeat, or None if it's no longer running.
+
+        Nothing times out until we've been up long enough to have heard from it.
+        """
+        kind, identity = key
+
+        if kind == "test":
+            heartbeat = self.liveness.testHeartbeats.get(identity)
+            if heartbeat is None:
+                return None
+
+            return max(heartbeat + TEST_TIMEOUT_SECONDS,
+                self.initialTimestamp + TEST_TIMEOUT_SECONDS + HEARTBEAT_FLUSH_INTERVAL
+                )
+
+        machine = self.database.Machine.lookupAny(machineId=identity)
+        if machine is None or not machine.isAlive:
+            return None
+
+        lastHeartbeat = self.liveness.lastMachineHeartbeat(machine)
+
+        if lastHeartbeat == 0:
+            timeout = MACHINE_TIMEOUT_SECONDS_FIRST_HEARTBEAT
+        else:
+            timeout = MACHINE_TIMEOUT_SECONDS
+
+        return max(max(lastHeartbeat, machine.bootTime) + timeout,
+            self.initialTimestamp + MACHINE_TIMEOUT_SECONDS
+            )
 
+    def checkpointSchedulerState(self, curTimestamp, close=False):
+        """Record that every active repo's derived scheduler state is current.
+
+        Pass 'close' when we're stopping and won't write again, so the next TestManager can trust it.
+        """
         with self.transaction_and_lock():
-            self._scheduleBootCheck()
-            self._shutdownMachinesIfNecessary(curTimestamp)
-            self._checkRetryTests(curTimestamp)
-            
+            self.lastSchedulerCheckpoint = curTimestamp
+
+            written = SchedulerCheckpoint.writeCheckpoint(self, curTimestamp, close)
+
+            if written:
+                logging.info("Wrote scheduler checkpoint for %s repos", written)
+
+    def restoreSchedulerState(self, curTimestamp):
+        """Load derived scheduler state from the checkpoint.
+
+        Returns False if there was no usable checkpoint when we started, in which case
+        the caller should fall back to checkAllTestPriorities and touchAllTestsAndRuns.
+        """
+        if not self._checkpointUsable:
+            return False
+
+        with self.transaction_and_lock():
+            #we skip the full priority check, but not its repair of activeRuns
+            self._repairActiveRunsIfCorrupt()
+
+            return True
+
     def _checkRetryTests(self, curTimestamp):
         for test in self.database.Test.lookupAll(waiting_to_retry=True):
             self._triggerTestPriorityUpdate(test)
@@ -1119,9 +1989,13 @@ class TestManager(object):
             return
 
         testRun.canceled = True
+        self._resolveHedge(testRun, curTimestamp)
+        self._chargeFairShare(testRun, curTimestamp)
+        self.liveness.testRunEnded(testRun._identity)
 
         testRun.test.activeRuns = testRun.test.activeRuns - 1
-        self.heartbeatHandler.testFinished(testRun.test._identity)
+        self._updateTestLiveness(testRun.test)
+        self.heartbeatHandler.testFinished(testRun._identity, curTimestamp)
 
 
         if testRun.machine:
@@ -1140,7 +2014,7 @@ class TestManager(object):
                         self.database.DataTask.lookupAll(status=pendingHigh) +
                         self.database.DataTask.lookupAll(status=pendingMedium) +
                     self.database.DataTask.lookupAll(status=pendingLow)):
-            count += task.prior_ct
+            count += task.prior_ct + 1
         return count
 
     def performBackgroundWorkSynchronously(self, curTimestamp, count):
@@ -1167,14 +2041,20 @@ class TestManager(object):
                 testDef = task.task
                 task.status = running
 
+                kind, waited = self._taskDequeued(task)
+                t0 = time.time()
+                succeeded = False
+
                 try:
                     self._processTask(task.task, curTimestamp)
+                    succeeded = True
                 except KeyboardInterrupt:
                     raise
                 except:
                     traceback.print_exc()
                     logging.error("Exception processing task %s:\n\n%s", task.task, traceback.format_exc())
                 finally:
+                    self._taskProcessed(kind, waited, time.time() - t0, succeeded)
                     if task.prior:
                         task.prior.isHead = True
                     task.delete()
@@ -1231,20 +2111,31 @@ class TestManager(object):
                 
             task.status = running
 
+            #the next task is the head from now on, so anything queued while we work goes on top of it
+            if task.prior:
+                task.prior.isHead = True
+            task.isHead = False
+            task.prior = self.database.DataTask.Null
+
             testDef = task.task
 
+            kind, waited = self._taskDequeued(task)
+
+        t0 = time.time()
+        succeeded = False
+
         try:
             with self.transaction_and_lock() as curLock:
                 self._processTask(testDef, curTimestamp, curLock)
+            succeeded = True
         except KeyboardInterrupt:
             raise
         except:
             traceback.print_exc()
             logging.error("Exception processing task %s:\n\n%s", testDef, traceback.format_exc())
         finally:
+            self._taskProcessed(kind, waited, time.time() - t0, succeeded)
             with self.transaction_and_lock():
-                if task.prior:
-                    task.prior.isHead=True
                 task.delete()
 
         return testDef
@@ -1256,6 +2147,9 @@ class TestManager(object):
             return
 
         machine.isAlive = False
+        self.machineCaches.pop(machineId, None)
+        self.machineSlots.pop(machineId, None)
+
         mc = self._machineCategoryForPair(machine.hardware, machine.os)
         
         mc.booted = mc.booted - 1
@@ -1324,13 +2218,13 @@ class TestManager(object):
             self._updateCommitData(task.commit)
 
         elif task.matches.UpdateTestPriority:
-            self._updateTestPriority(task.test, curTimestamp)
+            self._propagatePriorities(curTimestamp, tests=[task.test])
         elif task.matches.BootMachineCheck:
             self._bootMachinesIfNecessary(curTimestamp, curLock)
         elif task.matches.CheckBranchAutocreate:
             self._checkBranchAutocreate(task.branch, curTimestamp)
         elif task.matches.UpdateCommitPriority:
-            self._updateCommitPriority(task.commit)
+            self._propagatePriorities(curTimestamp, commits=[task.commit])
         else:
             raise Exception("Unknown task: %s" % task)
 
@@ -1444,7 +2338,6 @@ class TestManager(object):
         if template.deleteOnUnderlyingRemoval:
             newbranch.autocreateTrackingBranchName = branch.branchname
 
-        self._repoTouched(newbranch.repo)
         self._scheduleUpdateBranchTopCommit(newbranch)
 
         return "Successfully pushed %s to new branch %s" % (newHash, new_name)
@@ -1522,7 +2415,6 @@ class TestManager(object):
 
         for newname in branchnames_set - set([x.branchname for x in db_branches]):
             newbranch = self.database.Branch.New(branchname=newname, repo=db_repo)
-            self._repoTouched(db_repo)
 
             self._queueTask(
                 self.database.DataTask.New(
@@ -1616,8 +2508,6 @@ class TestManager(object):
 
         parents=[self._lookupCommitByHash(commit.repo, p) for p in parentHashes]
 
-        self._repoTouched(repo)
-
         commit.data = self.database.CommitData.New(
             commit=commit,
             subject=subject,
@@ -1636,6 +2526,10 @@ class TestManager(object):
 
         for p in parents:
             self.database.CommitRelationship.New(child=commit,parent=p)
+
+        CommitGraph.assignGenerations(self.database, commit)
+
+        BranchReachability.BranchReachability(self.database, self.commitGraph).commitDataAdded(commit)
         
         #when we get new commits, make sure we have the right priority
         #on them. This is a one-time operation when the commit is first created
@@ -1809,6 +2703,8 @@ class TestManager(object):
             self._setBranchHead(branch, self.database.Commit.Null)
             self._triggerCommitPriorityUpdate(old_branch_head)
 
+            BranchReachability.BranchReachability(self.database, self.commitGraph).syncBranch(branch)
+
         for trackingBranch in self.database.Branch.lookupAll(autocreateTrackingBranchName=branch.branchname):
             logging.info("Deleting test-tracking branch %s because %s was deleted." % (trackingBranch.branchname, branch.branchname))
             try:
@@ -1829,11 +2725,6 @@ class TestManager(object):
         if branch:
             branch.head = newHead
 
-            self._repoTouched(branch.repo)
-
-    def _repoTouched(self, repo):
-        if repo in self._repoCommitCalcCache:
-            del self._repoCommitCalcCache[repo]
 
     def _updateBranchTopCommit(self, branch):
         repo = self.source_control.getRepo(branch.repo.name)
@@ -1859,6 +2750,8 @@ class TestManager(object):
         if not branch.head.data:
             self._updateCommitData(branch.head)
 
+        BranchReachability.BranchReachability(self.database, self.commitGraph).syncBranch(branch)
+
         needingAnyBranchSet = set()
         if branch.head:
             needingAnyBranchSet.add(branch.head)
@@ -1873,6 +2766,14 @@ class TestManager(object):
                         needingAnyBranchSet.add(p)
 
 
+    def _commitTopologicalRank(self, commit):
+        """A number that's larger for children than for their parents.
+
+        Commits whose generation we don't know yet rank above everything, since
+        they can only be children of commits we do know.
+        """
+        return commit.generation or sys.maxint
+
     def _computeCommitPriority(self, commit):
         if commit.anyBranch:
             return commit.userPriority
@@ -1995,47 +2896,119 @@ class TestManager(object):
             self.lastAmiCheckTimestamp = curTimestamp
             self.machine_management.amiCollectionCheck()
 
-        def check():
-            wantingBoot = self.database.MachineCategory.lookupAll(want_more=True)
-            wantingShutdown = self.database.MachineCategory.lookupAll(want_less=True)
+        while True:
+            plan = self._planMachineBoots()
 
-            def canBoot():
-                for c in wantingBoot:
-                    if self.machine_management.canBoot(c.hardware, c.os):
-                        return c
-                    elif self.machine_management.wantsToSeeSetupScriptForOsConfig(c.os):
-                        setupContents = self._setupContentsForMachineCategory(c)
-                        if setupContents:
-                            self.machine_management.ensureOsConfigAvailable(c.os, setupContents)
-                        else:
-                            logging.warn("Can't find setup contents for %s/%s", c.os, c.hardware)
-                    elif self.machine_management.isOsConfigInvalid(c.os):
-                        c.hardwareComboUnbootable=True
-                        c.hardwareComboUnbootableReason="Ami creation failed"
-                        c.desired=0
+            if not plan.boots:
+                return
 
+            for category, count in plan.shutdowns:
+                for _ in xrange(count):
+                    self._shutdown(category, curTimestamp, onlyIdle=False)
 
+            bootedAny = False
 
-            while wantingBoot and not canBoot() and wantingShutdown:
-                shutAnyDown = False
+            for category, count in plan.boots:
+                for _ in xrange(count):
+                    if not self.machine_management.canBoot(category.hardware, category.os):
+                        break
+                    if not self._boot(category, curTimestamp, curLock):
+                        break
+                    bootedAny = True
 
-                for possibleCategory in wantingShutdown:
-                    if not shutAnyDown and self._shutdown(possibleCategory, curTimestamp, onlyIdle=False):
-                        shutAnyDown = True
+            if not bootedAny:
+                return
 
-                if not shutAnyDown:
-                    break
+    def _planMachineBoots(self):
+        demands = []
+
+        for c in self.database.MachineCategory.lookupAll(want_more=True):
+            if self.machine_management.isBootable(c.hardware, c.os):
+                demands.append(
+                    MachineBootPlanner.CategoryDemand(
+                        category=c,
+                        cores=c.hardware.cores,
+                        ram_gb=c.hardware.ram_gb,
+                        wanted=c.desired - c.booted,
+                        priority=self._machineCategoryPriority(c),
+                        predictedDuration=self._predictedTestDurationForCategory(c),
+                        hourlyCost=self.machine_management.hourlyCost(c.hardware)
+                        )
+                    )
+            elif self.machine_management.wantsToSeeSetupScriptForOsConfig(c.os):
+                setupContents = self._setupContentsForMachineCategory(c)
+                if setupContents:
+                    self.machine_management.ensureOsConfigAvailable(c.os, setupContents)
+                else:
+                    logging.warn("Can't find setup contents for %s/%s", c.os, c.hardware)
+            elif self.machine_management.isOsConfigInvalid(c.os):
+                c.hardwareComboUnbootable=True
+                c.hardwareComboUnbootableReason="Ami creation failed"
+                c.desired=0
+
+        surplus = []
+
+        if not DISABLE_MACHINE_TERMINATION:
+            for c in self.database.MachineCategory.lookupAll(want_less=True):
+                idle = [m for m in self.database.Machine.lookupAll(hardware_and_os=(c.hardware, c.os))
+                            if not self._anythingRunningOnMachine(m)]
+
+                if idle:
+                    surplus.append(
+                        MachineBootPlanner.Surplus(
+                            category=c,
+                            cores=c.hardware.cores,
+                            ram_gb=c.hardware.ram_gb,
+                            count=min(len(idle), c.booted - c.desired)
+                            )
+                        )
 
-            c = canBoot()
+        cores, ram_gb, workers = self.machine_management.remainingCapacity()
 
-            if c:
-                return self._boot(c, curTimestamp, curLock)
-            else:
-                return False
+        plan = MachineBootPlanner.planBoots(
+            demands, 
+            surplus, 
+            MachineBootPlanner.Capacity(cores=cores, ram_gb=ram_gb, workers=workers)
+            )
 
-        while check():
-            pass
+        for category, count in plan.boots:
+            logging.info("Boot plan: boot %s of %s/%s", count, category.hardware, category.os)
+        for category, count in plan.shutdowns:
+            logging.info("Boot plan: shut down %s of %s/%s", count, category.hardware, category.os)
+
+        return plan
+
+    def _machineCategoryPriority(self, category):
+        """The priority of the most important thing waiting on a machine in 'category'."""
+        for deployment in self.database.Deployment.lookupAll(isAlive=True):
+            if not deployment.machine and deployment.test.machineCategory == category:
+                #someone is sitting in front of a terminal waiting for this
+                return MAX_TEST_PRIORITY + 1
+
+        priority = 0
+
+        for test in self.database.Test.lookupAll(machineCategoryAndPrioritized=category):
+            priority = max(priority, test.calculatedPriority)
+            if priority >= MAX_TEST_PRIORITY:
+                break
+
+        return priority
+
+    def _predictedTestDurationForCategory(self, category):
+        """How many seconds of work we expect a newly booted machine in 'category' to pick up."""
+        predictions = []
 
+        for test in self.database.Test.lookupAll(machineCategoryAndPrioritized=category):
+            prediction = self.predictedTestRuntime(test)
+            if prediction:
+                predictions.append(prediction.mean)
+            if len(predictions) >= 20:
+                break
+
+        if not predictions:
+            return DEFAULT_PREDICTED_TEST_DURATION
+
+        return sum(predictions) / len(predictions)
 
     def _boot(self, category, curTimestamp, curLock):
         """Try to boot a machine from 'category'. Returns True if booted."""
@@ -2073,6 +3046,7 @@ class TestManager(object):
             os=category.os,
             isAlive=True
             )
+        self._watchTimeout(("machine", machineId))
         category.booted = category.booted + 1
         return True
 
@@ -2153,10 +3127,9 @@ class TestManager(object):
     def commitsReferencingTest(self, test):
         return [dep.commit for dep in self.database.CommitTestDependency.lookupAll(test=test)]
 
-    def _updateTestPriority(self, test, curTimestamp):
-        oldCalcPri = test.calculatedPriority
-
-        test.calculatedPriority = max(
+    def _inheritedTestPriority(self, test):
+        """Return (priority, anyTestsReferencingUs) from the commits and tests that reference 'test'."""
+        calculatedPriority = max(
             commit.calculatedPriority for commit in self.commitsReferencingTest(test)
             )
 
@@ -2167,7 +3140,28 @@ class TestManager(object):
             if dep.test.calculatedPriority:
                 anyTestsReferencingUs = True
 
-            test.calculatedPriority = max(dep.test.calculatedPriority, test.calculatedPriority)
+            calculatedPriority = max(dep.test.calculatedPriority, calculatedPriority)
+
+        return calculatedPriority, anyTestsReferencingUs
+
+    def _computeTestCalculatedPriority(self, test):
+        """Compute test.calculatedPriority the same way _updateTestPriority would, without side effects."""
+        calculatedPriority, anyTestsReferencingUs = self._inheritedTestPriority(test)
+
+        if test.machineCategory and test.machineCategory.hardwareComboUnbootable:
+            return 0
+
+        if test.testDefinitionSummary.type != "Deployment" and test.testDefinitionSummary.disabled and not anyTestsReferencingUs:
+            return 0
+
+        return calculatedPriority
+
+    def _updateTestPriority(self, test, curTimestamp):
+        oldCalcPri = test.calculatedPriority
+        oldCriticalPath = test.criticalPath
+
+        test.calculatedPriority, anyTestsReferencingUs = self._inheritedTestPriority(test)
+        test.criticalPath = self._criticalPathLength(test)
 
         #cancel any runs already going if this gets deprioritized
         if test.calculatedPriority == 0:
@@ -2178,6 +3172,8 @@ class TestManager(object):
 
         oldPriority = test.priority
         oldTargetMachineBoot = test.targetMachineBoot
+        oldCategory = test.machineCategory
+        wantedToRun = self._testWantsToRun(test)
 
         category = test.machineCategory = self._machineCategoryForTest(test)
 
@@ -2218,6 +3214,19 @@ class TestManager(object):
             else:
                 test.priority = self.database.TestPriority.WantsMoreTests(priority=test.calculatedPriority)
 
+        self._updateTestLiveness(test)
+        self.runnableTests.update(test)
+
+        wantsToRun = self._testWantsToRun(test)
+
+        #only wake idle workers for work they haven't already been told about
+        if category and wantsToRun and (not wantedToRun or category != oldCategory):
+            self._workAvailable(category)
+
+        if not wantsToRun:
+            #we only pass over tests that are waiting to run
+            self._cacheLocalitySkips.pop(test.hash, None)
+
         if category:
             net_change = test.targetMachineBoot - oldTargetMachineBoot
 
@@ -2225,9 +3234,13 @@ class TestManager(object):
                 category.desired = category.desired + net_change
                 self._scheduleBootCheck()
 
-        if test.priority != oldPriority or test.calculatedPriority != oldCalcPri:
+        #tests we depend on only look at our calculatedPriority and critical path, but
+        #tests depending on us look at our state as well.
+        if test.calculatedPriority != oldCalcPri or test.criticalPath != oldCriticalPath:
             for dep in self.database.TestDependency.lookupAll(test=test):
                 self._triggerTestPriorityUpdate(dep.dependsOn)
+
+        if test.priority != oldPriority or test.calculatedPriority != oldCalcPri:
             for dep in self.database.TestDependency.lookupAll(dependsOn=test):
                 self._triggerTestPriorityUpdate(dep.test)
 
@@ -2501,7 +3514,11 @@ class TestManager(object):
             self._markTestCreated(test)
             self._triggerTestPriorityUpdate(test)
 
-        self.database.CommitTestDependency.New(commit=commit,test=test)
+        if not self.database.CommitTestDependency.lookupAny(commit_and_test=(commit,test)):
+            self.database.CommitTestDependency.New(commit=commit,test=test)
+
+            if test.isLive:
+                commit.liveTestCount = commit.liveTestCount + 1
 
         return test
 
@@ -2590,7 +3607,62 @@ class TestManager(object):
             self._triggerTestPriorityUpdate(dep.test)
             dep.delete()
                 
+    def _propagatePriorities(self, curTimestamp, commits=(), tests=()):
+        """Recompute priorities for 'commits', 'tests', and anything queued, once each."""
+        if self._activePriorityBatch is not None:
+            for c in commits:
+                self._activePriorityBatch.markCommitDirty(c)
+            for t in tests:
+                self._activePriorityBatch.markTestDirty(t)
+            return
+
+        batch = PriorityPropagation.PriorityBatch(self, curTimestamp)
+
+        for c in commits:
+            batch.markCommitDirty(c)
+        for t in tests:
+            batch.markTestDirty(t)
+
+        #fold any other queued priority updates into this batch
+        tasks = self.database.DataTask.lookupSome(PriorityPropagation.MAX_TASKS_PER_BATCH, pending_priority_update=True)
+
+        for task in tasks:
+            if task.task.matches.UpdateCommitPriority:
+                batch.markCommitDirty(task.task.commit)
+            else:
+                batch.markTestDirty(task.task.test)
+
+        self._unlinkTasks(tasks)
+
+        self._activePriorityBatch = batch
+        try:
+            batch.run()
+        finally:
+            self._activePriorityBatch = None
+
+        for c in batch.deferredCommits():
+            self._triggerCommitPriorityUpdate(c)
+        for t in batch.deferredTests():
+            self._triggerTestPriorityUpdate(t)
+
+        stats = batch.stats()
+        self.priorityPropagationStats["batches"] += 1
+        for k in stats:
+            self.priorityPropagationStats[k] += stats[k]
+
+        logging.info(
+            "Propagated priorities across %s commits and %s tests in %.3f seconds. %s deferred.",
+            stats["commits_touched"],
+            stats["tests_touched"],
+            stats["elapsed"],
+            stats["deferred"]
+            )
+
     def _triggerCommitPriorityUpdate(self, commit):
+        if self._activePriorityBatch is not None:
+            self._activePriorityBatch.markCommitDirty(commit)
+            return
+
         if not self.database.DataTask.lookupAny(update_commit_priority=commit):
             self._queueTask(
                 self.database.DataTask.New(
@@ -2603,6 +3675,10 @@ class TestManager(object):
         #test priority updates are always 'low' because we want to ensure
         #that all commit updates have triggered first. This way we know that
         #we're not accidentally going to cancel a test
+        if self._activePriorityBatch is not None:
+            self._activePriorityBatch.markTestDirty(test)
+            return
+
         if not self.database.DataTask.lookupAny(update_test_priority=test):
             self._queueTask(
                 self.database.DataTask.New(
@@ -2652,7 +3728,6 @@ class TestManager(object):
             
             commit = self.database.Commit.New(repo=repo, hash=commitHash)
             repo.commits = repo.commits + 1
-            self._repoTouched(repo)
 
         if not commit.data:
             self._triggerCommitDataUpdate(commit)
@@ -2670,6 +3745,8 @@ class TestManager(object):
 
 
     def _queueTask(self, task):
+        task.queuedAt = time.time()
+
         existing = self.database.DataTask.lookupAny(status=task.status)
 
         task.isHead = True
@@ -2679,3 +3756,45 @@ class TestManager(object):
             task.prior = existing
             task.prior_ct = existing.prior_ct + 1
 
+
+    def _unlinkTasks(self, tasks):
+        """Remove pending tasks from wherever they sit in their queues.
+
+        Each task's prior_ct counts the tasks below it, so we walk each queue down from
+        its head, relinking around the tasks we remove and taking them out of the counts
+        of the tasks above them. We stop once we're past the deepest one.
+        """
+        byStatus = {}
+        for task in tasks:
+            byStatus.setdefault(task.status._which, []).append(task)
+
+        for queueTasks in byStatus.values():
+            removed = set(queueTasks)
+            below = len(removed)
+
+            task = self.database.DataTask.lookupAny(status=queueTasks[0].status)
+            newer = None
+
+            while task and below:
+                prior = task.prior
+
+                if task in removed:
+                    below -= 1
+                    if newer is not None:
+                        newer.prior = prior
+                    removed.discard(task)
+                    task.delete()
+                else:
+                    task.prior_ct = task.prior_ct - below
+                    if newer is None:
+                        task.isHead = True
+                    newer = task
+
+                task = prior
+
+            if task and newer is None:
+                task.isHead = True
+
+            #anything we didn't find in its queue is already unreachable
+            for task in removed:
+                task.delete()
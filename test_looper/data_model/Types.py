@@ -47,7 +47,8 @@ def setup_types(database):
         status=BackgroundTaskStatus,
         prior=database.DataTask,
         prior_ct=int,
-        isHead=bool
+        isHead=bool,
+        queuedAt=float
         )
 
     database.Commit.define(
@@ -56,7 +57,12 @@ def setup_types(database):
         data=database.CommitData,
         userPriority=int,
         calculatedPriority=int,
-        anyBranch=database.Branch
+        anyBranch=database.Branch,
+        liveTestCount=int, #the number of tests in this commit with test.isLive
+        generation=int, #see CommitGraph. 0 if we don't know it yet
+        reachBranch=database.Branch, #see BranchReachability
+        reachAnchor=int,
+        reachSuffix=str
         )
 
     database.CommitData.define(
@@ -116,6 +122,8 @@ def setup_types(database):
         priority=database.TestPriority,
         targetMachineBoot=int, #the number of machines we want to boot to achieve this
         runsDesired=int, #the number of runs the _user_ indicated they wanted
+        isLive=bool, #runnable, prioritized, or running. Maintained by TestManager._updateTestLiveness
+        criticalPath=float, #predicted seconds until everything depending on this is done. See TestManager._criticalPathLength
         )
 
     database.UnresolvedTestDependency.define(
@@ -157,6 +165,14 @@ def setup_types(database):
         totalFailedTestCount=int
         )
 
+    database.TestRuntimeStats.define(
+        key=str, #see RuntimePredictor
+        samples=int,
+        mean=float,
+        variance=float,
+        recent=algebraic.List(float)
+        )
+
     database.IndividualTestNameSet.define(
         shaHash=str,
         test_names=algebraic.List(str)
@@ -168,7 +184,9 @@ def setup_types(database):
         commits=int,
         commitsWithTests=int,
         branchCreateTemplates=algebraic.List(database.BranchCreateTemplate),
-        branchCreateLogs=database.LogMessage
+        branchCreateLogs=database.LogMessage,
+        fairShareWeight=float, #share of the machines relative to other repos. 0 means FairShare.DEFAULT_WEIGHT
+        fairShareByBranch=bool #if True, branches compete with each other for this repo's share
         )
 
     database.BranchCreateTemplate.define(
@@ -193,7 +211,10 @@ def setup_types(database):
         repo=database.Repo,
         head=database.Commit,
         isUnderTest=bool,
-        autocreateTrackingBranchName=str
+        autocreateTrackingBranchName=str,
+        reachHead=database.Commit, #the head that BranchReachability last indexed
+        reachHeadPosition=int,
+        fairShareWeight=float #if the repo is fairShareByBranch. 0 means the repo's weight
         )
 
     database.BranchPin.define(
@@ -234,13 +255,18 @@ def setup_types(database):
         isAlive=bool
         )
 
-    database.AllocatedGitRepoLocks.define(
-        requestUniqueId=str,
-        testOrDeployId=str,
-        testHash=str
+    #records the version of the derived scheduler state for a single repo, so we
+    #don't have to rebuild it by walking the whole commit graph every time the server starts.
+    database.SchedulerCheckpoint.define(
+        repo=database.Repo,
+        timestamp=float,
+        formatVersion=int,
+        closedCleanly=bool
         )
 
     database.addIndex(database.IndividualTestNameSet, 'shaHash')
+    database.addIndex(database.SchedulerCheckpoint, 'repo')
+    database.addIndex(database.SchedulerCheckpoint, 'closedCleanly', lambda c: True if c.closedCleanly else None)
 
     database.addIndex(database.DataTask, 'status', lambda d: d.status if d.isHead else None)
     database.addIndex(database.DataTask, 'pending_boot_machine_check', lambda d: True if d.status.matches.Pending and d.task.matches.BootMachineCheck else None)
@@ -250,9 +276,14 @@ def setup_types(database):
     database.addIndex(database.DataTask, 'update_test_priority', lambda d: 
         d.task.test if d.task.matches.UpdateTestPriority else None
         )
+    database.addIndex(database.DataTask, 'pending_priority_update', lambda d: 
+        True if (d.task.matches.UpdateTestPriority or d.task.matches.UpdateCommitPriority) and not d.status.matches.Running else None
+        )
+    database.addIndex(database.DataTask, 'prior', lambda d: d.prior if d.prior else None)
 
     database.addIndex(database.CommitTestDependency, 'test')
     database.addIndex(database.CommitTestDependency, 'commit')
+    database.addIndex(database.CommitTestDependency, 'commit_and_test', lambda o: (o.commit, o.test))
 
     database.addIndex(database.Machine, 'machineId')
 
@@ -268,10 +299,6 @@ def setup_types(database):
     database.addIndex(database.UnresolvedTestDependency, 'test')
     database.addIndex(database.UnresolvedTestDependency, 'test_and_depends', lambda o:(o.test, o.dependsOnHash, o.artifact))
 
-    database.addIndex(database.AllocatedGitRepoLocks, "alive", lambda o: True)
-    database.addIndex(database.AllocatedGitRepoLocks, "requestUniqueId")
-    database.addIndex(database.AllocatedGitRepoLocks, "testOrDeployId")
-    database.addIndex(database.AllocatedGitRepoLocks, "testHash")
 
     database.addIndex(database.UnresolvedCommitRepoDependency, 'commit')
     database.addIndex(database.UnresolvedCommitRepoDependency, 'reponame')
@@ -289,9 +316,12 @@ def setup_types(database):
     database.addIndex(database.Branch, 'head')
     database.addIndex(database.Branch, 'reponame_and_branchname', lambda o: (o.repo.name, o.branchname))
     database.addIndex(database.Branch, 'autocreateTrackingBranchName')
+    database.addIndex(database.Branch, 'reachStale', lambda o: o.repo if o.head != o.reachHead else None)
     database.addIndex(database.BranchPin, 'branch')
     database.addIndex(database.BranchPin, 'pinned_to', lambda o: (o.pinned_to_repo, o.pinned_to_branch))
     database.addIndex(database.Commit, 'repo_and_hash', lambda o: (o.repo, o.hash))
+    database.addIndex(database.Commit, 'hasLiveTests', lambda o: True if o.liveTestCount > 0 else None)
+    database.addIndex(database.Commit, 'reachBranch', lambda o: o.reachBranch if o.reachBranch else None)
     database.addIndex(database.CommitRelationship, 'parent')
     database.addIndex(database.CommitRelationship, 'child')
     database.addIndex(database.Deployment, 'isAlive', lambda d: d.isAlive or None)
@@ -310,6 +340,7 @@ def setup_types(database):
                 else None
             )
     database.addIndex(database.TestRun, 'test')
+    database.addIndex(database.TestRuntimeStats, 'key')
     database.addIndex(database.TestRun, 'isRunning', lambda t: True if not t.canceled and t.endTimestamp <= 0.0 else None)
     database.addIndex(database.TestRun, 'runningOnMachine', lambda t: t.machine if not t.canceled and t.endTimestamp <= 0.0 else None)
 
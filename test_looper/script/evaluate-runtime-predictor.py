@@ -0,0 +1,17 @@
+#!/usr/bin/python
+
+"""Replay the test runs in a test-looper-server --export dump through RuntimePredictor and report its error."""
+
+import test_looper.data_model.RuntimePredictor as RuntimePredictor
+import json
+import sys
+import yaml
+
+if len(sys.argv) != 2:
+    print "Usage: evaluate-runtime-predictor dump.yml"
+    sys.exit(1)
+
+with open(sys.argv[1], "r") as f:
+    results = yaml.load(f.read())
+
+print json.dumps(RuntimePredictor.evaluateDump(results), indent=4, sort_keys=True)
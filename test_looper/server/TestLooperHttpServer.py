@@ -36,13 +36,24 @@ time.tzset()
 
 MAX_BYTES_TO_SEND = 100000
 
+def parseLogOffset(offset):
+    """A byte offset into a test's log, from a query string. Raises ValueError unless it's a number >= 0."""
+    offset = int(offset)
+    if offset < 0:
+        raise ValueError("Negative log offset %s" % offset)
+    return offset
+
 class LogHandler:
-    def __init__(self, testManager, testId, websocket):
+    def __init__(self, testManager, testId, websocket, offset=None):
         self.testManager = testManager
         self.testId = testId
         self.websocket = websocket
 
-        testManager.heartbeatHandler.addListener(testId, self.logMsg)
+        #without an offset, start far enough back to fill a screen
+        if offset is None:
+            offset = max(0, testManager.heartbeatHandler.logSize(testId) - MAX_BYTES_TO_SEND)
+
+        testManager.heartbeatHandler.addListener(testId, self.logMsg, offset, MAX_BYTES_TO_SEND)
 
     def logMsg(self, message):
         if len(message) > MAX_BYTES_TO_SEND:
@@ -150,7 +161,13 @@ def MakeWebsocketHandler(httpServer):
                         return
 
                     if "testId" in query:
-                        handler[0] = LogHandler(httpServer.testManager, query["testId"][0], self)
+                        try:
+                            offset = parseLogOffset(query["offset"][0]) if "offset" in query else None
+                        except ValueError:
+                            self.send("Invalid log offset.", False)
+                            return
+
+                        handler[0] = LogHandler(httpServer.testManager, query["testId"][0], self, offset)
                     elif "deploymentId" in query:
                         handler[0] = InteractiveEnvironmentHandler(
                             httpServer.testManager,
@@ -468,7 +485,13 @@ class TestLooperHttpServer(object):
         pass
 
     @cherrypy.expose
-    def terminalForTest(self, testId):
+    def terminalForTest(self, testId, offset=None):
+        if offset is not None:
+            try:
+                offset = parseLogOffset(offset)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid log offset")
+            return self.websocketText(urllib.urlencode({"testId":testId, "offset":offset}))
         return self.websocketText(urllib.urlencode({"testId":testId}))
 
     @cherrypy.expose
@@ -479,6 +502,16 @@ class TestLooperHttpServer(object):
     def machineHeartbeatMessage(self, machineId, heartbeatmsg):
         self.testManager.machineHeartbeat(machineId, time.time(), heartbeatmsg)
 
+    @cherrypy.expose
+    def metrics(self, format="text"):
+        """The TestManager's metrics, in the Prometheus text format or (with format=json) as JSON."""
+        if format == "json":
+            cherrypy.response.headers['Content-Type'] = "application/json"
+            return simplejson.dumps(self.testManager.metrics.toJson(), indent=2, sort_keys=True)
+
+        cherrypy.response.headers['Content-Type'] = "text/plain; version=0.0.4"
+        return self.testManager.metrics.renderText()
+
     def websocketText(self, urlQuery):
         return """
         <!doctype html>
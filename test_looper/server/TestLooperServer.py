@@ -1,18 +1,16 @@
 import collections
-import json
 import logging
 import threading
 import traceback
 import base64
 import time
 import random
-import socket
 
 import test_looper.data_model.TestDefinition as TestDefinition
+import test_looper.core.EventLoop as EventLoop
+import test_looper.core.MessageCodec as MessageCodec
 import test_looper.core.SimpleServer as SimpleServer
-import test_looper.core.socket_util as socket_util
 import test_looper.core.algebraic as algebraic
-import test_looper.core.algebraic_to_json as algebraic_to_json
 
 CLEANUP_TASK_FREQUENCY = 30
 
@@ -32,6 +30,18 @@ ServerToClientMsg.ShutdownDeployment = {'deploymentId': str}
 
 ServerToClientMsg.GrantOrDenyPermissionToHitGitRepo = {'requestUniqueId': str, "allowed": bool}
 
+#answers NegotiateProtocol. Sent as JSON; everything after it uses the chosen version.
+ServerToClientMsg.ProtocolSelected = {'version': int, 'compression': bool}
+
+#we hold the first 'offset' bytes of the test's log. If 'resend', we lost some of what the worker sent
+#and it should send everything from 'offset' on again.
+ServerToClientMsg.LogsPersisted = {'testId': str, 'offset': int, 'resend': bool}
+
+#the test the worker will probably run after the current one, so it can fetch what it needs ahead of time.
+#it's only a guess until we send a TestAssignment, and we take it back with ReservationRevoked.
+ServerToClientMsg.NextTestReserved = {'testHash': str, 'testDefinition': TestDefinition.TestDefinition}
+ServerToClientMsg.ReservationRevoked = {'testHash': str}
+
 ClientToServerMsg = algebraic.Alternative("ClientToServerMsg")
 
 
@@ -39,34 +49,65 @@ WorkerState = algebraic.Alternative("WorkerState")
 WorkerState.Waiting = {}
 WorkerState.WorkingOnDeployment = {'deploymentId': str, 'logs_so_far': str}
 WorkerState.WorkingOnTest = {'testId': str, 'logs_so_far': str, 'artifacts': algebraic.List(str)}
+#like WorkingOnTest, but with only the part of the log past what the server last told us it had
+WorkerState.WorkingOnTestFrom = {'testId': str, 'log_offset': int, 'logs_since': str, 'artifacts': algebraic.List(str)}
 WorkerState.TestFinished = {'testId': str, 'success': bool, 'testSuccesses': algebraic.Dict(str,(bool, bool)), 'artifacts': algebraic.List(str)} #testSuccess: name->(success,hasLogs)
 
 ClientToServerMsg.CurrentState = {'machineId': str, 'state': WorkerState}
 ClientToServerMsg.WaitingHeartbeat = {}
+#what an idle worker has cached, sent just before its WaitingHeartbeat. cachedBuilds: build hash->bytes on disk.
+#workers only send it once we've negotiated the binary protocol, since older servers can't read it.
+ClientToServerMsg.CacheSummary = {'cachedBuilds': algebraic.Dict(str, int), 'cachedImages': algebraic.List(str)}
 ClientToServerMsg.TestHeartbeat = {'testId': str}
 ClientToServerMsg.ArtifactUploaded = {'testId': str, 'artifact': str}
 ClientToServerMsg.TestLogOutput = {'testId': str, 'log': str}
+#log output that starts at byte 'offset' of the test's log. The server answers with LogsPersisted.
+ClientToServerMsg.TestLogOutputAt = {'testId': str, 'offset': int, 'log': str}
 ClientToServerMsg.DeploymentHeartbeat = {'deploymentId': str}
 ClientToServerMsg.DeploymentExited = {'deploymentId': str}
 ClientToServerMsg.DeploymentTerminalOutput = {'deploymentId': str, 'data': str}
 ClientToServerMsg.TestFinished = {'testId': str, 'success': bool, 'testSuccesses': algebraic.Dict(str,(bool, bool)), 'artifacts': algebraic.List(str)} #testSuccess: name->(success,hasLogs)
 ClientToServerMsg.RequestPermissionToHitGitRepo = {'requestUniqueId': str, 'curTestOrDeployId': str}
 ClientToServerMsg.GitRepoPullCompleted = {'requestUniqueId': str}
+#newer workers send this first. 'schema' is the MessageCodec's hash of these definitions.
+ClientToServerMsg.NegotiateProtocol = {'versions': algebraic.List(int), 'schema': str, 'compression': bool}
+#sent after CurrentState by workers that run several tests at once, over one connection per slot.
+#we give the machine at most 'slots' tests and deployments at a time.
+ClientToServerMsg.MachineSlots = {'slots': int}
 
 SOCKET_CLEANUP_TIMEOUT = 360
 
+#how often a session asks the TestManager about the next test for its worker
+RESERVATION_CHECK_INTERVAL = 10.0
+
+#an idle worker's session waits for the TestManager to say there's work, but looks anyways this often
+IDLE_RECHECK_INTERVAL = 60.0
+
+#threads handling worker messages. Sessions share them, and each session's messages run in order.
+SESSION_WORKER_THREADS = 8
+
 class Session(object):
-    def __init__(self, server, testManager, machine_management, socket, address):
+    def __init__(self, server, testManager, machine_management, connection, address):
         self.server = server
-        self.socket = socket
+        self.connection = connection
         self.address = address
         self.testManager = testManager
         self.machine_management = machine_management
         self.currentTestId = None
         self.currentDeploymentId = None
-        self.socketLock = threading.Lock()
+        #the test we told the worker it runs after 'reservedAfter', and when we last checked on it
+        self.reservedTestHash = None
+        self.reservedAfter = None
+        self.reservationCheckedAt = 0.0
+        #when we parked the worker with the TestManager to wait for work, or None if it isn't waiting
+        self.waitingForWorkSince = None
         self.machineId = None
+        self.codec = MessageCodec.MessageCodec(ServerToClientMsg, ClientToServerMsg)
+        #held while encoding and queueing a message, so frames hit the wire in the order the codec saw them
+        self.sendLock = threading.Lock()
         self.lastMessageTimestamp = time.time()
+        #git repo requests this worker holds or is waiting on
+        self.gitRequestIds = set()
 
         logging.info("Incoming Server Connection initialized.")
 
@@ -76,38 +117,127 @@ class Session(object):
             if time.time() - self.lastMessageTimestamp > SOCKET_CLEANUP_TIMEOUT:
                 logging.info("Clearing out socket for machine %s as we have not heard from it in %s seconds.", self.machineId, SOCKET_CLEANUP_TIMEOUT)
 
-                self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
+                self.connection.close(discardPending=True)
                 return False
-            return True
+            return not self.connection.closed
         except:
             logging.error("Exception clearing old socket: %s", traceback.format_exc())
             return False
 
-    def __call__(self):
-        try:
-            self.send(ServerToClientMsg.IdentifyCurrentState())
-
-            while not self.server.shouldStop():
-                msg = algebraic_to_json.Encoder().from_json(
-                    json.loads(self.readString()),
-                    ClientToServerMsg
-                    )
-                self.lastMessageTimestamp = time.time()
-                self.processMsg(msg)
+    def onMessage(self, data):
+        """Handle one message from the worker. The event loop calls us with one message at a time."""
+        if self.server.shouldStop():
+            return
 
-        except socket_util.SocketException as e:
-            logging.info("Socket error: %s", e.message)
+        try:
+            msg = self.codec.decode(data)
+            self.lastMessageTimestamp = time.time()
+            self.processMsg(msg)
         except:
             logging.error("Exception: %s", traceback.format_exc())
-        finally:
-            self.socket.close()
+            self.connection.close()
+
+    def onClosed(self):
+        self.testManager.stopWaitingForWork(self)
+
+        if self.gitRequestIds:
+            try:
+                self.testManager.gitRepoSessionClosed(self.gitRequestIds, time.time())
+            except:
+                logging.error("Failed to release git repo locks for machine %s: %s", self.machineId, traceback.format_exc())
 
     def send(self, msg):
-        self.writeString(json.dumps(algebraic_to_json.Encoder().to_json(msg)))
+        with self.sendLock:
+            self.connection.send(self.codec.encode(msg))
+
+    def workAvailable(self):
+        """The TestManager has something our worker could run. Called from whatever thread made it available."""
+        self.server.eventLoop.call(self.connection, self.onWorkAvailable)
+
+    def onWorkAvailable(self):
+        if self.server.shouldStop() or self.connection.closed:
+            return
+
+        self.waitingForWorkSince = None
+
+        try:
+            self.assignWork()
+        except:
+            logging.error("Failed to assign work to machine %s:\n%s", self.machineId, traceback.format_exc())
+
+    def assignWork(self):
+        """Give our idle worker a deployment or test, or wait for the TestManager to say there is one."""
+        if self.machineId is None or self.currentDeploymentId is not None or self.currentTestId is not None:
+            return
+
+        stamp = self.testManager.workStamp()
+
+        deploymentId, testDefinition = self.testManager.startNewDeployment(self.machineId, time.time())
+        if deploymentId is not None:
+            self.currentDeploymentId = deploymentId
+            self.send(
+                ServerToClientMsg.DeploymentAssignment(
+                    deploymentId=deploymentId,
+                    testDefinition=testDefinition
+                    )
+                )
+            def onMessage(msg):
+                if self.currentDeploymentId == deploymentId:
+                    self.send(ServerToClientMsg.TerminalInput(deploymentId=deploymentId,msg=msg))
+            self.testManager.subscribeToClientMessages(deploymentId, onMessage)
+            return
+
+        t0 = time.time()
+        testId, testDefinition = self.testManager.startNewTest(self.machineId, time.time(), self.reservedAfter)
+        self.reservedTestHash = None
+        self.reservedAfter = None
+        if testId is not None:
+            self.currentTestId = testId
+            self.send(
+                ServerToClientMsg.TestAssignment(
+                    testId=testId,
+                    testDefinition=testDefinition
+                    )
+                )
+            logging.info("Allocated new test %s to machine %s in %s seconds.", testId, self.machineId, time.time() - t0)
+            return
+
+        self.waitingForWorkSince = time.time()
+        if not self.testManager.waitForWork(self.machineId, self, self.workAvailable, stamp):
+            self.waitingForWorkSince = None
+
+    def updateReservation(self):
+        """Tell the worker about changes to the test it runs next. Called while it runs a test."""
+        #only workers that speak the binary protocol know about reservations
+        if self.codec.version != MessageCodec.BINARY or self.currentTestId is None:
+            return
+
+        if time.time() - self.reservationCheckedAt < RESERVATION_CHECK_INTERVAL:
+            return
+        self.reservationCheckedAt = time.time()
+
+        testHash, testDefinition = self.testManager.reserveNextTest(self.currentTestId, time.time())
+
+        if testHash != self.reservedTestHash:
+            if self.reservedTestHash is not None:
+                self.send(ServerToClientMsg.ReservationRevoked(testHash=self.reservedTestHash))
+            if testHash is not None:
+                logging.info("Reserved test %s for machine %s after %s", testDefinition.name, self.machineId, self.currentTestId)
+                self.send(ServerToClientMsg.NextTestReserved(testHash=testHash, testDefinition=testDefinition))
+
+        self.reservedTestHash = testHash
+        self.reservedAfter = self.currentTestId if testHash is not None else None
 
     def processMsg(self, msg):
-        if msg.matches.CurrentState:
+        if msg.matches.NegotiateProtocol:
+            version, compression = self.codec.choose(msg.versions, msg.schema, msg.compression)
+
+            logging.info("Worker at %s speaks protocol %s. Using version %s, compression=%s", self.address, msg.versions, version, compression)
+
+            with self.sendLock:
+                self.connection.send(self.codec.encode(ServerToClientMsg.ProtocolSelected(version=version, compression=compression)))
+                self.codec.use(version, compression)
+        elif msg.matches.CurrentState:
             self.machineId = msg.machineId
             logging.info("WorkerChannel initialized with machineId=%s", self.machineId)
             
@@ -132,56 +262,61 @@ class Session(object):
                     self.send(ServerToClientMsg.CancelTest(msg.state.testId))
                 else:
                     self.currentTestId = msg.state.testId
+            elif msg.state.matches.WorkingOnTestFrom:
+                stillRunning, logBytes = self.testManager.handleTestConnectionResumed(
+                    msg.state.testId, time.time(), msg.state.log_offset, msg.state.logs_since, msg.state.artifacts
+                    )
+                if not stillRunning:
+                    self.send(ServerToClientMsg.CancelTest(msg.state.testId))
+                else:
+                    self.currentTestId = msg.state.testId
+                    self.send(ServerToClientMsg.LogsPersisted(testId=msg.state.testId, offset=logBytes, resend=logBytes < msg.state.log_offset))
             elif msg.state.matches.TestFinished:
                 self.testManager.recordTestResults(msg.state.success, msg.state.testId, msg.state.testSuccesses, msg.state.artifacts, time.time())
                 self.send(ServerToClientMsg.AcknowledgeFinishedTest(msg.state.testId))
+        elif msg.matches.MachineSlots:
+            if self.machineId is not None:
+                self.testManager.machineSlotsReported(self.machineId, msg.slots)
         elif msg.matches.RequestPermissionToHitGitRepo:
             if self.currentDeploymentId != msg.curTestOrDeployId and self.currentTestId != msg.curTestOrDeployId:
                 allowed = False
                 logging.warn("Denying git repo hit for unknown test/deploy id %s", msg.curTestOrDeployId)
             else:
+                #the server grants the request when a connection frees up, so we only answer now if we refuse
+                def onGranted(requestUniqueId):
+                    self.send(ServerToClientMsg.GrantOrDenyPermissionToHitGitRepo(requestUniqueId=requestUniqueId, allowed=True))
+
                 try:
-                    allowed = self.testManager.tryToAllocateGitRepoLock(msg.requestUniqueId, self.currentDeploymentId or self.currentTestId)
+                    self.gitRequestIds.add(msg.requestUniqueId)
+                    allowed = self.testManager.requestGitRepoLock(msg.requestUniqueId, self.currentDeploymentId or self.currentTestId, onGranted, time.time())
                 except:
                     logging.error("Allocating git repo lock failed!\n:%s", traceback.format_exc())
                     allowed = False
 
-            self.send(ServerToClientMsg.GrantOrDenyPermissionToHitGitRepo(requestUniqueId=msg.requestUniqueId, allowed=allowed))
+            if not allowed:
+                self.gitRequestIds.discard(msg.requestUniqueId)
+                self.send(ServerToClientMsg.GrantOrDenyPermissionToHitGitRepo(requestUniqueId=msg.requestUniqueId, allowed=False))
 
         elif msg.matches.GitRepoPullCompleted:
-            self.testManager.gitRepoLockReleased(msg.requestUniqueId)
+            self.gitRequestIds.discard(msg.requestUniqueId)
+            self.testManager.gitRepoLockReleased(msg.requestUniqueId, time.time())
+        elif msg.matches.CacheSummary:
+            if self.machineId is not None:
+                self.testManager.machineCacheReported(self.machineId, msg.cachedBuilds, msg.cachedImages)
         elif msg.matches.WaitingHeartbeat:
             if self.machineId is None:
                 return
 
             self.testManager.machineHeartbeat(self.machineId, time.time())
 
-            if self.currentDeploymentId is None and self.currentTestId is None:
-                deploymentId, testDefinition = self.testManager.startNewDeployment(self.machineId, time.time())
-                if deploymentId is not None:
-                    self.currentDeploymentId = deploymentId
-                    self.send(
-                        ServerToClientMsg.DeploymentAssignment(
-                            deploymentId=deploymentId,
-                            testDefinition=testDefinition
-                            )
-                        )
-                    def onMessage(msg):
-                        if self.currentDeploymentId == deploymentId:
-                            self.send(ServerToClientMsg.TerminalInput(deploymentId=deploymentId,msg=msg))
-                    self.testManager.subscribeToClientMessages(deploymentId, onMessage)
-                else:
-                    t0 = time.time()
-                    testId, testDefinition = self.testManager.startNewTest(self.machineId, time.time())
-                    if testId is not None:
-                        self.currentTestId = testId
-                        self.send(
-                            ServerToClientMsg.TestAssignment(
-                                testId=testId,
-                                testDefinition=testDefinition
-                                )
-                            )
-                        logging.info("Allocated new test %s to machine %s in %s seconds.", testId, self.machineId, time.time() - t0)
+            #a parked worker hears from us when there's work, so its heartbeats don't need to look
+            if self.waitingForWorkSince is not None and time.time() - self.waitingForWorkSince < IDLE_RECHECK_INTERVAL:
+                return
+
+            self.testManager.stopWaitingForWork(self)
+            self.waitingForWorkSince = None
+
+            self.assignWork()
         elif msg.matches.ArtifactUploaded:
             if msg.testId == self.currentTestId:
                 self.testManager.recordTestArtifactUploaded(self.currentTestId, msg.artifact, time.time(), isCumulative=False)
@@ -197,6 +332,20 @@ class Session(object):
 
                     self.send(ServerToClientMsg.CancelTest(testId=msg.testId))
                     self.currentTestId = None
+                else:
+                    self.updateReservation()
+        elif msg.matches.TestLogOutputAt:
+            if msg.testId == self.currentTestId:
+                stillRunning, logBytes = self.testManager.testLogOutputAt(msg.testId, time.time(), msg.offset, msg.log)
+
+                if not stillRunning:
+                    logging.info("Server canceling test %s on machine %s", msg.testId, self.machineId)
+
+                    self.send(ServerToClientMsg.CancelTest(testId=msg.testId))
+                    self.currentTestId = None
+                else:
+                    self.send(ServerToClientMsg.LogsPersisted(testId=msg.testId, offset=logBytes, resend=logBytes < msg.offset))
+                    self.updateReservation()
         elif msg.matches.DeploymentExited:
             if msg.deploymentId == self.currentDeploymentId:
                 self.testManager.shutdownDeployment(msg.deploymentId, time.time())
@@ -213,16 +362,9 @@ class Session(object):
             self.currentTestId = None
             self.send(ServerToClientMsg.AcknowledgeFinishedTest(msg.testId))
 
-    def readString(self):
-        return socket_util.readString(self.socket)
-
-    def writeString(self, s):
-        with self.socketLock:
-            return socket_util.writeString(self.socket, s)
-
 class TestLooperServer(SimpleServer.SimpleServer):
     #if we modify this protocol version, the loopers should reboot and pull a new copy of the code
-    protocolVersion = '2.2.6'
+    protocolVersion = '2.2.8'
 
     def __init__(self, server_ports, testManager, httpServer, machine_management):
         """
@@ -241,6 +383,7 @@ class TestLooperServer(SimpleServer.SimpleServer):
         self.machine_management = machine_management
         self.workerThread = threading.Thread(target=self.executeManagerWork)
         self.workerThread.daemon=True
+        self.eventLoop = EventLoop.EventLoop(SESSION_WORKER_THREADS, name="TestLooperSessions")
         self.sessions = []
 
     def executeManagerWork(self):
@@ -256,6 +399,14 @@ class TestLooperServer(SimpleServer.SimpleServer):
                         self.testManager.performCleanupTasks(time.time())
                     except:
                         logging.critical("Test manager failed during cleanup:\n%s", traceback.format_exc())
+                else:
+                    #between sweeps, catch timeouts as soon as they're due
+                    deadline = self.testManager.nextTimeoutDeadline()
+                    if deadline is not None and deadline <= time.time():
+                        try:
+                            self.testManager.expireTimeouts(time.time())
+                        except:
+                            logging.critical("Test manager failed expiring timeouts:\n%s", traceback.format_exc())
 
                 if task:
                     logging.info("Performed %s", task)
@@ -273,24 +424,32 @@ class TestLooperServer(SimpleServer.SimpleServer):
         logging.info("Initializing TestManager.")
         self.testManager.markRepoListDirty(time.time())
 
-        #start something to touch all the objects we can reach in the
-        #background
-        touchAllThread = threading.Thread(
-            target=self.testManager.touchAllTestsAndRuns,
-            args=(time.time(),)
-            )
-        touchAllThread.daemon=True
-        touchAllThread.start()
-
         try:
-            self.testManager.pruneDeadWorkers(time.time())
+            restored = self.testManager.restoreSchedulerState(time.time())
         except:
-            logging.error("Server had an exception during initialization:\n%s", traceback.format_exc())
+            logging.error("Server had an exception loading the scheduler checkpoint:\n%s", traceback.format_exc())
+            restored = False
+
+        if not restored:
+            #start something to touch all the objects we can reach in the
+            #background
+            touchAllThread = threading.Thread(
+                target=self.testManager.touchAllTestsAndRuns,
+                args=(time.time(),)
+                )
+            touchAllThread.daemon=True
+            touchAllThread.start()
 
         try:
-            self.testManager.checkAllTestPriorities(time.time(), resetUnbootable=False)
+            self.testManager.pruneDeadWorkers(time.time())
         except:
             logging.error("Server had an exception during initialization:\n%s", traceback.format_exc())
+
+        if not restored:
+            try:
+                self.testManager.checkAllTestPriorities(time.time(), resetUnbootable=False)
+            except:
+                logging.error("Server had an exception during initialization:\n%s", traceback.format_exc())
         
         logging.info("DONE Initializing TestManager.")
         
@@ -307,6 +466,7 @@ class TestLooperServer(SimpleServer.SimpleServer):
             logging.info("TestLooper initialized")
 
             self.workerThread.start()
+            self.eventLoop.start()
 
             super(TestLooperServer, self).runListenLoop()
         finally:
@@ -320,15 +480,26 @@ class TestLooperServer(SimpleServer.SimpleServer):
 
         self.workerThread.join()
 
+        logging.info("waiting for sessions to close...")
+
+        self.eventLoop.stop()
+
+        try:
+            self.testManager.checkpointSchedulerState(time.time(), close=True)
+        except:
+            logging.error("Failed to write the scheduler checkpoint:\n%s", traceback.format_exc())
+
         logging.info("successfully stopped TestLooperServer")
 
     def _onConnect(self, socket, address):
         logging.debug("Accepting connection from %s", address)
+        connection = EventLoop.Connection(socket, address)
+
         newSession = Session(
             self,
             self.testManager,
             self.machine_management,
-            socket,
+            connection,
             address
             )
         
@@ -340,4 +511,6 @@ class TestLooperServer(SimpleServer.SimpleServer):
 
         logging.info("Creating new session with %s sessions alive", len(self.sessions))
 
-        threading.Thread(target=newSession).start()
+        newSession.send(ServerToClientMsg.IdentifyCurrentState())
+
+        self.eventLoop.add(connection, newSession.onMessage, newSession.onClosed)
@@ -384,11 +384,6 @@ class CommitContext(Context.Context):
         if not commit:
             return preamble + HtmlGeneration.lightGreyWithHover(repoRef.reference[:--30], "Can't find commit %s" % commitHash[:10])
 
-        branches = {k.branchname: v for k,v in self.testManager.commitFindAllBranches(commit).iteritems()}
-
-        if repoRef.branch not in branches:
-            return preamble + self.contextFor(commit).renderLink()
-
         return preamble + self.contextFor(commit).renderLink()
 
     def contextViews(self):
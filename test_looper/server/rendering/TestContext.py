@@ -144,7 +144,7 @@ class TestContext(Context.Context):
             if not testRuns:
                 return card("No runs of this test")
 
-            return HtmlGeneration.grid(self.gridForTestList_(testRuns))
+            return self.renderPredictedRuntime() + HtmlGeneration.grid(self.gridForTestList_(testRuns))
 
         if self.currentView() == "test_definition":
             return card(
@@ -159,6 +159,20 @@ class TestContext(Context.Context):
                 return card("No dependencies")
             return HtmlGeneration.grid(grid)
 
+    def renderPredictedRuntime(self):
+        prediction = self.testManager.predictedTestRuntime(self.test)
+
+        if not prediction:
+            return ""
+
+        return card("Predicted runtime: %.2f min (median %.2f, 90th percentile %.2f) from %s runs of %s" % (
+            prediction.mean / 60.0,
+            prediction.p50 / 60.0,
+            prediction.p90 / 60.0,
+            prediction.samples,
+            "this test" if prediction.key.startswith("hash:") else "tests named " + cgi.escape(self.testName)
+            ))
+
     def allTestDependencyGrid(self):
         grid = [["COMMIT", "TEST", ""]]
 
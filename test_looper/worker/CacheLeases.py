@@ -0,0 +1,62 @@
+"""CacheLeases
+
+A worker machine that runs several tests at once gives each one a slot, and
+the slots share the machine's repo cache, build cache and docker images.
+
+A slot leases a cache entry while it fills it in or reads from it. Only one
+slot holds a given entry at a time, so two slots never download the same
+build or touch the same git repo at once, and the build cache's purge leaves
+alone anything a slot is holding or waiting for.
+"""
+
+import os
+import threading
+
+class CacheLeases(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        #key -> [lock, number of slots holding or waiting for it]
+        self._entries = {}
+
+    def lease(self, key):
+        """A context manager that holds 'key' while we're inside it."""
+        leases = self
+
+        class Scope:
+            def __enter__(scope):
+                leases._acquire(key)
+
+            def __exit__(scope, *args):
+                leases._release(key)
+
+        return Scope()
+
+    def isLeased(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def removeUnlessLeased(self, path):
+        """Delete the file at 'path' unless a slot is holding or waiting for it. Returns whether we did."""
+        with self._lock:
+            if path in self._entries:
+                return False
+            os.remove(path)
+            return True
+
+    def _acquire(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        entry[0].acquire()
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
+
+        entry[0].release()
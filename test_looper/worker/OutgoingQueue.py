@@ -0,0 +1,182 @@
+"""OutgoingQueue
+
+Messages a TestLooperClient has yet to send to the server, in two lanes.
+
+Control messages (heartbeats, results, git requests) go out first and in
+order. Test log output goes in the other lane, where we coalesce it into one
+message per test until the batch is big enough or old enough, and only send
+it when there's no control traffic waiting.
+
+Each test also gets a byte budget that refills at a fixed rate. Output that
+arrives when the budget is spent is dropped, and the next batch we send says
+how much we dropped, so a test that spews output can't swamp the connection
+or the server.
+
+The server's copy of a test's log is the concatenation of the batches we send,
+notices included. Anyone keeping their own copy to compare with it (say, to
+resend after a reconnect) has to build it from the text handed to
+makeMessage, not from what they passed to putLog.
+"""
+
+import threading
+import time
+
+#send a test's log batch once it's this big...
+LOG_BATCH_BYTES = 64 * 1024
+#...or once its oldest output is this old
+LOG_BATCH_SECONDS = .25
+
+#each test may send this many bytes of log per second on average...
+LOG_BYTES_PER_SECOND = 256 * 1024
+#...and this many in a burst
+LOG_BURST_BYTES = 4 * 1024 * 1024
+
+class _LogBatch(object):
+    def __init__(self, makeMessage, now, burstBytes):
+        self.makeMessage = makeMessage
+        self.chunks = []
+        self.bytes = 0
+        #when the batch's first output arrived, and a tiebreaker so batches go out in the order they started
+        self.started = None
+        self.sequence = None
+
+        #token bucket for the rate cap
+        self.budget = burstBytes
+        self.refilled = now
+
+        #output we dropped since we last said so
+        self.droppedBytes = 0
+        self.droppedLines = 0
+
+class OutgoingQueue(object):
+    def __init__(self,
+            batchBytes=LOG_BATCH_BYTES,
+            batchSeconds=LOG_BATCH_SECONDS,
+            bytesPerSecond=LOG_BYTES_PER_SECOND,
+            burstBytes=LOG_BURST_BYTES,
+            clock=time.time
+            ):
+        self.batchBytes = batchBytes
+        self.batchSeconds = batchSeconds
+        self.bytesPerSecond = bytesPerSecond
+        self.burstBytes = burstBytes
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._control = []
+        #key -> _LogBatch, for every test that has logged and hasn't been flushed
+        self._logs = {}
+        self._sequence = 0
+
+        self.droppedBytes = 0
+
+    def put(self, msg):
+        """Queue a control message. None tells the reader to stop."""
+        with self._lock:
+            self._control.append(msg)
+            self._ready.notify()
+
+    def putLog(self, key, text, makeMessage):
+        """Queue log output for 'key'. makeMessage(text) builds the message that carries a batch.
+
+        'text' is exactly what the batch adds to the server's copy of the log, including any
+        notice of dropped output. Returns whether we kept the output. We drop it if 'key' is
+        over its rate cap.
+        """
+        with self._lock:
+            now = self.clock()
+
+            batch = self._logs.get(key)
+            if batch is None:
+                batch = self._logs[key] = _LogBatch(makeMessage, now, self.burstBytes)
+
+            batch.budget = min(self.burstBytes, batch.budget + (now - batch.refilled) * self.bytesPerSecond)
+            batch.refilled = now
+
+            if len(text) > batch.budget:
+                batch.droppedBytes += len(text)
+                batch.droppedLines += text.count("\n")
+                self.droppedBytes += len(text)
+
+                #make sure the news goes out even if the test never logs again
+                if batch.started is None:
+                    self._start(batch, now)
+                return False
+
+            batch.budget -= len(text)
+            batch.chunks.append(text)
+            batch.bytes += len(text)
+
+            if batch.started is None:
+                self._start(batch, now)
+            elif batch.bytes >= self.batchBytes:
+                self._ready.notify()
+
+            return True
+
+    def flushLogs(self, key):
+        """Move whatever 'key' has batched up into the control lane, and forget its rate cap.
+
+        Call this before sending a message that has to arrive after the logs, like a test result.
+        """
+        with self._lock:
+            batch = self._logs.pop(key, None)
+            if batch is not None and batch.started is not None:
+                self._control.append(self._take(batch))
+                self._ready.notify()
+
+    def discardLogs(self, key):
+        """Forget 'key' and anything it has batched up."""
+        with self._lock:
+            self._logs.pop(key, None)
+
+    def get(self, timeout=None):
+        """Block until there's something to send, and return it. Returns None after 'timeout' seconds."""
+        with self._lock:
+            deadline = None if timeout is None else self.clock() + timeout
+
+            while True:
+                if self._control:
+                    return self._control.pop(0)
+
+                now = self.clock()
+                nextDue = None
+
+                for batch in sorted((b for b in self._logs.values() if b.started is not None), key=lambda b: (b.started, b.sequence)):
+                    due = batch.started + self.batchSeconds
+                    if batch.bytes >= self.batchBytes or due <= now:
+                        return self._take(batch)
+                    if nextDue is None or due < nextDue:
+                        nextDue = due
+
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    nextDue = deadline if nextDue is None else min(nextDue, deadline)
+
+                self._ready.wait(None if nextDue is None else max(nextDue - now, .001))
+
+    def _start(self, batch, now):
+        batch.started = now
+        batch.sequence = self._sequence
+        self._sequence += 1
+
+        #wake the reader, so it knows when to come back for this batch
+        self._ready.notify()
+
+    def _take(self, batch):
+        text = "".join(batch.chunks)
+
+        if batch.droppedBytes:
+            text += "\n[test-looper] Dropped %s bytes (%s lines) of output: this test logged faster than %s bytes/second.\n" % (
+                batch.droppedBytes, batch.droppedLines, self.bytesPerSecond
+                )
+            batch.droppedBytes = 0
+            batch.droppedLines = 0
+
+        batch.chunks = []
+        batch.bytes = 0
+        batch.started = None
+
+        return batch.makeMessage(text)
@@ -1,4 +1,3 @@
-import json
 import socket
 import time
 import uuid
@@ -6,27 +5,72 @@ import logging
 import traceback
 import ssl
 import threading
+import test_looper.core.MessageCodec as MessageCodec
 import test_looper.core.socket_util as socket_util
 import test_looper.server.TestLooperServer as TestLooperServer
-import test_looper.core.algebraic_to_json as algebraic_to_json
+import test_looper.worker.OutgoingQueue as OutgoingQueue
 import base64
 import Queue
 
 class ProtocolMismatchException(Exception):
     pass
 
+class TestLog(object):
+    """The log of the test we're running, as we've sent it, and how much of it the server says it has."""
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.persisted = 0
+        #where we last resent from. Messages in flight when the server lost output all ask for the same resend.
+        self.resentFrom = None
+
+    def append(self, text):
+        """Add 'text' to the end of the log. Returns the offset it landed at."""
+        offset = self.size
+        self.chunks.append(text)
+        self.size += len(text)
+        return offset
+
+    def since(self, offset):
+        """Everything in the log from 'offset' on."""
+        pieces = []
+        remaining = self.size - offset
+
+        for chunk in reversed(self.chunks):
+            if remaining <= 0:
+                break
+            pieces.append(chunk[-remaining:] if remaining < len(chunk) else chunk)
+            remaining -= len(chunk)
+
+        return "".join(reversed(pieces))
+
 class TestLooperClient(object):
     HEARTBEAT_INTERVAL = 10.0
+    #how often to repeat a git repo request, in case the server restarted and lost its queue
+    GIT_REQUEST_RESEND_INTERVAL = 60.0
+    #ask the server to zlib-compress the connection, if it speaks the binary protocol
+    COMPRESS_MESSAGES = True
 
-    def __init__(self, host, port, use_ssl, machineId):
+    def __init__(self, host, port, use_ssl, machineId, slots=1):
         self.host = host
         self.port = port
         self.machineId = machineId
+        #how many tests the machine runs at once. We're the connection for one of them.
+        self.slots = slots
         self.use_ssl = use_ssl
         self._shouldStop = False
+        #held to encode and write a message, and to swap the socket or the codec, so each frame
+        #goes out on the connection whose codec (and compression stream) encoded it
         self._socketLock = threading.Lock()
         self._socket = None
-        self._clientToServerMessageQueue = Queue.Queue()
+        self._codec = self._newCodec()
+        #whether to offer the server a better protocol than JSON. Older servers drop us if we do.
+        self._offerProtocol = True
+        #whether we've offered on this connection and haven't heard back yet
+        self._negotiating = False
+        #messages that arrived while we were negotiating. We hold them so we know what the server speaks before we answer.
+        self._heldMessages = []
+        self._clientToServerMessageQueue = OutgoingQueue.OutgoingQueue()
         self._serverToClientMessageQueue = Queue.Queue()
         self._hitRepoPermissionQueues = {}
         self._readThread = threading.Thread(target=self._readLoop)
@@ -35,7 +79,14 @@ class TestLooperClient(object):
         self._curTestResults = None
         self._curDeploymentId = None
         self._curOutputs = None
+        self._curTestLog = None
         self._curArtifacts = None
+        #when we last told the server we're idle, or None if we should tell it right away
+        self._lastWaitingHeartbeat = None
+        #hash of the test the server says we'll probably run next
+        self._reservedTestHash = None
+        #called with (testHash, testDefinition) when the server reserves our next test
+        self.onTestReserved = None
         self._subscriptions = {}
         self._subscriptionsLock = threading.Lock()
 
@@ -76,8 +127,52 @@ class TestLooperClient(object):
             logging.info("Failed to connect to %s:%s for %s", self.host, self.port, self.machineId)
             raise
 
+        with self._socketLock:
+            #each connection starts over in JSON, with fresh compression streams
+            self._codec = self._newCodec()
+            self._heldMessages = []
+
+            if self._offerProtocol:
+                socket_util.writeString(s, self._codec.encode(
+                    TestLooperServer.ClientToServerMsg.NegotiateProtocol(
+                        versions=MessageCodec.SUPPORTED_VERSIONS,
+                        schema=self._codec.schema,
+                        compression=self.COMPRESS_MESSAGES
+                        )
+                    ))
+                self._negotiating = True
+
+            self._socket = s
+
         return s
 
+    def _serverTracksLogOffsets(self):
+        #servers that speak the binary protocol have the same message definitions we do
+        return self._codec.version == MessageCodec.BINARY
+
+    def _serverTakesCacheSummaries(self):
+        #older servers can't decode CacheSummary, and drop the connection if we send it
+        return self._codec.version == MessageCodec.BINARY
+
+    def _serverParksIdleWorkers(self):
+        #servers with our message definitions send us work when they have it, rather than waiting for us to ask
+        return self._codec.version == MessageCodec.BINARY
+
+    def _sendCurrentState(self, workerState):
+        self._send(
+            TestLooperServer.ClientToServerMsg.CurrentState(
+                machineId=self.machineId,
+                state=workerState
+                )
+            )
+
+        #older servers don't know about slots, and run one test per connection anyways
+        if self.slots > 1 and self._codec.version == MessageCodec.BINARY:
+            self._send(TestLooperServer.ClientToServerMsg.MachineSlots(slots=self.slots))
+
+    def _newCodec(self):
+        return MessageCodec.MessageCodec(TestLooperServer.ClientToServerMsg, TestLooperServer.ServerToClientMsg)
+
     def _writeLoop(self):
         while not self._shouldStop and self._socket is None:
             time.sleep(0.01)
@@ -87,17 +182,27 @@ class TestLooperClient(object):
             msg = self._clientToServerMessageQueue.get()
             if msg is not None:
                 try:
-                    self._writeString(json.dumps(algebraic_to_json.Encoder().to_json(msg)))
+                    with self._socketLock:
+                        self._writeString(self._codec.encode(msg))
                 except:
                     logging.error("Failed to send message %s to server:\n\n%s", msg, traceback.format_exc())
 
     def _readLoop(self):
         while not self._shouldStop:
-            msg = algebraic_to_json.Encoder().from_json(
-                json.loads(self._readString()),
-                TestLooperServer.ServerToClientMsg
-                )
-            if msg.matches.TerminalInput:
+            msg = self._codec.decode(self._readString())
+
+            if msg.matches.ProtocolSelected:
+                logging.info("Server chose protocol version %s, compression=%s", msg.version, msg.compression)
+                self._negotiating = False
+                with self._socketLock:
+                    self._codec.use(msg.version, msg.compression)
+
+                for held in self._heldMessages:
+                    self._serverToClientMessageQueue.put(held)
+                self._heldMessages = []
+            elif self._negotiating:
+                self._heldMessages.append(msg)
+            elif msg.matches.TerminalInput:
                 with self._subscriptionsLock:
                     if msg.deploymentId not in self._subscriptions:
                         self._subscriptions[msg.deploymentId] = []
@@ -124,7 +229,7 @@ class TestLooperClient(object):
             try:
                 while self._socket is None and not self._shouldStop:
                     try:
-                        self._socket = self._connect()
+                        self._connect()
                     except:
                         logging.error("Socket connect failed. Retrying.\n\n%s", traceback.format_exc())
                         time.sleep(5.0)
@@ -134,16 +239,32 @@ class TestLooperClient(object):
                 logging.error("Socket write failed: trying to reconnect.\n\n%s", traceback.format_exc())
                 self._socket = None
 
+                if self._negotiating:
+                    logging.warn("Server hung up without answering our protocol offer. Sticking to JSON.")
+                    self._offerProtocol = False
+                    self._negotiating = False
+
     def _writeString(self, s):
         return socket_util.writeString(self._socket, s)
 
     def _send(self, msg):
         self._clientToServerMessageQueue.put(msg)
 
-    def checkoutWork(self, waitTime):
+    def checkoutWork(self, waitTime, cachedBuilds=None, cachedImages=()):
         t0 = time.time()
         while time.time() - t0 < waitTime:
-            self._send(TestLooperServer.ClientToServerMsg.WaitingHeartbeat())
+            #servers that park idle workers only need to know we're alive
+            if (not self._serverParksIdleWorkers() or self._lastWaitingHeartbeat is None
+                    or time.time() - self._lastWaitingHeartbeat >= TestLooperClient.HEARTBEAT_INTERVAL):
+                if self._serverTakesCacheSummaries():
+                    self._send(
+                        TestLooperServer.ClientToServerMsg.CacheSummary(
+                            cachedBuilds=cachedBuilds or {},
+                            cachedImages=list(cachedImages)
+                            )
+                        )
+                self._send(TestLooperServer.ClientToServerMsg.WaitingHeartbeat())
+                self._lastWaitingHeartbeat = time.time()
 
             msg = None
             try:
@@ -153,20 +274,20 @@ class TestLooperClient(object):
 
             if msg is not None:
                 if msg.matches.IdentifyCurrentState:
-                    self._send(
-                        TestLooperServer.ClientToServerMsg.CurrentState(
-                            machineId=self.machineId,
-                            state=TestLooperServer.WorkerState.Waiting()
-                            )
-                        )
+                    self._sendCurrentState(TestLooperServer.WorkerState.Waiting())
+                    #it's a new connection, so the server needs to hear we're idle again
+                    self._lastWaitingHeartbeat = None
                 if msg.matches.TestAssignment:
+                    self._reservedTestHash = None
+                    self._lastWaitingHeartbeat = None
                     self._curTestId = msg.testId
-                    self._curOutputs = []
+                    self._curTestLog = TestLog()
                     self._curArtifacts = []
                     logging.info("New TestID is %s", self._curTestId)
                     return msg.testId, msg.testDefinition, False
 
                 if msg.matches.DeploymentAssignment:
+                    self._lastWaitingHeartbeat = None
                     self._curDeploymentId = msg.deploymentId
                     self._curOutputs = []
                     self._curArtifacts = []
@@ -187,10 +308,19 @@ class TestLooperClient(object):
                             artifacts=self._curArtifacts,
                             testSuccesses=self._curTestResults['testSuccesses']
                             )
+                    elif self._curTestId is not None and self._serverTracksLogOffsets():
+                        #only send what the server hasn't confirmed. It tells us if it needs more.
+                        self._curTestLog.resentFrom = None
+                        workerState=TestLooperServer.WorkerState.WorkingOnTestFrom(
+                            testId=self._curTestId,
+                            log_offset=self._curTestLog.persisted,
+                            logs_since=self._curTestLog.since(self._curTestLog.persisted),
+                            artifacts=self._curArtifacts
+                            )
                     elif self._curTestId is not None:
                         workerState=TestLooperServer.WorkerState.WorkingOnTest(
                             testId=self._curTestId,
-                            logs_so_far="".join(self._curOutputs),
+                            logs_so_far=self._curTestLog.since(0),
                             artifacts=self._curArtifacts
                             )
                     elif self._curDeploymentId is not None:
@@ -201,24 +331,46 @@ class TestLooperClient(object):
                     else:
                         workerState=TestLooperServer.WorkerState.Waiting()
 
-                    self._send(
-                        TestLooperServer.ClientToServerMsg.CurrentState(
-                            machineId=self.machineId,
-                            state=workerState
+                    self._sendCurrentState(workerState)
+                if m.matches.LogsPersisted and self._curTestId == m.testId:
+                    if m.resend and m.offset != self._curTestLog.resentFrom:
+                        logging.info("Server lost the log of test %s past byte %s. Sending it again.", m.testId, m.offset)
+                        self._send(
+                            TestLooperServer.ClientToServerMsg.TestLogOutputAt(
+                                testId=m.testId,
+                                offset=m.offset,
+                                log=self._curTestLog.since(m.offset)
+                                )
                             )
-                        )
-                if m.matches.GrantOrDenyPermissionToHitGitRepo:
+                        self._curTestLog.persisted = m.offset
+                        self._curTestLog.resentFrom = m.offset
+                    elif not m.resend:
+                        self._curTestLog.persisted = max(self._curTestLog.persisted, m.offset)
+                if m.matches.NextTestReserved:
+                    logging.info("Server reserved test %s (%s) to run next.", m.testDefinition.name, m.testHash)
+                    self._reservedTestHash = m.testHash
+                    if self.onTestReserved is not None:
+                        try:
+                            self.onTestReserved(m.testHash, m.testDefinition)
+                        except:
+                            logging.error("Failed to start prefetching test %s:\n%s", m.testHash, traceback.format_exc())
+                if m.matches.ReservationRevoked and self._reservedTestHash == m.testHash:
+                    logging.info("Server revoked the reservation of test %s.", m.testHash)
+                    self._reservedTestHash = None
+                if m.matches.GrantOrDenyPermissionToHitGitRepo and m.requestUniqueId in self._hitRepoPermissionQueues:
                     self._hitRepoPermissionQueues[m.requestUniqueId].put(m.allowed)
                 if m.matches.AcknowledgeFinishedTest and self._curTestId == m.testId:
                     logging.info("TestLooperServer acknowledged test completion.")
+                    self._clientToServerMessageQueue.discardLogs(self._curTestId)
                     self._curTestId = None
-                    self._curOutputs = None
+                    self._curTestLog = None
                     self._curArtifacts = None
                     self._curTestResults = None
                 if m.matches.CancelTest and self._curTestId == m.testId:
                     logging.info("TestLooper canceling test %s", self._curTestId)
+                    self._clientToServerMessageQueue.discardLogs(self._curTestId)
                     self._curTestId = None
-                    self._curOutputs = None
+                    self._curTestLog = None
                     self._curArtifacts = None
                     self._curTestResults = None
                 if m.matches.ShutdownDeployment and self._curDeploymentId == m.deploymentId:
@@ -229,6 +381,9 @@ class TestLooperClient(object):
         except Queue.Empty:
             pass
 
+    def reservedTestHash(self):
+        return self._reservedTestHash
+
     def heartbeat(self, msg=None):
         if self._shouldStop:
             raise Exception("Shutting down")
@@ -239,8 +394,19 @@ class TestLooperClient(object):
             if msg is None:
                 self._send(TestLooperServer.ClientToServerMsg.TestHeartbeat(testId=self._curTestId))
             else:
-                self._curOutputs.append(msg)
-                self._send(TestLooperServer.ClientToServerMsg.TestLogOutput(testId=self._curTestId, log=msg))
+                testId = self._curTestId
+                testLog = self._curTestLog
+
+                def makeMessage(log):
+                    #batches join the log when they're sent, dropped-output notices included, so our
+                    #copy matches the server's. Recording only what putLog kept would fall short of it.
+                    offset = testLog.append(log)
+
+                    if self._serverTracksLogOffsets():
+                        return TestLooperServer.ClientToServerMsg.TestLogOutputAt(testId=testId, offset=offset, log=log)
+                    return TestLooperServer.ClientToServerMsg.TestLogOutput(testId=testId, log=log)
+
+                self._clientToServerMessageQueue.putLog(testId, msg, makeMessage)
 
         elif self._curDeploymentId is not None:
             if msg is None:
@@ -254,6 +420,9 @@ class TestLooperClient(object):
     def requestPermissionToHitGitRepo(self):
         """Request permission to hit the git repo and then block. Returns a guid if successful.
         Otherwise None. Throws if we get disconnected.
+
+        The server queues the request and tells us when it's our turn. We keep
+        heartbeating while we wait so the server doesn't think we've died.
         """
 
         reqId = str(uuid.uuid4())
@@ -265,22 +434,31 @@ class TestLooperClient(object):
 
         self._send(TestLooperServer.ClientToServerMsg.RequestPermissionToHitGitRepo(requestUniqueId=reqId, curTestOrDeployId=curId))
 
-        #now poll until we have permission
-        t0 = time.time()
-        while True:
-            try:
-                if time.time() - t0 > 10:
-                    #something's wrong - try again
-                    self._send(TestLooperServer.ClientToServerMsg.RequestPermissionToHitGitRepo(requestUniqueId=reqId, curTestOrDeployId=curId))
+        lastRequest = lastHeartbeat = time.time()
 
-                if queue.get(timeout=.1):
-                    return reqId
-                else:
-                    return None
+        try:
+            while True:
+                self.consumeMessages()
 
-            except Queue.Empty:
-                if curId != (self._curTestId or self._curDeploymentId):
-                    raise Exception("Server canceled the test.")
+                try:
+                    if queue.get(timeout=.1):
+                        return reqId
+                    else:
+                        return None
+
+                except Queue.Empty:
+                    if curId != (self._curTestId or self._curDeploymentId):
+                        raise Exception("Server canceled the test.")
+
+                    if time.time() - lastHeartbeat > TestLooperClient.HEARTBEAT_INTERVAL:
+                        self.heartbeat()
+                        lastHeartbeat = time.time()
+
+                    if time.time() - lastRequest > TestLooperClient.GIT_REQUEST_RESEND_INTERVAL:
+                        self._send(TestLooperServer.ClientToServerMsg.RequestPermissionToHitGitRepo(requestUniqueId=reqId, curTestOrDeployId=curId))
+                        lastRequest = time.time()
+        finally:
+            del self._hitRepoPermissionQueues[reqId]
 
     def releaseGitRepoLock(self, requestUniqueId):
         self._send(TestLooperServer.ClientToServerMsg.GitRepoPullCompleted(requestUniqueId))
@@ -344,6 +522,9 @@ class TestLooperClient(object):
         assert self._curTestId is not None
 
         self._curTestResults = {'success': succeeded, 'testSuccesses': individualTestSuccesses}
+
+        #the server has to see the last of the logs before the result
+        self._clientToServerMessageQueue.flushLogs(self._curTestId)
         self._send(TestLooperServer.ClientToServerMsg.TestFinished(testId=self._curTestId, success=succeeded, artifacts=self._curArtifacts, testSuccesses=individualTestSuccesses))
 
         while self._curTestId is not None:
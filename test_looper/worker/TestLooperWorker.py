@@ -35,7 +35,8 @@ class TestLooperWorker(object):
                  machineId,
                  serverPortConfig,
                  exitProcessOnException,
-                 timeToSleepWhenThereIsNoWork
+                 timeToSleepWhenThereIsNoWork,
+                 slots=1
                 ):
         self.workerState = workerState
         self.machineId = machineId
@@ -47,7 +48,19 @@ class TestLooperWorker(object):
 
         self.exitProcessOnException = exitProcessOnException
 
-        self.testLooperClient = None
+        #how many tests we run at once. Each slot has its own connection to the server.
+        self.slots = slots
+
+        if slots == 1:
+            self.slotStates = [workerState]
+        else:
+            self.slotStates = [workerState.slotState(slot, slots) for slot in xrange(slots)]
+
+        self.testLooperClients = []
+
+        #hashes of the reserved tests whose dependencies are queued for, or being, prefetched
+        self._prefetching = set()
+        self._prefetchLock = threading.Lock()
 
         self.thread = None
 
@@ -56,7 +69,8 @@ class TestLooperWorker(object):
             host=self.serverPortConfig.server_address,
             port=self.serverPortConfig.server_worker_port,
             use_ssl=self.serverPortConfig.server_worker_port_use_ssl,
-            machineId=self.machineId
+            machineId=self.machineId,
+            slots=self.slots
             )
 
     def stop(self, join=True):
@@ -64,8 +78,8 @@ class TestLooperWorker(object):
             logging.info("TestLooperWorker stopping")
             self.stopEvent.set()
 
-            if self.testLooperClient:
-                self.testLooperClient.stop()
+            for client in list(self.testLooperClients):
+                client.stop()
 
             if self.thread:
                 if join:
@@ -81,13 +95,27 @@ class TestLooperWorker(object):
 
     def _mainTestLoop(self):
         try:
-            self.testLooperClient = self.createTestLooperClient()
-
-            while not self.stopEvent.is_set():
-                work = self.testLooperClient.checkoutWork(self.timeToSleepWhenThereIsNoWork)
-                if work is not None:
-                    testOrDeployId, testDefinition, isDeploy = work
-                    self.run_task(testOrDeployId, testDefinition, isDeploy)
+            if len(self.slotStates) == 1:
+                self._slotLoop(self.slotStates[0])
+            else:
+                slotExited = threading.Event()
+
+                def slotLoop(workerState):
+                    try:
+                        self._slotLoop(workerState)
+                    except:
+                        logging.critical("Unhandled error in slot %s of TestLooperWorker:\n%s", workerState.slot, traceback.format_exc())
+                    finally:
+                        slotExited.set()
+
+                threads = [threading.Thread(target=slotLoop, args=(workerState,)) for workerState in self.slotStates]
+                for t in threads:
+                    t.daemon = True
+                    t.start()
+
+                #slots only exit when we're stopping or something broke, and either way the rest should go too
+                while not slotExited.wait(1.0):
+                    pass
         except:
             logging.critical("Unhandled error in TestLooperWorker socket loop:\n%s", traceback.format_exc())
         finally:
@@ -98,22 +126,64 @@ class TestLooperWorker(object):
             else:
                 logging.info("Machine %s is exiting the TestLooperWorker but not the process.", self.machineId)
 
-    def run_task(self, testId, testDefinition, isDeploy):
-        logging.info("Machine %s is working on %s %s, which is %s with hash %s",
+    def _slotLoop(self, workerState):
+        testLooperClient = self.createTestLooperClient()
+        testLooperClient.onTestReserved = lambda testHash, testDefinition: self._prefetch(workerState, testLooperClient, testHash, testDefinition)
+        self.testLooperClients.append(testLooperClient)
+
+        while not self.stopEvent.is_set():
+            work = testLooperClient.checkoutWork(
+                self.timeToSleepWhenThereIsNoWork,
+                workerState.cachedBuildSummary(),
+                workerState.cachedImageSummary()
+                )
+            if work is not None:
+                testOrDeployId, testDefinition, isDeploy = work
+                self.run_task(testOrDeployId, testDefinition, isDeploy, workerState, testLooperClient)
+
+    def _prefetch(self, workerState, testLooperClient, testHash, testDefinition):
+        """Fetch the dependencies of the test the server reserved for us, while the current one runs.
+
+        This waits its turn in the machine's download pool along with everything else we download.
+        """
+        with self._prefetchLock:
+            if testHash in self._prefetching:
+                return
+            self._prefetching.add(testHash)
+
+        def shouldContinue():
+            return not self.stopEvent.is_set() and testLooperClient.reservedTestHash() == testHash
+
+        def prefetch():
+            try:
+                workerState.prefetchDependencies(testDefinition, shouldContinue)
+            except:
+                #the test will try again when it runs
+                logging.warn("Failed to prefetch dependencies of %s:\n%s", testDefinition.name, traceback.format_exc())
+
+        def finished(future):
+            with self._prefetchLock:
+                self._prefetching.discard(testHash)
+
+        workerState.downloadPool.submit(prefetch).addDoneCallback(finished)
+
+    def run_task(self, testId, testDefinition, isDeploy, workerState, testLooperClient):
+        logging.info("Machine %s%s is working on %s %s, which is %s with hash %s",
                      self.machineId,
+                     "" if workerState.slot is None else " slot %s" % workerState.slot,
                      "test" if not isDeploy else "deployment",
                      testId,
                      testDefinition.name,
                      testDefinition.hash
                      )
 
-        self.workerState.purge_build_cache()
+        workerState.purge_build_cache()
 
-        result = self.workerState.runTest(testId, self.testLooperClient, testDefinition, isDeploy)
+        result = workerState.runTest(testId, testLooperClient, testDefinition, isDeploy)
         
         if not self.stopEvent.is_set():
             if isDeploy:
-                self.testLooperClient.deploymentExitedEarly()
+                testLooperClient.deploymentExitedEarly()
             else:
                 result, individualTestSuccesses = result
-                self.testLooperClient.publishTestResult(result, individualTestSuccesses)
+                testLooperClient.publishTestResult(result, individualTestSuccesses)
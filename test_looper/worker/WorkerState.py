@@ -22,6 +22,8 @@ import uuid
 for name in ["boto3", "requests", "urllib"]:
     logging.getLogger(name).setLevel(logging.CRITICAL)
 
+import test_looper.core.Config as Config
+import test_looper.core.Futures as Futures
 import test_looper.core.SubprocessRunner as SubprocessRunner
 import test_looper.core.tools.Git as Git
 
@@ -35,6 +37,7 @@ else:
     DockerWatcher = None
 
 import test_looper.data_model.TestDefinition as TestDefinition
+import test_looper.worker.CacheLeases as CacheLeases
 import test_looper
 
 def withTime(logger):
@@ -48,6 +51,57 @@ def withTime(logger):
 
         
 
+#how many dependencies a machine downloads at once, across all of its slots
+DEPENDENCY_DOWNLOAD_THREADS = 4
+
+#how much of a download we read at a time once the tarball inside it has ended
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+class _TeeReader(object):
+    """Reads from 'source', and writes whatever it reads to 'sink' as well."""
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+        self.bytes = 0
+
+    def read(self, size):
+        data = self.source.read(size)
+        self.sink.write(data)
+        self.bytes += len(data)
+        return data
+
+    def drain(self):
+        while self.read(STREAM_CHUNK_BYTES):
+            pass
+
+def extractWhileCaching(source, package_file, target_dir):
+    """Extract the gzipped tarball that 'source' reads into 'target_dir' as it arrives, and keep a copy at 'package_file'.
+
+    The copy goes to 'package_file' + ".partial" until we've read all of it, so 'package_file'
+    is always complete. We close 'source'. Returns the size of the tarball.
+    """
+    partial = package_file + ".partial"
+
+    try:
+        with open(partial, "wb") as cached:
+            tee = _TeeReader(source, cached)
+
+            with tarfile.open(fileobj=tee, mode="r|gz") as tar:
+                tar.extractall(target_dir)
+
+            #gzip can put bytes after the end of the archive, and the cached copy needs them
+            tee.drain()
+
+        os.rename(partial, package_file)
+
+        return tee.bytes
+    except:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        source.close()
+
 class DummyWorkerCallbacks:
     def __init__(self, localTerminal=False):
         self.logMessages = []
@@ -85,25 +139,29 @@ class NAKED_MACHINE:
     pass
 
 class TestLooperDirectories:
-    def __init__(self, worker_directory):
+    def __init__(self, worker_directory, slot=None):
+        #a slot gets its own copy of everything a test writes to. The caches belong to the machine.
+        run_directory = worker_directory if slot is None else os.path.join(worker_directory, "slot_%s" % slot)
+
         self.repo_cache = os.path.join(worker_directory, "repos")
-        self.repo_copy_dir = os.path.join(worker_directory, "src")
-        self.scratch_dir = os.path.join(worker_directory, "scratch_dir")
-        self.command_dir = os.path.join(worker_directory, "command")
-        self.test_inputs_dir = os.path.join(worker_directory, "test_inputs")
-        self.test_output_dir = os.path.join(worker_directory, "test_output")
-        self.build_output_dir = os.path.join(worker_directory, "build_output")
-        self.test_data_dir = os.path.join(worker_directory, "test_data")
+        self.repo_copy_dir = os.path.join(run_directory, "src")
+        self.scratch_dir = os.path.join(run_directory, "scratch_dir")
+        self.command_dir = os.path.join(run_directory, "command")
+        self.test_inputs_dir = os.path.join(run_directory, "test_inputs")
+        self.test_output_dir = os.path.join(run_directory, "test_output")
+        self.build_output_dir = os.path.join(run_directory, "build_output")
+        self.test_data_dir = os.path.join(run_directory, "test_data")
         self.build_cache_dir = os.path.join(worker_directory, "build_cache")
         self.ccache_dir = os.path.join(worker_directory, "ccache")
-        self.worker_directory = worker_directory
+        #where dependencies get exposed to the test
+        self.worker_directory = run_directory
 
     def all(self):
         return [self.repo_copy_dir, self.scratch_dir, self.command_dir, self.test_inputs_dir, self.test_data_dir, 
                 self.build_cache_dir, self.ccache_dir, self.test_output_dir, self.build_output_dir, self.repo_cache]
 
 class WorkerState(object):
-    def __init__(self, name_prefix, worker_directory, source_control, artifactStorage, machineId, hardwareConfig, verbose=False, docker_image_repo=None):
+    def __init__(self, name_prefix, worker_directory, source_control, artifactStorage, machineId, hardwareConfig, verbose=False, docker_image_repo=None, slot=None, cacheLeases=None):
         import test_looper.worker.TestLooperWorker
 
         self.name_prefix = name_prefix
@@ -115,7 +173,14 @@ class WorkerState(object):
 
         self.verbose = verbose
 
-        self.directories = TestLooperDirectories(worker_directory)
+        #which of the machine's slots we run tests in, or None if the machine runs one test at a time
+        self.slot = slot
+
+        self.directories = TestLooperDirectories(worker_directory, slot)
+
+        self.cacheLeases = cacheLeases or CacheLeases.CacheLeases()
+
+        self.downloadPool = Futures.FuturePool(DEPENDENCY_DOWNLOAD_THREADS, "DependencyDownloads")
 
         self.repos_by_name = {}
 
@@ -134,8 +199,36 @@ class WorkerState(object):
 
         self.docker_image_repo = docker_image_repo
 
+        #hashes of the dockerfiles whose images we've built or pulled
+        self.docker_images_seen = set()
+
         self.cleanup()
 
+    def slotState(self, slot, slots):
+        """A WorkerState for slot 'slot' of 'slots' on this machine.
+
+        It gets its share of the hardware, its own directories and docker containers,
+        and shares our caches with the other slots.
+        """
+        state = WorkerState(
+            self.name_prefix + "_slot%s_" % slot,
+            self.worker_directory,
+            self.source_control,
+            self.artifactStorage,
+            self.machineId,
+            Config.HardwareConfig(
+                cores=max(1, self.hardwareConfig.cores // slots),
+                ram_gb=max(1, self.hardwareConfig.ram_gb // slots)
+                ),
+            verbose=self.verbose,
+            docker_image_repo=self.docker_image_repo,
+            slot=slot,
+            cacheLeases=self.cacheLeases
+            )
+        state.docker_images_seen = self.docker_images_seen
+        state.downloadPool = self.downloadPool
+        return state
+
     def callHeartbeatInBackground(self, log_function, logMessage=None):
         if logMessage is not None:
             log_function(time.asctime() + " TestLooper> " + logMessage + "\n")
@@ -183,7 +276,9 @@ class WorkerState(object):
 
     def cleanup(self):
         if Docker is not None:
-            Docker.DockerImage.removeDanglingDockerImages()
+            #another slot may be building an image, so only the machine as a whole cleans up images
+            if self.slot is None:
+                Docker.DockerImage.removeDanglingDockerImages()
             Docker.killAllWithNamePrefix(self.name_prefix)
 
         self.clearDirectoryAsRoot(
@@ -242,6 +337,17 @@ class WorkerState(object):
             self.directories.command_dir: "/test_looper/command"
             }
 
+    def dockerResourceLimits(self):
+        """Keep a slot's test containers to its share of the machine."""
+        if self.slot is None:
+            return {}
+
+        return {
+            "cpu_period": 100000,
+            "cpu_quota": self.hardwareConfig.cores * 100000,
+            "mem_limit": "%sg" % self.hardwareConfig.ram_gb
+            }
+
     def _run_deployment(self, env, workerCallback, docker_image, extra_commands, working_directory, extraPorts=None):
         build_log = StringIO.StringIO()
 
@@ -682,7 +788,8 @@ class WorkerState(object):
                     privileged=True,
                     shm_size="1G",
                     environment=env,
-                    working_dir=working_directory
+                    working_dir=working_directory,
+                    **self.dockerResourceLimits()
                     )
 
                 t0 = time.time()
@@ -717,12 +824,13 @@ class WorkerState(object):
                 tail_proc.stop()
 
     def resetToCommitInDir(self, repoName, commitHash, pathWithinRepo, targetDir):
-        git_repo = self.getRepoCacheByName(repoName)
+        with self.cacheLeases.lease(os.path.join(self.directories.repo_cache, repoName)):
+            git_repo = self.getRepoCacheByName(repoName)
 
-        if not git_repo.isInitialized():
-            git_repo.cloneFrom(self.source_control.getRepo(repoName).cloneUrl())
+            if not git_repo.isInitialized():
+                git_repo.cloneFrom(self.source_control.getRepo(repoName).cloneUrl())
 
-        git_repo.resetToCommitInDirectory(commitHash, targetDir)
+            git_repo.resetToCommitInDirectory(commitHash, targetDir)
         os.unlink(os.path.join(targetDir, ".git"))
 
         if pathWithinRepo:
@@ -763,21 +871,61 @@ class WorkerState(object):
         self.ensureDirectoryExists(self.directories.build_cache_dir)
         
         while self._is_build_cache_full(cacheSize if cacheSize is not None else self.max_build_cache_depth):
-            self._remove_oldest_cached_build()
+            if not self._remove_oldest_cached_build():
+                #everything that's left is in use by some slot
+                return
+
+    def _cached_build_names(self):
+        """The files in the build cache, leaving out downloads that are still in progress."""
+        return [name for name in os.listdir(self.directories.build_cache_dir) if not name.endswith(".partial")]
 
     def _is_build_cache_full(self, cacheSize):
-        cache_count = len(os.listdir(self.directories.build_cache_dir))
+        cache_count = len(self._cached_build_names())
 
         logging.info("Checking the build cache: there are %s items in it", cache_count)
 
         return cache_count > cacheSize
 
     def _remove_oldest_cached_build(self):
+        """Remove the oldest build no slot is using. Returns False if they're all in use."""
         def full_path(p):
             return os.path.join(self.directories.build_cache_dir, p)
-        cached_builds = sorted([(os.path.getctime(full_path(p)), full_path(p))
+        def ctime(p):
+            try:
+                return os.path.getctime(p)
+            except OSError:
+                return 0.0
+        cached_builds = sorted([(ctime(full_path(p)), full_path(p))
                                 for p in os.listdir(self.directories.build_cache_dir)])
-        os.remove(cached_builds[0][1])
+        for _, path in cached_builds:
+            try:
+                if self.cacheLeases.removeUnlessLeased(path):
+                    return True
+            except OSError:
+                #another slot got to it first
+                return True
+        return False
+
+    def cachedBuildSummary(self):
+        """Bytes of build tarballs in the build cache, by build hash."""
+        res = {}
+
+        try:
+            names = self._cached_build_names()
+        except OSError:
+            return res
+
+        for name in names:
+            buildHash = name.split("_")[0]
+            try:
+                res[buildHash] = res.get(buildHash, 0) + os.path.getsize(os.path.join(self.directories.build_cache_dir, name))
+            except OSError:
+                pass
+
+        return res
+
+    def cachedImageSummary(self):
+        return sorted(self.docker_images_seen)
 
     def getDockerImage(self, testEnvironment, log_function):
         assert testEnvironment.matches.Environment
@@ -788,13 +936,18 @@ class WorkerState(object):
             if testEnvironment.image.matches.Dockerfile:
                 assert False, "This should have been resolved to dockerfile contents already."
             else:
-                return Docker.DockerImage.from_dockerfile_as_string(
-                    self.docker_image_repo, 
-                    testEnvironment.image.dockerfile_contents, 
-                    create_missing=True, 
-                    env_keys_to_passthrough=PASSTHROUGH_KEYS,
-                    logger=withTime(log_function)
-                    )
+                dockerfileHash = Docker.hash_string(testEnvironment.image.dockerfile_contents)
+
+                with self.cacheLeases.lease("docker_image_" + dockerfileHash):
+                    image = Docker.DockerImage.from_dockerfile_as_string(
+                        self.docker_image_repo, 
+                        testEnvironment.image.dockerfile_contents, 
+                        create_missing=True, 
+                        env_keys_to_passthrough=PASSTHROUGH_KEYS,
+                        logger=withTime(log_function)
+                        )
+                self.docker_images_seen.add(dockerfileHash)
+                return image
         except Exception as e:
             log_function(time.asctime() + " TestLooper> Failed to build docker image:\n" + str(e))
 
@@ -896,70 +1049,147 @@ class WorkerState(object):
             if not self.artifactStorage.build_exists(dep.buildHash, self.artifactKeyForBuild(full_name)):
                 return "can't run tests because dependent external build %s doesn't exist" % (dep.buildHash + "/" + full_name)
 
-            path = self._download_build(dep.buildHash, full_name, log_function)
-            
-            log_function(time.asctime() + " TestLooper> Extracting tarball for %s/%s.\n" % (dep.buildHash, full_name))
-
-            self.ensureDirectoryExists(target_dir)
-            self.extract_package(path, target_dir)
+            path = self._buildCachePathFor(dep.buildHash, full_name)
+
+            #hold the tarball until it's extracted, so no other slot purges it first
+            with self.cacheLeases.lease(path):
+                self._extractBuild(
+                    dep.buildHash, 
+                    self.artifactKeyForBuild(full_name), 
+                    path, 
+                    target_dir, 
+                    log_function, 
+                    "tarball for %s/%s" % (dep.buildHash, full_name)
+                    )
 
             return None
 
         if dep.matches.Source:
-            #keep the source tarballs separate by os-root, since windows line endings
-            #play havoc with linux builds!
-            source_platform_name = "source-linux" if sys.platform != "win32" else "source-win"
-
-            if dep.path:
-                source_platform_name = os.path.join(source_platform_name, dep.path)
-
-            sourceArtifactName = self.artifactKeyForBuild(source_platform_name)
-
-            tarball_name = self._buildCachePathFor(dep.commitHash, source_platform_name)
+            sourceArtifactName, tarball_name = self._sourceTarballFor(dep)
 
             log_function(time.asctime() + " TestLooper> Target tarball for %s/%s source is %s\n" 
                         % (dep.repo, dep.commitHash, tarball_name))
 
-            if not self.artifactStorage.build_exists(dep.commitHash, sourceArtifactName):
-                log_function(time.asctime() + " TestLooper> Building source cache for %s/%s at %s\n" 
-                        % (dep.repo, dep.commitHash, target_dir))
+            with self.cacheLeases.lease(tarball_name):
+                if not self.artifactStorage.build_exists(dep.commitHash, sourceArtifactName):
+                    log_function(time.asctime() + " TestLooper> Building source cache for %s/%s at %s\n" 
+                            % (dep.repo, dep.commitHash, target_dir))
 
-                if os.path.exists(target_dir):
-                    shutil.rmtree(target_dir)
+                    if os.path.exists(target_dir):
+                        shutil.rmtree(target_dir)
 
-                with worker_callback.scopedReadLockAroundGitRepo():
-                    self.resetToCommitInDir(dep.repo, dep.commitHash, dep.path, target_dir)
+                    with worker_callback.scopedReadLockAroundGitRepo():
+                        self.resetToCommitInDir(dep.repo, dep.commitHash, dep.path, target_dir)
 
-                with tarfile.open(tarball_name, "w:gz", compresslevel=1) as tf:
-                    tf.add(target_dir, ".")
+                    with tarfile.open(tarball_name, "w:gz", compresslevel=1) as tf:
+                        tf.add(target_dir, ".")
 
-                log_function(time.asctime() + " TestLooper> Resulting tarball at %s is %.2f MB.\n" %(tarball_name, os.stat(tarball_name).st_size / 1024.0**2))
+                    log_function(time.asctime() + " TestLooper> Resulting tarball at %s is %.2f MB.\n" %(tarball_name, os.stat(tarball_name).st_size / 1024.0**2))
 
-                try:
-                    log_function(
-                        time.asctime() + " TestLooper> Uploading %s to %s/%s/%s\n" % 
-                            (tarball_name, dep.repo, dep.commitHash, sourceArtifactName)
+                    try:
+                        log_function(
+                            time.asctime() + " TestLooper> Uploading %s to %s/%s/%s\n" % 
+                                (tarball_name, dep.repo, dep.commitHash, sourceArtifactName)
+                            )
+                        self.artifactStorage.upload_build(dep.commitHash, sourceArtifactName, tarball_name)
+                    except:
+                        log_function(time.asctime() + " TestLooper> Failed to upload package '%s':\n%s" % (
+                              tarball_name,
+                              traceback.format_exc()
+                              ))
+                else:
+                    self._extractBuild(
+                        dep.commitHash, 
+                        sourceArtifactName, 
+                        tarball_name, 
+                        target_dir, 
+                        log_function, 
+                        "source cache for %s/%s" % (dep.repo, dep.commitHash)
                         )
-                    self.artifactStorage.upload_build(dep.commitHash, sourceArtifactName, tarball_name)
-                except:
-                    log_function(time.asctime() + " TestLooper> Failed to upload package '%s':\n%s" % (
-                          tarball_name,
-                          traceback.format_exc()
-                          ))
-            else:
-                if not os.path.exists(tarball_name):
-                    log_function(time.asctime() + " TestLooper> Downloading source cache for %s/%s.\n" % (dep.repo, dep.commitHash))
-                
-                    self.artifactStorage.download_build(dep.commitHash, sourceArtifactName, tarball_name)
-
-                log_function(time.asctime() + " TestLooper> Extracting source cache for %s/%s.\n" % (dep.repo, dep.commitHash))
-
-                self.extract_package(tarball_name, target_dir)
 
             return None
 
         return "Unknown dependency type: %s" % dep
 
+    def _extractBuild(self, buildHash, key_name, package_file, target_dir, log_function, description):
+        """Extract build 'key_name' into 'target_dir', from the build cache at 'package_file' if it's there.
+
+        If it isn't, we extract it as it downloads and fill in the build cache as we go.
+        Callers hold a lease on 'package_file'.
+        """
+        self.ensureDirectoryExists(target_dir)
+
+        if os.path.exists(package_file):
+            log_function(time.asctime() + " TestLooper> Extracting cached %s.\n" % description)
+            self.extract_package(package_file, target_dir)
+            return
+
+        log_function(time.asctime() + " TestLooper> Downloading and extracting %s.\n" % description)
+
+        t0 = time.time()
+
+        #the purge doesn't know the partial download belongs to 'package_file', so hold it too
+        with self.cacheLeases.lease(package_file + ".partial"):
+            size = extractWhileCaching(self.artifactStorage.open_build(buildHash, key_name), package_file, target_dir)
+
+        log_function(time.asctime() + " TestLooper> Downloaded and extracted %s (%.2f MB) in %.1f seconds.\n" % 
+            (description, size / 1024.0 ** 2, time.time() - t0))
+
+    def _sourceTarballFor(self, dep):
+        """The artifact name and build cache path of the source tarball for a Source dependency."""
+        #keep the source tarballs separate by os-root, since windows line endings
+        #play havoc with linux builds!
+        source_platform_name = "source-linux" if sys.platform != "win32" else "source-win"
+
+        if dep.path:
+            source_platform_name = os.path.join(source_platform_name, dep.path)
+
+        return self.artifactKeyForBuild(source_platform_name), self._buildCachePathFor(dep.commitHash, source_platform_name)
+
+    def prefetchDependencies(self, test_definition, shouldContinue=lambda: True):
+        """Fetch what 'test_definition' needs into the machine's caches, while we're still running another test.
+
+        We only fill in the build cache and docker images, and leave the directories of the running test
+        alone. Source that nobody has packaged yet needs the git repo, so the test does that itself.
+        We stop early once 'shouldContinue' returns False.
+        """
+        log_function = lambda msg: logging.debug("Prefetching %s: %s", test_definition.name, msg.rstrip())
+
+        environment = test_definition.environment
+
+        test_definition = TestDefinition.apply_variable_substitution_to_test(
+            test_definition,
+            self.environment_variables(None, environment, test_definition)
+            )
+
+        all_dependencies = {}
+        all_dependencies.update(environment.dependencies)
+        all_dependencies.update(test_definition.dependencies)
+
+        if not environment.image.matches.AMI and shouldContinue():
+            self.getDockerImage(environment, log_function)
+
+        for expose_as, dep in sorted(all_dependencies.iteritems()):
+            if not shouldContinue():
+                return
+
+            if dep.matches.Build:
+                full_name = dep.name + ("/" if dep.artifact else "") + dep.artifact
+
+                if self.artifactStorage.build_exists(dep.buildHash, self.artifactKeyForBuild(full_name)):
+                    with self.cacheLeases.lease(self._buildCachePathFor(dep.buildHash, full_name)):
+                        self._download_build(dep.buildHash, full_name, log_function)
+
+            if dep.matches.Source:
+                sourceArtifactName, tarball_name = self._sourceTarballFor(dep)
+
+                if self.artifactStorage.build_exists(dep.commitHash, sourceArtifactName):
+                    with self.cacheLeases.lease(tarball_name):
+                        if not os.path.exists(tarball_name):
+                            self.artifactStorage.download_build(dep.commitHash, sourceArtifactName, tarball_name)
+
+        logging.info("Prefetched dependencies of %s", test_definition.name)
+
     def getEnvironmentAndDependencies(self, testId, test_definition, log_function, worker_callback):
         environment = test_definition.environment
         
@@ -972,9 +1202,6 @@ class WorkerState(object):
         all_dependencies.update(environment.dependencies)
         all_dependencies.update(test_definition.dependencies)
 
-        image = [None]
-        image_exception = [None]
-
         lock = threading.Lock()
 
         def heartbeatWithLock(msg=None):
@@ -986,57 +1213,61 @@ class WorkerState(object):
                 "Pulling dependencies:\n%s" % "\n".join(["\t%s -> %s" % (k,v) for k,v in sorted(all_dependencies.iteritems())])
                 ):
 
-            results = {}
-
-            def pullImage():
-                if environment.image.matches.AMI:
-                    image[0] = NAKED_MACHINE
-                else:
-                    try:
-                        image[0] = self.getDockerImage(environment, heartbeatWithLock)
-                    except:
-                        image_exception[0] = traceback.format_exc()
+            t0 = time.time()
 
+            #the image comes from docker rather than artifact storage, so it doesn't wait for a download thread
+            if environment.image.matches.AMI:
+                imageFuture = None
+            else:
+                imageFuture = Futures.spawn(self.getDockerImage, environment, heartbeatWithLock)
 
-            def callFun(expose_as, dep):
+            def pull(expose_as, dep):
                 for tries in xrange(3):
                     try:
-                        results[expose_as] = self.grabDependency(heartbeatWithLock, expose_as, dep, worker_callback)
-                        heartbeatWithLock(time.asctime() + " TestLooper> Done pulling %s.\n" % dep)
-                        return
+                        return self.grabDependency(heartbeatWithLock, expose_as, dep, worker_callback)
                     except Exception as e:
-                        if tries < 2:
-                            heartbeatWithLock(time.asctime() + " TestLooper> Failed to pull %s because %s, but retrying.\n" % (dep, str(e)))
-
-                        results[expose_as] = traceback.format_exc()
-
-            waiting_threads = []
-
-            waiting_threads.append(threading.Thread(target=pullImage))
-
-            for expose_as_and_dep in all_dependencies.iteritems():
-                waiting_threads.append(threading.Thread(target=callFun, args=expose_as_and_dep))
-
-            running_threads = []
-
-            simultaneous = self.hardwareConfig.cores
-
-            while running_threads + waiting_threads:
-                running_threads = [x for x in running_threads if x.isAlive()]
-                while len(running_threads) < simultaneous and waiting_threads:
-                    t = waiting_threads.pop(0)
-                    t.start()
-                    running_threads.append(t)
-                time.sleep(1.0)
+                        if tries == 2:
+                            raise
+                        heartbeatWithLock(time.asctime() + " TestLooper> Failed to pull %s because %s, but retrying.\n" % (dep, str(e)))
+
+            def reportTiming(future, dep):
+                heartbeatWithLock(time.asctime() + " TestLooper> %s %s in %.1f seconds, after waiting %.1f for a download slot.\n" % (
+                    "Done pulling" if future.exception() is None and future.result() is None else "Failed to pull",
+                    dep,
+                    future.secondsRunning(),
+                    future.secondsQueued()
+                    ))
+
+            futures = {}
+
+            for expose_as, dep in sorted(all_dependencies.iteritems()):
+                futures[expose_as] = self.downloadPool.submit(pull, expose_as, dep)
+                futures[expose_as].addDoneCallback(lambda future, dep=dep: reportTiming(future, dep))
+
+            Futures.waitAll(futures.values() + ([imageFuture] if imageFuture is not None else []))
+
+            logging.info("Pulled %s dependencies for %s in %.1f seconds. Slowest: %s", 
+                len(futures), 
+                test_definition.name, 
+                time.time() - t0,
+                ", ".join("%s=%.1f" % (e, seconds) for seconds, e in 
+                    sorted(((f.secondsQueued() + f.secondsRunning(), e) for e, f in futures.iteritems()), reverse=True)[:3])
+                )
 
-            for e in all_dependencies:
-                if results[e] is not None:
-                    raise Exception("Failed to download dependency %s: %s" % (all_dependencies[e], results[e]))
+            for e in sorted(futures):
+                if futures[e].exception() is not None:
+                    raise Exception("Failed to download dependency %s: %s" % (all_dependencies[e], futures[e].formattedTraceback()))
+                if futures[e].result() is not None:
+                    raise Exception("Failed to download dependency %s: %s" % (all_dependencies[e], futures[e].result()))
 
-            if image_exception[0]:
-                raise Exception(image_exception[0])
+            if imageFuture is None:
+                image = NAKED_MACHINE
+            elif imageFuture.exception() is not None:
+                raise Exception(imageFuture.formattedTraceback())
+            else:
+                image = imageFuture.result()
         
-        return environment, all_dependencies, test_definition, image[0]
+        return environment, all_dependencies, test_definition, image
 
     def _run_task(self, testId, test_definition, log_function, workerCallback, isDeploy, extraPorts, command_override):
         try:
@@ -31,6 +31,10 @@ def createArgumentParser():
     parser.add_argument('worker_path',
                         type=str,
                         help="Path to storage we can use")
+    parser.add_argument('--slots',
+                        type=int,
+                        default=1,
+                        help="Number of tests to run at once. Each gets an equal share of the cores and memory.")
     return parser
 
 def configureLogging(verbose=False):
@@ -51,7 +55,7 @@ def configureLogging(verbose=False):
     logging.getLogger().addHandler(handler)
 
 
-def createTestWorker(config, worker_path, machineId):
+def createTestWorker(config, worker_path, machineId, slots=1):
     config = algebraic_to_json.Encoder().from_json(config, Config.WorkerConfig)
     
     source_control = SourceControlFromConfig.getFromConfig(os.path.join(worker_path,"worker_repo_cache"), config.source_control)
@@ -70,7 +74,7 @@ def createTestWorker(config, worker_path, machineId):
         docker_image_repo=config.server_ports.docker_image_repo
         )
 
-    return TestLooperWorker.TestLooperWorker(workerState, machineId, config.server_ports, True, 2.0)
+    return TestLooperWorker.TestLooperWorker(workerState, machineId, config.server_ports, True, 2.0, slots=slots)
 
 def loadConfiguration(configFile):
     with open(configFile, 'r') as fin:
@@ -88,7 +92,7 @@ if __name__ == "__main__":
         pprint.PrettyPrinter().pformat(config)
         )
 
-    testLooperWorker = createTestWorker(config, args.worker_path, args.machineId)
+    testLooperWorker = createTestWorker(config, args.worker_path, args.machineId, args.slots)
 
     testLooperWorker.start()
 
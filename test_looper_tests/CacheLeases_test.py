@@ -0,0 +1,55 @@
+import test_looper.worker.CacheLeases as CacheLeases
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+class CacheLeasesTests(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_one_slot_holds_a_key_at_a_time(self):
+        leases = CacheLeases.CacheLeases()
+        events = []
+        lock = threading.Lock()
+
+        def slot(i):
+            with leases.lease("build"):
+                with lock:
+                    events.append(("in", i))
+                time.sleep(.01)
+                with lock:
+                    events.append(("out", i))
+
+        threads = [threading.Thread(target=slot, args=(i,)) for i in xrange(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        #nobody gets in until whoever was in gets out
+        for ix in xrange(0, len(events), 2):
+            self.assertEqual(events[ix][0], "in")
+            self.assertEqual(events[ix + 1], ("out", events[ix][1]))
+
+        self.assertFalse(leases.isLeased("build"))
+
+    def test_leased_files_survive_removal(self):
+        leases = CacheLeases.CacheLeases()
+
+        path = os.path.join(self.testdir, "tarball")
+        with open(path, "w") as f:
+            f.write("contents")
+
+        with leases.lease(path):
+            self.assertTrue(leases.isLeased(path))
+            self.assertFalse(leases.removeUnlessLeased(path))
+            self.assertTrue(os.path.exists(path))
+
+        self.assertTrue(leases.removeUnlessLeased(path))
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,213 @@
+import test_looper.core.object_database as object_database
+import test_looper.core.InMemoryJsonStore as InMemoryJsonStore
+import test_looper.data_model.Types as Types
+import test_looper.data_model.CommitGraph as CommitGraph
+import collections
+import logging
+import sys
+import time
+import unittest
+
+def makeDatabase():
+    db = object_database.Database(InMemoryJsonStore.InMemoryJsonStore())
+    Types.setup_types(db)
+    return db
+
+def addCommit(db, repo, hash, parents):
+    commit = db.Commit.lookupAny(repo_and_hash=(repo, hash))
+    if commit is None:
+        commit = db.Commit.New(repo=repo, hash=hash)
+
+    parents = [
+        db.Commit.lookupAny(repo_and_hash=(repo, p)) or db.Commit.New(repo=repo, hash=p)
+            for p in parents
+        ]
+
+    commit.data = db.CommitData.New(commit=commit, parents=parents)
+
+    for p in parents:
+        db.CommitRelationship.New(child=commit, parent=p)
+
+    CommitGraph.assignGenerations(db, commit)
+
+    return commit
+
+def buildSyntheticHistory(db, commitCount, mergeEvery=10, branchLength=3):
+    """A mainline where every 'mergeEvery' commits a short topic branch gets merged back in.
+
+    Returns the list of mainline hashes, oldest first.
+    """
+    mainline = []
+
+    with db.transaction():
+        repo = db.Repo.New(name="repo", isActive=True)
+
+    hashes = 0
+    while hashes < commitCount:
+        with db.transaction():
+            for _ in xrange(100):
+                if mainline and len(mainline) % mergeEvery == 0:
+                    topic = [mainline[-1]]
+                    for i in xrange(branchLength):
+                        topic.append("t_%s_%s" % (len(mainline), i))
+                        addCommit(db, repo, topic[-1], [topic[-2]])
+                        hashes += 1
+
+                    parents = [mainline[-1], topic[-1]]
+                else:
+                    parents = mainline[-1:]
+
+                mainline.append("m_%s" % len(mainline))
+                addCommit(db, repo, mainline[-1], parents)
+                hashes += 1
+
+    return mainline
+
+def naiveIsAncestor(ancestor, descendant):
+    """What we'd do without generation numbers."""
+    seen = set([descendant])
+    frontier = collections.deque([descendant])
+
+    while frontier:
+        c = frontier.popleft()
+        if c == ancestor:
+            return True
+        for p in c.data.parents if c.data else ():
+            if p not in seen:
+                seen.add(p)
+                frontier.append(p)
+
+    return False
+
+class CommitGraphTests(unittest.TestCase):
+    def test_generations(self):
+        db = makeDatabase()
+
+        with db.transaction():
+            repo = db.Repo.New(name="repo", isActive=True)
+
+            #ingest children before their parents, which UpdateCommitData can do
+            c3 = addCommit(db, repo, "c3", ["c2", "b1"])
+            c2 = addCommit(db, repo, "c2", ["c1"])
+            b1 = addCommit(db, repo, "b1", ["c0"])
+
+            self.assertEqual(c3.generation, 0)
+            self.assertEqual(b1.generation, 0)
+
+            c1 = addCommit(db, repo, "c1", ["c0"])
+            self.assertEqual(c1.generation, 0)
+
+            c0 = addCommit(db, repo, "c0", [])
+
+            self.assertEqual(
+                [c.generation for c in (c0, c1, c2, b1, c3)],
+                [1, 2, 3, 2, 4]
+                )
+
+    def test_ancestry(self):
+        db = makeDatabase()
+        buildSyntheticHistory(db, 500)
+
+        with db.view():
+            repo = db.Repo.lookupOne(name="repo")
+            graph = CommitGraph.CommitGraph()
+
+            def commit(hash):
+                return db.Commit.lookupOne(repo_and_hash=(repo, hash))
+
+            for old, new in [("m_0", "m_40"), ("t_10_1", "m_30"), ("m_40", "m_0"), ("t_10_1", "t_20_1"),
+                             ("m_10", "t_10_2"), ("t_20_0", "m_15"), ("m_17", "m_17")]:
+                self.assertEqual(
+                    graph.isAncestor(commit(old), commit(new)),
+                    naiveIsAncestor(commit(old), commit(new)),
+                    (old, new)
+                    )
+
+            self.assertEqual(graph.firstParentDistance(commit("m_40"), commit("m_0"), 100), 40)
+            self.assertEqual(graph.firstParentDistance(commit("m_40"), commit("m_0"), 30), None)
+            self.assertEqual(graph.firstParentDistance(commit("m_40"), commit("t_10_1"), 100), None)
+
+            self.assertEqual(
+                [c.hash for c in graph.commitsBelow(commit("m_21"), 6)],
+                ["m_21", "m_20", "m_19", "t_20_2", "m_18", "t_20_1"]
+                )
+
+    def test_cache_is_bounded(self):
+        db = makeDatabase()
+        mainline = buildSyntheticHistory(db, 500)
+
+        with db.view():
+            repo = db.Repo.lookupOne(name="repo")
+            graph = CommitGraph.CommitGraph(maxEntries=50)
+
+            def commit(hash):
+                return db.Commit.lookupOne(repo_and_hash=(repo, hash))
+
+            self.assertEqual(graph.firstParentDistance(commit(mainline[-1]), commit("m_0"), 1000), len(mainline) - 1)
+            self.assertEqual(len(graph._entries), 50)
+
+            #the most recently walked commits are the ones we kept
+            self.assertTrue(commit("m_1") in graph._entries)
+            self.assertFalse(commit(mainline[-1]) in graph._entries)
+
+            self.assertTrue(graph.isAncestor(commit("m_0"), commit(mainline[-1])))
+            self.assertEqual(len(graph._entries), 50)
+
+    def test_backfill(self):
+        db = makeDatabase()
+        mainline = buildSyntheticHistory(db, 200)
+
+        with db.transaction():
+            repo = db.Repo.lookupOne(name="repo")
+            head = db.Commit.lookupOne(repo_and_hash=(repo, mainline[-1]))
+
+            expected = {}
+            toClear = [head]
+            while toClear:
+                c = toClear.pop()
+                if c.generation:
+                    expected[c] = c.generation
+                    c.generation = 0
+                    toClear.extend(c.data.parents)
+
+            self.assertEqual(CommitGraph.backfillGenerations(db, [head]), len(expected))
+
+            for c in expected:
+                self.assertEqual(c.generation, expected[c])
+
+def benchmark(commitCount=100000, queries=20):
+    """Compare ancestry queries with and without generation numbers on a synthetic repo."""
+    db = makeDatabase()
+
+    t0 = time.time()
+    mainline = buildSyntheticHistory(db, commitCount)
+    print "Built %s mainline commits (%s total) in %.1f seconds" % (len(mainline), commitCount, time.time() - t0)
+
+    with db.view():
+        repo = db.Repo.lookupOne(name="repo")
+
+        def commit(hash):
+            return db.Commit.lookupOne(repo_and_hash=(repo, hash))
+
+        #pairs near the top of history, which is what the scheduler asks about.
+        #half of them aren't ancestors, which is the case the naive walk is worst at.
+        pairs = []
+        for i in xrange(queries):
+            newer = len(mainline) - 1 - i
+            older = newer - 1 - (i % 50)
+            if i % 2:
+                pairs.append((commit(mainline[older]), commit(mainline[newer])))
+            else:
+                pairs.append((commit(mainline[newer]), commit(mainline[older])))
+
+        for name, isAncestor in [
+                ("naive", naiveIsAncestor),
+                ("generation", CommitGraph.CommitGraph().isAncestor)
+                ]:
+            t0 = time.time()
+            answers = [isAncestor(a, d) for a, d in pairs]
+            print "%10s: %s queries in %.3f seconds (%s true)" % (name, len(pairs), time.time() - t0, sum(answers))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
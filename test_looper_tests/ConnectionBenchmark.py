@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""ConnectionBenchmark
+
+Opens many worker connections to a local echo server and reports message
+round-trip latency and the server's memory, as JSON.
+
+The server runs in a subprocess so we can read its RSS and thread count out of
+/proc. In 'loop' mode it serves connections the way TestLooperServer does now,
+on an EventLoop with a small worker pool. In 'threads' mode it starts a thread
+per connection, the way TestLooperServer used to, so the two can be compared.
+
+Each round, every client sends a heartbeat-sized JSON message at once and
+waits for its echo. The server decodes and re-encodes the message the way a
+Session does.
+
+    python -m test_looper_tests.ConnectionBenchmark --clients 2000 --mode threads
+"""
+
+import argparse
+import errno
+import json
+import logging
+import math
+import resource
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import test_looper.core.EventLoop as EventLoop
+import test_looper.core.socket_util as socket_util
+
+def summarize(values):
+    """count, mean, max and percentiles of a list of numbers, as in SchedulerBenchmark.
+
+    We don't import that one, since it pulls in the whole TestManager harness.
+    """
+    if not values:
+        return {"count": 0}
+
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(math.ceil(p * len(values))) - 1)]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(.5),
+        "p90": percentile(.9),
+        "p99": percentile(.99),
+        "max": values[-1]
+        }
+
+def raiseFileLimit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            raise Exception("Need %s file descriptors but the limit is %s" % (needed, hard))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+def processStatus(pid):
+    """RSS in bytes and thread count of 'pid', from /proc."""
+    res = {}
+    with open("/proc/%s/status" % pid, "r") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key == "VmRSS":
+                res["rss_bytes"] = int(value.split()[0]) * 1024
+            if key == "Threads":
+                res["threads"] = int(value)
+    return res
+
+def handle(data):
+    return json.dumps(json.loads(data))
+
+def serve(mode, clients, workerThreads):
+    raiseFileLimit(clients + 100)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1024)
+
+    if mode == "loop":
+        loop = EventLoop.EventLoop(workerThreads, name="ConnectionBenchmark")
+        loop.start()
+
+    def serveThread(sock):
+        try:
+            while True:
+                socket_util.writeString(sock, handle(socket_util.readString(sock)))
+        except socket_util.SocketException:
+            pass
+        finally:
+            sock.close()
+
+    sys.stdout.write("%s\n" % listener.getsockname()[1])
+    sys.stdout.flush()
+
+    while True:
+        sock, address = listener.accept()
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+
+        if mode == "loop":
+            connection = EventLoop.Connection(sock, address)
+            loop.add(connection, lambda data, connection=connection: connection.send(handle(data)))
+        else:
+            t = threading.Thread(target=serveThread, args=(sock,))
+            t.daemon = True
+            t.start()
+
+class Clients(object):
+    """Many client sockets, driven from one thread with epoll."""
+    def __init__(self, port, count):
+        self.sockets = {}
+        self.buffers = {}
+
+        for i in xrange(count):
+            s = socket.create_connection(("127.0.0.1", port))
+            s.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            self.sockets[s.fileno()] = s
+            self.buffers[s.fileno()] = ""
+
+        self.poller = select.epoll()
+        for fd in self.sockets:
+            self.poller.register(fd, select.EPOLLIN)
+
+    def round(self, latencies, timeout):
+        for fd, s in self.sockets.iteritems():
+            msg = json.dumps({"type": "Heartbeat", "machineId": "worker_%s" % fd, "sent": time.time(), "msg": "x" * 64})
+            s.sendall(socket_util.prependSize(msg))
+
+        outstanding = set(self.sockets)
+        t0 = time.time()
+
+        while outstanding:
+            if time.time() - t0 > timeout:
+                raise Exception("%s clients never heard back" % len(outstanding))
+
+            for fd, events in self.poller.poll(1.0):
+                try:
+                    data = self.sockets[fd].recv(65536)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    raise
+
+                if not data:
+                    raise Exception("Server closed a connection")
+
+                buf = self.buffers[fd] + data
+
+                while len(buf) >= socket_util.longLength:
+                    size = socket_util.stringToLong(buf[:socket_util.longLength])
+                    if len(buf) < socket_util.longLength + size:
+                        break
+                    msg = json.loads(buf[socket_util.longLength:socket_util.longLength + size])
+                    buf = buf[socket_util.longLength + size:]
+
+                    latencies.append(time.time() - msg["sent"])
+                    outstanding.discard(fd)
+
+                self.buffers[fd] = buf
+
+        return time.time() - t0
+
+    def close(self):
+        for s in self.sockets.values():
+            s.close()
+        self.poller.close()
+
+def runBenchmark(clients=2000, mode="loop", rounds=20, workerThreads=8, timeout=60.0):
+    raiseFileLimit(clients + 100)
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "test_looper_tests.ConnectionBenchmark", "--serve",
+            "--mode", mode, "--clients", str(clients), "--workerThreads", str(workerThreads)],
+        stdout=subprocess.PIPE
+        )
+
+    try:
+        port = int(server.stdout.readline())
+
+        idle = processStatus(server.pid)
+
+        t0 = time.time()
+        conns = Clients(port, clients)
+        connectSeconds = time.time() - t0
+
+        #one round to make sure every connection has been accepted before we look at memory
+        conns.round([], timeout)
+        connected = processStatus(server.pid)
+
+        latencies = []
+        roundSeconds = []
+        for _ in xrange(rounds):
+            roundSeconds.append(conns.round(latencies, timeout))
+
+        loaded = processStatus(server.pid)
+
+        conns.close()
+
+        return {
+            "mode": mode,
+            "clients": clients,
+            "rounds": rounds,
+            "worker_threads": workerThreads if mode == "loop" else None,
+            "connect_seconds": connectSeconds,
+            "latency_seconds": summarize(latencies),
+            "round_seconds": summarize(roundSeconds),
+            "messages_per_second": len(latencies) / sum(roundSeconds),
+            "server": {
+                "idle": idle,
+                "connected": connected,
+                "after_rounds": loaded,
+                "rss_bytes_per_connection": (connected["rss_bytes"] - idle["rss_bytes"]) / float(clients)
+                }
+            }
+    finally:
+        server.kill()
+        server.wait()
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(description="Measure message latency and server memory with many worker connections")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--mode", choices=["loop", "threads"], default="loop")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--workerThreads", type=int, default=8, help="EventLoop worker threads, in 'loop' mode")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    return parser
+
+def main(argv):
+    args = createArgumentParser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    if args.serve:
+        serve(args.mode, args.clients, args.workerThreads)
+        return 0
+
+    report = json.dumps(
+        runBenchmark(args.clients, args.mode, args.rounds, args.workerThreads),
+        indent=4,
+        sort_keys=True
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print report
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
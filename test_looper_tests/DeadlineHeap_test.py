@@ -0,0 +1,46 @@
+import test_looper.data_model.DeadlineHeap as DeadlineHeap
+import unittest
+
+class DeadlineHeapTests(unittest.TestCase):
+    def test_pops_only_what_expired(self):
+        deadlines = {}
+        heap = DeadlineHeap.DeadlineHeap(deadlines.get)
+
+        for i in xrange(1000):
+            deadlines[i] = 100.0 + i
+            heap.add(i, deadlines[i])
+
+        self.assertEqual(heap.nextDeadline(), 100.0)
+        self.assertEqual(heap.popExpired(104.0), [0, 1, 2, 3, 4])
+        self.assertEqual(heap.examined, 5)
+        self.assertEqual(len(heap), 995)
+        self.assertEqual(heap.nextDeadline(), 105.0)
+
+    def test_moved_and_removed_deadlines(self):
+        deadlines = {"a": 10.0, "b": 20.0, "c": 30.0}
+        heap = DeadlineHeap.DeadlineHeap(deadlines.get)
+
+        for key, deadline in deadlines.items():
+            heap.add(key, deadline)
+
+        #heartbeats move deadlines out without touching the heap
+        deadlines["a"] = 50.0
+        del deadlines["b"]
+
+        self.assertEqual(heap.popExpired(25.0), [])
+        self.assertEqual(sorted(heap._scheduled), ["a", "c"])
+        self.assertEqual(heap.nextDeadline(), 30.0)
+
+        #adding an earlier deadline wins, adding a later one is a no-op
+        deadlines["c"] = 5.0
+        heap.add("c", 5.0)
+        heap.add("a", 100.0)
+
+        self.assertEqual(heap.popExpired(30.0), ["c"])
+        self.assertEqual(heap.popExpired(60.0), ["a"])
+        self.assertEqual(len(heap), 0)
+        self.assertEqual(heap.nextDeadline(), None)
+
+        heap.add("d", 1.0)
+        heap.discard("d")
+        self.assertEqual(heap.nextDeadline(), None)
@@ -0,0 +1,130 @@
+import test_looper.core.EventLoop as EventLoop
+import test_looper.core.socket_util as socket_util
+import socket
+import threading
+import time
+import unittest
+
+class EventLoopTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop.EventLoop(4, name="EventLoopTest")
+        self.loop.start()
+
+    def tearDown(self):
+        self.loop.stop()
+
+    def connectPair(self, onMessage, onClosed=None):
+        serverSide, clientSide = socket.socketpair()
+        connection = EventLoop.Connection(serverSide, "test")
+        self.loop.add(connection, lambda data: onMessage(connection, data), onClosed)
+        return connection, clientSide
+
+    def waitFor(self, condition, timeout=10.0):
+        t0 = time.time()
+        while not condition():
+            self.assertLess(time.time() - t0, timeout, "timed out")
+            time.sleep(.01)
+
+    def test_echo_many_clients(self):
+        clients = [self.connectPair(lambda c, data: c.send(data))[1] for _ in xrange(200)]
+
+        for i, client in enumerate(clients):
+            for j in xrange(5):
+                socket_util.writeString(client, "%s-%s" % (i, j))
+
+        for i, client in enumerate(clients):
+            for j in xrange(5):
+                self.assertEqual(socket_util.readString(client), "%s-%s" % (i, j))
+
+        self.assertEqual(self.loop.connectionCount(), 200)
+
+        for client in clients:
+            client.close()
+
+        self.waitFor(lambda: self.loop.connectionCount() == 0)
+
+    def test_large_messages_in_both_directions(self):
+        payload = "".join(chr(i % 256) for i in xrange(256)) * 40000
+
+        connection, client = self.connectPair(lambda c, data: c.send(data[::-1]))
+
+        #write from another thread, since the echo comes back while we're still sending
+        writer = threading.Thread(target=lambda: socket_util.writeString(client, payload))
+        writer.start()
+
+        self.assertEqual(socket_util.readString(client), payload[::-1])
+        writer.join()
+
+        self.assertGreater(connection.bytesRead, len(payload))
+        self.assertGreater(connection.bytesWritten, len(payload))
+
+    def test_messages_are_handled_in_order_and_closed_last(self):
+        seen = []
+        closed = threading.Event()
+
+        def onMessage(connection, data):
+            #a slow handler shouldn't let later messages jump ahead
+            time.sleep(.001)
+            seen.append(int(data))
+
+        def onClosed():
+            seen.append("closed")
+            closed.set()
+
+        connection, client = self.connectPair(onMessage, onClosed)
+
+        client.sendall("".join(socket_util.prependSize(str(i)) for i in xrange(100)))
+        client.close()
+
+        self.assertTrue(closed.wait(10.0))
+        self.assertEqual(seen, range(100) + ["closed"])
+        self.assertTrue(connection.closed)
+
+    def test_close_flushes_pending_writes(self):
+        def onMessage(connection, data):
+            connection.send("goodbye")
+            connection.close()
+            self.assertFalse(connection.send("too late"))
+
+        connection, client = self.connectPair(onMessage)
+
+        socket_util.writeString(client, "hello")
+
+        self.assertEqual(socket_util.readString(client), "goodbye")
+        self.assertEqual(client.recv(10), "")
+
+    def test_worker_pool_orders_by_key(self):
+        pool = EventLoop.OrderedWorkerPool(8)
+        results = {}
+        lock = threading.Lock()
+
+        def record(key, i):
+            with lock:
+                results.setdefault(key, []).append(i)
+
+        for i in xrange(200):
+            for key in xrange(10):
+                pool.submit(key, lambda key=key, i=i: record(key, i))
+
+        pool.stop()
+
+        self.assertEqual(sorted(results), range(10))
+        for key in results:
+            self.assertEqual(results[key], range(200))
+
+    def test_calls_run_in_order_with_messages(self):
+        seen = []
+        done = threading.Event()
+
+        def onMessage(connection, data):
+            time.sleep(.001)
+            seen.append(data)
+            if data == "last":
+                self.loop.call(connection, lambda: (seen.append("called"), done.set()))
+
+        connection, client = self.connectPair(onMessage)
+
+        client.sendall(socket_util.prependSize("first") + socket_util.prependSize("last"))
+
+        self.assertTrue(done.wait(10.0))
+        self.assertEqual(seen, ["first", "last", "called"])
@@ -0,0 +1,110 @@
+import test_looper.data_model.FairShare as FairShare
+import heapq
+import unittest
+
+def simulate(tenants, machines, horizon, scheduler=None):
+    """Run tenants' queues of test durations on 'machines' identical machines until 'horizon'.
+
+    'tenants' maps name -> (weight, arrivalTime, durations). Without a scheduler we run
+    tests in the order they arrived, which is what global priority ordering amounts to
+    when everything has the same priority. Returns machine-seconds used by each tenant
+    while every tenant had work waiting.
+    """
+    queues = dict((name, list(durations)) for name, (_, _, durations) in tenants.iteritems())
+    running = []
+    usage = dict((name, 0.0) for name in tenants)
+    timestamp = 0.0
+    runIds = [0]
+
+    contendedFrom = max(arrival for _, arrival, _ in tenants.itervalues())
+
+    def waiting():
+        return [name for name in sorted(tenants) if queues[name] and tenants[name][1] <= timestamp]
+
+    def start():
+        contending = waiting()
+        if not contending:
+            return False
+
+        if scheduler:
+            name = scheduler.choose(dict((n, tenants[n][0]) for n in contending), timestamp)
+        else:
+            name = min(contending, key=lambda n: tenants[n][1])
+
+        duration = queues[name].pop(0)
+        runIds[0] += 1
+
+        if scheduler:
+            scheduler.runStarted(runIds[0], name, timestamp, duration)
+
+        heapq.heappush(running, (timestamp + duration, runIds[0], name, timestamp))
+        return True
+
+    while timestamp < horizon:
+        while len(running) < machines and start():
+            pass
+
+        nextArrival = min([a for _, a, _ in tenants.itervalues() if a > timestamp] or [horizon])
+
+        if running and running[0][0] <= nextArrival:
+            end, runId, name, started = heapq.heappop(running)
+            timestamp = end
+
+            if scheduler:
+                scheduler.runFinished(runId, name, end - started)
+
+            if started >= contendedFrom and end <= horizon:
+                usage[name] += end - started
+        else:
+            timestamp = nextArrival
+
+    return usage
+
+def shares(usage):
+    total = sum(usage.values())
+    return dict((name, u / total) for name, u in usage.iteritems())
+
+class FairShareTests(unittest.TestCase):
+    def test_lowest_pass_wins(self):
+        scheduler = FairShare.StrideScheduler()
+
+        scheduler.runFinished(1, "a", 100)
+        scheduler.runFinished(2, "b", 100)
+
+        self.assertEqual(scheduler.choose({"a": 1.0, "b": 2.0}, 0), "b")
+
+        #in-flight runs count at their predicted duration until they run longer than that
+        scheduler.runStarted(3, "b", 0, 200)
+        self.assertEqual(scheduler.choose({"a": 1.0, "b": 2.0}, 1), "a")
+
+    def test_idle_tenant_cant_bank_credit(self):
+        scheduler = FairShare.StrideScheduler()
+
+        for i in xrange(10):
+            scheduler.choose({"a": 1.0}, i * 100)
+            scheduler.runFinished(i, "a", 100)
+
+        self.assertEqual(scheduler.choose({"a": 1.0, "b": 1.0}, 1000), "b")
+        self.assertEqual(scheduler.passFor("b", 1.0, 1000), scheduler.globalPass)
+
+        #b is charged from where a was, not from zero, so they alternate from here
+        scheduler.runFinished(100, "b", 100)
+        self.assertEqual(scheduler.choose({"a": 1.0, "b": 1.0}, 1100), "a")
+
+    def test_three_repos_get_their_weighted_share(self):
+        #'big' pushed a giant merge before the others showed up
+        tenants = {
+            "big": (1.0, 0.0, [600, 300, 900] * 400),
+            "small": (1.0, 1800.0, [300, 120] * 400),
+            "important": (2.0, 3600.0, [450] * 400)
+            }
+
+        fifo = shares(simulate(tenants, machines=8, horizon=6 * 3600))
+
+        #run in arrival order, the merge starves everybody else
+        self.assertGreater(fifo["big"], .99)
+
+        fair = shares(simulate(tenants, machines=8, horizon=6 * 3600, scheduler=FairShare.StrideScheduler()))
+
+        for name, expected in [("big", .25), ("small", .25), ("important", .5)]:
+            self.assertAlmostEqual(fair[name], expected, delta=.03, msg=fair)
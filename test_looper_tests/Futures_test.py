@@ -0,0 +1,60 @@
+import test_looper.core.Futures as Futures
+import threading
+import time
+import unittest
+
+class FuturesTests(unittest.TestCase):
+    def test_pool_bounds_its_threads(self):
+        pool = Futures.FuturePool(2)
+        lock = threading.Lock()
+        running = [0]
+        mostRunning = [0]
+
+        def work(i):
+            with lock:
+                running[0] += 1
+                mostRunning[0] = max(mostRunning[0], running[0])
+            time.sleep(.01)
+            with lock:
+                running[0] -= 1
+            return i * i
+
+        futures = [pool.submit(work, i) for i in xrange(8)]
+
+        self.assertTrue(Futures.waitAll(futures, 10.0))
+        self.assertEqual([f.result() for f in futures], [i * i for i in xrange(8)])
+        self.assertEqual(mostRunning[0], 2)
+
+        #the last ones had to wait their turn
+        self.assertGreater(futures[-1].secondsQueued(), 0.0)
+        self.assertEqual(pool.queued(), 0)
+
+    def test_exceptions_come_back_through_result(self):
+        def fail():
+            raise ValueError("no good")
+
+        future = Futures.spawn(fail)
+
+        self.assertTrue(Futures.waitAll([future], 10.0))
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        self.assertIn("no good", future.formattedTraceback())
+        self.assertRaises(ValueError, future.result)
+
+    def test_waiting_wakes_on_completion(self):
+        release = threading.Event()
+        future = Futures.spawn(release.wait)
+
+        self.assertFalse(Futures.waitAll([future], .01))
+
+        calledBack = []
+        future.addDoneCallback(calledBack.append)
+
+        release.set()
+        self.assertTrue(future.wait(10.0))
+        self.assertEqual(calledBack, [future])
+
+        #callbacks added afterwards happen right away
+        future.addDoneCallback(calledBack.append)
+        self.assertEqual(calledBack, [future, future])
+
+        self.assertTrue(Futures.waitAll([]))
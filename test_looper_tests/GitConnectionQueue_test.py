@@ -0,0 +1,82 @@
+import test_looper.data_model.GitConnectionQueue as GitConnectionQueue
+import unittest
+
+class GitConnectionQueueTests(unittest.TestCase):
+    def granted(self, grants):
+        return [requestId for requestId, _ in grants]
+
+    def test_grants_in_priority_then_fifo_order(self):
+        queue = GitConnectionQueue.GitConnectionQueue(2, 1, 2)
+
+        self.assertEqual(self.granted(queue.request("r0", "t0", "h0", 1, 0.0, None)), ["r0"])
+        self.assertEqual(self.granted(queue.request("r1", "t1", "h1", 1, 1.0, None)), ["r1"])
+
+        for i, priority in [(2, 1), (3, 1), (4, 5)]:
+            self.assertEqual(queue.request("r%s" % i, "t%s" % i, "h%s" % i, priority, 2.0, None), [])
+
+        self.assertEqual(queue.queueLength(), 3)
+
+        #asking again while queued doesn't lose our place or double-count us
+        self.assertEqual(queue.request("r2", "t2", "h2", 1, 3.0, None), [])
+        self.assertEqual(queue.stats["queued"], 3)
+
+        self.assertEqual(self.granted(queue.release("r0", 10.0)), ["r4"])
+        self.assertEqual(self.granted(queue.release("r1", 11.0)), ["r2"])
+        self.assertEqual(self.granted(queue.release("r4", 12.0)), ["r3"])
+
+        self.assertEqual(queue.stats["granted"], 5)
+        self.assertEqual(queue.stats["max_wait_seconds"], 10.0)
+        self.assertEqual(queue.stats["wait_seconds_total"], 8.0 + 9.0 + 10.0)
+
+    def test_one_test_cant_hog_the_connections(self):
+        queue = GitConnectionQueue.GitConnectionQueue(4, 1, 4)
+
+        for i in xrange(3):
+            queue.request("r%s" % i, "t0", "h0", 1, 0.0, None)
+        queue.request("other", "t1", "h1", 1, 0.0, None)
+
+        self.assertEqual(sorted(queue.leases), ["other", "r0", "r1"])
+
+        self.assertEqual(self.granted(queue.release("r0", 1.0)), ["r2"])
+
+    def test_leases_expire_and_abandoned_requests_leave_the_queue(self):
+        queue = GitConnectionQueue.GitConnectionQueue(1, 1, 1)
+
+        queue.request("r0", "t0", "h0", 1, 0.0, None)
+        queue.request("r1", "t1", "h1", 1, 0.0, None)
+        queue.request("r2", "t2", "h2", 1, 0.0, None)
+
+        self.assertEqual(self.granted(queue.abandon(["r1"], 1.0)), [])
+        self.assertEqual(self.granted(queue.expire(10.0)), [])
+        self.assertEqual(self.granted(queue.expire(GitConnectionQueue.LEASE_SECONDS + 1.0)), ["r2"])
+
+        #a lease for a test that died goes right away
+        self.assertEqual(queue.request("r3", "t3", "h3", 1, 2000.0, None), [])
+        self.assertEqual(queue.expire(2000.0, isDead=lambda t: t == "t2"), [("r3", None)])
+        self.assertEqual(queue.stats["expired"], 2)
+        self.assertEqual(queue.stats["abandoned"], 1)
+
+    def test_limit_adapts_to_git_latency(self):
+        queue = GitConnectionQueue.GitConnectionQueue(4, 1, 8)
+
+        def cycle(timestamp, holdTime, count):
+            """Run 'count' leases through a permanently backed-up queue, each held 'holdTime' seconds."""
+            for i in xrange(count):
+                requestId = "%s_%s" % (timestamp, i)
+                queue.request(requestId, requestId, requestId, 1, timestamp, None)
+            for requestId in sorted(queue.leases):
+                queue.release(requestId, timestamp + holdTime)
+            return timestamp + holdTime
+
+        timestamp = 0.0
+
+        #git is fast and we're backed up, so we open up more connections
+        for _ in xrange(20):
+            timestamp = cycle(timestamp, 2.0, 20)
+        self.assertEqual(queue.currentLimit(), 8)
+
+        #git gets slow, so we back off
+        for _ in xrange(5):
+            timestamp = cycle(timestamp, 20.0, 20)
+        self.assertLess(queue.currentLimit(), 4)
+        self.assertGreaterEqual(queue.currentLimit(), 1)
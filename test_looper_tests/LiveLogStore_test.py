@@ -0,0 +1,100 @@
+import test_looper.data_model.LiveLogStore as LiveLogStore
+import test_looper.data_model.TestManager as TestManager
+import os
+import shutil
+import tempfile
+import unittest
+
+class LiveLogStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spills_past_the_per_test_budget(self):
+        store = LiveLogStore.LiveLogStore(self.directory, maxBytesPerTest=100, maxBytesInMemory=1000)
+
+        expected = ""
+        for i in xrange(50):
+            msg = "line %s\n" % i
+            self.assertEqual(store.append("t0", msg), len(expected))
+            expected += msg
+
+        self.assertLessEqual(store.memoryBytes, 100)
+        self.assertEqual(store.memoryBytes + store.spilledBytes, len(expected))
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, "t0.log")), store.spilledBytes)
+
+        self.assertEqual(store.readAll("t0"), expected)
+        self.assertEqual(store.tail("t0", 30), expected[-30:])
+
+        #reads that straddle the disk and memory
+        for offset in [0, 5, store.spilledBytes - 3, store.spilledBytes, len(expected) - 1, len(expected)]:
+            data, nextOffset = store.read("t0", offset, 17)
+            self.assertEqual(data, expected[offset:offset + 17])
+            self.assertEqual(nextOffset, offset + len(data))
+
+    def test_memory_stays_bounded(self):
+        store = LiveLogStore.LiveLogStore(self.directory, maxBytesPerTest=10000, maxBytesInMemory=25000)
+
+        #a few chatty tests, one of which writes giant lines
+        for i in xrange(200):
+            for testId in ["a", "b", "c", "d"]:
+                store.append(testId, ("x" * 50000 if testId == "d" and i % 10 == 0 else testId * 100) + "\n")
+                self.assertLessEqual(store.memoryBytes, 25000)
+
+        self.assertEqual(store.size("a"), 200 * 101)
+        self.assertEqual(store.readAll("a"), ("a" * 100 + "\n") * 200)
+        self.assertEqual(store.size("d"), 20 * 50001 + 180 * 101)
+
+        store.discard("a")
+        self.assertEqual(store.size("a"), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "a.log")))
+
+    def test_listeners_can_seek(self):
+        handler = TestManager.HeartbeatHandler(LiveLogStore.LiveLogStore(self.directory, maxBytesPerTest=10))
+
+        for i in xrange(10):
+            handler.testHeartbeat("t0", i, "message %s\n" % i)
+
+        received = []
+        handler.addListener("t0", received.append, offset=len("message 0\n") * 8, chunkSize=7)
+        handler.testHeartbeat("t0", 11, "message 10\n")
+
+        self.assertEqual("".join(received), "message 8\nmessage 9\nmessage 10\n")
+        self.assertEqual(handler.getAllLogsFor("t0"), "".join("message %s\n" % i for i in xrange(11)))
+
+    def test_disk_stays_bounded(self):
+        store = LiveLogStore.LiveLogStore(self.directory, maxBytesPerTest=100, maxBytesInMemory=1000, maxBytesOnDisk=2000)
+
+        expected = ""
+        for i in xrange(500):
+            msg = "line %s\n" % i
+            store.append("t0", msg)
+            store.append("t1", "x\n")
+            expected += msg
+            self.assertLessEqual(store.spilledBytes, 2000)
+
+        self.assertGreater(store.droppedBytes, 0)
+
+        #offsets don't move, and reads from before what we still hold start at the first byte we have
+        self.assertEqual(store.size("t0"), len(expected))
+        data, nextOffset = store.read("t0", 0, 50)
+        self.assertEqual(data, expected[nextOffset - len(data):nextOffset])
+        self.assertEqual(store.tail("t0", 30), expected[-30:])
+
+    def test_finished_logs_expire(self):
+        handler = TestManager.HeartbeatHandler(LiveLogStore.LiveLogStore(self.directory, maxBytesPerTest=10))
+
+        handler.testHeartbeat("t0", 0, "some output\n")
+        handler.testHeartbeat("t1", 0, "other output\n")
+        handler.testFinished("t0", 10)
+
+        #anybody still watching gets to see it for a while
+        handler.testHeartbeat("t1", 10 + TestManager.FINISHED_LOG_SECONDS - 1)
+        self.assertEqual(handler.getAllLogsFor("t0"), "some output\n")
+
+        handler.testHeartbeat("t1", 10 + TestManager.FINISHED_LOG_SECONDS)
+        self.assertEqual(handler.logSize("t0"), 0)
+        self.assertEqual(handler.logs.logs.keys(), ["t1"])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "t0.log")))
@@ -0,0 +1,205 @@
+import test_looper.data_model.MachineBootPlanner as MachineBootPlanner
+import unittest
+
+IDLE_TIME_BEFORE_SHUTDOWN = 180
+
+class Simulation(object):
+    """A cluster of single-test machines working through per-category queues of test durations.
+
+    Machines boot instantly and cost their core count per hour while they're up.
+    """
+    def __init__(self, categories, queues, maxCores):
+        self.categories = categories
+        self.queues = dict((c, list(q)) for c, q in queues.iteritems())
+        self.maxCores = maxCores
+        self.machines = []
+        self.timestamp = 0
+        self.cost = 0.0
+        self.completed = 0
+        self.workCompleted = 0
+
+    def cores(self, category):
+        return self.categories[category]
+
+    def coresBooted(self):
+        return sum(self.cores(m["category"]) for m in self.machines)
+
+    def machinesIn(self, category):
+        return [m for m in self.machines if m["category"] == category]
+
+    def idleMachinesIn(self, category):
+        return [m for m in self.machinesIn(category) if m["busyUntil"] is None]
+
+    def desired(self, category):
+        return len(self.queues[category]) + len([m for m in self.machinesIn(category) if m["busyUntil"] is not None])
+
+    def canBoot(self, category):
+        return self.coresBooted() + self.cores(category) <= self.maxCores
+
+    def boot(self, category):
+        assert self.canBoot(category)
+        self.machines.append({"category": category, "busyUntil": None, "idleSince": self.timestamp})
+
+    def shutdownIdle(self, category):
+        idle = self.idleMachinesIn(category)
+        if not idle:
+            return False
+        self.machines.remove(idle[0])
+        return True
+
+    def run(self, policy, horizon, tick=60):
+        while self.timestamp < horizon:
+            for m in self.machines:
+                if m["busyUntil"] is not None and m["busyUntil"] <= self.timestamp:
+                    self.completed += 1
+                    self.workCompleted += m["duration"]
+                    m["busyUntil"] = None
+                    m["idleSince"] = self.timestamp
+
+            for m in self.machines:
+                if m["busyUntil"] is None and self.queues[m["category"]]:
+                    m["duration"] = self.queues[m["category"]].pop(0)
+                    m["busyUntil"] = self.timestamp + m["duration"]
+
+            for m in list(self.machines):
+                if (m["busyUntil"] is None and self.timestamp - m["idleSince"] > IDLE_TIME_BEFORE_SHUTDOWN
+                        and self.desired(m["category"]) < len(self.machinesIn(m["category"]))):
+                    self.machines.remove(m)
+
+            policy(self)
+
+            self.cost += self.coresBooted() * float(tick) / 3600
+            self.timestamp += tick
+
+    def throughputPerDollar(self):
+        return self.completed / self.cost
+
+def greedyPolicy(order):
+    """What TestManager did before the planner: boot the first category that fits, one at a time."""
+    def policy(sim):
+        while True:
+            wantingBoot = [c for c in order if sim.desired(c) > len(sim.machinesIn(c))]
+            wantingShutdown = [c for c in order if sim.desired(c) < len(sim.machinesIn(c))]
+
+            def canBoot():
+                for c in wantingBoot:
+                    if sim.canBoot(c):
+                        return c
+
+            while wantingBoot and not canBoot() and wantingShutdown:
+                if not any(sim.shutdownIdle(c) for c in wantingShutdown):
+                    break
+
+            c = canBoot()
+            if not c:
+                return
+            sim.boot(c)
+    return policy
+
+def plannerPolicy(durations):
+    def policy(sim):
+        demands = []
+        surplus = []
+
+        for c in sorted(sim.categories):
+            booted = len(sim.machinesIn(c))
+
+            if sim.desired(c) > booted:
+                demands.append(
+                    MachineBootPlanner.CategoryDemand(
+                        category=c,
+                        cores=sim.cores(c),
+                        ram_gb=0,
+                        wanted=sim.desired(c) - booted,
+                        priority=1,
+                        predictedDuration=durations[c],
+                        hourlyCost=float(sim.cores(c))
+                        )
+                    )
+            elif sim.desired(c) < booted and sim.idleMachinesIn(c):
+                surplus.append(
+                    MachineBootPlanner.Surplus(c, sim.cores(c), 0, min(booted - sim.desired(c), len(sim.idleMachinesIn(c))))
+                    )
+
+        plan = MachineBootPlanner.planBoots(
+            demands,
+            surplus,
+            MachineBootPlanner.Capacity(cores=sim.maxCores - sim.coresBooted())
+            )
+
+        for c, count in plan.shutdowns:
+            for _ in xrange(count):
+                sim.shutdownIdle(c)
+
+        for c, count in plan.boots:
+            for _ in xrange(count):
+                sim.boot(c)
+    return policy
+
+class MachineBootPlannerTests(unittest.TestCase):
+    def test_planner_respects_limits_and_priority(self):
+        plan = MachineBootPlanner.planBoots(
+            [
+                MachineBootPlanner.CategoryDemand("big", 32, 128, 3, 1, 3600, 32.0),
+                MachineBootPlanner.CategoryDemand("small", 2, 8, 40, 1, 600, 2.0),
+                MachineBootPlanner.CategoryDemand("urgent", 8, 32, 2, 2, 60, 8.0)
+                ],
+            [],
+            MachineBootPlanner.Capacity(cores=64, workers=20)
+            )
+
+        boots = dict(plan.boots)
+
+        self.assertEqual(plan.boots[0], ("urgent", 2))
+        self.assertEqual(boots["big"], 1)
+        self.assertEqual(boots["small"], 8)
+        self.assertEqual(plan.shutdowns, [])
+
+    def test_planner_shuts_down_only_what_it_needs(self):
+        plan = MachineBootPlanner.planBoots(
+            [MachineBootPlanner.CategoryDemand("small", 2, 8, 4, 1, 600, 2.0)],
+            [MachineBootPlanner.Surplus("medium", 4, 16, 3)],
+            MachineBootPlanner.Capacity(cores=2)
+            )
+
+        self.assertEqual(plan.boots, [("small", 4)])
+        self.assertEqual(plan.shutdowns, [("medium", 2)])
+
+    def test_planner_unlimited_capacity(self):
+        plan = MachineBootPlanner.planBoots(
+            [
+                MachineBootPlanner.CategoryDemand("a", 2, 8, 10, 1, 600, 2.0),
+                MachineBootPlanner.CategoryDemand("b", 16, 64, 5, 0, 600, 16.0)
+                ],
+            [],
+            MachineBootPlanner.Capacity()
+            )
+
+        self.assertEqual(dict(plan.boots), {"a": 10, "b": 5})
+
+    def simulate(self, policy):
+        categories = {"big": 32, "small": 2}
+        queues = {"big": [3600] * 4, "small": [600] * 60}
+
+        sim = Simulation(categories, queues, maxCores=64)
+        sim.run(policy, horizon=2 * 3600)
+        return sim
+
+    def test_simulated_throughput_per_dollar(self):
+        durations = {"big": 3600, "small": 600}
+
+        planned = self.simulate(plannerPolicy(durations))
+
+        #when greedy happens to see the small category first it does about as well as
+        #the planner (which spends a little on keeping a big machine going)
+        greedy = self.simulate(greedyPolicy(["small", "big"]))
+
+        self.assertEqual(planned.completed, greedy.completed)
+        self.assertGreater(planned.throughputPerDollar(), .99 * greedy.throughputPerDollar())
+
+        #but when the big category comes first, greedy fills the core limit with big
+        #machines and the small tests wait behind them
+        greedy = self.simulate(greedyPolicy(["big", "small"]))
+
+        self.assertGreater(planned.completed, greedy.completed)
+        self.assertGreater(planned.throughputPerDollar(), 2 * greedy.throughputPerDollar())
@@ -0,0 +1,160 @@
+import test_looper.core.MessageCodec as MessageCodec
+import test_looper.data_model.TestDefinitionScript as TestDefinitionScript
+import test_looper.server.TestLooperServer as TestLooperServer
+import json
+import unittest
+
+ClientToServerMsg = TestLooperServer.ClientToServerMsg
+ServerToClientMsg = TestLooperServer.ServerToClientMsg
+
+test_yaml = """
+looper_version: 4
+environments:
+  linux:
+    platform: linux
+    image:
+      dockerfile_contents: 'FROM ubuntu:16.04'
+builds:
+  build/linux:
+    command: 'build.sh'
+    dependencies:
+      src: HEAD
+tests:
+  test/linux:
+    command: 'test.sh'
+    dependencies:
+      src: HEAD
+      build: build/linux
+"""
+
+WorkerState = TestLooperServer.WorkerState
+
+#every kind of message a worker from before the binary protocol sends, byte for byte as it encoded
+#them, and what they should decode to
+OLD_WORKER_FRAMES = [
+    ('{"machineId": "m1", "state": "Waiting"}',
+        ClientToServerMsg.CurrentState(machineId="m1", state=WorkerState.Waiting())),
+    ('{"machineId": "m1", "state": {"artifacts": ["a1"], "logs_so_far": "hi\\n", "testId": "t1"}}',
+        ClientToServerMsg.CurrentState(machineId="m1", state=WorkerState.WorkingOnTest(testId="t1", logs_so_far="hi\n", artifacts=("a1",)))),
+    ('{"machineId": "m1", "state": {"deploymentId": "d1", "logs_so_far": "$ "}}',
+        ClientToServerMsg.CurrentState(machineId="m1", state=WorkerState.WorkingOnDeployment(deploymentId="d1", logs_so_far="$ "))),
+    ('{"machineId": "m1", "state": {"artifacts": ["a1"], "testSuccesses": {"x": [true, false]}, "testId": "t1", "success": true}}',
+        ClientToServerMsg.CurrentState(machineId="m1", state=WorkerState.TestFinished(testId="t1", success=True, testSuccesses={"x": (True, False)}, artifacts=("a1",)))),
+    ('"WaitingHeartbeat"',
+        ClientToServerMsg.WaitingHeartbeat()),
+    ('{"testId": "t1"}',
+        ClientToServerMsg.TestHeartbeat(testId="t1")),
+    ('{"testId": "t1", "artifact": "a1"}',
+        ClientToServerMsg.ArtifactUploaded(testId="t1", artifact="a1")),
+    ('{"log": "line\\n", "testId": "t1"}',
+        ClientToServerMsg.TestLogOutput(testId="t1", log="line\n")),
+    ('{"_type": "DeploymentHeartbeat", "deploymentId": "d1"}',
+        ClientToServerMsg.DeploymentHeartbeat(deploymentId="d1")),
+    ('{"_type": "DeploymentExited", "deploymentId": "d1"}',
+        ClientToServerMsg.DeploymentExited(deploymentId="d1")),
+    ('{"deploymentId": "d1", "data": "ls\\n"}',
+        ClientToServerMsg.DeploymentTerminalOutput(deploymentId="d1", data="ls\n")),
+    ('{"artifacts": [], "testSuccesses": {"x": [false, true]}, "testId": "t1", "success": false}',
+        ClientToServerMsg.TestFinished(testId="t1", success=False, testSuccesses={"x": (False, True)}, artifacts=())),
+    ('{"curTestOrDeployId": "t1", "requestUniqueId": "r1"}',
+        ClientToServerMsg.RequestPermissionToHitGitRepo(requestUniqueId="r1", curTestOrDeployId="t1")),
+    ('{"requestUniqueId": "r1"}',
+        ClientToServerMsg.GitRepoPullCompleted(requestUniqueId="r1")),
+    ]
+
+def connect(compression=True):
+    """A server and client codec that have negotiated as a new worker would."""
+    server = MessageCodec.MessageCodec(ServerToClientMsg, ClientToServerMsg)
+    client = MessageCodec.MessageCodec(ClientToServerMsg, ServerToClientMsg)
+
+    offer = server.decode(client.encode(
+        ClientToServerMsg.NegotiateProtocol(versions=MessageCodec.SUPPORTED_VERSIONS, schema=client.schema, compression=compression)
+        ))
+
+    version, compression = server.choose(offer.versions, offer.schema, offer.compression)
+    answer = client.decode(server.encode(ServerToClientMsg.ProtocolSelected(version=version, compression=compression)))
+    server.use(version, compression)
+    client.use(answer.version, answer.compression)
+
+    return server, client
+
+class MessageCodecTests(unittest.TestCase):
+    def test_starts_out_as_plain_json(self):
+        codec = MessageCodec.MessageCodec(ServerToClientMsg, ClientToServerMsg)
+        frame = codec.encode(ServerToClientMsg.CancelTest(testId="t"))
+
+        self.assertEqual(json.loads(frame), {"testId": "t", "_type": "CancelTest"})
+
+        #what an old worker sends
+        self.assertEqual(
+            codec.decode(json.dumps({"machineId": "m", "state": "Waiting"})),
+            ClientToServerMsg.CurrentState(machineId="m", state=TestLooperServer.WorkerState.Waiting())
+            )
+        self.assertEqual(codec.decode('"WaitingHeartbeat"'), ClientToServerMsg.WaitingHeartbeat())
+
+    def test_old_workers_are_understood(self):
+        #old workers never negotiate, but whatever mode a session is in, their frames have to decode
+        for mode in [None, False, True]:
+            if mode is None:
+                server = MessageCodec.MessageCodec(ServerToClientMsg, ClientToServerMsg)
+            else:
+                server, _ = connect(compression=mode)
+
+            for frame, msg in OLD_WORKER_FRAMES:
+                self.assertEqual(server.decode(frame), msg, frame)
+
+    def test_negotiation(self):
+        server, client = connect()
+
+        self.assertEqual((server.version, server.compression), (MessageCodec.BINARY, True))
+        self.assertEqual((client.version, client.compression), (MessageCodec.BINARY, True))
+
+        #a worker built from different message definitions stays on JSON
+        self.assertEqual(server.choose([MessageCodec.BINARY], "somethingElse", True), (MessageCodec.JSON, False))
+        #as does one that only speaks versions we don't
+        self.assertEqual(server.choose([99], server.schema, True), (MessageCodec.JSON, False))
+
+        server, client = connect(compression=False)
+        self.assertEqual((server.version, server.compression), (MessageCodec.BINARY, False))
+
+    def test_messages_roundtrip(self):
+        tests = TestDefinitionScript.extract_tests_from_str("repo", "hash", ".yml", test_yaml)[0]
+
+        for compression in [False, True]:
+            server, client = connect(compression)
+
+            for name, testDefinition in sorted(tests.items()):
+                msg = ServerToClientMsg.TestAssignment(testId=name, testDefinition=testDefinition)
+                self.assertEqual(client.decode(server.encode(msg)), msg)
+
+            msgs = [
+                ClientToServerMsg.CacheSummary(cachedBuilds={"abc": 123456789}, cachedImages=("img",)),
+                ClientToServerMsg.WaitingHeartbeat(),
+                ClientToServerMsg.TestLogOutput(testId="t", log="\x00\xffbinary junk"),
+                ClientToServerMsg.TestFinished(testId="t", success=True, testSuccesses={"a": (True, False)}, artifacts=("x",))
+                ]
+
+            #a JSON frame that was in flight when we switched is still readable
+            self.assertEqual(server.decode(json.dumps({"testId": "t"})), ClientToServerMsg.TestHeartbeat(testId="t"))
+
+            for _ in xrange(3):
+                for msg in msgs:
+                    self.assertEqual(server.decode(client.encode(msg)), msg)
+
+    def test_compression_shrinks_repetitive_traffic(self):
+        json_codec = MessageCodec.MessageCodec(ClientToServerMsg, ServerToClientMsg)
+        _, binary = connect(compression=False)
+        _, compressed = connect(compression=True)
+
+        def totalBytes(codec):
+            total = 0
+            for i in xrange(100):
+                total += len(codec.encode(ClientToServerMsg.TestLogOutput(testId="test_%s" % (i % 3), log="step %s: running unit tests\n" % i * 5)))
+                total += len(codec.encode(ClientToServerMsg.TestHeartbeat(testId="test_%s" % (i % 3))))
+            return total
+
+        jsonBytes, binaryBytes, compressedBytes = totalBytes(json_codec), totalBytes(binary), totalBytes(compressed)
+
+        self.assertLess(binaryBytes, jsonBytes)
+        self.assertLess(compressedBytes * 4, binaryBytes)
+        self.assertLess(compressed.compressedBytes, compressed.uncompressedBytes)
@@ -0,0 +1,65 @@
+import test_looper.core.Metrics as Metrics
+import threading
+import unittest
+
+class MetricsTests(unittest.TestCase):
+    def test_render_text(self):
+        registry = Metrics.Registry()
+
+        tasks = registry.counter("tasks_total", "Tasks")
+        tasks.inc(task="A")
+        tasks.inc(2, task="A")
+        tasks.inc(task='B"')
+
+        registry.gauge("depth", "Depth", lambda: Metrics.labeled("priority", {"high": 3}))
+
+        seconds = registry.histogram("seconds", "Seconds", buckets=(.1, 1.0))
+        for value in [.05, .5, .5, 5.0]:
+            seconds.observe(value, task="A")
+
+        self.assertIs(registry.counter("tasks_total", "Tasks"), tasks)
+        self.assertEqual(tasks.get(task="A"), 3)
+
+        self.assertEqual(registry.renderText().split("\n"), [
+            '# HELP depth Depth',
+            '# TYPE depth gauge',
+            'depth{priority="high"} 3.0',
+            '# HELP seconds Seconds',
+            '# TYPE seconds histogram',
+            'seconds_bucket{task="A",le="0.1"} 1',
+            'seconds_bucket{task="A",le="1.0"} 3',
+            'seconds_bucket{task="A",le="+Inf"} 4',
+            'seconds_sum{task="A"} 6.05',
+            'seconds_count{task="A"} 4',
+            '# HELP tasks_total Tasks',
+            '# TYPE tasks_total counter',
+            'tasks_total{task="A"} 3.0',
+            'tasks_total{task="B\\""} 1.0',
+            ''
+            ])
+
+        json = registry.toJson()
+        self.assertEqual(json["seconds"]["values"][0]["count"], 4)
+        self.assertEqual(json["seconds"]["values"][0]["buckets"][-1], ["+Inf", 4])
+        self.assertEqual(json["depth"]["values"], [{"labels": {"priority": "high"}, "value": 3}])
+
+    def test_timed_lock_only_times_the_outermost_acquisition(self):
+        registry = Metrics.Registry()
+        wait = registry.histogram("wait", "")
+        hold = registry.histogram("hold", "")
+        lock = Metrics.TimedLock(threading.RLock(), wait, hold)
+
+        with lock:
+            with lock:
+                pass
+
+        def other():
+            with lock:
+                pass
+
+        t = threading.Thread(target=other)
+        t.start()
+        t.join()
+
+        self.assertEqual(wait.samples()[0][1], 2)
+        self.assertEqual(hold.samples()[0][1], 2)
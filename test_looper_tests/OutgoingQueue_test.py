@@ -0,0 +1,118 @@
+import test_looper.worker.OutgoingQueue as OutgoingQueue
+import threading
+import time
+import unittest
+
+class Clock(object):
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+def logMessage(key):
+    return lambda text: ("log", key, text)
+
+class OutgoingQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.queue = OutgoingQueue.OutgoingQueue(
+            batchBytes=100,
+            batchSeconds=1.0,
+            bytesPerSecond=50,
+            burstBytes=200,
+            clock=self.clock
+            )
+
+    def test_logs_are_batched_by_size_and_age(self):
+        for i in xrange(5):
+            self.queue.putLog("t1", "line %s\n" % i, logMessage("t1"))
+
+        #not big enough or old enough yet
+        self.assertEqual(self.queue.get(timeout=0), None)
+
+        self.clock.t += 1.0
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t1", "".join("line %s\n" % i for i in xrange(5))))
+        self.assertEqual(self.queue.get(timeout=0), None)
+
+        self.queue.putLog("t1", "x" * 60, logMessage("t1"))
+        self.queue.putLog("t1", "y" * 60, logMessage("t1"))
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t1", "x" * 60 + "y" * 60))
+
+    def test_control_messages_go_first(self):
+        self.queue.putLog("t1", "x" * 150, logMessage("t1"))
+        self.queue.put("heartbeat")
+        self.queue.put("gitRequest")
+
+        self.assertEqual(self.queue.get(timeout=0), "heartbeat")
+        self.assertEqual(self.queue.get(timeout=0), "gitRequest")
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t1", "x" * 150))
+
+    def test_flush_keeps_logs_ahead_of_results(self):
+        self.queue.putLog("t1", "last words\n", logMessage("t1"))
+        self.queue.flushLogs("t1")
+        self.queue.put("finished")
+
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t1", "last words\n"))
+        self.assertEqual(self.queue.get(timeout=0), "finished")
+
+    def test_rate_cap_drops_and_summarizes(self):
+        self.assertTrue(self.queue.putLog("t1", "a" * 150, logMessage("t1")))
+        self.assertFalse(self.queue.putLog("t1", "b\n" * 50, logMessage("t1")))
+
+        #other tests have their own budget
+        self.assertTrue(self.queue.putLog("t2", "c" * 150, logMessage("t2")))
+
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t1", "a" * 150 + "\n[test-looper] Dropped 100 bytes (50 lines) of output: this test logged faster than 50 bytes/second.\n"))
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t2", "c" * 150))
+        self.assertEqual(self.queue.droppedBytes, 100)
+
+        #the budget refills with time
+        self.clock.t += 2.0
+        self.assertTrue(self.queue.putLog("t1", "d" * 150, logMessage("t1")))
+        self.assertFalse(self.queue.putLog("t1", "e", logMessage("t1")))
+
+    def test_drops_are_reported_even_if_the_test_goes_quiet(self):
+        self.queue.putLog("t1", "a" * 200, logMessage("t1"))
+        self.assertEqual(self.queue.get(timeout=0), ("log", "t1", "a" * 200))
+
+        self.queue.putLog("t1", "b", logMessage("t1"))
+        self.clock.t += 1.0
+
+        self.assertIn("Dropped 1 bytes", self.queue.get(timeout=0)[2])
+
+    def test_sent_text_is_the_whole_log(self):
+        #what the server ends up with, and what a client keeping only the output it queued would have
+        sent = []
+        kept = []
+
+        def makeMessage(text):
+            sent.append(text)
+            return ("log", "t1", text)
+
+        for text in ["a" * 150, "b\n" * 50, "c" * 10]:
+            if self.queue.putLog("t1", text, makeMessage):
+                kept.append(text)
+
+        self.queue.flushLogs("t1")
+        message = self.queue.get(timeout=0)
+
+        self.assertEqual(message[2], "".join(sent))
+        self.assertIn("Dropped 100 bytes", message[2])
+
+        #so a copy of the log has to come from makeMessage, or it falls short of the server's
+        self.assertGreater(len("".join(sent)), len("".join(kept)))
+
+    def test_get_blocks_until_a_batch_is_due(self):
+        queue = OutgoingQueue.OutgoingQueue(batchSeconds=.05)
+        results = []
+
+        t = threading.Thread(target=lambda: results.append(queue.get()))
+        t.start()
+
+        t0 = time.time()
+        queue.putLog("t1", "hi", logMessage("t1"))
+        t.join(5.0)
+
+        self.assertEqual(results, [("log", "t1", "hi")])
+        self.assertGreaterEqual(time.time() - t0, .04)
@@ -0,0 +1,49 @@
+import test_looper.core.RankedWorklist as RankedWorklist
+import unittest
+
+class RankedWorklistTests(unittest.TestCase):
+    def test_pops_in_rank_order(self):
+        worklist = RankedWorklist.RankedWorklist(lambda n: n % 10)
+
+        for n in [13, 5, 21, 9, 40]:
+            worklist.add(n)
+
+        self.assertEqual(len(worklist), 5)
+        self.assertEqual([worklist.pop() for _ in range(5)], [40, 21, 13, 5, 9])
+        self.assertIs(worklist.pop(), None)
+
+    def test_descending(self):
+        worklist = RankedWorklist.RankedWorklist(lambda n: n, descending=True)
+
+        for n in [3,1,2]:
+            worklist.add(n)
+
+        self.assertEqual([worklist.pop() for _ in range(3)], [3,2,1])
+
+    def test_each_node_processed_once(self):
+        #a chain where each node dirties the node below it, plus a diamond
+        edges = {5: [4], 4: [3, 2], 3: [1], 2: [1], 1: []}
+
+        worklist = RankedWorklist.RankedWorklist(lambda n: n, descending=True)
+        worklist.add(5)
+        worklist.add(2)
+
+        order = []
+        while len(worklist):
+            n = worklist.pop()
+            order.append(n)
+            for child in edges[n]:
+                worklist.add(child)
+
+        self.assertEqual(order, [5,4,3,2,1])
+        self.assertEqual(worklist.deferred, [])
+
+    def test_redirtied_nodes_are_deferred(self):
+        worklist = RankedWorklist.RankedWorklist(lambda n: n)
+        worklist.add(1)
+        self.assertEqual(worklist.pop(), 1)
+
+        self.assertFalse(worklist.add(1))
+        self.assertFalse(worklist.add(1))
+        self.assertEqual(worklist.deferred, [1])
+        self.assertEqual(len(worklist), 0)
@@ -0,0 +1,76 @@
+import test_looper.data_model.RunnableTestIndex as RunnableTestIndex
+import unittest
+
+class FakeTest(object):
+    def __init__(self, name):
+        self._identity = name
+
+    def __repr__(self):
+        return self._identity
+
+class RunnableTestIndexTests(unittest.TestCase):
+    def makeIndex(self):
+        #test -> (category, priority, tenant, weight, rank), standing in for the database
+        slots = {}
+        index = RunnableTestIndex.RunnableTestIndex(slots.get, lambda test, slot: slots.get(test) == slot)
+        return slots, index
+
+    def test_best_first_per_tenant(self):
+        slots, index = self.makeIndex()
+
+        tests = [FakeTest("t%s" % i) for i in xrange(10)]
+        for i, test in enumerate(tests):
+            slots[test] = ("cat", "pri", "repo%s" % (i % 2), 1.0, float(i))
+            index.update(test)
+
+        self.assertEqual(sorted(index.tenants("cat", "pri")), ["repo0", "repo1"])
+        self.assertEqual(index.tenants("cat", "other"), [])
+
+        self.assertEqual(index.best("cat", "pri", "repo0", 3), [tests[8], tests[6], tests[4]])
+        self.assertEqual(index.best("cat", "pri", "repo1", 1), [tests[9]])
+        self.assertEqual(index.best("cat", "pri", "repo1", 2, skip=("t9",)), [tests[7], tests[5]])
+
+        #equal ranks come out in the order they went in
+        a, b = FakeTest("a"), FakeTest("b")
+        for test in (a, b):
+            slots[test] = ("cat", "pri", "repo2", 1.0, 0.0)
+            index.update(test)
+        self.assertEqual(index.best("cat", "pri", "repo2", 2), [a, b])
+
+    def test_moved_tests_leave_stale_entries_behind(self):
+        slots, index = self.makeIndex()
+
+        a, b, c = FakeTest("a"), FakeTest("b"), FakeTest("c")
+        for rank, test in enumerate((a, b, c)):
+            slots[test] = ("cat", "pri", "", 1.0, float(rank))
+            index.update(test)
+
+        #'c' starts running, and 'a' is now on a longer critical path
+        del slots[c]
+        index.update(c)
+        slots[a] = ("cat", "pri", "", 1.0, 10.0)
+        index.update(a)
+
+        self.assertEqual(index.best("cat", "pri", "", 5), [a, b])
+        self.assertEqual(len(index), 2)
+
+        #a change the index never heard about (a rolled back transaction) is caught when we look
+        slots[a] = ("cat", "pri", "", 1.0, 3.0)
+        self.assertEqual(index.best("cat", "pri", "", 5), [b])
+        self.assertFalse(a in index)
+
+        del slots[b]
+        index.update(b)
+        self.assertEqual(index.best("cat", "pri", "", 5), [])
+        self.assertEqual(index.tenants("cat", "pri"), [])
+
+    def test_stale_entries_get_compacted(self):
+        slots, index = self.makeIndex()
+
+        test = FakeTest("t")
+        for rank in xrange(1000):
+            slots[test] = ("cat", "pri", "", 1.0, float(rank))
+            index.update(test)
+
+        self.assertLess(index._entries, 200)
+        self.assertEqual(index.best("cat", "pri", "", 5), [test])
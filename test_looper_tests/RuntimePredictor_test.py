@@ -0,0 +1,83 @@
+import test_looper.core.object_database as object_database
+import test_looper.core.InMemoryJsonStore as InMemoryJsonStore
+import test_looper.core.machine_management.MachineManagement as MachineManagement
+import test_looper.data_model.Types as Types
+import test_looper.data_model.RuntimePredictor as RuntimePredictor
+import unittest
+
+def makeTest(db, hash, name):
+    return db.Test.New(
+        hash=hash,
+        priority=db.TestPriority.NoMoreTests(),
+        testDefinitionSummary=db.TestDefinitionSummary.Summary(
+            name=name, 
+            machineOs=MachineManagement.OsConfig.LinuxWithDocker(), 
+            _fill_in_missing=True
+            )
+        )
+
+class RuntimePredictorTests(unittest.TestCase):
+    def test_percentile(self):
+        self.assertEqual(RuntimePredictor.percentile([], .5), 0.0)
+        self.assertEqual(RuntimePredictor.percentile([5.0], .9), 5.0)
+        self.assertEqual(RuntimePredictor.percentile([4.0, 1.0, 3.0, 2.0, 5.0], .5), 3.0)
+        self.assertAlmostEqual(RuntimePredictor.percentile([1.0, 2.0], .25), 1.25)
+
+    def test_stats_follow_recent_runs(self):
+        stats = RuntimePredictor._OfflineStats("k")
+
+        for _ in xrange(50):
+            RuntimePredictor.updateStats(stats, 100.0)
+
+        self.assertAlmostEqual(stats.mean, 100.0)
+        self.assertAlmostEqual(stats.variance, 0.0)
+
+        for _ in xrange(50):
+            RuntimePredictor.updateStats(stats, 200.0)
+
+        prediction = RuntimePredictor.predictionFromStats(stats)
+
+        self.assertAlmostEqual(prediction.mean, 200.0, places=1)
+        self.assertEqual(prediction.p90, 200.0)
+        self.assertEqual(len(stats.recent), RuntimePredictor.WINDOW)
+        self.assertEqual(prediction.samples, 100)
+
+    def test_new_definitions_use_the_test_name(self):
+        db = object_database.Database(InMemoryJsonStore.InMemoryJsonStore())
+        Types.setup_types(db)
+
+        with db.transaction():
+            old = makeTest(db, "h0", "build/linux")
+            new = makeTest(db, "h1", "build/linux")
+
+            self.assertIsNone(RuntimePredictor.predict(db, new))
+
+            for duration in [100, 110, 120]:
+                RuntimePredictor.recordRun(db, old, duration)
+
+            self.assertEqual(RuntimePredictor.predict(db, old).key, "hash:h0")
+            self.assertEqual(RuntimePredictor.predict(db, new).key, "name:build/linux")
+
+            RuntimePredictor.recordRun(db, new, 500)
+
+            #one run isn't enough to trust the hash on its own
+            self.assertEqual(RuntimePredictor.predict(db, new).key, "name:build/linux")
+            self.assertEqual(RuntimePredictor.predict(db, new).samples, 4)
+
+    def test_evaluate_dump(self):
+        def run(start, end, canceled=False):
+            return {"startedTimestamp": start, "endTimestamp": end, "canceled": canceled}
+
+        results = {"repos": {"repo": {"commits": {
+            "c0": {"tests": {"build": {"runs": [run(10.0, 110.0), run(200.0, 310.0, canceled=True)]}}},
+            "c1": {"tests": {"build": {"runs": [run(1000.0, 1120.0)]}, "test": {"runs": [run(1000.0, 1050.0)]}}}
+            }}}}
+
+        report = RuntimePredictor.evaluateDump(results)
+
+        self.assertEqual(report["runs"], 3)
+        self.assertEqual(report["tests"], 2)
+        self.assertEqual(report["unpredicted"], 2)
+        self.assertEqual(report["predicted"], 1)
+        self.assertEqual(report["mean_absolute_error"], 20.0)
+        self.assertEqual(report["p90_coverage"], 0.0)
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+"""SchedulerBenchmark
+
+Drives a TestManager with synthetic repos and simulated workers on a virtual
+clock and reports how the scheduler held up, as JSON, so that runs can be
+compared across versions.
+
+The repos, commits and test definitions live in the MockSourceControl from
+TestManagerTestHarness. Workers heartbeat, ask for work and report results
+the way the real ones do, except that time only moves when we say so. We
+measure the real time the TestManager spends on each call.
+
+    python -m test_looper_tests.SchedulerBenchmark --workers 200 --output results.json
+
+The TestManager parses every commit we generate, so setup time grows with
+--repos and --commitsPerRepo and is reported separately from the run.
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import time
+
+import test_looper.core.Metrics as Metrics
+import test_looper_tests.TestManagerTestHarness as TestManagerTestHarness
+
+#how often the server runs performCleanupTasks (see TestLooperServer.CLEANUP_TASK_FREQUENCY)
+CLEANUP_INTERVAL = 30.0
+
+class LoadConfig(object):
+    def __init__(self,
+            repos=4,
+            commitsPerRepo=250,
+            branchesPerRepo=10,
+            commitsPerBranch=5,
+            buildsPerCommit=3,
+            testsPerCommit=20,
+            testDepth=100,
+            workers=100,
+            duration=2 * 3600.0,
+            commitInterval=600.0,
+            meanTestSeconds=300.0,
+            failureRate=.05,
+            tick=5.0,
+            heartbeatInterval=30.0,
+            backgroundTasksPerTick=50,
+            seed=0
+            ):
+        self.repos = repos
+        self.commitsPerRepo = commitsPerRepo
+        self.branchesPerRepo = branchesPerRepo
+        self.commitsPerBranch = commitsPerBranch
+        self.buildsPerCommit = buildsPerCommit
+        self.testsPerCommit = testsPerCommit
+        self.testDepth = testDepth
+        self.workers = workers
+        self.duration = duration
+        self.commitInterval = commitInterval
+        self.meanTestSeconds = meanTestSeconds
+        self.failureRate = failureRate
+        self.tick = tick
+        self.heartbeatInterval = heartbeatInterval
+        self.backgroundTasksPerTick = backgroundTasksPerTick
+        self.seed = seed
+
+def testDefinitionsFor(repoName, builds, tests):
+    lines = [
+        "looper_version: 4",
+        "environments:",
+        "  linux:",
+        "    platform: linux",
+        "    image:",
+        "      dockerfile_contents: 'FROM ubuntu:16.04 # %s'" % repoName,
+        "builds:"
+        ]
+
+    for i in xrange(builds):
+        lines += [
+            "  build%s/linux:" % i,
+            "    command: 'build.sh %s'" % i,
+            "    dependencies:",
+            "      src: HEAD"
+            ]
+
+    lines.append("tests:")
+
+    for i in xrange(tests):
+        lines += [
+            "  test%s/linux:" % i,
+            "    command: 'test.sh %s'" % i,
+            "    dependencies:",
+            "      src: HEAD",
+            "      build: build%s/linux" % (i % builds)
+            ]
+
+    return "\n".join(lines) + "\n"
+
+def summarize(values):
+    """count, mean, max and percentiles of a list of numbers."""
+    if not values:
+        return {"count": 0}
+
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(math.ceil(p * len(values))) - 1)]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(.5),
+        "p90": percentile(.9),
+        "p99": percentile(.99),
+        "max": values[-1]
+        }
+
+class RecordingHistogram(object):
+    """Passes observations on to a Metrics histogram, and keeps them so we can report percentiles."""
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.values = []
+
+    def observe(self, value):
+        self.histogram.observe(value)
+        self.values.append(value)
+
+class Simulation(object):
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+
+        self.harness = TestManagerTestHarness.getHarness(max_workers=config.workers)
+        self.manager = self.harness.manager
+        self.sourceControl = self.manager.source_control
+
+        writelock = self.manager.writelock
+        self.writelockHolds = RecordingHistogram(writelock.holdHistogram)
+        self.manager.writelock = Metrics.TimedLock(writelock.lock, writelock.waitHistogram, self.writelockHolds)
+
+        #transaction number when the run started
+        self.firstTransaction = None
+
+        #repo -> number of commits on master
+        self.masterLength = {}
+        #commit hash -> virtual time it was pushed
+        self.pushTimes = {}
+        #commit hash -> virtual time its first test started
+        self.firstAssignments = {}
+
+        #testId -> (machineId, virtual end time, testDefinition)
+        self.running = {}
+        #machineId -> testId
+        self.busy = {}
+
+        self.assignmentLatencies = []
+        self.emptyPollLatencies = []
+        self.resultLatencies = []
+        self.backlogSamples = []
+        self.backgroundTasks = 0
+        self.testsFinished = 0
+        self.testsFailed = 0
+        self.busyMachineSeconds = 0.0
+        self.aliveMachineSeconds = 0.0
+
+        self.setupSeconds = 0.0
+        self.setupTasks = 0
+
+    def now(self):
+        return self.harness.timestamp
+
+    def repoName(self, ix):
+        return "repo%s" % ix
+
+    def _baseDuration(self, testName):
+        rng = random.Random("%s/%s" % (self.config.seed, testName))
+        sigma = .5
+        return rng.lognormvariate(math.log(self.config.meanTestSeconds) - sigma * sigma / 2, sigma)
+
+    def generateHistory(self):
+        config = self.config
+        testDefs = {}
+
+        for ix in xrange(config.repos):
+            repo = self.repoName(ix)
+            testDefs[repo] = testDefinitionsFor(repo, config.buildsPerCommit, config.testsPerCommit)
+
+            masterLength = max(1, config.commitsPerRepo - config.branchesPerRepo * config.commitsPerBranch)
+
+            for i in xrange(masterLength):
+                self.sourceControl.addCommit(
+                    "%s/c%s" % (repo, i),
+                    ["%s/c%s" % (repo, i - 1)] if i else [],
+                    testDefs[repo]
+                    )
+
+            self.masterLength[repo] = masterLength
+            self.sourceControl.setBranch(repo + "/master", "%s/c%s" % (repo, masterLength - 1))
+
+            #feature branches off of recent history
+            for b in xrange(config.branchesPerRepo):
+                parent = "%s/c%s" % (repo, max(0, masterLength - 1 - self.rng.randint(0, config.testDepth)))
+
+                for i in xrange(config.commitsPerBranch):
+                    commitId = "%s/b%s_%s" % (repo, b, i)
+                    self.sourceControl.addCommit(commitId, [parent], testDefs[repo])
+                    parent = commitId
+
+                self.sourceControl.setBranch("%s/feature%s" % (repo, b), parent)
+
+        self.testDefs = testDefs
+
+    def setup(self):
+        t0 = time.time()
+
+        self.generateHistory()
+
+        self.harness.markRepoListDirty()
+        self.setupTasks += self._drainBackgroundTasks()
+
+        for ix in xrange(self.config.repos):
+            repo = self.repoName(ix)
+            for branch in ["master"] + ["feature%s" % b for b in xrange(self.config.branchesPerRepo)]:
+                with self.manager.database.transaction():
+                    b = self.manager.database.Branch.lookupOne(reponame_and_branchname=(repo, branch))
+                    self.manager.toggleBranchUnderTest(b)
+                    self.manager.prioritizeAllCommitsUnderBranch(b, 1, self.config.testDepth)
+
+        self.setupTasks += self._drainBackgroundTasks()
+
+        self.setupSeconds = time.time() - t0
+
+    def _drainBackgroundTasks(self):
+        """Run background tasks until there are none, with one cleanup pass in the middle."""
+        count = 0
+        cleanedUp = False
+
+        while True:
+            self.harness.timestamp += .01
+            if self.manager.performBackgroundWork(self.now()) is not None:
+                count += 1
+            elif not cleanedUp:
+                cleanedUp = True
+                self.manager.performCleanupTasks(self.now())
+            else:
+                return count
+
+    def pushCommit(self, repo):
+        i = self.masterLength[repo]
+        commitId = "%s/c%s" % (repo, i)
+
+        self.sourceControl.addCommit(commitId, ["%s/c%s" % (repo, i - 1)], self.testDefs[repo])
+        self.sourceControl.setBranch(repo + "/master", commitId)
+        self.masterLength[repo] = i + 1
+
+        self.pushTimes["c%s" % i, repo] = self.now()
+        self.manager.markBranchListDirty(repo, self.now())
+
+    def _commitsFor(self, testDefinition):
+        with self.manager.database.view():
+            test = self.manager.database.Test.lookupAny(hash=testDefinition.hash)
+            if not test:
+                return []
+            return [(c.hash, c.repo.name) for c in self.manager.commitsReferencingTest(test)]
+
+    def aliveMachines(self):
+        with self.manager.database.view():
+            return sorted(m.machineId for m in self.manager.database.Machine.lookupAll(isAlive=True))
+
+    def assignWork(self, machines):
+        for machineId in machines:
+            if machineId in self.busy:
+                continue
+
+            t0 = time.time()
+            testId, testDefinition = self.manager.startNewTest(machineId, self.now())
+            latency = time.time() - t0
+
+            if not testId:
+                self.emptyPollLatencies.append(latency)
+                #every other idle worker would hear the same thing
+                return
+
+            self.assignmentLatencies.append(latency)
+
+            duration = self._baseDuration(testDefinition.name) * self.rng.uniform(.8, 1.2)
+
+            self.running[testId] = (machineId, self.now() + duration, testDefinition)
+            self.busy[machineId] = testId
+            self.manager.testHeartbeat(testId, self.now())
+
+            for commit in self._commitsFor(testDefinition):
+                if commit in self.pushTimes and commit not in self.firstAssignments:
+                    self.firstAssignments[commit] = self.now() - self.pushTimes[commit]
+
+    def finishTests(self):
+        for testId, (machineId, endTime, testDefinition) in sorted(self.running.items()):
+            if endTime > self.now():
+                continue
+
+            del self.running[testId]
+            del self.busy[machineId]
+
+            artifacts = [a.name for stage in testDefinition.stages for a in stage.artifacts]
+            success = self.rng.random() >= self.config.failureRate
+
+            t0 = time.time()
+            for artifact in artifacts:
+                self.manager.recordTestArtifactUploaded(testId, artifact, self.now(), False)
+            self.manager.recordTestResults(success, testId, {}, artifacts, self.now())
+            self.resultLatencies.append(time.time() - t0)
+
+            self.testsFinished += 1
+            if not success:
+                self.testsFailed += 1
+
+    def heartbeat(self, machines):
+        for testId in sorted(self.running):
+            self.manager.testHeartbeat(testId, self.now())
+
+        for machineId in machines:
+            if machineId not in self.busy:
+                self.manager.machineHeartbeat(machineId, self.now())
+
+    def run(self):
+        config = self.config
+        t0 = time.time()
+        start = self.now()
+        end = start + config.duration
+
+        self.firstTransaction = self.manager.database._cur_transaction_num
+        self.writelockHolds.values = []
+
+        nextCommit = dict(
+            (self.repoName(ix), start + self.rng.expovariate(1.0 / config.commitInterval))
+                for ix in xrange(config.repos)
+            )
+        nextHeartbeat = start
+        nextCleanup = start
+
+        while self.now() < end:
+            self.harness.timestamp += config.tick
+
+            for repo in sorted(nextCommit):
+                while nextCommit[repo] <= self.now():
+                    self.pushCommit(repo)
+                    nextCommit[repo] += self.rng.expovariate(1.0 / config.commitInterval)
+
+            for _ in xrange(config.backgroundTasksPerTick):
+                if self.manager.performBackgroundWork(self.now()) is None:
+                    break
+                self.backgroundTasks += 1
+
+            with self.manager.database.view():
+                self.backlogSamples.append(self.manager._taskCount())
+
+            self.finishTests()
+
+            machines = self.aliveMachines()
+
+            #tests on machines that went away are gone
+            for machineId in set(self.busy) - set(machines):
+                self.running.pop(self.busy.pop(machineId), None)
+
+            if self.now() >= nextHeartbeat:
+                self.heartbeat(machines)
+                nextHeartbeat += config.heartbeatInterval
+
+            if self.now() >= nextCleanup:
+                self.manager.performCleanupTasks(self.now())
+                nextCleanup += CLEANUP_INTERVAL
+            else:
+                deadline = self.manager.nextTimeoutDeadline()
+                if deadline is not None and deadline <= self.now():
+                    self.manager.expireTimeouts(self.now())
+
+            self.assignWork(machines)
+
+            self.busyMachineSeconds += len(self.busy) * config.tick
+            self.aliveMachineSeconds += len(machines) * config.tick
+
+        return time.time() - t0
+
+    def report(self, wallSeconds):
+        with self.manager.database.view():
+            finalBacklog = self.manager._taskCount()
+
+        return {
+            "config": dict(self.config.__dict__),
+            "setup": {
+                "wall_seconds": self.setupSeconds,
+                "background_tasks": self.setupTasks
+                },
+            "virtual_seconds": self.config.duration,
+            "wall_seconds": wallSeconds,
+            "tests": {
+                "started": len(self.assignmentLatencies),
+                "finished": self.testsFinished,
+                "failed": self.testsFailed,
+                "running_at_end": len(self.running)
+                },
+            "commits_pushed": len(self.pushTimes),
+            "assignment_latency_seconds": summarize(self.assignmentLatencies),
+            "empty_poll_latency_seconds": summarize(self.emptyPollLatencies),
+            "result_latency_seconds": summarize(self.resultLatencies),
+            "commit_first_assignment_virtual_seconds": summarize(self.firstAssignments.values()),
+            "background_tasks": {
+                "processed": self.backgroundTasks,
+                "backlog": summarize(self.backlogSamples),
+                "final_backlog": finalBacklog
+                },
+            "transactions_committed": self.manager.database._cur_transaction_num - self.firstTransaction,
+            "writelock": {
+                "hold_seconds": summarize(self.writelockHolds.values),
+                "held_seconds_total": sum(self.writelockHolds.values)
+                },
+            "worker_utilization": self.busyMachineSeconds / self.aliveMachineSeconds if self.aliveMachineSeconds else 0.0,
+            "metrics": self.manager.metrics.toJson()
+            }
+
+def runBenchmark(config):
+    simulation = Simulation(config)
+    simulation.setup()
+    return simulation.report(simulation.run())
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the test-looper scheduler against synthetic load on a virtual clock."
+        )
+
+    defaults = LoadConfig()
+
+    for name in sorted(defaults.__dict__):
+        value = defaults.__dict__[name]
+        parser.add_argument("--" + name, type=type(value), default=value)
+
+    parser.add_argument("--output",
+                        default=None,
+                        help="Write the JSON report here instead of stdout")
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        action='store_true',
+                        help="Show the TestManager's logging")
+
+    return parser
+
+def main(argv):
+    args = createArgumentParser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    config = LoadConfig(**dict((k, getattr(args, k)) for k in LoadConfig().__dict__))
+
+    report = json.dumps(runBenchmark(config), indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print report
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,38 @@
+import test_looper_tests.SchedulerBenchmark as SchedulerBenchmark
+import json
+import unittest
+
+class SchedulerBenchmarkTests(unittest.TestCase):
+    def test_small_benchmark_runs(self):
+        config = SchedulerBenchmark.LoadConfig(
+            repos=2,
+            commitsPerRepo=20,
+            branchesPerRepo=1,
+            commitsPerBranch=2,
+            buildsPerCommit=1,
+            testsPerCommit=2,
+            testDepth=5,
+            workers=4,
+            duration=1800.0,
+            commitInterval=300.0
+            )
+
+        report = json.loads(json.dumps(SchedulerBenchmark.runBenchmark(config)))
+
+        self.assertGreater(report["tests"]["finished"], 0)
+        self.assertEqual(report["tests"]["started"], report["assignment_latency_seconds"]["count"])
+        self.assertEqual(report["tests"]["finished"], report["result_latency_seconds"]["count"])
+        self.assertGreater(report["commits_pushed"], 0)
+        self.assertGreater(report["transactions_committed"], 0)
+        self.assertGreater(report["writelock"]["hold_seconds"]["count"], 0)
+        self.assertEqual(report["background_tasks"]["backlog"]["count"], 1800 / 5)
+        self.assertTrue(0.0 < report["worker_utilization"] <= 1.0)
+
+    def test_summarize(self):
+        summary = SchedulerBenchmark.summarize(range(1, 101))
+
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50"], 50)
+        self.assertEqual(summary["p99"], 99)
+        self.assertEqual(summary["max"], 100)
+        self.assertEqual(SchedulerBenchmark.summarize([]), {"count": 0})
@@ -0,0 +1,14 @@
+import test_looper.worker.TestLooperClient as TestLooperClient
+import unittest
+
+class TestLogTests(unittest.TestCase):
+    def test_since(self):
+        log = TestLooperClient.TestLog()
+
+        self.assertEqual(log.append("hello "), 0)
+        self.assertEqual(log.append("big "), 6)
+        self.assertEqual(log.append("world"), 10)
+        self.assertEqual(log.size, 15)
+
+        for offset in xrange(16):
+            self.assertEqual(log.since(offset), "hello big world"[offset:])
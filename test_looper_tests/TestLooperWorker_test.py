@@ -0,0 +1,53 @@
+import test_looper.core.Futures as Futures
+import test_looper.worker.TestLooperWorker as TestLooperWorker
+import threading
+import unittest
+
+class FakeWorkerState(object):
+    def __init__(self):
+        self.downloadPool = Futures.FuturePool(1, "TestDownloads")
+        self.release = threading.Event()
+        self.prefetched = []
+
+    def prefetchDependencies(self, testDefinition, shouldContinue):
+        self.prefetched.append(testDefinition)
+        self.release.wait()
+
+class FakeClient(object):
+    def reservedTestHash(self):
+        return "reserved"
+
+class TestLooperWorkerTests(unittest.TestCase):
+    def test_prefetch_uses_the_download_pool_once_per_test(self):
+        workerState = FakeWorkerState()
+        worker = TestLooperWorker.TestLooperWorker(workerState, "machine", None, False, 1.0)
+
+        #the one download thread is busy, so prefetches have to wait for it
+        started = threading.Event()
+        def download():
+            started.set()
+            workerState.release.wait()
+        busy = workerState.downloadPool.submit(download)
+        started.wait()
+
+        for _ in xrange(3):
+            worker._prefetch(workerState, FakeClient(), "reserved", "testDefinition")
+        worker._prefetch(workerState, FakeClient(), "other", "otherDefinition")
+
+        self.assertEqual(workerState.downloadPool.queued(), 2)
+        self.assertEqual(workerState.prefetched, [])
+
+        workerState.release.set()
+        busy.wait()
+
+        #the pool runs work in order on its one thread, so this finishes after the prefetches
+        Futures.waitAll([workerState.downloadPool.submit(lambda: None)])
+
+        self.assertEqual(workerState.prefetched, ["testDefinition", "otherDefinition"])
+        self.assertEqual(worker._prefetching, set())
+
+        #once it's done, a new reservation of the same test gets prefetched again
+        worker._prefetch(workerState, FakeClient(), "reserved", "testDefinition")
+        Futures.waitAll([workerState.downloadPool.submit(lambda: None)])
+
+        self.assertEqual(workerState.prefetched, ["testDefinition", "otherDefinition", "testDefinition"])
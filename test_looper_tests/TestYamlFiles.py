@@ -267,3 +267,81 @@ builds:
      input: repo2_ref/build_without_deps/linux
 """
 
+
+repo10_critical_path = """
+looper_version: 4
+environments:
+  e1: 
+    platform: linux
+    image:
+      dockerfile: "test_looper/Dockerfile.txt"
+builds:
+  leaf0/e1:
+    command: hi
+  leaf1/e1:
+    command: hi
+  leaf2/e1:
+    command: hi
+  leaf3/e1:
+    command: hi
+  chain0/e1:
+    command: hi
+  chain1/e1:
+    command: hi
+    dependencies:
+     input: chain0/e1
+tests:
+  chain_test/e1:
+    command: hi
+    dependencies:
+     input: chain1/e1
+"""
+
+repo11_cache_locality = """
+looper_version: 4
+environments:
+  e1: 
+    platform: linux
+    image:
+      dockerfile: "test_looper/Dockerfile.txt"
+builds:
+  b0/e1:
+    command: hi
+  b1/e1:
+    command: hi
+tests:
+  t0/e1:
+    command: hi
+    dependencies:
+     input: b0/e1
+  t1/e1:
+    command: hi
+    dependencies:
+     input: b1/e1
+  t2/e1:
+    command: hi
+    dependencies:
+     input: b1/e1
+  t3/e1:
+    command: hi
+    dependencies:
+     input: b1/e1
+  t4/e1:
+    command: hi
+    dependencies:
+     input: b1/e1
+"""
+
+repo12_hedging = """
+looper_version: 4
+environments:
+  e1: 
+    platform: linux
+    image:
+      dockerfile: "test_looper/Dockerfile.txt"
+builds:
+  slow/e1:
+    command: hi
+  quick/e1:
+    command: hi
+"""
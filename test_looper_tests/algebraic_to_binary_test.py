@@ -0,0 +1,80 @@
+import test_looper.core.algebraic as algebraic
+import test_looper.core.algebraic_to_binary as algebraic_to_binary
+import test_looper.core.Bitstring as Bitstring
+import unittest
+
+Expr = algebraic.Alternative("Expr")
+Expr.Constant = {'value': int}
+Expr.Add = {'lhs': Expr, 'rhs': Expr}
+Expr.Named = {'name': str, 'tags': algebraic.List(str), 'weights': algebraic.Dict(str, (float, bool))}
+Expr.Maybe = {'inner': algebraic.Nullable(Expr)}
+Expr.Flags = {'bits': Bitstring.Bitstring}
+Expr.Nothing = {}
+
+class AlgebraicToBinaryTests(unittest.TestCase):
+    def roundtrip(self, value, t):
+        encoder = algebraic_to_binary.Encoder()
+        data = encoder.to_binary(value, t)
+        self.assertEqual(encoder.from_binary(data, t), value)
+        return data
+
+    def test_primitives(self):
+        for i in [0, 1, -1, 63, 64, -65, 2**40, -2**70]:
+            self.roundtrip(i, int)
+
+        self.assertEqual(len(self.roundtrip(5, int)), 1)
+        self.roundtrip(True, bool)
+        self.roundtrip(1.5, float)
+        self.roundtrip("\x00\xff not utf8 \x80", str)
+
+    def test_alternatives(self):
+        e = Expr.Add(
+            lhs=Expr.Constant(-3),
+            rhs=Expr.Add(
+                lhs=Expr.Named(name="x", tags=("a", "b"), weights={"w": (.5, True)}),
+                rhs=Expr.Maybe(inner=Expr.Nothing())
+                )
+            )
+        self.roundtrip(e, Expr)
+        self.roundtrip(Expr.Maybe(inner=None), Expr)
+
+    def test_types_with_their_own_json(self):
+        encoder = algebraic_to_binary.Encoder()
+        bits = Bitstring.Bitstring.fromBools([True, False, True] * 10)
+
+        decoded = encoder.from_binary(encoder.to_binary(Expr.Flags(bits), Expr), Expr)
+
+        self.assertEqual(decoded.bits.bits, bits.bits)
+
+    def test_partial_builds_stay_private(self):
+        encoder = algebraic_to_binary.Encoder()
+        makeEncoder = encoder._makeEncoder
+        published = []
+
+        def spying(t):
+            #another thread looking up encoders mid-build mustn't find an unfinished one
+            published.append(encoder._key(t) in encoder._encoders)
+            return makeEncoder(t)
+        encoder._makeEncoder = spying
+
+        value = Expr.Add(lhs=Expr.Constant(1), rhs=Expr.Named(name="x", tags=("a",), weights={"w": (.5, True)}))
+        self.assertEqual(encoder.from_binary(encoder.to_binary(value, Expr), Expr), value)
+
+        self.assertTrue(published)
+        self.assertFalse(any(published))
+
+    def test_bad_input(self):
+        encoder = algebraic_to_binary.Encoder()
+        data = encoder.to_binary(Expr.Constant(1), Expr)
+
+        with self.assertRaises(UserWarning):
+            encoder.from_binary(data + "x", Expr)
+        with self.assertRaises(UserWarning):
+            encoder.from_binary("\x7f", Expr)
+
+    def test_schema_hash(self):
+        Other = algebraic.Alternative("Expr")
+        Other.Constant = {'value': int}
+
+        self.assertEqual(algebraic_to_binary.schemaHash(Expr), algebraic_to_binary.schemaHash(Expr))
+        self.assertNotEqual(algebraic_to_binary.schemaHash(Expr), algebraic_to_binary.schemaHash(Other))
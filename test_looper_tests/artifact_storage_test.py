@@ -49,6 +49,12 @@ class Mixin:
 
         self.assertEqual(open(os.path.join(self.scratchdir, "worker", "out2.tar.gz"), "rb").read(), "some_tarball")
 
+        stream = self.artifactStorage.open_build("testhash", "build_key")
+        try:
+            self.assertEqual(stream.read(4) + stream.read(), "some_tarball")
+        finally:
+            stream.close()
+
     def test_upload_test_artifacts(self):
         put_into(self.scratchdir, 
             {"worker": {
@@ -1,5 +1,6 @@
 import unittest
 import os
+import re
 import logging
 import textwrap
 
@@ -8,6 +9,8 @@ import test_looper_tests.TestYamlFiles as TestYamlFiles
 import test_looper_tests.TestManagerTestHarness as TestManagerTestHarness
 import test_looper.data_model.BranchPinning as BranchPinning
 import test_looper.data_model.ImportExport as ImportExport
+import test_looper.data_model.RuntimePredictor as RuntimePredictor
+import test_looper.data_model.TestManager as TestManager
 common.configureLogging()
 
 class TestManagerTests(unittest.TestCase):
@@ -195,6 +198,8 @@ class TestManagerTests(unittest.TestCase):
             top_commit = top_commit.data.parents[0]
             self.assertEqual(top_commit.data.repos["child"].reference, "repo2/c5")
 
+        self.assertBranchReachabilityIsConsistent(harness)
+
         
 
     def test_manager_branch_circular_pinning(self):
@@ -747,6 +752,17 @@ class TestManagerTests(unittest.TestCase):
         exporter = ImportExport.ImportExport(harness.manager)
         jsonRepresentation = exporter.export()
 
+        with harness.database.view():
+            ranTests = [t for t in harness.manager.allTestsForCommit(harness.getCommit("repo1/c1")) if t.totalRuns]
+            self.assertTrue(ranTests)
+
+            for test in ranTests:
+                self.assertTrue(harness.manager.predictedTestRuntime(test).samples >= test.totalRuns)
+
+        self.assertEqual(RuntimePredictor.evaluateDump(jsonRepresentation)["runs"], sum(
+            len(t["runs"]) for r in jsonRepresentation["repos"].values() for c in r["commits"].values() for t in c["tests"].values()
+            ))
+
         harness2 = TestManagerTestHarness.getHarness()
         harness2.add_content()
 
@@ -758,6 +774,524 @@ class TestManagerTests(unittest.TestCase):
 
         self.assertEqual(importer.export(), jsonRepresentation)
 
+    def simulateCommitLatency(self, durations, workers):
+        """Run repo10/c0 on a virtual clock where each test takes durations[name]. Returns seconds to all-green."""
+        harness = TestManagerTestHarness.getHarness(max_workers=workers)
+
+        harness.manager.source_control.addCommit("repo10/c0", [], TestYamlFiles.repo10_critical_path)
+        harness.manager.source_control.setBranch("repo10/master", "repo10/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        #give the predictor some history
+        with harness.database.transaction():
+            for name, duration in durations.iteritems():
+                for _ in xrange(3):
+                    RuntimePredictor.recordRun(harness.database, harness.lookupTestByFullname("repo10/c0/" + name), duration)
+
+        harness.enableBranchTesting("repo10", "master")
+
+        start = harness.timestamp
+        running = {}
+
+        while True:
+            for testId in running:
+                harness.manager.testHeartbeat(testId, harness.timestamp)
+
+            harness.consumeBackgroundTasks()
+
+            for testId, testDef in harness.startAllNewTests():
+                running[testId] = (harness.timestamp + durations[testDef.name], testDef)
+                harness.manager.testHeartbeat(testId, harness.timestamp)
+
+            if not running:
+                break
+
+            testId = min(running, key=lambda t: running[t][0])
+            end, testDef = running.pop(testId)
+
+            harness.timestamp = max(harness.timestamp, end)
+
+            artifacts = [a.name for stage in testDef.stages for a in stage.artifacts]
+            for artifact in artifacts:
+                harness.manager.recordTestArtifactUploaded(testId, artifact, harness.timestamp, False)
+            harness.manager.recordTestResults(True, testId, {}, artifacts, harness.timestamp)
+
+            end = harness.timestamp
+
+        with harness.database.view():
+            for test in harness.manager.allTestsForCommit(harness.getCommit("repo10/c0")):
+                self.assertEqual(test.successes, 1, test.testDefinitionSummary.name)
+
+        return end - start
+
+    def test_manager_critical_path_scheduling(self):
+        durations = {
+            "leaf0/e1": 300, "leaf1/e1": 300, "leaf2/e1": 300, "leaf3/e1": 300,
+            "chain0/e1": 400, "chain1/e1": 400, "chain_test/e1": 400
+            }
+
+        old = TestManager.CRITICAL_PATH_SCHEDULING
+        try:
+            TestManager.CRITICAL_PATH_SCHEDULING = False
+            baseline = self.simulateCommitLatency(durations, workers=2)
+
+            TestManager.CRITICAL_PATH_SCHEDULING = True
+            criticalPath = self.simulateCommitLatency(durations, workers=2)
+        finally:
+            TestManager.CRITICAL_PATH_SCHEDULING = old
+
+        #2400 seconds of work on two machines can't finish in less than 1200 seconds, and
+        #the harness adds a second of bookkeeping for each background task it runs
+        self.assertLess(criticalPath, 1400, (baseline, criticalPath))
+        self.assertLess(criticalPath, baseline, (baseline, criticalPath))
+
+    def test_manager_stores_critical_paths(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo10/c0", [], TestYamlFiles.repo10_critical_path)
+        harness.manager.source_control.setBranch("repo10/master", "repo10/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        with harness.database.transaction():
+            for name, duration in [("chain0/e1", 100), ("chain1/e1", 200), ("chain_test/e1", 400)]:
+                for _ in xrange(3):
+                    RuntimePredictor.recordRun(harness.database, harness.lookupTestByFullname("repo10/c0/" + name), duration)
+
+        harness.enableBranchTesting("repo10", "master")
+        harness.consumeBackgroundTasks()
+
+        with harness.database.view():
+            def criticalPath(name):
+                return harness.lookupTestByFullname("repo10/c0/" + name).criticalPath
+
+            self.assertEqual(criticalPath("chain_test/e1"), 400)
+            self.assertEqual(criticalPath("chain1/e1"), 600)
+            self.assertEqual(criticalPath("chain0/e1"), 700)
+            self.assertEqual(criticalPath("leaf0/e1"), TestManager.DEFAULT_PREDICTED_TEST_DURATION)
+
+        #picking a test takes the top of the runnable test index, without scoring candidates
+        manager = harness.manager
+        lookup = manager._lookupHighestPriorityTest
+        scoredDuringLookup = []
+        inLookup = [False]
+
+        def counting(method):
+            def f(test):
+                if inLookup[0]:
+                    scoredDuringLookup.append(test)
+                return method(test)
+            return f
+
+        def countingLookup(*args, **kwargs):
+            inLookup[0] = True
+            try:
+                return lookup(*args, **kwargs)
+            finally:
+                inLookup[0] = False
+
+        manager.predictedTestRuntime = counting(manager.predictedTestRuntime)
+        manager._fairShareTenant = counting(manager._fairShareTenant)
+        manager._lookupHighestPriorityTest = countingLookup
+
+        testId, testDef = manager.startNewTest(harness.getUnusedMachineId(), harness.timestamp)
+
+        self.assertEqual(testDef.name, "chain0/e1")
+        self.assertEqual(scoredDuringLookup, [])
+
+    def test_manager_cache_locality(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo11/c0", [], TestYamlFiles.repo11_cache_locality)
+        harness.manager.source_control.setBranch("repo11/master", "repo11/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        with harness.database.transaction():
+            #t0 has the longest critical path, so it's what we'd run first
+            for _ in xrange(3):
+                RuntimePredictor.recordRun(harness.database, harness.lookupTestByFullname("repo11/c0/t0/e1"), 3000)
+            b1Hash = harness.lookupTestByFullname("repo11/c0/b1/e1").hash
+
+        harness.enableBranchTesting("repo11", "master")
+        harness.consumeBackgroundTasks()
+
+        builds = harness.startAllNewTests()
+        self.assertEqual(sorted(testDef.name for _, testDef in builds), ["b0/e1", "b1/e1"])
+
+        for testId, testDef in builds:
+            artifacts = [a.name for stage in testDef.stages for a in stage.artifacts]
+            for artifact in artifacts:
+                harness.manager.recordTestArtifactUploaded(testId, artifact, harness.timestamp, False)
+            harness.manager.recordTestResults(True, testId, {}, artifacts, harness.timestamp)
+
+        harness.consumeBackgroundTasks()
+
+        #every machine that asks has b1 cached
+        assigned = []
+        while True:
+            machineId = harness.getUnusedMachineId()
+            if machineId is None:
+                break
+            harness.manager.machineCacheReported(machineId, {b1Hash: 10**9}, [])
+
+            testId, testDef = harness.manager.startNewTest(machineId, harness.timestamp)
+            if testId is None:
+                break
+            assigned.append(testDef.name)
+
+        #t0 gets passed over MAX_CACHE_LOCALITY_SKIPS times, and then it runs
+        self.assertEqual(assigned.index("t0/e1"), TestManager.MAX_CACHE_LOCALITY_SKIPS)
+        self.assertEqual(sorted(assigned), ["t0/e1", "t1/e1", "t2/e1", "t3/e1", "t4/e1"])
+
+        self.assertEqual(harness.manager.cacheLocalityStats, {
+            "local_hits": 4,
+            "passed_over": TestManager.MAX_CACHE_LOCALITY_SKIPS,
+            "forced": 1,
+            "bytes_saved": 4 * 10**9
+            })
+
+        #we forget skips for tests that stop waiting to run
+        with harness.manager.transaction_and_lock():
+            t1 = harness.lookupTestByFullname("repo11/c0/t1/e1")
+            harness.manager._cacheLocalitySkips[t1.hash] = 1
+            harness.manager._updateTestPriority(t1, harness.timestamp)
+
+        self.assertEqual(harness.manager._cacheLocalitySkips, {})
+
+    def test_manager_hedges_stragglers(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        with harness.database.transaction():
+            for name in ["slow/e1", "quick/e1"]:
+                for _ in xrange(3):
+                    RuntimePredictor.recordRun(harness.database, harness.lookupTestByFullname("repo12/c0/" + name), 300)
+
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        runs = dict((testDef.name, (testId, testDef)) for testId, testDef in harness.startAllNewTests())
+        self.assertEqual(sorted(runs), ["quick/e1", "slow/e1"])
+
+        def finish(testId, testDef):
+            artifacts = [a.name for stage in testDef.stages for a in stage.artifacts]
+            for artifact in artifacts:
+                harness.manager.recordTestArtifactUploaded(testId, artifact, harness.timestamp, False)
+            return harness.manager.recordTestResults(True, testId, {}, artifacts, harness.timestamp)
+
+        start = harness.timestamp
+
+        harness.timestamp = start + 300
+        finish(*runs["quick/e1"])
+
+        idleMachine = harness.getUnusedMachineId()
+        self.assertTrue(idleMachine)
+
+        #'slow' is late, but not late enough to duplicate yet
+        harness.timestamp = start + 500
+        harness.manager._refreshStragglers(harness.timestamp)
+        self.assertEqual(harness.manager.startNewTest(idleMachine, harness.timestamp), (None, None))
+
+        #we only notice stragglers during cleanup
+        harness.timestamp = start + 1000
+        self.assertEqual(harness.manager.startNewTest(idleMachine, harness.timestamp), (None, None))
+
+        harness.manager._refreshStragglers(harness.timestamp)
+        hedgeId, hedgeDef = harness.manager.startNewTest(idleMachine, harness.timestamp)
+        self.assertEqual(hedgeDef.name, "slow/e1")
+
+        #the duplicate finishes first, so we take its result and cancel the original
+        harness.timestamp = start + 1300
+        self.assertTrue(finish(hedgeId, hedgeDef))
+
+        self.assertFalse(finish(*runs["slow/e1"]))
+
+        with harness.database.view():
+            test = harness.lookupTestByFullname("repo12/c0/slow/e1")
+            self.assertEqual(test.successes, 1)
+            self.assertEqual(test.activeRuns, 0)
+            self.assertTrue(harness.database.TestRun(runs["slow/e1"][0]).canceled)
+
+        self.assertEqual(harness.manager.hedgeStats, {"launched": 1, "hedge_won": 1, "original_won": 0})
+
+    def test_manager_fair_share(self):
+        harness = TestManagerTestHarness.getHarness(max_workers=4)
+
+        weights = {"fair0": 1.0, "fair1": 1.0, "fair2": 2.0}
+
+        for reponame in sorted(weights):
+            #distinct names, so the repos don't share runtime predictions
+            builds = "".join("  %s_b%s/e1:\n    command: build %s\n" % (reponame, i, reponame) for i in xrange(40))
+            harness.manager.source_control.addCommit(reponame + "/c0", [], TestYamlFiles.repo12_hedging.split("builds:")[0] + "builds:\n" + builds)
+            harness.manager.source_control.setBranch(reponame + "/master", reponame + "/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        with harness.database.transaction():
+            for reponame, weight in weights.iteritems():
+                harness.getRepo(reponame).fairShareWeight = weight
+
+        for reponame in sorted(weights):
+            harness.enableBranchTesting(reponame, "master")
+
+        running = {}
+        completed = dict((reponame, 0) for reponame in weights)
+
+        for _ in xrange(40):
+            harness.consumeBackgroundTasks()
+
+            for testId, testDef in harness.startAllNewTests():
+                running[testId] = (harness.timestamp + 300, testDef)
+                harness.manager.testHeartbeat(testId, harness.timestamp)
+
+            testId = min(running, key=lambda t: running[t][0])
+            end, testDef = running.pop(testId)
+            harness.timestamp = max(harness.timestamp, end)
+
+            for t in running:
+                harness.manager.testHeartbeat(t, harness.timestamp)
+
+            artifacts = [a.name for stage in testDef.stages for a in stage.artifacts]
+            for artifact in artifacts:
+                harness.manager.recordTestArtifactUploaded(testId, artifact, harness.timestamp, False)
+            harness.manager.recordTestResults(True, testId, {}, artifacts, harness.timestamp)
+
+            with harness.database.view():
+                completed[harness.manager._fairShareTenant(harness.database.TestRun(testId).test)[0]] += 1
+
+        self.assertEqual(completed, {"fair0": 10, "fair1": 10, "fair2": 20})
+
+    def test_manager_fair_share_respects_priority(self):
+        harness = TestManagerTestHarness.getHarness(max_workers=4)
+
+        for reponame in ["fairhi", "fairlo"]:
+            builds = "".join("  b%s/e1:\n    command: build %s\n" % (i, reponame) for i in xrange(4))
+            harness.manager.source_control.addCommit(reponame + "/c0", [], TestYamlFiles.repo12_hedging.split("builds:")[0] + "builds:\n" + builds)
+            harness.manager.source_control.setBranch(reponame + "/master", reponame + "/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        with harness.database.transaction():
+            harness.manager.prioritizeAllCommitsUnderBranch(harness.getBranch("fairhi", "master"), 2, 100)
+            harness.manager.prioritizeAllCommitsUnderBranch(harness.getBranch("fairlo", "master"), 1, 100)
+
+        harness.consumeBackgroundTasks()
+
+        #'fairhi' has used far more than its share, but its tests outrank all of 'fairlo's
+        harness.manager.fairShare.usage["fairhi"] = 10.0 ** 6
+
+        for _ in xrange(4):
+            testId, _ = harness.manager.startNewTest(harness.getUnusedMachineId(), harness.timestamp)
+
+            with harness.database.view():
+                self.assertEqual(harness.manager._fairShareTenant(harness.database.TestRun(testId).test)[0], "fairhi")
+
+    def test_manager_git_repo_lock_queue(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        runs = dict((testDefinition.name, testId) for testId, testDefinition in harness.startAllNewTests())
+        slowId, quickId = runs["slow/e1"], runs["quick/e1"]
+
+        granted = []
+
+        self.assertFalse(harness.manager.requestGitRepoLock("unknown", "not_a_test", granted.append, harness.timestamp))
+
+        old = harness.manager.gitConnections.limit
+        try:
+            harness.manager.gitConnections.limit = 1
+
+            self.assertTrue(harness.manager.requestGitRepoLock("r0", slowId, granted.append, harness.timestamp))
+            self.assertTrue(harness.manager.requestGitRepoLock("r1", quickId, granted.append, harness.timestamp))
+            self.assertEqual(granted, ["r0"])
+
+            #r1 gets its turn as soon as r0 is done, without asking again
+            harness.manager.gitRepoLockReleased("r0", harness.timestamp + 5)
+            self.assertEqual(granted, ["r0", "r1"])
+
+            #and a lease whose test is canceled goes back in the pool
+            self.assertTrue(harness.manager.requestGitRepoLock("r2", slowId, granted.append, harness.timestamp))
+            with harness.manager.transaction_and_lock():
+                harness.manager._cancelTestRun(harness.database.TestRun(quickId), harness.timestamp)
+            harness.manager.performCleanupTasks(harness.timestamp)
+            self.assertEqual(granted, ["r0", "r1", "r2"])
+        finally:
+            harness.manager.gitConnections.limit = old
+
+    def test_manager_heartbeats_are_coalesced(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        (quickId, _), (slowId, _) = sorted(harness.startAllNewTests(), key=lambda r: r[1].name)
+        start = harness.timestamp
+
+        for i in xrange(1, 20):
+            self.assertTrue(harness.manager.testHeartbeat(slowId, start + i))
+
+        #nothing hits the database until we flush
+        with harness.database.view():
+            self.assertEqual(harness.database.TestRun(slowId).lastHeartbeat, start)
+
+        harness.manager.flushHeartbeats()
+
+        with harness.database.view():
+            self.assertEqual(harness.database.TestRun(slowId).lastHeartbeat, start + 19)
+            self.assertEqual(harness.database.TestRun(slowId).machine.lastHeartbeat, start + 19)
+
+        #the in-memory heartbeats decide who times out
+        harness.manager.testHeartbeat(slowId, start + 100)
+        harness.manager.performCleanupTasks(start + 100)
+
+        with harness.database.view():
+            self.assertTrue(harness.database.TestRun(quickId).canceled)
+            self.assertFalse(harness.database.TestRun(slowId).canceled)
+
+        self.assertFalse(harness.manager.testHeartbeat(quickId, start + 101))
+
+        #after a restart we don't know what's running until we check the database
+        harness.manager.liveness = TestManager.LivenessTable()
+
+        self.assertTrue(harness.manager.testHeartbeat(slowId, start + 102))
+        self.assertFalse(harness.manager.testHeartbeat(quickId, start + 102))
+        self.assertEqual(harness.manager.liveness.runningTests.keys(), [slowId])
+
+    def test_manager_timeouts_come_off_a_deadline_heap(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        (quickId, _), (slowId, _) = sorted(harness.startAllNewTests(), key=lambda r: r[1].name)
+        manager = harness.manager
+
+        deadline = manager.nextTimeoutDeadline()
+        self.assertEqual(deadline, manager._timeoutDeadline(("test", quickId)))
+
+        manager.testHeartbeat(slowId, deadline - 1)
+        manager.flushHeartbeats()
+        examined = manager.timeouts.examined
+
+        manager.expireTimeouts(deadline - .5)
+        self.assertEqual(manager.timeouts.examined, examined)
+
+        #'quick' times out and 'slow' goes back in the heap at its new deadline. The
+        #machines aren't due, so we don't look at them.
+        manager.expireTimeouts(deadline)
+        self.assertEqual(manager.timeouts.examined, examined + 2)
+
+        with harness.database.view():
+            self.assertTrue(harness.database.TestRun(quickId).canceled)
+            self.assertFalse(harness.database.TestRun(slowId).canceled)
+            slowMachineId = harness.database.TestRun(slowId).machine.machineId
+
+        self.assertEqual(manager.nextTimeoutDeadline(), deadline - 1 + TestManager.TEST_TIMEOUT_SECONDS)
+
+        manager.expireTimeouts(deadline - 1 + TestManager.TEST_TIMEOUT_SECONDS)
+
+        with harness.database.view():
+            self.assertTrue(harness.database.TestRun(slowId).canceled)
+
+        #the machine that heartbeat goes once it's been quiet for MACHINE_TIMEOUT_SECONDS
+        manager.expireTimeouts(deadline - 2 + TestManager.MACHINE_TIMEOUT_SECONDS)
+
+        with harness.database.view():
+            self.assertTrue(harness.database.Machine.lookupOne(machineId=slowMachineId).isAlive)
+
+        manager.expireTimeouts(deadline - 1 + TestManager.MACHINE_TIMEOUT_SECONDS)
+
+        with harness.database.view():
+            self.assertFalse(harness.database.Machine.lookupOne(machineId=slowMachineId).isAlive)
+
+    def test_manager_records_metrics(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.add_content()
+        harness.markRepoListDirty()
+
+        self.assertTrue(dict(harness.manager.metrics.gauge("test_looper_task_queue_depth", "").samples())[(("priority", "PendingVeryHigh"),)] > 0)
+
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo1", "master")
+        harness.consumeBackgroundTasks()
+
+        harness.startAllNewTests()
+        harness.manager.startNewTest(harness.getUnusedMachineId() or "unknown_machine", harness.timestamp)
+
+        metrics = harness.manager.metrics.toJson()
+
+        def total(name, **labels):
+            return sum(v.get("count", v.get("value")) for v in metrics[name]["values"]
+                if all(v["labels"].get(k) == labels[k] for k in labels))
+
+        self.assertGreater(total("test_looper_tasks_total", task="RefreshRepos", outcome="ok"), 0)
+        self.assertEqual(total("test_looper_tasks_total"), total("test_looper_task_seconds"))
+        self.assertEqual(total("test_looper_task_wait_seconds"), total("test_looper_task_seconds"))
+
+        #the gauge agrees with what's actually queued
+        queued = 0
+        with harness.database.view():
+            for status in [TestManager.pendingVeryHigh, TestManager.pendingHigh, TestManager.pendingMedium, 
+                           TestManager.pendingLow, TestManager.pendingVeryLow]:
+                task = harness.database.DataTask.lookupAny(status=status)
+                while task:
+                    queued += 1
+                    task = task.prior
+        self.assertEqual(total("test_looper_task_queue_depth"), queued)
+
+        #work queued in a transaction that doesn't commit isn't counted
+        try:
+            with harness.manager.transaction_and_lock():
+                harness.manager._queueTask(
+                    harness.database.DataTask.New(
+                        task=harness.database.BackgroundTask.BootMachineCheck(),
+                        status=TestManager.pendingLow
+                        )
+                    )
+                raise UserWarning("abandon this transaction")
+        except UserWarning:
+            pass
+
+        self.assertEqual(sum(v for _, v in harness.manager.metrics.gauge("test_looper_task_queue_depth", "").samples()), queued)
+
+        self.assertGreater(total("test_looper_start_new_test_seconds", outcome="assigned"), 0)
+        self.assertGreater(total("test_looper_start_new_test_seconds", outcome="idle"), 0)
+        self.assertGreater(total("test_looper_writelock_hold_seconds"), 0)
+
+        text = harness.manager.metrics.renderText()
+        self.assertIn('test_looper_hedges{stat="launched"}', text)
+        self.assertIn('# TYPE test_looper_writelock_wait_seconds histogram', text)
+
     def test_child_repo_refs(self):
         harness = TestManagerTestHarness.getHarness()
 
@@ -769,7 +1303,6 @@ class TestManagerTests(unittest.TestCase):
         harness.consumeBackgroundTasks()
 
         with harness.database.view():
-            c = harness.getCommit("repo9/c0")
             test0 = harness.lookupTestByFullname("repo9/c0/build/repo0_env")
             test1 = harness.lookupTestByFullname("repo9/c0/build/repo1_env")
             test2 = harness.lookupTestByFullname("repo9/c0/build/repo2_env")
@@ -838,3 +1371,510 @@ class TestManagerTests(unittest.TestCase):
         self.assertTrue("repo6/a_branch-looper" in harness.manager.source_control.listBranches(),
             harness.manager.source_control.listBranches()
             )
+
+    def test_manager_priority_batch_touches_each_test_once(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.add_content()
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        harness.enableBranchTesting("repo1", "master")
+        harness.enableBranchTesting("repo2", "master")
+        harness.consumeBackgroundTasks()
+
+        with harness.manager.transaction_and_lock():
+            tests = set()
+            for commitId in ["repo1/c0", "repo1/c1", "repo2/c0", "repo2/c1"]:
+                tests.update(harness.getCommit(commitId).data.tests.values())
+
+            statsBefore = dict(harness.manager.priorityPropagationStats)
+
+            harness.manager._propagatePriorities(harness.timestamp, tests=list(tests))
+
+        stats = harness.manager.priorityPropagationStats
+
+        self.assertEqual(stats["batches"], statsBefore["batches"] + 1)
+        self.assertEqual(stats["tests_touched"] - statsBefore["tests_touched"], len(tests))
+        self.assertEqual(stats["deferred"], statsBefore["deferred"])
+
+    def test_manager_priority_batch_topological_order(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.add_content()
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        harness.enableBranchTesting("repo1", "master")
+        harness.enableBranchTesting("repo2", "master")
+        harness.consumeBackgroundTasks()
+
+        manager = harness.manager
+        order = {"commits": [], "calculated": [], "tests": []}
+
+        def recording(kind, f):
+            def inner(obj, *args):
+                if obj not in order[kind]:
+                    order[kind].append(obj)
+                return f(obj, *args)
+            return inner
+
+        manager._updateCommitPriority = recording("commits", manager._updateCommitPriority)
+        manager._computeTestCalculatedPriority = recording("calculated", manager._computeTestCalculatedPriority)
+        manager._updateTestPriority = recording("tests", manager._updateTestPriority)
+
+        with manager.transaction_and_lock():
+            tests = set()
+
+            #queue the updates behind and in front of other work, which has to survive the batch
+            for commitId in ["repo1/c0", "repo1/c1", "repo2/c0", "repo2/c1"]:
+                tests.update(harness.getCommit(commitId).data.tests.values())
+                manager._queueTask(
+                    manager.database.DataTask.New(
+                        task=manager.database.BackgroundTask.BootMachineCheck(),
+                        status=TestManager.pendingMedium
+                        )
+                    )
+                manager._triggerCommitPriorityUpdate(harness.getCommit(commitId))
+
+            manager._propagatePriorities(harness.timestamp, tests=list(tests))
+
+            #only the other work is left, and the queue still counts it correctly
+            head = manager.database.DataTask.lookupAny(status=TestManager.pendingMedium)
+            depth = 0
+            task = head
+            while task:
+                self.assertTrue(task.task.matches.BootMachineCheck)
+                self.assertEqual(task.prior_ct, 4 - depth - 1)
+                depth += 1
+                task = task.prior
+            self.assertEqual(depth, 4)
+
+            #children before parents
+            for commit in order["commits"]:
+                for r in manager.database.CommitRelationship.lookupAll(child=commit):
+                    if r.parent in order["commits"]:
+                        self.assertLess(order["commits"].index(commit), order["commits"].index(r.parent))
+
+            #calculated priorities flow from dependents to their builds, test priorities the other way
+            pairs = 0
+            for test in order["tests"]:
+                for dep in manager.database.TestDependency.lookupAll(test=test):
+                    if dep.dependsOn in order["tests"]:
+                        pairs += 1
+                        self.assertLess(order["tests"].index(dep.dependsOn), order["tests"].index(test))
+                        self.assertLess(order["calculated"].index(test), order["calculated"].index(dep.dependsOn))
+            self.assertTrue(pairs)
+            self.assertTrue(len(order["commits"]) >= 4)
+
+        harness.consumeBackgroundTasks()
+
+    def test_manager_scheduler_checkpoint(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.add_content()
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        harness.enableBranchTesting("repo1", "master")
+        harness.consumeBackgroundTasks()
+
+        #what the server does when it stops
+        harness.manager.checkpointSchedulerState(harness.timestamp, close=True)
+
+        def restoreInNewManager():
+            manager = TestManager.TestManager(
+                None,
+                harness.manager.source_control,
+                harness.manager.machine_management,
+                harness.database._kvstore,
+                initialTimestamp=harness.timestamp
+                )
+            self.restoredManager = manager
+            return manager.restoreSchedulerState(harness.timestamp)
+
+        #a new manager on the same store can use the checkpoint instead of scanning
+        self.assertTrue(restoreInNewManager())
+
+        #but that one never stopped cleanly, as if it crashed, so the next one can't tell what changed since
+        self.assertFalse(restoreInNewManager())
+
+        #changes to a repo's graph are in the database along with the state derived from them
+        harness.manager.source_control.addCommit("repo1/c2", ["repo1/c1"], TestYamlFiles.repo1)
+        harness.manager.source_control.setBranch("repo1/master", "repo1/c2")
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.manager.checkpointSchedulerState(harness.timestamp, close=True)
+
+        self.assertTrue(restoreInNewManager())
+
+        #restoring still repairs a corrupt activeRuns count
+        with harness.manager.transaction_and_lock():
+            testHash = harness.lookupTestByFullname("repo1/c2/build/linux")._identity
+            harness.database.Test(testHash).activeRuns = -1
+        harness.manager.checkpointSchedulerState(harness.timestamp, close=True)
+
+        self.assertTrue(restoreInNewManager())
+
+        with self.restoredManager.database.view():
+            self.assertEqual(self.restoredManager.database.Test(testHash).activeRuns, 0)
+
+        #a checkpoint written under different rules forces a full scan
+        with harness.manager.transaction_and_lock():
+            harness.database.SchedulerCheckpoint.lookupOne(repo=harness.getRepo("repo2")).formatVersion = 0
+
+        self.assertFalse(restoreInNewManager())
+
+        harness.manager.checkpointSchedulerState(harness.timestamp, close=True)
+
+        self.assertTrue(restoreInNewManager())
+
+    def assertLiveTestIndexIsConsistent(self, harness):
+        with harness.database.view():
+            manager = harness.manager
+
+            expected = set()
+            for repo in harness.database.Repo.lookupAll(isActive=True):
+                for c in manager._walkCommitsWithPossibilityOfTests(repo):
+                    liveTests = set(dep.test for dep in harness.database.CommitTestDependency.lookupAll(commit=c)
+                        if manager._testIsLive(dep.test))
+
+                    self.assertEqual(c.liveTestCount, len(liveTests), c.hash)
+                    for t in liveTests:
+                        self.assertTrue(t.isLive)
+                    if liveTests:
+                        expected.add(c)
+
+            self.assertEqual(set(manager._allCommitsWithPossibilityOfTests()), expected)
+
+    def test_manager_commits_with_live_tests(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.add_content()
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        self.assertLiveTestIndexIsConsistent(harness)
+
+        with harness.database.view():
+            self.assertEqual(harness.manager._allCommitsWithPossibilityOfTests(), [])
+
+        harness.enableBranchTesting("repo1", "master")
+        harness.enableBranchTesting("repo2", "master")
+        harness.consumeBackgroundTasks()
+
+        self.assertLiveTestIndexIsConsistent(harness)
+
+        with harness.database.view():
+            self.assertTrue(harness.manager._allCommitsWithPossibilityOfTests())
+
+        harness.doTestsInPhases()
+
+        self.assertLiveTestIndexIsConsistent(harness)
+
+        harness.disableBranchTesting("repo1", "master")
+        harness.consumeBackgroundTasks()
+
+        self.assertLiveTestIndexIsConsistent(harness)
+
+    def assertBranchReachabilityIsConsistent(self, harness):
+        def branchesReaching(database, commit):
+            """Every branch whose head reaches 'commit', by brute-force search of its descendants."""
+            seen = set([commit])
+            toCheck = [commit]
+            branches = set()
+
+            while toCheck:
+                c = toCheck.pop()
+                branches.update(database.Branch.lookupAll(head=c))
+                for r in database.CommitRelationship.lookupAll(parent=c):
+                    if r.child not in seen:
+                        seen.add(r.child)
+                        toCheck.append(r.child)
+
+            return branches
+
+        with harness.database.view():
+            manager = harness.manager
+
+            for repo in harness.database.Repo.lookupAll(isActive=True):
+                for branch in harness.database.Branch.lookupAll(repo=repo):
+                    self.assertEqual(branch.reachHead, branch.head, branch.branchname)
+
+                commits = set()
+                for branch in harness.database.Branch.lookupAll(repo=repo):
+                    if branch.head:
+                        commits.add(branch.head)
+
+                toCheck = list(commits)
+                while toCheck:
+                    c = toCheck.pop()
+                    if c.data:
+                        for p in c.data.parents:
+                            if p not in commits:
+                                commits.add(p)
+                                toCheck.append(p)
+
+                for c in commits:
+                    allBranches = branchesReaching(harness.database, c)
+
+                    if not allBranches:
+                        self.assertFalse(c.reachBranch, c.hash)
+                        continue
+
+                    self.assertTrue(c.reachBranch in allBranches, (c.hash, c.reachBranch.branchname))
+
+                    #walk the path from the branch head and make sure we get back to the commit
+                    branch, path = manager.bestCommitBranchAndName(c)
+                    cur = branch.head
+                    for op, count in re.findall(r"([~^])([0-9]*)", path):
+                        count = int(count) if count else 1
+                        if op == "~":
+                            for _ in xrange(count):
+                                cur = cur.data.parents[0]
+                        else:
+                            cur = cur.data.parents[count-1]
+
+                    self.assertEqual(cur, c, (c.hash, branch.branchname, path))
+
+    def test_manager_branch_reachability(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.add_content()
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        self.assertBranchReachabilityIsConsistent(harness)
+
+        with harness.database.view():
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/c0")), "master~")
+
+        source_control = harness.manager.source_control
+
+        #fast-forward master through a merge with a feature branch
+        source_control.addCommit("repo1/f0", ["repo1/c1"], TestYamlFiles.repo1)
+        source_control.addCommit("repo1/f1", ["repo1/f0"], TestYamlFiles.repo1)
+        source_control.setBranch("repo1/feature", "repo1/f1")
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        self.assertBranchReachabilityIsConsistent(harness)
+
+        with harness.database.view():
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/f0")), "feature~")
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/c1")), "master")
+
+        source_control.addCommit("repo1/c2", ["repo1/c1"], TestYamlFiles.repo1)
+        source_control.addCommit("repo1/c3", ["repo1/c2", "repo1/f1"], TestYamlFiles.repo1)
+        source_control.setBranch("repo1/master", "repo1/c3")
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        self.assertBranchReachabilityIsConsistent(harness)
+
+        with harness.database.view():
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/c0")), "master~3")
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/f0")), "master^2~")
+
+        #force-push master backwards. The feature branch picks its commits back up.
+        source_control.setBranch("repo1/master", "repo1/c1")
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+
+        self.assertBranchReachabilityIsConsistent(harness)
+
+        with harness.database.view():
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/f0")), "feature~")
+            self.assertEqual(harness.manager.bestCommitName(harness.getCommit("repo1/c0")), "master~")
+
+    def test_manager_log_output_resumes_at_offsets(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        (testId, _), _ = sorted(harness.startAllNewTests(), key=lambda r: r[1].name)
+        manager = harness.manager
+        ts = harness.timestamp
+
+        self.assertEqual(manager.testLogOutputAt(testId, ts, 0, "hello "), (True, 6))
+        #a repeat, and a repeat that runs past what we have, only add what's new
+        self.assertEqual(manager.testLogOutputAt(testId, ts, 0, "hello "), (True, 6))
+        self.assertEqual(manager.testLogOutputAt(testId, ts, 3, "lo world"), (True, 11))
+
+        #a reconnect only sends what we hadn't confirmed
+        self.assertEqual(manager.handleTestConnectionResumed(testId, ts, 11, "!\n", ()), (True, 13))
+        self.assertEqual(manager.heartbeatHandler.getAllLogsFor(testId), "hello world!\n")
+
+        #output past a gap isn't recorded, and we say how much we have so the worker can resend
+        self.assertEqual(manager.testLogOutputAt(testId, ts, 20, "later"), (True, 13))
+        self.assertEqual(manager.heartbeatHandler.getAllLogsFor(testId), "hello world!\n")
+
+        #workers that send the whole log still work
+        self.assertTrue(manager.handleTestConnectionReinitialized(testId, ts, "hello world!\nmore\n", ()))
+        self.assertEqual(manager.heartbeatHandler.getAllLogsFor(testId), "hello world!\nmore\n")
+
+    def test_manager_machine_slots(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        manager = harness.manager
+        machineId = harness.getUnusedMachineId()
+
+        manager.machineSlotsReported(machineId, 1)
+
+        firstId, firstDef = manager.startNewTest(machineId, harness.timestamp)
+        self.assertTrue(firstId)
+
+        #its only slot is busy
+        self.assertEqual(manager.startNewTest(machineId, harness.timestamp), (None, None))
+
+        manager.machineSlotsReported(machineId, 2)
+
+        secondId, secondDef = manager.startNewTest(machineId, harness.timestamp)
+        self.assertEqual(sorted([firstDef.name, secondDef.name]), ["quick/e1", "slow/e1"])
+
+        with harness.database.view():
+            self.assertEqual(harness.database.TestRun(firstId).machine, harness.database.TestRun(secondId).machine)
+
+    def test_manager_reserves_next_test(self):
+        def setUp():
+            harness = TestManagerTestHarness.getHarness()
+
+            harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+            harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+            harness.markRepoListDirty()
+            harness.consumeBackgroundTasks()
+
+            with harness.database.transaction():
+                for name in ["slow/e1", "quick/e1"]:
+                    for _ in xrange(3):
+                        RuntimePredictor.recordRun(harness.database, harness.lookupTestByFullname("repo12/c0/" + name), 300)
+
+            harness.enableBranchTesting("repo12", "master")
+            harness.consumeBackgroundTasks()
+
+            machineId = harness.getUnusedMachineId()
+            testId, testDef = harness.manager.startNewTest(machineId, harness.timestamp)
+
+            return harness, machineId, testId, testDef
+
+        harness, machineId, firstId, firstDef = setUp()
+        manager = harness.manager
+        start = harness.timestamp
+
+        locks = []
+        def countingLock(f):
+            def inner(*args):
+                locks.append(True)
+                return f(*args)
+            return inner
+        manager.transaction_and_lock = countingLock(manager.transaction_and_lock)
+
+        #too far from the predicted end to guess
+        self.assertEqual(manager.reserveNextTest(firstId, start + 60), (None, None))
+
+        testHash, reservedDef = manager.reserveNextTest(firstId, start + 200)
+        self.assertNotEqual(reservedDef.name, firstDef.name)
+        self.assertEqual(manager.reserveNextTest(firstId, start + 210)[0], testHash)
+
+        #only picking the test needed the writelock
+        self.assertEqual(len(locks), 1)
+
+        #the machine finishes and asks for work, and gets what we reserved
+        artifacts = [a.name for stage in firstDef.stages for a in stage.artifacts]
+        manager.recordTestResults(True, firstId, {}, artifacts, start + 300)
+
+        nextId, nextDef = manager.startNewTest(machineId, start + 300, reservedAfter=firstId)
+        self.assertEqual(nextDef.name, reservedDef.name)
+        self.assertEqual(manager.reservationStats, {"reserved": 1, "taken": 1, "revoked": 0})
+
+        #reservations don't hold up idle machines. If one takes the test, we revoke it.
+        harness, machineId, firstId, firstDef = setUp()
+        manager = harness.manager
+        start = harness.timestamp
+
+        testHash, reservedDef = manager.reserveNextTest(firstId, start + 200)
+
+        otherId, otherDef = manager.startNewTest(harness.getUnusedMachineId(), start + 200)
+        self.assertEqual(otherDef.name, reservedDef.name)
+
+        self.assertEqual(manager.reserveNextTest(firstId, start + 210), (None, None))
+        self.assertEqual(manager.reservationStats, {"reserved": 1, "taken": 0, "revoked": 1})
+
+    def test_manager_wakes_idle_workers(self):
+        harness = TestManagerTestHarness.getHarness()
+
+        harness.manager.source_control.addCommit("repo12/c0", [], TestYamlFiles.repo12_hedging)
+        harness.manager.source_control.setBranch("repo12/master", "repo12/c0")
+
+        harness.markRepoListDirty()
+        harness.consumeBackgroundTasks()
+        harness.enableBranchTesting("repo12", "master")
+        harness.consumeBackgroundTasks()
+
+        manager = harness.manager
+        runs = dict((testDef.name, (testId, testDef)) for testId, testDef in harness.startAllNewTests())
+
+        testId, testDef = runs["quick/e1"]
+        artifacts = [a.name for stage in testDef.stages for a in stage.artifacts]
+        manager.recordTestResults(True, testId, {}, artifacts, harness.timestamp)
+
+        idleMachine = harness.getUnusedMachineId()
+        woken = []
+
+        stamp = manager.workStamp()
+        self.assertEqual(manager.startNewTest(idleMachine, harness.timestamp), (None, None))
+        self.assertTrue(manager.waitForWork(idleMachine, "session", lambda: woken.append("session"), stamp))
+        self.assertEqual(manager.idleWorkerCount(), 1)
+        self.assertEqual(woken, [])
+
+        #a deployment is work its machine category can do
+        with harness.database.view():
+            quickHash = harness.lookupTestByFullname("repo12/c0/quick/e1").hash
+        manager.createDeployment(quickHash, harness.timestamp)
+
+        self.assertEqual(woken, ["session"])
+        self.assertEqual(manager.idleWorkerCount(), 0)
+
+        #if work showed up while the worker was looking, it hears about it right away
+        self.assertTrue(manager.waitForWork(idleMachine, "session", lambda: woken.append("late"), stamp))
+        self.assertEqual(woken, ["session", "late"])
+
+        #and closed connections stop waiting
+        self.assertTrue(manager.waitForWork(idleMachine, "session", lambda: woken.append("closed"), manager.workStamp()))
+        manager.stopWaitingForWork("session")
+        self.assertEqual(manager.idleWorkerCount(), 0)
+
+        #tests becoming runnable wake workers too. Here 'slow' times out, and wants to run again.
+        self.assertTrue(manager.waitForWork(idleMachine, "session", lambda: woken.append("timeout"), manager.workStamp()))
+
+        harness.timestamp += 200
+        manager.machineHeartbeat(idleMachine, harness.timestamp)
+        harness.consumeBackgroundTasks()
+
+        self.assertEqual(woken, ["session", "late", "timeout"])
+
+        #recomputing priorities doesn't wake anyone unless something new can run
+        stamp = manager.workStamp()
+        self.assertTrue(manager.waitForWork(idleMachine, "session", lambda: woken.append("recompute"), stamp))
+
+        with manager.transaction_and_lock():
+            manager._updateTestPriority(harness.lookupTestByFullname("repo12/c0/slow/e1"), harness.timestamp)
+        manager.checkAllTestPriorities(harness.timestamp, False)
+
+        self.assertEqual(woken, ["session", "late", "timeout"])
+        self.assertEqual(manager.workStamp(), stamp)
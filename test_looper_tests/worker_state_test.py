@@ -515,3 +515,53 @@ class WorkerStateTests(unittest.TestCase):
             self.runWorkerTest(worker, "test3", repoName, commitHash, "build_consuming_stage_2", callbacks3, isDeploy=False)[0]
             )
 
+
+    def test_build_cache_ignores_partial_downloads(self):
+        worker = WorkerState.WorkerState(
+            "test_looper_testing",
+            os.path.join(self.testdir, "worker"),
+            None,
+            None,
+            "worker",
+            Config.HardwareConfig(cores=1,ram_gb=4)
+            )
+        worker.ensureDirectoryExists(worker.directories.build_cache_dir)
+
+        for name, size in [("hash1_build.tar.gz", 100), ("hash2_build.tar.gz", 10), ("hash3_build.tar.gz.partial", 1000)]:
+            with open(os.path.join(worker.directories.build_cache_dir, name), "wb") as f:
+                f.write("x" * size)
+
+        self.assertEqual(worker.cachedBuildSummary(), {"hash1": 100, "hash2": 10})
+        self.assertTrue(worker._is_build_cache_full(1))
+        self.assertFalse(worker._is_build_cache_full(2))
+
+    def test_extract_while_caching(self):
+        tarball = StringIO.StringIO()
+        with tarfile.open(fileobj=tarball, mode="w:gz") as tf:
+            for name in ["a.txt", "dir/b.txt"]:
+                contents = "contents of %s\n" % name * 1000
+                info = tarfile.TarInfo(name)
+                info.size = len(contents)
+                tf.addfile(info, StringIO.StringIO(contents))
+
+        package_file = os.path.join(self.testdir, "package.tar.gz")
+        target_dir = os.path.join(self.testdir, "extracted")
+
+        size = WorkerState.extractWhileCaching(StringIO.StringIO(tarball.getvalue()), package_file, target_dir)
+
+        self.assertEqual(size, len(tarball.getvalue()))
+        self.assertEqual(open(package_file, "rb").read(), tarball.getvalue())
+        self.assertFalse(os.path.exists(package_file + ".partial"))
+        self.assertEqual(open(os.path.join(target_dir, "dir", "b.txt")).read(), "contents of dir/b.txt\n" * 1000)
+
+        #a download that breaks off leaves nothing in the cache
+        os.remove(package_file)
+        self.assertRaises(
+            Exception,
+            WorkerState.extractWhileCaching,
+            StringIO.StringIO(tarball.getvalue()[:len(tarball.getvalue()) // 2]), 
+            package_file, 
+            target_dir
+            )
+        self.assertFalse(os.path.exists(package_file))
+        self.assertFalse(os.path.exists(package_file + ".partial"))